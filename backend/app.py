@@ -2,12 +2,17 @@
 import os
 import sys # Cho sys.platform khi check admin
 import ctypes # Check admin win
+import time
+import uuid
+import atexit
 import logging
 from logging.handlers import RotatingFileHandler
-from flask import Flask
+from flask import Flask, g, request, has_request_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import google.generativeai as genai # Them import genai
+from .log_utils import setup_queue_logging, JsonLogFormatter, CappedTextFormatter
+from .metrics_utils import HTTP_REQUEST_DURATION, REGISTRY
 
 # Tai bien .env o goc (CAN CHAY TRUOC KHI IMPORT CAC MODULE KHAC NEU CHUNG DUNG BIEN ENV)
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env') # Duong dan chinh xac den .env o goc
@@ -26,17 +31,115 @@ CORS(app, resources={r"/api/*": {"origins": "http://localhost:5174"}}) # Cho phe
 app.config['GOOGLE_API_KEY'] = os.getenv('GOOGLE_API_KEY')
 app.config['PROMPT_DATA_DIR'] = os.path.join(os.path.dirname(__file__), 'prompt_data')
 app.config['PROMPTS_DIR'] = os.path.join(app.config['PROMPT_DATA_DIR'], 'prompts')
+app.config['PROMPT_TOKEN_BUDGET'] = int(os.getenv('PROMPT_TOKEN_BUDGET', '12000')) # Token dau vao toi da / prompt, ko vuot cua so dau vao cua model (0 = dung ca cua so)
+app.config['PROMPT_WINDOW_RESERVE_TOKENS'] = int(os.getenv('PROMPT_WINDOW_RESERVE_TOKENS', '2048')) # Chua lai trong cua so model cho tool declaration / luot FC
+app.config['TOKEN_COUNTER_MODEL'] = os.getenv('TOKEN_COUNTER_MODEL', 'gemini-1.5-flash') # Model mac dinh khi request ko chi dinh (dem token, cua so dau vao)
+app.config['TOKEN_COUNTER'] = os.getenv('TOKEN_COUNTER', 'approx') # 'approx' (uoc luong local) hoac 'gemini' (model.count_tokens)
+app.config['PROMPT_RELOAD_CHECK_INTERVAL'] = float(os.getenv('PROMPT_RELOAD_CHECK_INTERVAL', '2')) # Kiem tra mtime file prompt toi da 1 lan / N giay (0 = chi nap lai qua /api/prompts/reload)
 app.config['SAFETY_SETTINGS_MAP'] = {
     "BLOCK_NONE": [{"category": c, "threshold": "BLOCK_NONE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]],
     "BLOCK_ONLY_HIGH": [{"category": c, "threshold": "BLOCK_ONLY_HIGH"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]],
     "BLOCK_MEDIUM_AND_ABOVE": [{"category": c, "threshold": "BLOCK_MEDIUM_AND_ABOVE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]],
     "BLOCK_LOW_AND_ABOVE": [{"category": c, "threshold": "BLOCK_LOW_AND_ABOVE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]],
 }
+# Pool phien SSH FortiGate (tai su dung ket noi giua cac lan goi tool/lay ngu canh)
+app.config['FGT_POOL_MAX_PER_DEVICE'] = int(os.getenv('FGT_POOL_MAX_PER_DEVICE', '2')) # So phien dong thoi toi da / thiet bi
+app.config['FGT_POOL_IDLE_TIMEOUT'] = int(os.getenv('FGT_POOL_IDLE_TIMEOUT', '300')) # Dong phien idle sau N giay
+app.config['FGT_POOL_ACQUIRE_TIMEOUT'] = int(os.getenv('FGT_POOL_ACQUIRE_TIMEOUT', '60')) # Cho slot ranh toi da N giay
+app.config['FGT_CONTEXT_MAX_PARALLEL'] = int(os.getenv('FGT_CONTEXT_MAX_PARALLEL', '2')) # So phien song song khi lay ngu canh (<= FGT_POOL_MAX_PER_DEVICE)
+app.config['FC_MAX_PARALLEL_TOOL_CALLS'] = int(os.getenv('FC_MAX_PARALLEL_TOOL_CALLS', '4')) # Tool call cung 1 luot model chay song song (<= FGT_POOL_MAX_PER_DEVICE)
+# Nho ket qua get_fortigate_data trong 1 hoi thoai: TTL (giay) theo prefix lenh, khop prefix dau tien, 0 = ko nho
+app.config['FC_TOOL_MEMO_ENABLED'] = os.getenv('FC_TOOL_MEMO_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+app.config['FC_TOOL_MEMO_MAX_ENTRIES'] = int(os.getenv('FC_TOOL_MEMO_MAX_ENTRIES', '64'))
+app.config['FC_TOOL_MEMO_TTLS'] = [
+    ("get system performance", 0), # Trang thai thay doi lien tuc
+    ("get system session", 0),
+    ("diagnose", 0),
+    ("execute", 0),
+    ("get", 60),
+    ("show", 300),
+]
+# Rut gon ket qua tool lon truoc khi gui Gemini (giu khoi lien quan nhat theo BM25 voi cau hoi + lenh)
+app.config['FC_TOOL_OUTPUT_REDUCER_ENABLED'] = os.getenv('FC_TOOL_OUTPUT_REDUCER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+app.config['FC_TOOL_OUTPUT_TOKEN_BUDGET'] = int(os.getenv('FC_TOOL_OUTPUT_TOKEN_BUDGET', '2500')) # Token toi da / ket qua tool
+app.config['FC_TOOL_OUTPUT_MAX_BYTES'] = int(os.getenv('FC_TOOL_OUTPUT_MAX_BYTES', '12000')) # Byte toi da / ket qua tool
+# Hoi thoai /api/fortigate_chat giu phia server: LRU + het han khi idle, gop luot cu thanh tom tat khi vuot ngan sach
+app.config['CHAT_SESSION_MAX_SESSIONS'] = int(os.getenv('CHAT_SESSION_MAX_SESSIONS', '200'))
+app.config['CHAT_SESSION_IDLE_TTL'] = int(os.getenv('CHAT_SESSION_IDLE_TTL', '3600')) # Giay
+app.config['CHAT_SESSION_HISTORY_TOKEN_BUDGET'] = int(os.getenv('CHAT_SESSION_HISTORY_TOKEN_BUDGET', '6000')) # Vuot -> gop luot cu
+app.config['CHAT_SESSION_SUMMARY_MAX_WORDS'] = int(os.getenv('CHAT_SESSION_SUMMARY_MAX_WORDS', '250'))
+app.config['CHAT_SESSION_LOCK_TIMEOUT'] = int(os.getenv('CHAT_SESSION_LOCK_TIMEOUT', '120')) # Cho luot truoc cua cung hoi thoai toi da N giay
+app.config['CHAT_SESSION_UPDATE_TOKEN_BUDGET'] = int(os.getenv('CHAT_SESSION_UPDATE_TOKEN_BUDGET', '3000')) # Token toi da cho hoat dong ngoai chat (generate/execute) gui kem 1 luot
+# Chi muc cau hinh tu 'show full-configuration': tra loi tool show tai cho, bo khi chay lenh config
+app.config['FGT_CONFIG_INDEX_ENABLED'] = os.getenv('FGT_CONFIG_INDEX_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+app.config['FGT_CONFIG_INDEX_TTL'] = int(os.getenv('FGT_CONFIG_INDEX_TTL', '300')) # Giay; thay doi ngoai app (GUI...) toi da tre N giay
+app.config['FGT_CONFIG_INDEX_FETCH_TIMEOUT'] = int(os.getenv('FGT_CONFIG_INDEX_FETCH_TIMEOUT', '120')) # read_timeout khi lay cau hinh day du
+# Doi chieu luong voi firewall policy tai cho (tool match_firewall_policy, /api/fortigate_policy_match)
+app.config['FGT_POLICY_MATCH_INDEX_WAIT'] = int(os.getenv('FGT_POLICY_MATCH_INDEX_WAIT', '150')) # Cho dung chi muc cau hinh toi da N giay
+app.config['FGT_POLICY_MATCH_MAX_FLOWS'] = int(os.getenv('FGT_POLICY_MATCH_MAX_FLOWS', '20000')) # So luong toi da / request
+# Bang dinh tuyen tra cuu tai cho (tool lookup_route, /api/fortigate_route_lookup)
+app.config['FGT_ROUTE_TABLE_TTL'] = int(os.getenv('FGT_ROUTE_TABLE_TTL', '60')) # Giay; route dong (BGP/OSPF) thay doi ngoai app
+app.config['FGT_ROUTE_TABLE_FETCH_TIMEOUT'] = int(os.getenv('FGT_ROUTE_TABLE_FETCH_TIMEOUT', '120')) # read_timeout khi lay routing-table
+app.config['FGT_ROUTE_TABLE_INLINE_MAX_LINES'] = int(os.getenv('FGT_ROUTE_TABLE_INLINE_MAX_LINES', '200')) # Lon hon -> tool chi tra tom tat
+app.config['FGT_ROUTE_LOOKUP_MAX_IPS'] = int(os.getenv('FGT_ROUTE_LOOKUP_MAX_IPS', '10000')) # So IP toi da / request
+# Fleet: chay cung bo lenh tren nhieu FortiGate (/api/fleet/*)
+app.config['FGT_FLEET_INVENTORY_PATH'] = os.getenv('FGT_FLEET_INVENTORY_PATH') or None # Mac dinh data/fleet_inventory.json (ko luu mat khau)
+app.config['FGT_FLEET_MAX_PARALLEL'] = int(os.getenv('FGT_FLEET_MAX_PARALLEL', '16')) # So thiet bi chay dong thoi
+app.config['FGT_FLEET_DEVICE_TIMEOUT'] = int(os.getenv('FGT_FLEET_DEVICE_TIMEOUT', '180')) # Giay / thiet bi; qua -> 'timeout', nhuong slot
+app.config['FGT_FLEET_MAX_DEVICES'] = int(os.getenv('FGT_FLEET_MAX_DEVICES', '500')) # So thiet bi toi da / lan chay
+app.config['FGT_FLEET_DIFF_MAX_LINES'] = int(os.getenv('FGT_FLEET_DIFF_MAX_LINES', '200')) # Dong diff toi da / nhom thiet bi
+# Cache ngu canh FortiGate theo thiet bi + lenh. TTL (giay) theo prefix lenh, khop prefix dau tien.
+app.config['FGT_CONTEXT_CACHE_MAX_ENTRIES'] = int(os.getenv('FGT_CONTEXT_CACHE_MAX_ENTRIES', '256'))
+app.config['FGT_CONTEXT_CACHE_DEFAULT_TTL'] = int(os.getenv('FGT_CONTEXT_CACHE_DEFAULT_TTL', '60'))
+app.config['FGT_CONTEXT_CACHE_TTLS'] = [
+    ("get system performance", 10), # Trang thai thay doi lien tuc
+    ("diagnose", 10),
+    ("get", 60),
+    ("show", 600), # Cau hinh -> bi xoa khi co lenh config
+]
+# Phien ban ngu canh FortiGate theo thiet bi; client gui lai phien ban da nhan -> prompt chi gom tom tat + delta
+app.config['FGT_CONTEXT_SNAPSHOT_VERSIONS'] = int(os.getenv('FGT_CONTEXT_SNAPSHOT_VERSIONS', '20')) # So phien ban giu / thiet bi
+app.config['FGT_CONTEXT_SNAPSHOT_MAX_DEVICES'] = int(os.getenv('FGT_CONTEXT_SNAPSHOT_MAX_DEVICES', '64'))
+app.config['FGT_CONTEXT_DELTA_ENABLED'] = os.getenv('FGT_CONTEXT_DELTA_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+app.config['FGT_CONTEXT_DELTA_MAX_RATIO'] = float(os.getenv('FGT_CONTEXT_DELTA_MAX_RATIO', '0.6')) # Delta >= ty le nay * ban day du -> gui day du
+app.config['FGT_CONTEXT_DELTA_SUMMARY_LINES'] = int(os.getenv('FGT_CONTEXT_DELTA_SUMMARY_LINES', '5')) # So dong giu lai cua lenh ko doi
+# Kho snapshot ngu canh FortiGate (nen, dinh danh theo noi dung, chi muc SQLite); mac dinh logs/context_snapshots
+app.config['FGT_SNAPSHOT_STORE_DIR'] = os.getenv('FGT_SNAPSHOT_STORE_DIR') or None
+app.config['FGT_SNAPSHOT_COMPRESSION'] = os.getenv('FGT_SNAPSHOT_COMPRESSION', 'auto') # auto (zstd neu co 'zstandard') / zstd / gzip
+app.config['FGT_SNAPSHOT_RETENTION_DAYS'] = float(os.getenv('FGT_SNAPSHOT_RETENTION_DAYS', '30'))
+app.config['FGT_SNAPSHOT_MAX_BYTES'] = int(os.getenv('FGT_SNAPSHOT_MAX_BYTES', str(200 * 1024 * 1024))) # Tong dung luong da nen
+# Thuc thi script local: timeout & gioi han output giu trong bo nho (moi stream)
+app.config['SCRIPT_TIMEOUT_SECONDS'] = int(os.getenv('SCRIPT_TIMEOUT_SECONDS', '60'))
+app.config['SCRIPT_OUTPUT_MAX_LINES'] = int(os.getenv('SCRIPT_OUTPUT_MAX_LINES', '2000')) # Ring buffer: chi giu N dong cuoi
+app.config['SCRIPT_OUTPUT_MAX_LINE_CHARS'] = int(os.getenv('SCRIPT_OUTPUT_MAX_LINE_CHARS', '4000'))
+# Cache phan hoi Gemini cho review/explain/debug (tang SQLite chi bat khi co RESPONSE_CACHE_SQLITE_PATH)
+app.config['RESPONSE_CACHE_ENABLED'] = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+app.config['RESPONSE_CACHE_TTL'] = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '512'))
+app.config['RESPONSE_CACHE_SQLITE_PATH'] = os.getenv('RESPONSE_CACHE_SQLITE_PATH') or None
+# Registry client/model Gemini theo API key (LRU)
+app.config['GEMINI_MAX_CLIENTS'] = int(os.getenv('GEMINI_MAX_CLIENTS', '16'))
+app.config['GEMINI_MAX_MODELS'] = int(os.getenv('GEMINI_MAX_MODELS', '64'))
+# Job chay nen (/api/jobs): so worker, do dai hang doi & gioi han moi job
+app.config['JOB_MAX_WORKERS'] = int(os.getenv('JOB_MAX_WORKERS', '4'))
+app.config['JOB_MAX_QUEUE_DEPTH'] = int(os.getenv('JOB_MAX_QUEUE_DEPTH', '16')) # Job cho toi da (ngoai so dang chay)
+app.config['JOB_DEFAULT_TIMEOUT_SECONDS'] = int(os.getenv('JOB_DEFAULT_TIMEOUT_SECONDS', '600'))
+app.config['JOB_MAX_TIMEOUT_SECONDS'] = int(os.getenv('JOB_MAX_TIMEOUT_SECONDS', '3600'))
+app.config['JOB_MAX_OUTPUT_LINES'] = int(os.getenv('JOB_MAX_OUTPUT_LINES', '5000')) # Buffer output tang dan / job
+app.config['JOB_MAX_FINISHED'] = int(os.getenv('JOB_MAX_FINISHED', '200')) # So job da xong con giu ket qua
+# Theo doi log qua /api/backend_logs (long-poll & SSE)
+app.config['LOG_LONG_POLL_MAX_SECONDS'] = int(os.getenv('LOG_LONG_POLL_MAX_SECONDS', '30')) # /api/backend_logs?cursor=..&wait=..
+app.config['LOG_FOLLOW_MAX_SECONDS'] = int(os.getenv('LOG_FOLLOW_MAX_SECONDS', '300')) # Thoi gian toi da 1 ket noi SSE theo doi log
+# Pipeline log: ghi file qua hang doi, dinh dang json/text, gioi han kich thuoc message
+app.config['LOG_FORMAT'] = os.getenv('LOG_FORMAT', 'json').lower() # 'json' hoac 'text'
+app.config['LOG_MAX_MESSAGE_CHARS'] = int(os.getenv('LOG_MAX_MESSAGE_CHARS', '8000')) # Dai hon -> cat, ban day du ghi vao logs/blobs/
+app.config['LOG_MAX_BLOB_FILES'] = int(os.getenv('LOG_MAX_BLOB_FILES', '200')) # So file blob toi da giu lai
+app.config['LOG_QUEUE_MAX_SIZE'] = int(os.getenv('LOG_QUEUE_MAX_SIZE', '10000')) # Hang doi day -> bo record thay vi chan request
+app.config['FGT_SESSION_LOG_ENABLED'] = os.getenv('FGT_SESSION_LOG_ENABLED', 'false').lower() in ('1', 'true', 'yes') # Netmiko session_log (logs/netmiko_session.log)
 
 # Cau hinh GenAI key ngay khi app khoi tao (neu key co san trong env)
-# Viec nay giup cac module khac (nhu routes) co the su dung genai.GenerativeModel ngay
-# ma khong can goi genai.configure() moi lan.
-# Trong routes, neu co UI API Key, se configure lai tam thoi.
+# Chi la cau hinh mac dinh cho thu vien; cac request dung client theo key rieng
+# qua GeminiClientRegistry (gemini_utils), ko goi genai.configure() giua request.
 if app.config['GOOGLE_API_KEY']:
     try:
         genai.configure(api_key=app.config['GOOGLE_API_KEY'])
@@ -49,6 +152,31 @@ else:
 
 # --- Het Constants ---
 
+# Request id cho moi request (header X-Request-ID neu client gui, nguoc lai tu sinh)
+def current_request_id():
+    return g.get('request_id') if has_request_context() else None
+
+@app.before_request
+def assign_request_id():
+    incoming_id = request.headers.get('X-Request-ID', '')
+    g.request_id = incoming_id[:64] if incoming_id.replace('-', '').isalnum() else uuid.uuid4().hex[:12]
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def expose_request_id(response):
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    # Do tre theo route (template url_rule, ko theo path that de giu so label it).
+    # Ghi khi response dong -> luong SSE duoc tinh ca thoi gian stream.
+    started = g.get('request_started')
+    if started is not None:
+        labels = {
+            'method': request.method,
+            'route': request.url_rule.rule if request.url_rule else 'unmatched',
+            'status': str(response.status_code),
+        }
+        response.call_on_close(lambda: HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, **labels))
+    return response
+
 # Import va dang ky Blueprint cho routes
 # Import sau khi 'app' va app.config da duoc khoi tao
 from .routes import api_bp # Su dung relative import
@@ -77,11 +205,24 @@ if not app.debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
 
     if os.path.isdir(logs_dir_path): # Chi tao handler neu dir ton tai (hoac vua tao thanh cong)
         file_handler = RotatingFileHandler(log_file_path, maxBytes=102400, backupCount=10, encoding='utf-8')
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-        ))
+        log_blob_dir = os.path.join(logs_dir_path, 'blobs') # Noi dung log qua dai duoc ghi rieng o day
+        if app.config['LOG_FORMAT'] == 'json':
+            file_handler.setFormatter(JsonLogFormatter(app.config['LOG_MAX_MESSAGE_CHARS'], blob_dir=log_blob_dir, max_blob_files=app.config['LOG_MAX_BLOB_FILES']))
+        else:
+            file_handler.setFormatter(CappedTextFormatter(
+                '%(asctime)s %(levelname)s [%(request_id)s]: %(message)s [in %(pathname)s:%(lineno)d]',
+                app.config['LOG_MAX_MESSAGE_CHARS'], blob_dir=log_blob_dir, max_blob_files=app.config['LOG_MAX_BLOB_FILES']
+            ))
         file_handler.setLevel(logging.INFO) # Muc log cua handler
-        app.logger.addHandler(file_handler)
+        # Ghi file trong thread rieng (QueueListener): request chi day record vao hang doi
+        log_queue_handler, log_listener = setup_queue_logging(
+            app.logger, [file_handler], request_id_provider=current_request_id,
+            max_queue_size=app.config['LOG_QUEUE_MAX_SIZE']
+        )
+        atexit.register(log_listener.stop) # Flush hang doi khi tat
+        REGISTRY.register_collector(lambda: [
+            ("log_records_dropped", "So record log bi bo do hang doi day (tich luy).", "counter", [({}, log_queue_handler.dropped)]),
+        ])
         if not app.logger.level or app.logger.level > logging.INFO: # Dat muc log cho app logger
             app.logger.setLevel(logging.INFO)
         print(f"Logging vao file: {log_file_path}")
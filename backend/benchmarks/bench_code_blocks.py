@@ -0,0 +1,58 @@
+# backend/benchmarks/bench_code_blocks.py
+# Chay: python -m backend.benchmarks.bench_code_blocks [so_khoi] [so_lan]
+import re
+import sys
+import timeit
+
+from backend.code_block_utils import scan_code_blocks, select_code_block, code_block_tag_priority
+
+
+# Cach cu: moi tag 2 regex moi + 2 regex chung, moi lan quet lai toan bo phan hoi
+def legacy_extract(raw_text, requested_extension, is_fortigate_request=False):
+    for tag in code_block_tag_priority(requested_extension, is_fortigate_request):
+        pattern_strict = r"```" + re.escape(tag) + r"(?:[^\S\n].*?)?\s*\n([\s\S]*?)\n```"
+        pattern_flexible = r"```" + re.escape(tag) + r"(?:[^\S\n].*?)?\s*([\s\S]*?)\s*```"
+        for pattern_str in (pattern_strict, pattern_flexible):
+            matches = list(re.finditer(pattern_str, raw_text, re.IGNORECASE))
+            if matches:
+                return matches[-1].group(1).strip()
+    generic_matches = list(re.finditer(r"```(?:([\w\-\./\+]+)[^\S\n]*)?\s*\n([\s\S]*?)\n```", raw_text))
+    if not generic_matches:
+        generic_matches = list(re.finditer(r"```(?:([\w\-\./\+]+)[^\S\n]*)?\s*([\s\S]*?)\s*```", raw_text))
+    return generic_matches[-1].group(2).strip() if generic_matches else raw_text.strip()
+
+
+def scanner_extract(raw_text, requested_extension, is_fortigate_request=False):
+    blocks = scan_code_blocks(raw_text)
+    block = select_code_block(blocks, code_block_tag_priority(requested_extension, is_fortigate_request))
+    if block:
+        return block.content
+    return blocks[-1].content if blocks else raw_text.strip()
+
+
+def build_response(num_blocks, lines_per_block=40):
+    """Phan hoi gia lap: nhieu khoi json/text/yaml, khoi fortios o cuoi."""
+    parts = []
+    langs = ["json", "text", "yaml", "bash", ""]
+    for i in range(num_blocks):
+        body = "\n".join(f"    set field{j} value-{i}-{j}" for j in range(lines_per_block))
+        parts.append(f"Giải thích bước {i}: cấu hình mẫu như sau.\n```{langs[i % len(langs)]}\n{body}\n```\n")
+    parts.append("Lệnh cuối cùng:\n```fortios\nconfig firewall policy\n    edit 0\n    next\nend\n```\n")
+    return "".join(parts)
+
+
+def main():
+    num_blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    response = build_response(num_blocks)
+    cases = [("fortios", True), ("py", False), ("sh", False)]
+    print(f"Phan hoi: {len(response)} ky tu, {num_blocks + 1} khoi, {repeat} lan / truong hop")
+    for ext, is_fgt in cases:
+        assert legacy_extract(response, ext, is_fgt) == scanner_extract(response, ext, is_fgt), ext
+        legacy_s = timeit.timeit(lambda: legacy_extract(response, ext, is_fgt), number=repeat) / repeat
+        scanner_s = timeit.timeit(lambda: scanner_extract(response, ext, is_fgt), number=repeat) / repeat
+        print(f"  .{ext:<8} cu: {legacy_s * 1000:8.2f} ms   1 lan quet: {scanner_s * 1000:8.2f} ms   x{legacy_s / scanner_s:5.1f}")
+
+
+if __name__ == "__main__":
+    main()
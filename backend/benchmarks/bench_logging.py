@@ -0,0 +1,69 @@
+# backend/benchmarks/bench_logging.py
+# Chay: python -m backend.benchmarks.bench_logging [so_lan] [kb_payload_lon]
+# Do do tre phia thread goi log (thread request) khi ghi dong bo vs qua QueueListener.
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import statistics
+from logging.handlers import RotatingFileHandler
+
+from backend.log_utils import setup_queue_logging, JsonLogFormatter
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _make_file_handler(log_dir, name):
+    handler = RotatingFileHandler(os.path.join(log_dir, f"{name}.log"), maxBytes=102400, backupCount=10, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+    return handler
+
+
+def _measure(logger, iterations, big_payload):
+    """Moi 10 lan log 1 payload lon (vd bang dinh tuyen), con lai la dong log ngan."""
+    samples = []
+    for i in range(iterations):
+        message = f"Ket qua lenh FortiGate:\n{big_payload}" if i % 10 == 0 else f"Request {i}: xu ly xong"
+        start = time.perf_counter()
+        logger.info(message)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    big_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+    big_payload = "\n".join(f"S*  10.{i // 256 % 256}.{i % 256}.0/24 [10/0] via 192.168.1.1, port1" for i in range(big_kb * 1024 // 60))
+    log_dir = tempfile.mkdtemp(prefix="bench_logging_")
+    try:
+        sync_logger = logging.getLogger("bench.sync")
+        sync_logger.propagate = False
+        sync_logger.setLevel(logging.INFO)
+        sync_logger.addHandler(_make_file_handler(log_dir, "sync"))
+
+        queued_logger = logging.getLogger("bench.queued")
+        queued_logger.propagate = False
+        queued_logger.setLevel(logging.INFO)
+        queued_file_handler = _make_file_handler(log_dir, "queued")
+        queued_file_handler.setFormatter(JsonLogFormatter(8000, blob_dir=os.path.join(log_dir, "blobs")))
+        _, listener = setup_queue_logging(queued_logger, [queued_file_handler], request_id_provider=lambda: "bench")
+
+        print(f"{iterations} lan log, 10% la payload ~{big_kb} KB")
+        for label, logger in (("ghi dong bo", sync_logger), ("hang doi + listener", queued_logger)):
+            samples = _measure(logger, iterations, big_payload)
+            print(f"  {label:<20} p50 {_percentile(samples, 50):8.3f} ms  p95 {_percentile(samples, 95):8.3f} ms  "
+                  f"p99 {_percentile(samples, 99):8.3f} ms  max {max(samples):8.3f} ms  tb {statistics.mean(samples):8.3f} ms")
+        drain_start = time.perf_counter()
+        listener.stop()
+        print(f"  (listener xu ly xong hang doi sau {(time.perf_counter() - drain_start) * 1000:.1f} ms)")
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# backend/benchmarks/bench_routes.py
+# Benchmark cac route chinh ko can API key / FortiGate that: Gemini gia lap (stub_gemini)
+# + FortiGate gia lap qua SSH (fake_fortigate), app chay that tren werkzeug (threaded).
+# Chay: python -m backend.benchmarks.bench_routes --requests 50 --concurrency 8
+#       python -m backend.benchmarks.bench_routes --scenarios chat,generate_fc --stream --gemini-latency-ms 1500
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import http.client
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('GOOGLE_API_KEY', 'bench-offline-key') # Truoc khi import app (doc config luc import)
+
+from backend.benchmarks.stub_gemini import StubBehavior, install_stub_gemini
+from backend.benchmarks.fake_fortigate import FakeFortiGateBehavior, FakeFortiGateServer, default_command_outputs
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+# --- Kich ban: (ten) -> (path, body(i)) ---
+def build_scenarios(fortigate_config, stream, refresh_context):
+    model_config = {"model_name": "gemini-bench"}
+    context_commands = ["get system status", "get system performance status", "get router info routing-table all"]
+
+    def body(extra):
+        payload = {"model_config": model_config, "fortigate_selected_context_commands": context_commands,
+                   "refresh_fortigate_context": refresh_context}
+        payload.update(extra)
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    return {
+        "generate": ("/api/generate", lambda i: body({
+            "prompt": f"Viết script liệt kê tiến trình đang chạy #{i}", "file_type": "py", "target_os": "auto",
+        })),
+        "generate_fc": ("/api/generate", lambda i: body({
+            "prompt": f"Tạo address object cho host 10.10.10.{i % 250} trên FortiGate", "file_type": "fortios",
+            "target_os": "fortios", "fortigate_config": fortigate_config,
+        })),
+        "chat": ("/api/fortigate_chat", lambda i: body({
+            "prompt": f"Policy nào cho phép traffic từ port2 ra internet? (#{i})", "fortigate_config": fortigate_config,
+            "conversation_history_for_chat_context": "User: Xin chào\n\n---\n\nAI: Chào bạn, tôi có thể giúp gì?",
+        })),
+        "debug": ("/api/debug", lambda i: {
+            "prompt": "Liệt kê tiến trình", "code": f"import psutil\nprint(psutil.pids()[{i}])", "stdout": "",
+            "stderr": "ModuleNotFoundError: No module named 'psutil'", "file_type": "py", "model_config": model_config,
+            "bypass_cache": True,
+        }),
+        "execute": ("/api/execute", lambda i: {
+            "code": "get system status\nget system performance status", "file_type": "fortios",
+            "fortigate_config": fortigate_config,
+        }),
+        "execute_script": ("/api/execute", lambda i: dict({"code": f"print('bench {i}')", "file_type": "py"}, **({"stream": True} if stream else {}))),
+    }
+
+
+def _send(host, port, path, payload, timeout):
+    """1 request; tra ve (status, giay toi header, tong giay, so byte body). SSE loi -> status 'sse-error'."""
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    body = json.dumps(payload).encode('utf-8')
+    started = time.perf_counter()
+    try:
+        connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        first_byte = time.perf_counter() - started
+        total_bytes, sse_error = 0, False
+        while True:
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            total_bytes += len(chunk)
+            sse_error = sse_error or b"event: error" in chunk
+        return ("sse-error" if sse_error else response.status), first_byte, time.perf_counter() - started, total_bytes
+    finally:
+        connection.close()
+
+
+def run_scenario(name, path, make_body, host, port, total_requests, concurrency, timeout):
+    results = []
+    results_lock = threading.Lock()
+
+    def worker(i):
+        try:
+            outcome = _send(host, port, path, make_body(i), timeout)
+        except Exception as e:
+            outcome = (f"exc:{type(e).__name__}", None, None, 0)
+        with results_lock:
+            results.append(outcome)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"bench-{name}") as executor:
+        list(executor.map(worker, range(total_requests)))
+    wall_seconds = time.perf_counter() - started
+
+    latencies = [total for status, _, total, _ in results if status == 200]
+    first_bytes = [first for status, first, _, _ in results if status == 200]
+    statuses = {}
+    for status, _, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    report = {
+        "scenario": name, "requests": total_requests, "concurrency": concurrency, "ok": len(latencies),
+        "statuses": statuses, "rps": round(total_requests / wall_seconds, 2) if wall_seconds else 0.0,
+        "wall_seconds": round(wall_seconds, 3),
+    }
+    if latencies:
+        report.update({
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 1), "p95_ms": round(_percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 1), "mean_ms": round(statistics.mean(latencies) * 1000, 1),
+            "ttfb_p50_ms": round(_percentile(first_bytes, 50) * 1000, 1),
+        })
+    return report
+
+
+def _start_app_server(response_cache_enabled):
+    from werkzeug.serving import make_server
+    from backend.app import app
+
+    app.config['RESPONSE_CACHE_ENABLED'] = response_cache_enabled
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+    return server
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark route backend voi Gemini & FortiGate gia lap.")
+    parser.add_argument("--scenarios", default="generate,generate_fc,chat,debug,execute",
+                        help="Danh sach kich ban, phan cach dau phay (them: execute_script).")
+    parser.add_argument("--requests", type=int, default=40, help="So request moi kich ban.")
+    parser.add_argument("--concurrency", type=int, default=8, help="So request dong thoi.")
+    parser.add_argument("--warmup", type=int, default=2, help="So request lam nong (ko tinh) moi kich ban.")
+    parser.add_argument("--stream", action="store_true", help="Goi ban SSE (stream=true) cua cac route ho tro.")
+    parser.add_argument("--timeout", type=float, default=300, help="Timeout moi request (giay).")
+    parser.add_argument("--gemini-latency-ms", type=float, default=800)
+    parser.add_argument("--gemini-jitter-ms", type=float, default=200)
+    parser.add_argument("--gemini-stream-chunks", type=int, default=8)
+    parser.add_argument("--fc-commands", default="get system status;show firewall policy",
+                        help="Lenh get_fortigate_data stub goi truoc khi tra loi: cac luot phan cach ';', "
+                             "nhieu lenh trong cung 1 luot phan cach ' & ' (rong = ko goi tool).")
+    parser.add_argument("--fgt-latency-ms", type=float, default=20, help="Do tre moi lenh tren FortiGate gia lap.")
+    parser.add_argument("--fgt-routes", type=int, default=200, help="So route trong 'get router info routing-table all'.")
+    parser.add_argument("--fgt-policies", type=int, default=50, help="So policy trong 'show firewall policy'.")
+    parser.add_argument("--refresh-context", action="store_true", help="Bo qua cache ngu canh FortiGate (luon SSH).")
+    parser.add_argument("--response-cache", action="store_true", help="Bat cache phan hoi Gemini (mac dinh tat khi benchmark).")
+    parser.add_argument("--json", action="store_true", help="In ket qua dang JSON (moi dong 1 kich ban).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    fgt_behavior = FakeFortiGateBehavior(
+        command_outputs=default_command_outputs(route_count=args.fgt_routes, policy_count=args.fgt_policies),
+        command_latency_ms=args.fgt_latency_ms,
+    )
+    fgt_server = FakeFortiGateServer(fgt_behavior).start()
+    restore_gemini = install_stub_gemini(StubBehavior(
+        latency_ms=args.gemini_latency_ms, jitter_ms=args.gemini_jitter_ms, stream_chunks=args.gemini_stream_chunks,
+        fc_commands=[[cmd.strip() for cmd in turn.split(" & ") if cmd.strip()] for turn in args.fc_commands.split(";") if turn.strip()],
+    ))
+    app_server = _start_app_server(args.response_cache)
+    host, port = app_server.server_address[:2]
+    scenarios = build_scenarios(fgt_server.fortigate_config(), args.stream, args.refresh_context)
+    try:
+        selected = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+        unknown = [name for name in selected if name not in scenarios]
+        if unknown:
+            raise SystemExit(f"Kich ban ko ton tai: {', '.join(unknown)}. Co: {', '.join(scenarios)}")
+        if not args.json:
+            print(f"App: http://{host}:{port}  FortiGate gia lap: 127.0.0.1:{fgt_server.port}  "
+                  f"Gemini: {args.gemini_latency_ms:.0f}±{args.gemini_jitter_ms:.0f} ms  stream={args.stream}")
+            print(f"{'kich ban':<16}{'ok/tong':>9}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ttfb p50':>10}  status")
+        for name in selected:
+            path, make_body = scenarios[name]
+            if args.warmup:
+                run_scenario(name, path, make_body, host, port, args.warmup, 1, args.timeout)
+            report = run_scenario(name, path, make_body, host, port, args.requests, args.concurrency, args.timeout)
+            if args.json:
+                print(json.dumps(report, ensure_ascii=False))
+                continue
+            print(f"{name:<16}{report['ok']:>4}/{report['requests']:<4}{report['rps']:>9.2f}"
+                  f"{report.get('p50_ms', float('nan')):>10.1f}{report.get('p95_ms', float('nan')):>10.1f}"
+                  f"{report.get('p99_ms', float('nan')):>10.1f}{report.get('ttfb_p50_ms', float('nan')):>10.1f}  {report['statuses']}")
+        if not args.json:
+            print(f"(FortiGate gia lap nhan {fgt_server.connections} ket noi SSH)")
+    finally:
+        app_server.shutdown()
+        restore_gemini()
+        fgt_server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+# backend/benchmarks/fake_fortigate.py
+# SSH server gia lap FortiGate (paramiko) cho benchmark: xac thuc password, prompt
+# "HOST # " / "HOST (ngu canh) # ", output lenh soan san, ho tro "| grep".
+# Chay rieng: python -m backend.benchmarks.fake_fortigate [port]
+import os
+import re
+import sys
+import time
+import socket
+import tempfile
+import threading
+
+import paramiko
+
+DEFAULT_HOSTNAME = "FGT-BENCH"
+UNKNOWN_COMMAND_OUTPUT = "Unknown action 0\nCommand fail. Return code -61"
+
+
+def _routing_table(route_count):
+    lines = [
+        "Codes: K - kernel, C - connected, S - static, R - RIP, B - BGP, O - OSPF",
+        "",
+        "Routing table for VRF=0",
+        "S*      0.0.0.0/0 [10/0] via 192.168.1.1, port1, [1/0]",
+        "C       192.168.1.0/24 is directly connected, port1",
+    ]
+    for i in range(route_count):
+        lines.append(f"S       10.{i // 256 % 256}.{i % 256}.0/24 [10/0] via 192.168.1.{2 + i % 200}, port{2 + i % 4}, [1/0]")
+    lines.extend([ # Cac dang dong khac: ECMP, BGP de quy, OSPF, blackhole, VRF khac
+        "O E2    172.16.0.0/16 [110/20] via 192.168.1.10, port1, 02:11:05, [1/0]",
+        "                      [110/20] via 192.168.1.11, port1, 02:11:05, [1/0]",
+        "B       172.16.5.0/24 [20/0] via 10.255.0.1 (recursive via 192.168.1.12, port1), 1d02h03m, [1/0]",
+        "S       10.0.0.0/8 [10/0] is a summary, Null, [1/0]",
+        "",
+        "Routing table for VRF=1",
+        "S*      0.0.0.0/0 [10/0] via 10.99.0.1, port4, [1/0]",
+        "C       10.99.0.0/24 is directly connected, port4",
+    ])
+    return "\n".join(lines)
+
+
+def _firewall_policies(policy_count):
+    lines = ["config firewall policy"]
+    for i in range(1, policy_count + 1):
+        lines.extend([
+            f"    edit {i}",
+            f"        set name \"bench-policy-{i}\"",
+            "        set srcintf \"port2\"",
+            "        set dstintf \"port1\"",
+            f"        set srcaddr \"net-{i}\"",
+            "        set dstaddr \"all\"",
+            "        set action accept",
+            "        set schedule \"always\"",
+            "        set service \"HTTPS\" \"DNS\"",
+            "        set nat enable",
+            "    next",
+        ])
+    lines.append("end")
+    return "\n".join(lines)
+
+
+def _firewall_addresses(address_count):
+    return "config firewall address\n" + "\n".join(
+        f"    edit \"net-{i}\"\n        set subnet 10.{i // 256 % 256}.{i % 256}.0 255.255.255.0\n    next" for i in range(1, address_count + 1)
+    ) + "\nend"
+
+
+def _firewall_services():
+    services = (("ALL", "set protocol IP"), ("HTTPS", "set tcp-portrange 443"), ("DNS", "set tcp-portrange 53\n        set udp-portrange 53"))
+    return "config firewall service custom\n" + "\n".join(
+        f"    edit \"{name}\"\n        {settings}\n    next" for name, settings in services
+    ) + "\nend"
+
+
+def _system_interfaces():
+    return "config system interface\n" + "\n".join(
+        f"    edit \"port{i}\"\n        set vdom \"root\"\n        set ip 192.168.{i}.1 255.255.255.0\n"
+        f"        set allowaccess ping https ssh\n        set type physical\n    next" for i in range(1, 5)
+    ) + "\nend"
+
+
+def default_command_outputs(hostname=DEFAULT_HOSTNAME, route_count=200, policy_count=50):
+    """Output soan san cho cac lenh hay dung (va lenh netmiko goi khi mo phien)."""
+    full_configuration = "\n".join([
+        "#config-version=FGVM64-7.2.5-FW-build1517-230606:opmode=0:vdom=0:user=admin",
+        f"config system global\n    set hostname \"{hostname}\"\n    set admin-sport 443\n    set timezone 57\nend",
+        _system_interfaces(), _firewall_addresses(policy_count), _firewall_services(), _firewall_policies(policy_count),
+    ])
+    return {
+        "get system status": (
+            f"Version: FortiGate-VM64 v7.2.5,build1517,230606 (GA.F)\nSerial-Number: FGVMEVBENCH000001\n"
+            f"Hostname: {hostname}\nOperation Mode: NAT\nVirtual domain configuration: disable\n"
+            "Current HA mode: standalone\nSystem time: Mon Jan  1 00:00:00 2024"
+        ),
+        "show full-configuration system console": "config system console\n    set output standard\n    set login-failure-audit enable\nend",
+        "get system console": "output              : standard\nlogin-failure-audit : enable", # netmiko (FortiOS v7) doc output mode
+        "get system performance status": (
+            "CPU states: 2% user 1% system 0% nice 97% idle 0% iowait 0% irq 0% softirq\n"
+            "Memory: 2055096k total, 1034568k used (50.3%), 1020528k free (49.7%)\n"
+            "Average network usage: 120 / 98 kbps in 1 minute\nUptime: 12 days,  3 hours,  41 minutes"
+        ),
+        "get system interface physical": "\n".join(
+            f"==[port{i}]\n\tmode: static\n\tip: 192.168.{i}.1 255.255.255.0\n\tstatus: up\n\tspeed: 10000Mbps (Duplex: full)"
+            for i in range(1, 5)
+        ),
+        "get router info routing-table all": _routing_table(route_count),
+        "show firewall policy": _firewall_policies(policy_count),
+        "show full-configuration firewall policy": _firewall_policies(policy_count),
+        "show firewall address": _firewall_addresses(policy_count),
+        "show system interface": _system_interfaces(),
+        "show full-configuration": full_configuration,
+        "diagnose sys session stat": "misc info:       session_count=1520 setup_rate=35 exp_count=0 clash=0\n\tmemory_tension_drop=0 ephemeral=0/196608 removeable=0",
+    }
+
+
+class FakeFortiGateBehavior:
+    """Cau hinh server: tai khoan, output lenh, do tre moi lenh (ms) & do tre rieng theo lenh."""
+
+    def __init__(self, username="admin", password="bench", hostname=DEFAULT_HOSTNAME, command_outputs=None,
+                 command_latency_ms=20, latency_overrides_ms=None):
+        self.username = username
+        self.password = password
+        self.hostname = hostname
+        self.command_outputs = command_outputs if command_outputs is not None else default_command_outputs(hostname)
+        self.command_latency_ms = command_latency_ms
+        self.latency_overrides_ms = latency_overrides_ms or {}
+
+    def latency_seconds(self, command):
+        for prefix, latency_ms in self.latency_overrides_ms.items():
+            if command.startswith(prefix):
+                return latency_ms / 1000
+        return self.command_latency_ms / 1000
+
+
+_moduli_lock = threading.Lock()
+
+def _ensure_server_moduli():
+    """
+    Netmiko (fortinet) chi cho phep kex diffie-hellman-group(-exchange)-sha1/sha256; paramiko moi bo sha1
+    -> con group-exchange, ma server can file moduli. May ko co /etc/ssh/moduli thi dung nhom RFC 3526 (group 14).
+    """
+    with _moduli_lock:
+        if paramiko.Transport._modulus_pack is not None or paramiko.Transport.load_server_moduli():
+            return
+        from paramiko.kex_group14 import KexGroup14SHA256
+        prime = KexGroup14SHA256.P
+        with tempfile.NamedTemporaryFile("w", suffix=".moduli", delete=False) as moduli_file:
+            moduli_file.write(f"20000101000000 2 6 100 {prime.bit_length() - 1} 2 {prime:X}\n")
+        try:
+            paramiko.Transport.load_server_moduli(moduli_file.name)
+        finally:
+            os.unlink(moduli_file.name)
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, behavior):
+        self.behavior = behavior
+        self.shell_requested = threading.Event()
+
+    def check_auth_password(self, username, password):
+        if username == self.behavior.username and password == self.behavior.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_REQUEST
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.shell_requested.set()
+        return True
+
+
+class FortiOSShell:
+    """Gia lap CLI: theo doi ngu canh config/edit de dung prompt, tra output theo lenh."""
+
+    def __init__(self, behavior):
+        self.behavior = behavior
+        self._context = [] # [(loai 'config'/'edit', ten)] -> prompt "HOST (ten cuoi) # "
+
+    def prompt(self):
+        if self._context:
+            return f"{self.behavior.hostname} ({self._context[-1][1]}) # "
+        return f"{self.behavior.hostname} # "
+
+    def in_config_mode(self):
+        return bool(self._context)
+
+    def _output_for(self, command):
+        base_command, _, grep_expr = command.partition("|")
+        base_command = " ".join(base_command.split())
+        output = self.behavior.command_outputs.get(base_command)
+        if output is None:
+            return UNKNOWN_COMMAND_OUTPUT
+        grep_match = re.match(r"\s*grep\s+(?:-\w+\s+)*(.+)", grep_expr) if grep_expr else None
+        if grep_match:
+            pattern = grep_match.group(1).strip().strip("'\"")
+            output = "\n".join(line for line in output.splitlines() if pattern.lower() in line.lower())
+        return output
+
+    def execute(self, command):
+        """Tra ve output cua 1 dong lenh (chua gom echo & prompt)."""
+        words = command.split()
+        if not words:
+            return ""
+        verb = words[0]
+        if verb == "config" and len(words) > 1:
+            self._context.append(("config", words[-1]))
+            return ""
+        if verb == "edit" and len(words) > 1 and self._context:
+            self._context.append(("edit", words[1].strip('"')))
+            return ""
+        if verb == "next" and self._context and self._context[-1][0] == "edit":
+            self._context.pop()
+            return ""
+        if verb in ("end", "abort") and self._context:
+            while self._context and self._context.pop()[0] != "config":
+                pass # Dong edit dang mo roi thoat khoi khoi config gan nhat
+            return ""
+        if verb in ("set", "unset", "append", "delete", "select", "unselect"):
+            return "" if self._context else UNKNOWN_COMMAND_OUTPUT
+        return self._output_for(command)
+
+
+def _serve_channel(channel, behavior):
+    shell = FortiOSShell(behavior)
+    channel.sendall(f"\r\n{shell.prompt()}".encode())
+    pending = b""
+    while True:
+        data = channel.recv(4096)
+        if not data:
+            return
+        pending += data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        while b"\n" in pending:
+            raw_line, pending = pending.split(b"\n", 1)
+            command = raw_line.decode("utf-8", errors="replace").strip()
+            if command in ("exit", "quit") and not shell.in_config_mode():
+                channel.sendall(b"\r\n")
+                return
+            if command:
+                time.sleep(behavior.latency_seconds(command))
+            output = shell.execute(command)
+            response = command + "\r\n" + (output.replace("\n", "\r\n") + "\r\n" if output else "") + "\r\n" + shell.prompt()
+            channel.sendall(response.encode())
+
+
+def _serve_connection(client_socket, host_key, behavior):
+    transport = paramiko.Transport(client_socket)
+    try:
+        transport.add_server_key(host_key)
+        server = _ServerInterface(behavior)
+        transport.start_server(server=server)
+        channel = transport.accept(30)
+        if channel is None or not server.shell_requested.wait(30):
+            return
+        try:
+            _serve_channel(channel, behavior)
+        finally:
+            channel.close()
+    except (EOFError, OSError, paramiko.SSHException):
+        pass # Client dong ket noi giua chung
+    finally:
+        transport.close()
+
+
+class FakeFortiGateServer:
+    """SSH server chay nen tren 127.0.0.1 (port 0 = tu chon). Dung: start() ... stop()."""
+
+    def __init__(self, behavior=None, host="127.0.0.1", port=0):
+        _ensure_server_moduli()
+        self.behavior = behavior or FakeFortiGateBehavior()
+        self.host = host
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self.port = self._socket.getsockname()[1]
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.connections = 0
+
+    def fortigate_config(self):
+        """fortigate_config cho request API tro toi server nay."""
+        return {"ipHost": self.host, "portSsh": str(self.port), "username": self.behavior.username, "password": self.behavior.password}
+
+    def start(self):
+        self._socket.listen(64)
+        self._socket.settimeout(0.5)
+        self._thread = threading.Thread(target=self._accept_loop, name="fake-fortigate", daemon=True)
+        self._thread.start()
+        return self
+
+    def _accept_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                client_socket, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=_serve_connection, args=(client_socket, self._host_key, self.behavior), daemon=True).start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._socket.close()
+        if self._thread:
+            self._thread.join(timeout=2)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 2222
+    server = FakeFortiGateServer(port=port).start()
+    behavior = server.behavior
+    print(f"FortiGate gia lap: ssh {behavior.username}@{server.host} -p {server.port} (password: {behavior.password}). Ctrl+C de dung.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# backend/benchmarks/stub_gemini.py
+# Gemini gia lap cho benchmark: thay genai.GenerativeModel, ko can API key / mang.
+# Do tre cau hinh duoc, function call theo kich ban (moi phien chat chay lai tu dau).
+import time
+import random
+import threading
+
+DEFAULT_TEXT_RESPONSE = (
+    "Phân tích: script dưới đây thực hiện yêu cầu.\n\n"
+    "```python\nimport platform\nprint(platform.platform())\n```\n"
+)
+DEFAULT_FINAL_FC_RESPONSE = (
+    "Dựa trên thông tin thu thập được, đây là lệnh cần chạy:\n\n"
+    "```fortios\nconfig firewall address\n    edit \"bench-host\"\n        set subnet 10.10.10.10 255.255.255.255\n    next\nend\n```\n"
+)
+DEFAULT_FC_COMMANDS = ("get system status", "show firewall policy")
+
+
+class StubBehavior:
+    """
+    Cau hinh hanh vi cua stub:
+      latency_ms / jitter_ms : do tre moi lan goi (generate_content, send_message)
+      stream_chunks          : so doan khi stream=True (do tre chia deu cho cac doan)
+      fc_commands            : lenh get_fortigate_data goi lan luot truoc khi tra loi cuoi;
+                               1 phan tu la list/tuple -> nhieu function call trong cung 1 luot
+      text_response          : phan hoi cho generate_content (generate thuong / debug / review)
+      final_fc_response      : phan hoi cuoi cua vong lap Function Calling
+    """
+
+    def __init__(self, latency_ms=800, jitter_ms=200, stream_chunks=8, fc_commands=DEFAULT_FC_COMMANDS,
+                 text_response=DEFAULT_TEXT_RESPONSE, final_fc_response=DEFAULT_FINAL_FC_RESPONSE, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.stream_chunks = max(1, int(stream_chunks))
+        self.fc_commands = list(fc_commands)
+        self.text_response = text_response
+        self.final_fc_response = final_fc_response
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def delay_seconds(self):
+        with self._lock:
+            self.calls += 1
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0
+        return max(0.0, self.latency_ms + jitter) / 1000
+
+
+# --- Doi tuong phan hoi (chi cac thuoc tinh backend doc) ---
+class _FinishReason:
+    def __init__(self, name):
+        self.name = name
+
+
+class _FunctionCall:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+
+class _Part:
+    def __init__(self, text=None, function_call=None):
+        self.text = text
+        self.function_call = function_call
+
+
+class _Content:
+    def __init__(self, parts):
+        self.parts = parts
+
+
+class _Candidate:
+    def __init__(self, parts, finish_reason="STOP"):
+        self.content = _Content(parts)
+        self.finish_reason = _FinishReason(finish_reason)
+        self.safety_ratings = []
+
+
+class _TokenCount:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+
+class StubResponse:
+    """Giong GenerateContentResponse: .candidates, .text, .prompt_feedback; lap duoc khi stream."""
+
+    def __init__(self, parts, delay_seconds, stream_chunks=1):
+        self.candidates = [_Candidate(parts)]
+        self.prompt_feedback = None
+        self._delay_seconds = delay_seconds
+        self._stream_chunks = stream_chunks
+
+    @property
+    def text(self):
+        return "".join(part.text for part in self.candidates[0].content.parts if part.text)
+
+    def __iter__(self):
+        text = self.text
+        if not text: # Function call: 1 chunk duy nhat, ko co text
+            time.sleep(self._delay_seconds)
+            yield self
+            return
+        chunk_count = min(self._stream_chunks, len(text))
+        chunk_size = -(-len(text) // chunk_count)
+        for start in range(0, len(text), chunk_size):
+            time.sleep(self._delay_seconds / chunk_count)
+            yield StubResponse([_Part(text=text[start:start + chunk_size])], 0)
+
+
+def _text_response(text, delay_seconds, stream, stream_chunks):
+    response = StubResponse([_Part(text=text)], delay_seconds, stream_chunks)
+    if not stream:
+        time.sleep(delay_seconds)
+    return response
+
+
+class StubChatSession:
+    """Phien chat: moi send_message tra ve function call tiep theo trong kich ban, het thi tra loi cuoi."""
+
+    def __init__(self, model, behavior, history=None):
+        self.model = model
+        self.behavior = behavior
+        self.history = list(history or []) # Nhu ChatSession that: tin nhan gui di + phan hoi model
+        self._step = 0
+
+    def send_message(self, content=None, generation_config=None, safety_settings=None, stream=False):
+        delay_seconds = self.behavior.delay_seconds()
+        step, self._step = self._step, self._step + 1
+        if isinstance(content, str):
+            content = {"role": "user", "parts": [{"text": content}]}
+        self.history.append(content if isinstance(content, dict) else {"role": "user", "parts": list(content or [])})
+        if step < len(self.behavior.fc_commands):
+            turn_commands = self.behavior.fc_commands[step]
+            if isinstance(turn_commands, str):
+                turn_commands = [turn_commands]
+            parts = [_Part(function_call=_FunctionCall("get_fortigate_data", {"command": cmd})) for cmd in turn_commands]
+            response = StubResponse(parts, delay_seconds)
+            if not stream:
+                time.sleep(delay_seconds)
+        else:
+            response = _text_response(self.behavior.final_fc_response, delay_seconds, stream, self.behavior.stream_chunks)
+        self.history.append({"role": "model", "parts": response.candidates[0].content.parts})
+        return response
+
+
+class StubGenerativeModel:
+    """Thay the genai.GenerativeModel (cung chu ky khoi tao & cac ham backend dung)."""
+
+    behavior = StubBehavior()
+
+    def __init__(self, model_name="gemini-1.5-flash", tools=None, safety_settings=None, **kwargs):
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self.tools = tools
+        self.safety_settings = safety_settings
+        self._client = None
+
+    def generate_content(self, contents, generation_config=None, safety_settings=None, stream=False, **kwargs):
+        behavior = self.behavior
+        return _text_response(behavior.text_response, behavior.delay_seconds(), stream, behavior.stream_chunks)
+
+    def start_chat(self, history=None):
+        return StubChatSession(self, self.behavior, history)
+
+    def count_tokens(self, contents):
+        return _TokenCount(max(1, len(str(contents)) // 4))
+
+
+class StubServiceClient:
+    """Thay glm.GenerativeServiceClient: registry chi gan vao model, ko goi mang."""
+
+    def __init__(self, client_options=None, **kwargs):
+        self.client_options = client_options
+
+
+def install_stub_gemini(behavior=None):
+    """
+    Thay genai.GenerativeModel & glm.GenerativeServiceClient bang stub, xoa registry
+    model da tao. Tra ve ham khoi phuc ban goc.
+    """
+    import google.generativeai as genai
+    from backend import gemini_utils
+
+    if behavior is not None:
+        StubGenerativeModel.behavior = behavior
+    original_model = genai.GenerativeModel
+    original_client = gemini_utils.glm.GenerativeServiceClient
+    genai.GenerativeModel = StubGenerativeModel
+    gemini_utils.glm.GenerativeServiceClient = StubServiceClient
+    gemini_utils._client_registry = None
+
+    def restore():
+        genai.GenerativeModel = original_model
+        gemini_utils.glm.GenerativeServiceClient = original_client
+        gemini_utils._client_registry = None
+    return restore
@@ -0,0 +1,174 @@
+# backend/cache_utils.py
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Cache LRU gioi han so entry, moi entry co TTL rieng. Thread-safe."""
+
+    def __init__(self, max_entries=256, default_ttl=60):
+        self.max_entries = max(1, int(max_entries))
+        self.default_ttl = float(default_ttl)
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl_value = self.default_ttl if ttl is None else float(ttl)
+        if ttl_value <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl_value, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._data.pop(key, _MISSING) is not _MISSING
+
+    def invalidate_where(self, predicate):
+        """Xoa moi entry co key thoa predicate(key). Tra ve so entry da xoa."""
+        with self._lock:
+            keys = [k for k in self._data if predicate(k)]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class SQLiteCacheTier:
+    """Tang cache tren dia (SQLite) cho gia tri chuoi, co TTL."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        try:
+            with conn: # commit/rollback
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT value, expires_at FROM cache_entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= time.time():
+                conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+                return None
+            return row[0]
+
+    def set(self, key, value, ttl):
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)", (key, value, time.time() + float(ttl)))
+
+    def purge_expired(self):
+        with self._lock, self._connect() as conn:
+            return conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM cache_entries")
+
+
+class TieredResponseCache:
+    """Cache phan hoi 2 tang: LRU trong bo nho + (tuy chon) SQLite tren dia."""
+
+    def __init__(self, max_entries=512, ttl=3600, sqlite_path=None):
+        self.ttl = float(ttl)
+        self.memory = TTLCache(max_entries=max_entries, default_ttl=ttl)
+        self.disk = SQLiteCacheTier(sqlite_path) if sqlite_path else None
+        self.disk_hits = 0
+
+    @staticmethod
+    def make_key(*parts):
+        """Hash noi dung cac phan cua key (prompt, model, tham so...)."""
+        hasher = hashlib.sha256()
+        for part in parts:
+            hasher.update(str(part).encode('utf-8'))
+            hasher.update(b"\x1f")
+        return hasher.hexdigest()
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.disk is None:
+            return value
+        value = self.disk.get(key)
+        if value is not None:
+            self.disk_hits += 1
+            self.memory.set(key, value) # Dua len tang bo nho
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value, self.ttl)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats["ttl"] = self.ttl
+        stats["disk_enabled"] = self.disk is not None
+        stats["disk_hits"] = self.disk_hits
+        return stats
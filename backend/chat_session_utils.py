@@ -0,0 +1,253 @@
+# backend/chat_session_utils.py
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+from .token_utils import get_token_counter, HISTORY_TURN_SEPARATOR
+from .gemini_utils import generate_response_from_gemini
+
+SUMMARY_PROMPT_TEMPLATE = """Bạn đang tóm tắt một cuộc hội thoại giữa người dùng và trợ lý AI về FortiGate để dùng làm bộ nhớ cho các lượt sau.
+Giữ lại: yêu cầu của người dùng, kết luận/câu trả lời của AI, các lệnh FortiOS đã chạy hoặc đề xuất và kết quả quan trọng (IP, policy ID, interface, lỗi).
+Bỏ: lời chào, output dài không còn cần thiết. Viết ngắn gọn bằng tiếng Việt, tối đa khoảng {max_words} từ, dạng gạch đầu dòng.
+
+Tóm tắt hiện có (có thể trống):
+{previous_summary}
+
+Các lượt hội thoại cần gộp thêm vào tóm tắt:
+{turns_text}
+"""
+PREAMBLE_ACK = "Đã nắm hướng dẫn, ngữ cảnh FortiGate và lịch sử hội thoại. Sẵn sàng trả lời."
+
+
+def _field(obj, name):
+    """Doc truong cua Content/Part (dict hoac proto cua google-generativeai)."""
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def part_to_text(part):
+    text = _field(part, 'text')
+    if text:
+        return text
+    function_call = _field(part, 'function_call')
+    if function_call and _field(function_call, 'name'):
+        args = _field(function_call, 'args')
+        return f"[Gọi tool {_field(function_call, 'name')}: {dict(args) if args else {}}]"
+    function_response = _field(part, 'function_response')
+    if function_response and _field(function_response, 'name'):
+        response = _field(function_response, 'response')
+        output = (response.get('output') if hasattr(response, 'get') else None) if response else None
+        return f"[Kết quả tool {_field(function_response, 'name')}]\n{output if output is not None else response}"
+    return ""
+
+
+def content_to_text(content):
+    role = _field(content, 'role') or 'user'
+    body = "\n".join(filter(None, (part_to_text(part) for part in (_field(content, 'parts') or []))))
+    return f"{'Người dùng' if role == 'user' else 'AI'}: {body}"
+
+
+def is_user_text_turn(content):
+    """Content bat dau 1 luot moi: role user co text (ko phai function_response)."""
+    if (_field(content, 'role') or 'user') != 'user':
+        return False
+    return any(_field(part, 'text') for part in (_field(content, 'parts') or []))
+
+
+def split_turns(history):
+    """Chia history thanh cac luot: moi luot tu 1 tin nhan user den truoc tin nhan user ke tiep."""
+    turns = []
+    for content in history:
+        if is_user_text_turn(content) or not turns:
+            turns.append([])
+        turns[-1].append(content)
+    return turns
+
+
+class ChatSession:
+    """
+    1 hoi thoai /api/fortigate_chat. history chi gom cac luot hoi thoai (Content Gemini native);
+    huong dan + ngu canh FortiGate + tom tat duoc dung lai moi luot thanh tin nhan dau (preamble).
+    """
+
+    def __init__(self, session_id, tool_memo=None):
+        self.session_id = session_id
+        self.history = [] # list Content (dict hoac proto) sau preamble
+        self.summary = "" # Tom tat cuon cac luot da bi gop (hoac lich su client gui o luot dau)
+        self.compacted_turns = 0
+        self.turns = 0
+        self.history_tokens = 0
+        # Ngu canh FortiGate nam trong preamble (baseline cho delta): phien ban chi duy nhat theo thiet bi
+        # va co the danh lai tu 1 (LRU) -> luon so kem khoa thiet bi + digest noi dung
+        self.context_device_key = None
+        self.context_version = None
+        self.context_digest = None
+        self.context_text = ""
+        self.tool_memo = tool_memo
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock() # 1 luot / hoi thoai tai 1 thoi diem (ca luc gop history)
+
+    def start_history(self, preamble_text):
+        """History cho model.start_chat: preamble + xac nhan + cac luot da luu."""
+        return [
+            {"role": "user", "parts": [{"text": preamble_text}]},
+            {"role": "model", "parts": [{"text": PREAMBLE_ACK}]},
+        ] + list(self.history)
+
+    def summary_info(self):
+        return {
+            "session_id": self.session_id, "turns": self.turns, "history_messages": len(self.history),
+            "history_tokens": self.history_tokens, "compacted_turns": self.compacted_turns,
+            "has_summary": bool(self.summary), "context_version": self.context_version, "idle_seconds": round(time.monotonic() - self.last_used, 1),
+        }
+
+
+class ChatSessionStore:
+    """
+    Luu ChatSession theo session_id trong bo nho: LRU (max_sessions) + het han khi idle qua idle_ttl.
+    Khi history vuot history_token_budget, cac luot cu duoc gop vao tom tat (chay nen sau luot).
+    """
+
+    def __init__(self, app, max_sessions=200, idle_ttl=3600, history_token_budget=6000, keep_ratio=0.5, summary_max_words=250):
+        self.app = app
+        self.max_sessions = max(1, int(max_sessions))
+        self.idle_ttl = float(idle_ttl)
+        self.history_token_budget = int(history_token_budget)
+        self.keep_ratio = float(keep_ratio)
+        self.summary_max_words = int(summary_max_words)
+        self._sessions = OrderedDict() # session_id -> ChatSession
+        self._lock = threading.Lock()
+        self._compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-compact")
+        self.evictions = 0
+        self.expirations = 0
+        self.compactions = 0
+
+    def _evict_expired_locked(self, now):
+        expired = [sid for sid, session in self._sessions.items() if now - session.last_used > self.idle_ttl]
+        for sid in expired:
+            del self._sessions[sid]
+        self.expirations += len(expired)
+
+    def get_or_create(self, session_id=None, tool_memo_factory=None):
+        """Tra ve (session, created). session_id ko ton tai/het han -> tao hoi thoai moi (id moi)."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_expired_locked(now)
+            session = self._sessions.get(session_id) if session_id else None
+            if session is not None:
+                session.last_used = now
+                self._sessions.move_to_end(session_id)
+                return session, False
+            session = ChatSession(uuid.uuid4().hex, tool_memo_factory() if tool_memo_factory else None)
+            self._sessions[session.session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+            return session, True
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def list_sessions(self):
+        with self._lock:
+            return [session.summary_info() for session in reversed(self._sessions.values())]
+
+    def commit_turn(self, session, chat_history, model_config=None):
+        """
+        Luu history sau 1 luot thanh cong (chat_history = history cua ChatSession Gemini, gom preamble).
+        Goi khi dang giu session.lock. Vuot ngan sach -> len lich gop luot cu chay nen va tra ve
+        True: lock duoc chuyen cho luong gop (no se release), nguoi goi KHONG release nua.
+        """
+        counter = get_token_counter()
+        session.history = list(chat_history)[2:] # Bo preamble + xac nhan (dung lai moi luot)
+        session.turns += 1
+        session.last_used = time.monotonic()
+        session.history_tokens = sum(counter.estimate(content_to_text(content)) for content in session.history)
+        if session.history_tokens <= self.history_token_budget:
+            return False
+        # Luot tiep theo cua hoi thoai nay cho den khi gop xong, ko doc history dang sua
+        self._compactor.submit(self._compact_in_app_context, session, dict(model_config or {}))
+        return True
+
+    def _compact_in_app_context(self, session, model_config):
+        with self.app.app_context():
+            try:
+                self.compact(session, model_config)
+            except Exception as e:
+                current_app.logger.error(f"Chat session {session.session_id}: loi khi gop history: {e}", exc_info=True)
+            finally:
+                session.lock.release()
+
+    def compact(self, session, model_config=None):
+        """Gop cac luot cu nhat vao tom tat, giu nguyen cac luot moi nhat trong keep_ratio * ngan sach."""
+        counter = get_token_counter()
+        turns = split_turns(session.history)
+        keep_budget = int(self.history_token_budget * self.keep_ratio)
+        kept_count, kept_tokens = 0, 0
+        for turn in reversed(turns):
+            turn_tokens = sum(counter.estimate(content_to_text(content)) for content in turn)
+            if kept_count and kept_tokens + turn_tokens > keep_budget:
+                break
+            kept_count += 1
+            kept_tokens += turn_tokens
+        dropped_turns = turns[:len(turns) - kept_count]
+        if not dropped_turns:
+            return
+        turns_text = HISTORY_TURN_SEPARATOR.join("\n".join(content_to_text(c) for c in turn) for turn in dropped_turns)
+        session.summary = self._summarize(session.summary, turns_text, model_config)
+        session.compacted_turns += len(dropped_turns)
+        session.history = [content for turn in turns[len(dropped_turns):] for content in turn]
+        session.history_tokens = kept_tokens
+        self.compactions += 1
+        current_app.logger.info(
+            f"Chat session {session.session_id}: gop {len(dropped_turns)} luot cu vao tom tat, "
+            f"history con ~{kept_tokens} token ({kept_count} luot giu nguyen)."
+        )
+
+    def _summarize(self, previous_summary, turns_text, model_config):
+        prompt = SUMMARY_PROMPT_TEMPLATE.format(
+            max_words=self.summary_max_words, previous_summary=previous_summary or "(trống)", turns_text=turns_text
+        )
+        summary = generate_response_from_gemini(prompt, model_config) if model_config is not None else ""
+        if summary and not summary.startswith("Lỗi"):
+            return summary
+        # Ko goi duoc Gemini: tom tat trich dan (dau moi tin nhan), van giu trong gioi han
+        current_app.logger.warning("Chat session: ko tom tat duoc bang Gemini, dung tom tat trich dan.")
+        excerpt_lines = [f"- {line[:200]}" for line in turns_text.splitlines() if line.startswith(("Người dùng:", "AI:"))]
+        return "\n".join(filter(None, [previous_summary] + excerpt_lines))[-self.summary_max_words * 8:]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions), "max_sessions": self.max_sessions, "idle_ttl": self.idle_ttl,
+                "history_token_budget": self.history_token_budget, "evictions": self.evictions,
+                "expirations": self.expirations, "compactions": self.compactions,
+            }
+
+
+_chat_session_store = None
+_chat_session_store_lock = threading.Lock()
+
+def get_chat_session_store():
+    """Lay ChatSessionStore dung chung (khoi tao lan dau tu app.config)."""
+    global _chat_session_store
+    if _chat_session_store is None:
+        with _chat_session_store_lock:
+            if _chat_session_store is None:
+                cfg = current_app.config
+                _chat_session_store = ChatSessionStore(
+                    current_app._get_current_object(),
+                    max_sessions=cfg.get('CHAT_SESSION_MAX_SESSIONS', 200),
+                    idle_ttl=cfg.get('CHAT_SESSION_IDLE_TTL', 3600),
+                    history_token_budget=cfg.get('CHAT_SESSION_HISTORY_TOKEN_BUDGET', 6000),
+                    summary_max_words=cfg.get('CHAT_SESSION_SUMMARY_MAX_WORDS', 250),
+                )
+    return _chat_session_store
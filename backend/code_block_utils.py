@@ -0,0 +1,116 @@
+# backend/code_block_utils.py
+import re
+
+_FENCE = "```"
+_LANG_RE = re.compile(r"[\w\-\./\+]+")
+_PIP_INSTALL_RE = re.compile(r"pip install\s+([\w\-==\.\+\[\]]+)", re.IGNORECASE)
+
+# Alias tag ngon ngu theo extension file
+TAG_ALIASES = {
+    'py': ['python'],
+    'sh': ['bash', 'shell'],
+    'bat': ['batch'],
+    'ps1': ['powershell'],
+    'fortios': ['cli', 'text'],
+}
+
+class CodeBlock:
+    """1 khoi ``` trong phan hoi. Noi dung chi duoc cat ra khi can (thuoc tinh content)."""
+    __slots__ = ("index", "lang", "start", "end", "fenced", "_text", "_content_start", "_content_end")
+
+    def __init__(self, index, lang, start, end, fenced, text, content_start, content_end):
+        self.index = index            # Thu tu khoi trong phan hoi
+        self.lang = lang              # Tag ngon ngu (lowercase, '' neu ko co)
+        self.start = start            # Vi tri ``` mo
+        self.end = end                # Vi tri ngay sau ``` dong
+        self.fenced = fenced          # True neu tag nam rieng 1 dong va noi dung ket thuc bang '\n```'
+        self._text = text
+        self._content_start = content_start
+        self._content_end = content_end
+
+    @property
+    def content(self):
+        return self._text[self._content_start:self._content_end].strip()
+
+    def __repr__(self):
+        return f"CodeBlock(index={self.index}, lang={self.lang!r}, span=({self.start}, {self.end}), fenced={self.fenced})"
+
+
+def scan_code_blocks(text):
+    """
+    Quet phan hoi 1 lan (str.find, ko backtracking), tra ve list CodeBlock theo
+    thu tu xuat hien. Moi cap ``` mo/dong la 1 khoi; neu ``` dong nam tren cung
+    dong voi ``` mo thi la khoi inline ```tag noi dung```.
+    """
+    blocks = []
+    if not text:
+        return blocks
+    text_len = len(text)
+    pos = text.find(_FENCE)
+    while pos != -1:
+        info_start = pos + 3
+        line_end = text.find("\n", info_start)
+        if line_end == -1:
+            line_end = text_len
+        inline_close = text.find(_FENCE, info_start, line_end)
+        if inline_close != -1:
+            lang_match = _LANG_RE.match(text, info_start, inline_close)
+            content_start = lang_match.end() if lang_match else info_start
+            lang = lang_match.group(0).lower() if lang_match else ""
+            blocks.append(CodeBlock(len(blocks), lang, pos, inline_close + 3, False, text, content_start, inline_close))
+            pos = text.find(_FENCE, inline_close + 3)
+            continue
+        if line_end == text_len:
+            break
+        close = text.find(_FENCE, line_end + 1)
+        if close == -1:
+            break
+        lang_match = _LANG_RE.match(text, info_start, line_end)
+        lang = lang_match.group(0).lower() if lang_match else ""
+        fenced = close > line_end + 1 and text[close - 1] == "\n"
+        blocks.append(CodeBlock(len(blocks), lang, pos, close + 3, fenced, text, line_end + 1, close))
+        pos = text.find(_FENCE, close + 3)
+    return blocks
+
+
+def code_block_tag_priority(extension, is_fortigate_request=False):
+    """Thu tu tag uu tien khi chon khoi ma cho 1 extension."""
+    tags = [extension] + TAG_ALIASES.get(extension, [])
+    if is_fortigate_request:
+        tags.insert(0, 'fortios')
+        tags.extend(['cli', 'text'])
+    unique_tags = []
+    for tag in tags:
+        if tag and tag.lower() not in unique_tags:
+            unique_tags.append(tag.lower())
+    return unique_tags
+
+
+def select_code_block(blocks, tag_priority, fenced_only=False):
+    """
+    Chon khoi cuoi cung khop tag co uu tien cao nhat. Voi moi tag, khoi dung
+    dinh dang (tag rieng dong) duoc uu tien hon khoi inline. Tag '' = khoi ko co tag.
+    """
+    by_lang = {}
+    for block in blocks:
+        by_lang.setdefault(block.lang, []).append(block)
+    for tag in tag_priority:
+        candidates = by_lang.get(tag)
+        if not candidates:
+            continue
+        fenced_candidates = [block for block in candidates if block.fenced]
+        if fenced_candidates:
+            return fenced_candidates[-1]
+        if not fenced_only:
+            return candidates[-1]
+    return None
+
+
+def find_pip_install_block(blocks):
+    """Khoi ```bash chi chua 'pip install <package>'. Tra ve (block, package) hoac (None, None)."""
+    for block in blocks:
+        if block.lang == 'bash':
+            match = _PIP_INSTALL_RE.fullmatch(block.content)
+            if match:
+                return block, match.group(1).strip()
+    return None, None
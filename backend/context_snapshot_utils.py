@@ -0,0 +1,170 @@
+# backend/context_snapshot_utils.py
+import time
+import difflib
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import current_app
+
+from .token_utils import split_blocks, get_token_counter
+
+
+def split_context_sections(context_text):
+    """Tach ngu canh FortiGate ('$ lenh' + output) thanh OrderedDict lenh -> output."""
+    sections = OrderedDict()
+    for block in split_blocks(context_text or ""):
+        header, _, body = block.partition("\n")
+        if header.startswith("$ "):
+            sections[" ".join(header[2:].split())] = body.rstrip("\n")
+        else: # Phan truoc lenh dau tien (VD: thong bao loi)
+            sections[""] = (sections.get("", "") + "\n" + block).strip("\n")
+    return sections
+
+
+class ContextSnapshot:
+    """1 phien ban ngu canh cua 1 thiet bi (bat bien sau khi tao)."""
+
+    def __init__(self, version, context_text):
+        self.version = version
+        self.created_at = time.time()
+        self.text = context_text
+        self.sections = split_context_sections(context_text)
+        self.digest = hashlib.sha256(context_text.encode('utf-8')).hexdigest()
+
+    def summary_info(self):
+        return {
+            "version": self.version, "created_at": self.created_at, "commands": [cmd for cmd in self.sections if cmd],
+            "bytes": len(self.text.encode('utf-8')), "digest": self.digest[:16],
+        }
+
+
+def diff_snapshots(base, current, context_lines=1):
+    """
+    So sanh tung lenh giua 2 snapshot. Tra ve list (lenh, trang thai, dong diff);
+    trang thai: unchanged / changed / added / removed.
+    """
+    entries = []
+    for cmd, output in current.sections.items():
+        if cmd not in base.sections:
+            entries.append((cmd, "added", output.splitlines()))
+        elif base.sections[cmd] == output:
+            entries.append((cmd, "unchanged", []))
+        else:
+            diff_lines = list(difflib.unified_diff(
+                base.sections[cmd].splitlines(), output.splitlines(), lineterm="", n=context_lines
+            ))[2:] # Bo header ---/+++
+            entries.append((cmd, "changed", diff_lines))
+    for cmd in base.sections:
+        if cmd not in current.sections:
+            entries.append((cmd, "removed", []))
+    return entries
+
+
+def render_context_delta(base, current, summary_lines=5):
+    """
+    Ngu canh dang 'tom tat baseline + delta': lenh ko doi chi giu vai dong dau, lenh doi
+    gui unified diff, lenh moi gui day du. Moi khoi van bat dau bang '$ lenh' de cat theo ngan sach.
+    """
+    blocks = [f"(Ngữ cảnh phiên bản v{current.version}, so với v{base.version} đã gửi trước đó.)"]
+    for cmd, status, lines in diff_snapshots(base, current):
+        header = f"$ {cmd}" if cmd else "$ (thông báo)"
+        if status == "unchanged":
+            output_lines = current.sections[cmd].splitlines()
+            kept = output_lines[:summary_lines]
+            note = f"[không đổi so với v{base.version}, {len(output_lines)} dòng" + (", chỉ trích đầu]" if len(output_lines) > len(kept) else "]")
+            blocks.append("\n".join([f"{header}  {note}"] + kept))
+        elif status == "changed":
+            blocks.append("\n".join([f"{header}  [thay đổi so với v{base.version}, dạng unified diff]"] + lines))
+        elif status == "added":
+            blocks.append("\n".join([f"{header}  [lệnh mới]"] + lines))
+        else:
+            blocks.append(f"{header}  [không còn trong ngữ cảnh hiện tại]")
+    return "\n".join(blocks)
+
+
+class ContextSnapshotStore:
+    """
+    Phien ban ngu canh FortiGate theo thiet bi (trong bo nho). Noi dung trung phien ban
+    moi nhat ko tao phien ban moi. Giu toi da max_versions / thiet bi, max_devices thiet bi (LRU).
+    """
+
+    def __init__(self, max_versions=20, max_devices=64):
+        self.max_versions = max(1, int(max_versions))
+        self.max_devices = max(1, int(max_devices))
+        self._devices = OrderedDict() # device_key -> {"next_version": int, "snapshots": OrderedDict(version -> ContextSnapshot)}
+        self._lock = threading.Lock()
+        self.deltas_built = 0
+        self.delta_fallbacks = 0
+
+    def record(self, device_key, context_text):
+        """Luu ngu canh moi lay, tra ve snapshot (phien ban moi hoac moi nhat neu ko doi)."""
+        snapshot_digest = hashlib.sha256(context_text.encode('utf-8')).hexdigest()
+        with self._lock:
+            device = self._devices.get(device_key)
+            if device is None:
+                device = self._devices[device_key] = {"next_version": 1, "snapshots": OrderedDict()}
+                while len(self._devices) > self.max_devices:
+                    self._devices.popitem(last=False)
+            self._devices.move_to_end(device_key)
+            snapshots = device["snapshots"]
+            if snapshots:
+                latest = next(reversed(snapshots.values()))
+                if latest.digest == snapshot_digest:
+                    return latest
+            snapshot = ContextSnapshot(device["next_version"], context_text)
+            device["next_version"] += 1
+            snapshots[snapshot.version] = snapshot
+            while len(snapshots) > self.max_versions:
+                snapshots.popitem(last=False)
+            return snapshot
+
+    def get(self, device_key, version):
+        with self._lock:
+            device = self._devices.get(device_key)
+            return device["snapshots"].get(version) if device else None
+
+    def versions(self, device_key):
+        with self._lock:
+            device = self._devices.get(device_key)
+            return [snapshot.summary_info() for snapshot in device["snapshots"].values()] if device else []
+
+    def build_delta(self, device_key, current, base_version, max_ratio=0.6, summary_lines=5, base_digest=None):
+        """
+        Ngu canh delta so voi base_version. Tra ve None (-> gui day du) neu ko con base, base khac noi dung
+        base_digest (phien ban bi danh lai sau khi thiet bi bi day khoi LRU), hoac delta ko nho hon max_ratio lan ban day du.
+        """
+        base = self.get(device_key, base_version) if base_version is not None else None
+        if base is None or base.version > current.version or (base_digest is not None and base.digest != base_digest):
+            return None
+        delta_text = render_context_delta(base, current, summary_lines=summary_lines)
+        counter = get_token_counter()
+        if counter.estimate(delta_text) >= max_ratio * counter.estimate(current.text):
+            with self._lock:
+                self.delta_fallbacks += 1
+            return None
+        with self._lock:
+            self.deltas_built += 1
+        return delta_text
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._devices), "snapshots": sum(len(d["snapshots"]) for d in self._devices.values()),
+                "max_versions": self.max_versions, "deltas_built": self.deltas_built, "delta_fallbacks": self.delta_fallbacks,
+            }
+
+
+_context_snapshot_store = None
+_context_snapshot_store_lock = threading.Lock()
+
+def get_context_snapshot_store():
+    """Lay ContextSnapshotStore dung chung (khoi tao lan dau tu app.config)."""
+    global _context_snapshot_store
+    if _context_snapshot_store is None:
+        with _context_snapshot_store_lock:
+            if _context_snapshot_store is None:
+                _context_snapshot_store = ContextSnapshotStore(
+                    max_versions=current_app.config.get('FGT_CONTEXT_SNAPSHOT_VERSIONS', 20),
+                    max_devices=current_app.config.get('FGT_CONTEXT_SNAPSHOT_MAX_DEVICES', 64),
+                )
+    return _context_snapshot_store
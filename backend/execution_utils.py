@@ -1,16 +1,34 @@
 # backend/execution_utils.py
 import os
+import sys
 import subprocess
 import re
 import shlex
 import ctypes
 import tempfile
 import stat
+import time
+import queue
+import sqlite3
+import threading
 from datetime import datetime
-from netmiko import ConnectHandler, NetmikoTimeoutException, NetmikoAuthenticationException
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from netmiko import NetmikoTimeoutException, NetmikoAuthenticationException
 from paramiko.ssh_exception import SSHException
 from flask import current_app
 import logging # Them logging
+from .ssh_pool_utils import get_fortigate_pool, secret_digest, PoolAcquireTimeout
+from .cache_utils import TTLCache
+from .context_snapshot_utils import get_context_snapshot_store
+from .snapshot_store_utils import get_context_snapshot_archive, device_label
+from .fortios_config_utils import get_config_index_store
+from .route_lookup_utils import get_route_table_store, is_routing_table_command, ROUTING_TABLE_COMMAND
+from .metrics_utils import (
+    FORTIGATE_COMMAND_DURATION, FORTIGATE_COMMAND_OUTPUT_BYTES, SCRIPT_EXECUTION_DURATION, SCRIPT_OUTPUT_BYTES, command_verb, timed_stage
+)
+from .helpers import get_os_name
+from .code_block_utils import scan_code_blocks, select_code_block, code_block_tag_priority
 
 # Lenh lay ctx FortiGate
 DEFAULT_FORTIGATE_CONTEXT_COMMANDS = [
@@ -18,71 +36,31 @@ DEFAULT_FORTIGATE_CONTEXT_COMMANDS = [
 ]
 
 # Ham trich xuat khoi ma
+@timed_stage("code_extraction")
 def extract_code_block(raw_text, requested_extension, user_input_for_context=""):
     """Trich xuat khoi ma tu phan hoi tho cua Gemini."""
     logger = current_app.logger
-    primary_tags = [requested_extension]
-    if requested_extension == 'py': primary_tags.append('python')
-    if requested_extension == 'sh': primary_tags.extend(['bash', 'shell'])
-    if requested_extension == 'bat': primary_tags.append('batch')
-    if requested_extension == 'ps1': primary_tags.append('powershell')
-    if requested_extension == 'fortios': primary_tags.extend(['cli', 'text'])
-
     is_fortigate_request = "fortigate" in user_input_for_context.lower() or \
                            "fortios" in user_input_for_context.lower() or \
                            requested_extension == 'fortios'
-
-    if is_fortigate_request:
-        if 'fortios' not in primary_tags: primary_tags.insert(0, 'fortios')
-        if requested_extension in ['txt', 'conf', 'cli', 'text', 'log']:
-             if 'fortios' not in primary_tags: primary_tags.insert(0, 'fortios')
-        if 'cli' not in primary_tags: primary_tags.append('cli')
-        if 'text' not in primary_tags: primary_tags.append('text')
-
-    unique_primary_tags = []
-    for tag in primary_tags:
-        if tag and tag not in unique_primary_tags:
-            unique_primary_tags.append(tag)
-
-    logger.info(f"Trich xuat code voi tags: {unique_primary_tags} cho ext: .{requested_extension}")
-
-    for tag in unique_primary_tags:
-        pattern_strict = r"```" + re.escape(tag) + r"(?:[^\S\n].*?)?\s*\n([\s\S]*?)\n```"
-        pattern_flexible = r"```" + re.escape(tag) + r"(?:[^\S\n].*?)?\s*([\s\S]*?)\s*```"
-
-        for p_idx, pattern_str in enumerate([pattern_strict, pattern_flexible]):
-            try:
-                matches = list(re.finditer(pattern_str, raw_text, re.IGNORECASE))
-                if matches:
-                    logger.info(f"Tim thay khoi code voi tag: '{tag}' (pattern {p_idx}).")
-                    return matches[-1].group(1).strip()
-            except re.error as re_err:
-                logger.error(f"Loi Regex voi pattern '{pattern_str}' cho tag '{tag}': {re_err}")
-                continue
-
-    # Fallback to generic code block
-    generic_matches = list(re.finditer(r"```(?:([\w\-\./\+]+)[^\S\n]*)?\s*\n([\s\S]*?)\n```", raw_text))
-    if not generic_matches:
-        generic_matches = list(re.finditer(r"```(?:([\w\-\./\+]+)[^\S\n]*)?\s*([\s\S]*?)\s*```", raw_text))
-
-    if generic_matches:
-        last_block_match = generic_matches[-1]
-        lang_tag_found = last_block_match.group(1)
-        code_content = last_block_match.group(2).strip()
-
-        if lang_tag_found:
-            lang_tag_found = lang_tag_found.strip().lower()
-            logger.warning(f"Tim thay khoi code chung voi hint '```{lang_tag_found}```. Dung cho '.{requested_extension}'.")
-            if lang_tag_found == 'fortios' and is_fortigate_request: return code_content
-            if lang_tag_found == requested_extension or \
-               (requested_extension == 'py' and lang_tag_found == 'python') or \
-               (requested_extension == 'sh' and lang_tag_found in ['bash', 'shell']) or \
-               (requested_extension == 'bat' and lang_tag_found == 'batch') or \
-               (requested_extension == 'ps1' and lang_tag_found == 'powershell'):
-                return code_content
+    tag_priority = code_block_tag_priority(requested_extension, is_fortigate_request)
+    logger.info(f"Trich xuat code voi tags: {tag_priority} cho ext: .{requested_extension}")
+
+    blocks = scan_code_blocks(raw_text)
+    selected_block = select_code_block(blocks, tag_priority)
+    if selected_block:
+        logger.info(f"Tim thay khoi code voi tag: '{selected_block.lang}' ({len(blocks)} khoi trong phan hoi).")
+        return selected_block.content
+
+    # Fallback: khoi cuoi cung bat ky (uu tien khoi dung dinh dang)
+    if blocks:
+        fenced_blocks = [block for block in blocks if block.fenced]
+        last_block = fenced_blocks[-1] if fenced_blocks else blocks[-1]
+        if last_block.lang:
+            logger.warning(f"Tim thay khoi code chung voi hint '```{last_block.lang}```. Dung cho '.{requested_extension}'.")
         else:
             logger.warning(f"Tim thay khoi code ```...``` (khong co hint ngon ngu). Gia su dung cho '.{requested_extension}'.")
-        return code_content
+        return last_block.content
 
     lines = raw_text.splitlines()
     is_likely_direct_code = (
@@ -97,11 +75,21 @@ def extract_code_block(raw_text, requested_extension, user_input_for_context="")
     logger.warning(f"Ko tim thay khoi code cho '.{requested_extension}' hoac khoi chung. Tra ve raw text. Raw: '{raw_text[:100]}...'")
     return raw_text.strip()
 
-def execute_fortigate_commands(commands_string, fortigate_config):
-    """Thuc thi lenh tren FortiGate qua Netmiko."""
-    logger = current_app.logger
+# Dau hieu loi trong output lenh FortiGate
+_FGT_ERROR_MARKERS = ("Command fail", "command_cli_error", "Unknown action", "Invalid input")
+_FGT_CONFIG_PREFIXES = ("config ", "edit ", "set ", "unset ", "append ", "delete ")
+
+def _split_fortigate_commands(commands_string):
+    """Tach chuoi lenh thanh list, bo dong rong & comment."""
+    return [cmd.strip() for cmd in commands_string.splitlines() if cmd.strip() and not cmd.strip().startswith('#')]
+
+def _is_config_command(cmd):
+    return cmd.startswith(_FGT_CONFIG_PREFIXES)
+
+def _build_fortigate_device_params(fortigate_config):
+    """Tao dict tham so Netmiko tu fortigate_config. Tra ve (device, loi)."""
     if not fortigate_config or not isinstance(fortigate_config, dict):
-        return {"output": "", "error": "Thiếu cấu hình FortiGate.", "return_code": -1}
+        return None, "Thiếu cấu hình FortiGate."
 
     host = fortigate_config.get('ipHost')
     username = fortigate_config.get('username')
@@ -109,85 +97,340 @@ def execute_fortigate_commands(commands_string, fortigate_config):
     port = fortigate_config.get('portSsh', '22')
 
     if not host or not username:
-        return {"output": "", "error": "Thiếu IP/Hostname hoặc Username cho FortiGate.", "return_code": -1}
+        return None, "Thiếu IP/Hostname hoặc Username cho FortiGate."
 
     try: port = int(port)
     except ValueError:
-        return {"output": "", "error": f"Port SSH không hợp lệ: {port}", "return_code": -1}
-
-    log_file_path = os.path.join(os.path.dirname(__file__), '..', 'logs', 'netmiko_session.log')
-    os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
-
+        return None, f"Port SSH không hợp lệ: {port}"
 
     device = {
         'device_type': 'fortinet', 'host': host, 'username': username, 'password': password, 'port': port,
-        'session_log': log_file_path, 'global_delay_factor': 2,
+        'global_delay_factor': 2,
         'conn_timeout': 30, 'auth_timeout': 30, 'banner_timeout': 30,
     }
+    if current_app.config.get('FGT_SESSION_LOG_ENABLED', False): # Ghi toan bo phien SSH (dong bo) - chi bat khi can debug
+        log_file_path = os.path.join(os.path.dirname(__file__), '..', 'logs', 'netmiko_session.log')
+        os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
+        device['session_log'] = log_file_path
+    return device, None
+
+def _describe_fortigate_exception(e):
+    """Anh xa exception ket noi/thuc thi sang (thong bao loi, return_code)."""
+    if isinstance(e, PoolAcquireTimeout): return f"Lỗi: {e}", -104
+    if isinstance(e, NetmikoTimeoutException): return f"Lỗi Timeout khi kết nối hoặc thực thi lệnh trên FortiGate: {e}", -101
+    if isinstance(e, NetmikoAuthenticationException): return f"Lỗi xác thực với FortiGate (sai Username/Password?): {e}", -102
+    if isinstance(e, SSHException): return f"Lỗi SSH khi kết nối FortiGate (Port SSH đúng? Firewall?): {e}", -103
+    return f"Lỗi không xác định khi thực thi lệnh FortiGate: {e}", -100
+
+def _extract_return_code(output, default_code):
+    match_error_code = re.search(r"Return code (\-?\d+)", output)
+    if match_error_code:
+        try:
+            return int(match_error_code.group(1))
+        except ValueError:
+            pass
+    return default_code
+
+def _run_read_only_command(net_connect, cmd, read_timeout=None):
+    """Chay 1 lenh show/get/diagnose tren phien da mo, tra ve ket qua rieng cua lenh."""
+    prompt_pattern_str = r"\(.+?\) # $"
+    verb = command_verb(cmd)
+    timeout_kwargs = {"read_timeout": read_timeout} if read_timeout is not None else {}
+    with FORTIGATE_COMMAND_DURATION.time(verb=verb, outcome="exception") as metric_labels:
+        current_output = net_connect.send_command(
+            cmd,
+            delay_factor=2,
+            expect_string=prompt_pattern_str if re.search(prompt_pattern_str, net_connect.base_prompt) else None,
+            **timeout_kwargs
+        )
+        error_str, return_code = "", 0
+        if any(marker in current_output for marker in _FGT_ERROR_MARKERS):
+            error_str = f"Loi khi chay '{cmd}': {current_output}\n"
+            return_code = _extract_return_code(current_output, 1)
+        metric_labels["outcome"] = "error" if error_str else "ok"
+    FORTIGATE_COMMAND_OUTPUT_BYTES.observe(len(current_output), verb=verb)
+    return {"command": cmd, "output": current_output, "error": error_str, "return_code": return_code}
+
+def _collect_worker(app, pool, device, work_queue, results):
+    """Worker giu 1 phien SSH, lay lenh tu hang doi chung den khi het."""
+    with app.app_context():
+        if work_queue.empty(): # Cac worker khac da lam het -> ko mo phien thua
+            return None
+        try:
+            with pool.session(device) as net_connect:
+                while True:
+                    try:
+                        idx, cmd = work_queue.get_nowait()
+                    except queue.Empty:
+                        return None
+                    started = time.perf_counter()
+                    try:
+                        cmd_result = _run_read_only_command(net_connect, cmd)
+                    except Exception as e_cmd:
+                        error_str, return_code = _describe_fortigate_exception(e_cmd)
+                        results[idx] = {"command": cmd, "output": "", "error": error_str, "return_code": return_code,
+                                        "duration_ms": round((time.perf_counter() - started) * 1000, 1), "bytes": 0}
+                        raise # Bo phien nay khoi pool
+                    cmd_result["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                    cmd_result["bytes"] = len(cmd_result["output"].encode('utf-8'))
+                    results[idx] = cmd_result
+        except Exception as e:
+            return e
+
+def collect_fortigate_commands(commands_list, fortigate_config, max_parallel=None):
+    """
+    Chay song song cac lenh read-only doc lap tren nhieu phien SSH toi cung thiet bi.
+    Tra ve list ket qua theo dung thu tu lenh: command, output, error, return_code, duration_ms, bytes.
+    """
+    logger = current_app.logger
+    device, config_error = _build_fortigate_device_params(fortigate_config)
+    if config_error:
+        return [{"command": cmd, "output": "", "error": config_error, "return_code": -1, "duration_ms": 0.0, "bytes": 0} for cmd in commands_list]
+    if not commands_list:
+        return []
+
+    pool = get_fortigate_pool()
+    if max_parallel is None:
+        max_parallel = current_app.config.get('FGT_CONTEXT_MAX_PARALLEL', 2)
+    # Ko vuot gioi han phien dong thoi / thiet bi cua pool
+    worker_count = max(1, min(int(max_parallel), pool.max_per_device, len(commands_list)))
+
+    work_queue = queue.Queue()
+    for idx, cmd in enumerate(commands_list):
+        work_queue.put((idx, cmd))
+    results = [None] * len(commands_list)
+
+    started = time.perf_counter()
+    app = current_app._get_current_object()
+    if worker_count == 1:
+        worker_errors = [_collect_worker(app, pool, device, work_queue, results)]
+    else:
+        with ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="fgt-collect") as executor:
+            futures = [executor.submit(_collect_worker, app, pool, device, work_queue, results) for _ in range(worker_count)]
+            worker_errors = [f.result() for f in futures]
+
+    last_error = next((e for e in reversed(worker_errors) if e is not None), None)
+    if last_error is not None:
+        error_str, return_code = _describe_fortigate_exception(last_error)
+        logger.error(error_str, exc_info=return_code == -100)
+        for idx, cmd in enumerate(commands_list):
+            if results[idx] is None: # Lenh chua chay do moi phien deu loi
+                results[idx] = {"command": cmd, "output": "", "error": error_str, "return_code": return_code, "duration_ms": 0.0, "bytes": 0}
+
+    logger.info(
+        f"Thu thap {len(commands_list)} lenh FortiGate voi {worker_count} phien trong {(time.perf_counter() - started):.2f}s: "
+        + ", ".join(f"'{r['command']}' {r['duration_ms']}ms/{r['bytes']}B{' (loi)' if r['error'] else ''}" for r in results)
+    )
+    return results
+
+def _fortigate_stop_reason(cancel_event, deadline):
+    """Ly do dung som (huy / het thoi gian) truoc khi gui lenh tiep theo; None neu duoc chay tiep."""
+    if cancel_event is not None and cancel_event.is_set():
+        return "Cancelled"
+    if deadline is not None and time.monotonic() >= deadline:
+        return "Timeout"
+    return None
+
+def execute_fortigate_commands(commands_string, fortigate_config, cancel_event=None, timeout_seconds=None):
+    """
+    Thuc thi lenh tren FortiGate qua Netmiko.
+    cancel_event / timeout_seconds (job): kiem tra truoc moi lenh, read_timeout moi lenh ko vuot thoi gian con lai;
+    dung som -> ket qua co 'error_type' ('Cancelled' / 'Timeout') va output cac lenh da chay.
+    """
+    logger = current_app.logger
+    device, config_error = _build_fortigate_device_params(fortigate_config)
+    if config_error:
+        return {"output": "", "error": config_error, "return_code": -1}
+
     output_str, error_str, return_code = "", "", 0
-    commands_list = [cmd.strip() for cmd in commands_string.splitlines() if cmd.strip() and not cmd.strip().startswith('#')]
+    commands_list = _split_fortigate_commands(commands_string)
     if not commands_list:
         return {"output": "Không có lệnh hợp lệ để thực thi.", "error": "", "return_code": 0}
 
+    deadline = time.monotonic() + float(timeout_seconds) if timeout_seconds else None
+    remaining = lambda: max(1.0, deadline - time.monotonic()) if deadline is not None else None
+    stop_reason = None
+    full_output = [] # Output tung lenh read-only (giu lai khi loi/dung giua chung)
+    is_config_mode_likely = any(_is_config_command(cmd) for cmd in commands_list)
     try:
-        logger.info(f"Dang ket noi toi FortiGate: {host}:{port} voi user: {username}")
-        with ConnectHandler(**device) as net_connect:
-            logger.info("Ket noi FortiGate thanh cong.")
-            is_config_mode_likely = any(cmd.startswith(("config ", "edit ", "set ", "unset ", "append ", "delete ")) for cmd in commands_list)
-
-            if is_config_mode_likely:
+        logger.info(f"Dang lay phien SSH (pool) toi FortiGate: {device['host']}:{device['port']} voi user: {device['username']}")
+        # Phien da chay lenh config co the con ket trong ngu canh 'config ...' -> ko tra lai pool
+        with get_fortigate_pool().session(device, reusable=not is_config_mode_likely) as net_connect:
+            logger.info("Ket noi FortiGate san sang.")
+            stop_reason = _fortigate_stop_reason(cancel_event, deadline)
+
+            if stop_reason:
+                logger.info(f"Ko gui lenh FortiGate: {stop_reason} truoc khi bat dau.")
+            elif is_config_mode_likely:
                 logger.info("Phat hien lenh config, su dung send_config_set.")
-                output_str = net_connect.send_config_set(commands_list, exit_config_mode=True, delay_factor=2, cmd_verify=False)
+                # Bo lenh config gui 1 lan (ko dung giua chung de tranh cau hinh dang do)
+                timeout_kwargs = {"read_timeout": remaining()} if deadline is not None else {}
+                with FORTIGATE_COMMAND_DURATION.time(verb="config", outcome="exception") as metric_labels:
+                    output_str = net_connect.send_config_set(commands_list, exit_config_mode=True, delay_factor=2, cmd_verify=False, **timeout_kwargs)
+                    metric_labels["outcome"] = "ok"
                 if "Command fail" in output_str or "error" in output_str.lower() or "Invalid" in output_str:
                     if not (len(commands_list) == 1 and commands_list[0].strip() == output_str.strip()):
                         error_str = output_str
-                        return_code = 1
-                        match_error_code = re.search(r"Return code (\-?\d+)", output_str)
-                        if match_error_code:
-                            try:
-                                return_code = int(match_error_code.group(1))
-                            except ValueError:
-                                pass
+                        return_code = _extract_return_code(output_str, 1)
                         logger.warning(f"Loi khi thuc thi config tren FortiGate: {output_str}")
                 else: logger.info(f"Ket qua config FortiGate:\n{output_str}")
             else:
                 logger.info("Chi co lenh show/get/diagnose, su dung send_command cho tung lenh.")
-                full_output = []
                 for cmd in commands_list:
-                    prompt_pattern_str = r"\(.+?\) # $"
-                    current_output = net_connect.send_command(
-                        cmd,
-                        delay_factor=2,
-                        expect_string=prompt_pattern_str if re.search(prompt_pattern_str, net_connect.base_prompt) else None
-                    )
-                    full_output.append(f"$ {cmd}\n{current_output}\n")
-                    if "Command fail" in current_output or "command_cli_error" in current_output or "Unknown action" in current_output or "Invalid input" in current_output:
-                         error_str += f"Loi khi chay '{cmd}': {current_output}\n"
-                         return_code = 1
-                         match_error_code = re.search(r"Return code (\-?\d+)", current_output)
-                         if match_error_code:
-                            try:
-                                return_code = int(match_error_code.group(1))
-                            except ValueError:
-                                pass
+                    stop_reason = _fortigate_stop_reason(cancel_event, deadline)
+                    if stop_reason:
+                        break
+                    cmd_result = _run_read_only_command(net_connect, cmd, read_timeout=remaining())
+                    full_output.append(f"$ {cmd}\n{cmd_result['output']}\n")
+                    if cmd_result["error"]:
+                        error_str += cmd_result["error"]
+                        return_code = cmd_result["return_code"]
                 output_str = "\n".join(full_output)
                 if return_code == 0: logger.info(f"Ket qua lenh FortiGate:\n{output_str}")
                 else: logger.warning(f"Loi khi thuc thi lenh FortiGate: {error_str}")
-    except NetmikoTimeoutException as e: error_str, return_code = f"Lỗi Timeout khi kết nối hoặc thực thi lệnh trên FortiGate: {e}", -101; logger.error(error_str)
-    except NetmikoAuthenticationException as e: error_str, return_code = f"Lỗi xác thực với FortiGate (sai Username/Password?): {e}", -102; logger.error(error_str)
-    except SSHException as e: error_str, return_code = f"Lỗi SSH khi kết nối FortiGate (Port SSH đúng? Firewall?): {e}", -103; logger.error(error_str)
-    except Exception as e: error_str, return_code = f"Lỗi không xác định khi thực thi lệnh FortiGate: {e}", -100; logger.error(error_str, exc_info=True)
+    except Exception as e:
+        error_str, return_code = _describe_fortigate_exception(e)
+        output_str = output_str or "\n".join(full_output)
+        if deadline is not None and time.monotonic() >= deadline and return_code in (-100, -101):
+            stop_reason = "Timeout" # ReadTimeout do read_timeout bi gioi han theo thoi gian con lai
+        logger.error(error_str, exc_info=return_code == -100 and not stop_reason)
+    finally:
+        if is_config_mode_likely:
+            # Cau hinh co the da doi -> bo ngu canh cache & chi muc cau hinh cua thiet bi nay
+            invalidate_fortigate_context_cache(fortigate_config)
+            get_config_index_store().invalidate(_context_snapshot_key(device))
+            get_route_table_store().invalidate(_context_snapshot_key(device))
+    if stop_reason:
+        stop_message = "Đã hủy thực thi lệnh FortiGate theo yêu cầu." if stop_reason == "Cancelled" else \
+                       f"Thực thi lệnh FortiGate vượt quá thời gian cho phép ({timeout_seconds}s)."
+        logger.warning(f"Dung thuc thi lenh FortiGate som: {stop_reason}.")
+        return {"output": output_str, "error": (error_str + "\n" if error_str else "") + stop_message,
+                "return_code": -1, "error_type": stop_reason, "message": stop_message}
     return {"output": output_str, "error": error_str, "return_code": return_code}
 
-def fetch_and_save_fortigate_context(fortigate_config, commands_to_fetch=None):
+def fortigate_device_key(fortigate_config):
+    """Khoa thiet bi (host, port, user, digest mat khau) cho cac kho theo thiet bi; None neu thieu cau hinh."""
+    device, config_error = _build_fortigate_device_params(fortigate_config)
+    return None if config_error else _context_snapshot_key(device)
+
+def _fetch_long_output(fortigate_config, command, read_timeout):
+    """Lay output rat dai cua 1 lenh read-only (1 phien pool, timeout dai). Tra ve (noi dung, loi)."""
+    device, config_error = _build_fortigate_device_params(fortigate_config)
+    if config_error:
+        return "", config_error
+    verb = command_verb(command)
+    try:
+        with get_fortigate_pool().session(device) as net_connect:
+            with FORTIGATE_COMMAND_DURATION.time(verb=verb, outcome="exception") as metric_labels:
+                output = net_connect.send_command(command, read_timeout=read_timeout)
+                metric_labels["outcome"] = "ok"
+        FORTIGATE_COMMAND_OUTPUT_BYTES.observe(len(output), verb=verb)
+    except Exception as e:
+        return "", _describe_fortigate_exception(e)[0]
+    if any(marker in output[:200] for marker in _FGT_ERROR_MARKERS): # Chi xet dau output (replacemsg co the chua cac chuoi nay)
+        return "", f"'{command}' thất bại: {output[:200]}"
+    return output, None
+
+def fetch_fortigate_full_configuration(fortigate_config):
+    """Lay 'show full-configuration'. Tra ve (noi dung, loi)."""
+    return _fetch_long_output(fortigate_config, "show full-configuration", current_app.config.get('FGT_CONFIG_INDEX_FETCH_TIMEOUT', 120))
+
+def fetch_fortigate_routing_table(fortigate_config):
+    """Lay 'get router info routing-table all' (co the hang chuc nghin dong). Tra ve (noi dung, loi)."""
+    return _fetch_long_output(fortigate_config, ROUTING_TABLE_COMMAND, current_app.config.get('FGT_ROUTE_TABLE_FETCH_TIMEOUT', 120))
+
+# --- Cache ngu canh FortiGate (theo thiet bi + lenh) ---
+_fortigate_context_cache = None
+_fortigate_context_cache_lock = threading.Lock()
+
+def get_fortigate_context_cache():
+    """Lay cache ngu canh dung chung (khoi tao lan dau tu app.config)."""
+    global _fortigate_context_cache
+    if _fortigate_context_cache is None:
+        with _fortigate_context_cache_lock:
+            if _fortigate_context_cache is None:
+                _fortigate_context_cache = TTLCache(
+                    max_entries=current_app.config.get('FGT_CONTEXT_CACHE_MAX_ENTRIES', 256),
+                    default_ttl=current_app.config.get('FGT_CONTEXT_CACHE_DEFAULT_TTL', 60),
+                )
+    return _fortigate_context_cache
+
+def _context_cache_ttl(cmd):
+    """TTL cho 1 lenh theo FGT_CONTEXT_CACHE_TTLS (prefix khop dau tien)."""
+    cmd_lower = cmd.lower()
+    for prefix, ttl in current_app.config.get('FGT_CONTEXT_CACHE_TTLS', []):
+        if cmd_lower.startswith(prefix.lower()):
+            return ttl
+    return current_app.config.get('FGT_CONTEXT_CACHE_DEFAULT_TTL', 60)
+
+def _context_cache_key(device, cmd):
+    # Chi chuan hoa khoang trang: ten object FortiOS phan biet hoa/thuong ("Web" != "web")
+    return get_fortigate_pool().make_key(device) + (secret_digest(device), " ".join(cmd.split()))
+
+def invalidate_fortigate_context_cache(fortigate_config):
+    """Xoa moi entry cache ngu canh cua 1 thiet bi (VD sau khi chay lenh config)."""
+    device, config_error = _build_fortigate_device_params(fortigate_config)
+    if config_error:
+        return 0
+    device_key = get_fortigate_pool().make_key(device)
+    removed = get_fortigate_context_cache().invalidate_where(lambda k: k[:3] == device_key)
+    if removed:
+        current_app.logger.info(f"Da xoa {removed} entry cache ngu canh cua {device_key[0]}:{device_key[1]}.")
+    return removed
+
+def _context_snapshot_key(device):
+    return get_fortigate_pool().make_key(device) + (secret_digest(device),)
+
+def _record_context_snapshot(device, context_content):
+    """Ghi phien ban ngu canh cua thiet bi (trung phien ban moi nhat -> dung lai)."""
+    snapshot = get_context_snapshot_store().record(_context_snapshot_key(device), context_content)
+    current_app.logger.info(f"Ngu canh {device['host']}:{device['port']} la phien ban v{snapshot.version}.")
+    return snapshot
+
+def build_fortigate_context_delta(fortigate_config, snapshot, base_version, base_digest=None):
+    """
+    Ngu canh 'tom tat baseline + delta' cua snapshot so voi base_version (phien ban model da thay, noi dung base_digest).
+    Tra ve None khi nen gui ban day du (ko co snapshot/base, tat delta, delta ko du nho).
+    """
+    cfg = current_app.config
+    if snapshot is None or base_version is None or not cfg.get('FGT_CONTEXT_DELTA_ENABLED', True):
+        return None
+    device, config_error = _build_fortigate_device_params(fortigate_config)
+    if config_error:
+        return None
+    try:
+        base_version = int(base_version)
+    except (TypeError, ValueError):
+        return None
+    delta_text = get_context_snapshot_store().build_delta(
+        _context_snapshot_key(device), snapshot, base_version,
+        max_ratio=cfg.get('FGT_CONTEXT_DELTA_MAX_RATIO', 0.6), summary_lines=cfg.get('FGT_CONTEXT_DELTA_SUMMARY_LINES', 5),
+        base_digest=base_digest,
+    )
+    if delta_text is None:
+        current_app.logger.info(f"Ngu canh v{snapshot.version}: ko dung delta so voi v{base_version}, gui ban day du.")
+    else:
+        current_app.logger.info(f"Ngu canh v{snapshot.version}: gui delta so voi v{base_version} ({len(delta_text)}/{len(snapshot.text)} ky tu).")
+    return delta_text
+
+@timed_stage("fortigate_context")
+def fetch_and_save_fortigate_context(fortigate_config, commands_to_fetch=None, bypass_cache=False, return_snapshot=False):
     """
     Lay ngu canh FortiGate, luu file log & tra ve noi dung.
+    Ket qua tung lenh read-only duoc cache theo thiet bi (TTL theo loai lenh).
+    Ngu canh lay thanh cong duoc danh phien ban theo thiet bi; return_snapshot=True -> tra ve
+    (noi dung, ContextSnapshot hoac None).
     """
+    if not return_snapshot:
+        return _fetch_and_save_fortigate_context(fortigate_config, commands_to_fetch, bypass_cache)[0]
+    return _fetch_and_save_fortigate_context(fortigate_config, commands_to_fetch, bypass_cache)
+
+def _fetch_and_save_fortigate_context(fortigate_config, commands_to_fetch, bypass_cache):
     logger = current_app.logger
     if not fortigate_config or not isinstance(fortigate_config, dict):
         # Ko raise error o day de route co the xu ly, chi log
         logger.error("fetch_and_save_fortigate_context: Thieu hoac cau hinh FortiGate khong hop le.")
-        return "Lỗi: Thiếu cấu hình FortiGate để lấy ngữ cảnh."
+        return "Lỗi: Thiếu cấu hình FortiGate để lấy ngữ cảnh.", None
 
     # Su dung commands_to_fetch neu dc cung cap, ko thi fallback DEFAULT_FORTIGATE_CONTEXT_COMMANDS
     effective_commands = commands_to_fetch
@@ -197,7 +440,7 @@ def fetch_and_save_fortigate_context(fortigate_config, commands_to_fetch=None):
     
     if not effective_commands: # Van ko co lenh nao (VD: default cung rong)
          logger.warning("fetch_and_save_fortigate_context: Khong co lenh nao de thuc thi (ca cung cap va default).")
-         return "Thông báo: Không có lệnh nào được chọn để lấy ngữ cảnh FortiGate."
+         return "Thông báo: Không có lệnh nào được chọn để lấy ngữ cảnh FortiGate.", None
 
 
     commands_string = "\n".join(effective_commands)
@@ -207,8 +450,48 @@ def fetch_and_save_fortigate_context(fortigate_config, commands_to_fetch=None):
     else: # Log 1 phan neu nhieu
         logger.info(f"Cac lenh (mot phan):\n{commands_string[:500]}...")
 
+    commands_list = _split_fortigate_commands(commands_string)
+    device, config_error = _build_fortigate_device_params(fortigate_config)
+    read_only = not config_error and commands_list and not any(_is_config_command(cmd) for cmd in commands_list)
+
+    all_from_cache = False
+    if read_only:
+        # bypass_cache: chi bo qua doc cache, van lay song song & ghi lai cache
+        cache = get_fortigate_context_cache()
+        cmd_results = [None] * len(commands_list)
+        missing_indexes = []
+        for idx, cmd in enumerate(commands_list):
+            cached_result = None if bypass_cache else cache.get(_context_cache_key(device, cmd))
+            if cached_result is not None:
+                cmd_results[idx] = cached_result
+            else:
+                missing_indexes.append(idx)
 
-    result = execute_fortigate_commands(commands_string, fortigate_config)
+        if bypass_cache:
+            logger.info(f"Bo qua cache ngu canh theo yeu cau, lay moi {len(missing_indexes)} lenh.")
+        else:
+            logger.info(f"Cache ngu canh: {len(commands_list) - len(missing_indexes)} hit, {len(missing_indexes)} miss.")
+        if missing_indexes:
+            fresh_results = collect_fortigate_commands([commands_list[i] for i in missing_indexes], fortigate_config)
+            for idx, cmd_result in zip(missing_indexes, fresh_results):
+                cmd_results[idx] = cmd_result
+                if not cmd_result["error"] and cmd_result["return_code"] == 0:
+                    cache.set(_context_cache_key(device, cmd_result["command"]), cmd_result, ttl=_context_cache_ttl(cmd_result["command"]))
+                    if is_routing_table_command(cmd_result["command"]): # Dung luon bang tra cuu route
+                        get_route_table_store().record_output(_context_snapshot_key(device), cmd_result["output"])
+        else:
+            all_from_cache = True
+
+        error_messages = []
+        for cmd_result in cmd_results:
+            if cmd_result["error"] and cmd_result["error"] not in error_messages:
+                error_messages.append(cmd_result["error"])
+        result = {
+            "output": "\n".join(f"$ {r['command']}\n{r['output']}\n" for r in cmd_results if r["output"] or not r["error"]),
+            "error": "".join(msg if msg.endswith("\n") else msg + "\n" for msg in error_messages).strip(),
+        }
+    else:
+        result = execute_fortigate_commands(commands_string, fortigate_config)
 
     context_content = ""
     if result["error"]:
@@ -222,132 +505,265 @@ def fetch_and_save_fortigate_context(fortigate_config, commands_to_fetch=None):
         context_content = "Khong lay duoc thong tin ngu canh nao tu FortiGate."
         logger.warning("Khong co output nao tu viec lay ngu canh FortiGate.")
 
-    project_log_dir = os.path.abspath(os.path.join(current_app.root_path, '..', 'logs'))
+    # Chi danh phien ban ngu canh lay tron ven (loi ket noi se tao delta gia)
+    snapshot = _record_context_snapshot(device, context_content) if not config_error and not result["error"] and result["output"] else None
 
-    if not os.path.exists(project_log_dir):
-        try:
-            os.makedirs(project_log_dir)
-            logger.info(f"Da tao thu muc log du an: {project_log_dir}")
-        except OSError as e:
-            logger.error(f"Khong the tao thu muc log du an '{project_log_dir}': {e}")
-            return context_content
+    if all_from_cache:
+        # Noi dung ko doi so voi snapshot truoc -> ko ghi file moi
+        logger.info("Toan bo ngu canh lay tu cache, bo qua ghi snapshot.")
+        return context_content, snapshot
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    context_file_path = os.path.join(project_log_dir, f"fortigate_context_{timestamp}.txt")
+    try:
+        # Kho snapshot nen, dinh danh theo noi dung (trung lap chi cap nhat chi muc)
+        snapshot_id = get_context_snapshot_archive().put(
+            device_label(fortigate_config), effective_commands, context_content,
+            target=fortigate_config.get('ipHost'), username=fortigate_config.get('username'),
+            version=snapshot.version if snapshot else None
+        )
+        logger.info(f"Da luu ngu canh FortiGate vao kho snapshot (id {snapshot_id}).")
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Khong the luu ngu canh FortiGate vao kho snapshot: {e}")
+
+    return context_content, snapshot
+
+# Giu N dong cuoi cua 1 stream output (ring buffer)
+class _BoundedStreamBuffer:
+    """Ring buffer dong output, dem tong so dong/byte da nhan."""
+
+    def __init__(self, max_lines):
+        self.lines = deque(maxlen=max(1, int(max_lines)))
+        self.total_lines = 0
+        self.total_bytes = 0
+
+    def append(self, line):
+        self.total_lines += 1
+        self.total_bytes += len(line.encode('utf-8', errors='replace'))
+        self.lines.append(line)
+
+    @property
+    def dropped_lines(self):
+        return self.total_lines - len(self.lines)
+
+    def text(self):
+        body = "".join(self.lines)
+        if self.dropped_lines:
+            body = f"[... đã lược bỏ {self.dropped_lines} dòng đầu, chỉ giữ {len(self.lines)} dòng cuối ...]\n" + body
+        return body
+
+def _pump_pipe(pipe, stream_name, out_queue, max_line_chars, stop_event):
+    """Thread doc tung dong tu pipe, day vao hang doi (co backpressure)."""
+    def put(item):
+        while True:
+            try:
+                out_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                if stop_event.is_set():
+                    return False
+    try:
+        for line in iter(pipe.readline, ''):
+            if len(line) > max_line_chars:
+                line = line[:max_line_chars] + " [... dòng quá dài, đã cắt]\n"
+            if not put((stream_name, line, datetime.now().isoformat())):
+                return
+    except (ValueError, OSError):
+        pass # Pipe da dong (process bi kill)
+    finally:
+        try: pipe.close()
+        except Exception: pass
+        put((stream_name, None, None))
 
+def _kill_process(process):
     try:
-        with open(context_file_path, 'w', encoding='utf-8') as f:
-            f.write(f"--- FortiGate Context Snapshot at {timestamp} ---\n")
-            f.write(f"Target: {fortigate_config.get('ipHost', 'N/A')}\n")
-            f.write(f"User: {fortigate_config.get('username', 'N/A')}\n") # Them username
-            f.write(f"--- Commands Executed ({len(effective_commands)} commands) ---\n")
-            f.write(commands_string + "\n")
-            f.write("--- Output ---\n")
-            f.write(context_content)
-        logger.info(f"Da luu ngu canh FortiGate vao: {context_file_path}")
-    except IOError as e:
-        logger.error(f"Khong the ghi file ngu canh FortiGate '{context_file_path}': {e}")
-
-    return context_content
+        process.kill()
+    except Exception:
+        pass
 
-def execute_local_script(code_to_execute, file_extension, run_as_admin):
-    """Thuc thi script local (py, sh, bat, ps1)."""
+def _prepare_local_command(code_to_execute, file_extension, run_as_admin, backend_os):
+    """Ghi code ra file tam & dung lenh chay. Tra ve (temp_file_path, command, admin_warning)."""
     logger = current_app.logger
+    admin_warning = None
+    with tempfile.NamedTemporaryFile(mode='w', suffix=f'.{file_extension}', delete=False, encoding='utf-8', newline='') as temp_file:
+        temp_file_path = temp_file.name
+        temp_file.write(code_to_execute)
+    logger.info(f"Da luu code vao file tam: {temp_file_path}")
+
+    if backend_os in ["linux", "macos"] and file_extension in ['sh', 'py']:
+        try:
+            current_stat = os.stat(temp_file_path).st_mode
+            os.chmod(temp_file_path, current_stat | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+            logger.info(f"Da cap quyen thuc thi (chmod +x) cho: {temp_file_path}")
+        except Exception as chmod_e:
+            logger.error(f"Ko the cap quyen thuc thi file tam: {chmod_e}")
+
+    interpreter_path = sys.executable
+    command_map = {
+        'py': [interpreter_path, temp_file_path],
+        'bat': {'windows': ['cmd', '/c', temp_file_path]},
+        'ps1': {'windows': ['powershell', '-NoProfile', '-ExecutionPolicy', 'Bypass', '-File', temp_file_path]},
+        'sh':  {'linux': ['bash', temp_file_path], 'macos': ['bash', temp_file_path]}
+    }
+    command = command_map.get(file_extension)
+    if isinstance(command, dict):
+        command = command.get(backend_os)
+
+    if not command:
+        if backend_os == 'windows': command = ['cmd', '/c', temp_file_path]
+        else: command = ['bash', temp_file_path]
+        logger.warning(f"Loai file '.{file_extension}' ko xd ro tren {backend_os}, thu chay bang {'cmd /c' if backend_os == 'windows' else 'bash'}.")
+
+    if run_as_admin:
+        if backend_os == "windows":
+            try:
+                is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
+                if not is_admin:
+                    admin_warning = "Yeu cau Admin, nhung backend ko co quyen. Thuc thi quyen thuong."
+            except Exception as admin_check_e:
+                admin_warning = f"Ko the check admin ({admin_check_e}). Thuc thi quyen thuong."
+        elif backend_os in ["linux", "darwin"]: # darwin la macos
+            try:
+                subprocess.run(['which', 'sudo'], check=True, capture_output=True, text=True, errors='ignore')
+                command.insert(0, 'sudo')
+            except (FileNotFoundError, subprocess.CalledProcessError):
+                 admin_warning = "Yeu cau Root, nhung ko tim thay 'sudo'. Thuc thi quyen thuong."
+            except Exception as sudo_check_e:
+                 admin_warning = f"Loi khi check sudo ({sudo_check_e}). Thuc thi quyen thuong."
+        else:
+            admin_warning = f"Yeu cau 'Admin/Root' ko ho tro tren HDH ({backend_os}). Thuc thi quyen thuong."
+        if admin_warning: logger.warning(f"{admin_warning}")
+    return temp_file_path, command, admin_warning
+
+def _metric_extension(file_extension):
+    ext = (file_extension or "").lower()
+    return ext if ext in ('py', 'sh', 'bat', 'ps1') else "other"
+
+def stream_local_script(code_to_execute, file_extension, run_as_admin, timeout_seconds=None, cancel_event=None):
+    """
+    Thuc thi script local (py, sh, bat, ps1) dang generator.
+    Phat {'type': 'output', 'stream', 'line', 'timestamp'} cho tung dong stdout/stderr ngay khi co,
+    ket thuc bang {'type': 'result', 'result': {...}} (cung dinh dang voi execute_local_script).
+    Moi stream chi giu toi da SCRIPT_OUTPUT_MAX_LINES dong cuoi trong bo nho.
+    """
+    logger = current_app.logger
+    cfg = current_app.config
+    timeout_seconds = timeout_seconds or cfg.get('SCRIPT_TIMEOUT_SECONDS', 60)
+    max_lines = cfg.get('SCRIPT_OUTPUT_MAX_LINES', 2000)
+    max_line_chars = cfg.get('SCRIPT_OUTPUT_MAX_LINE_CHARS', 4000)
+
     logger.info(f"--- CANH BAO: Chuan bi thuc thi code file .{file_extension} (Admin/Root: {run_as_admin}) ---")
     temp_file_path = None
     admin_warning = None
+    process = None
+    stop_event = threading.Event()
+    buffers = {"stdout": _BoundedStreamBuffer(max_lines), "stderr": _BoundedStreamBuffer(max_lines)}
     backend_os = get_os_name()
 
     try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix=f'.{file_extension}', delete=False, encoding='utf-8', newline='') as temp_file:
-            temp_file_path = temp_file.name
-            temp_file.write(code_to_execute)
-        logger.info(f"Da luu code vao file tam: {temp_file_path}")
-
-        if backend_os in ["linux", "macos"] and file_extension in ['sh', 'py']:
-            try:
-                current_stat = os.stat(temp_file_path).st_mode
-                os.chmod(temp_file_path, current_stat | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-                logger.info(f"Da cap quyen thuc thi (chmod +x) cho: {temp_file_path}")
-            except Exception as chmod_e:
-                logger.error(f"Ko the cap quyen thuc thi file tam: {chmod_e}")
-
-        import sys
-        interpreter_path = sys.executable
-        command_map = {
-            'py': [interpreter_path, temp_file_path],
-            'bat': {'windows': ['cmd', '/c', temp_file_path]},
-            'ps1': {'windows': ['powershell', '-NoProfile', '-ExecutionPolicy', 'Bypass', '-File', temp_file_path]},
-            'sh':  {'linux': ['bash', temp_file_path], 'macos': ['bash', temp_file_path]}
-        }
-        command = command_map.get(file_extension)
-        if isinstance(command, dict):
-            command = command.get(backend_os)
-
-        if not command:
-            if backend_os == 'windows': command = ['cmd', '/c', temp_file_path]
-            else: command = ['bash', temp_file_path]
-            logger.warning(f"Loai file '.{file_extension}' ko xd ro tren {backend_os}, thu chay bang {'cmd /c' if backend_os == 'windows' else 'bash'}.")
-
-        if run_as_admin:
-            if backend_os == "windows":
-                try:
-                    is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
-                    if not is_admin:
-                        admin_warning = "Yeu cau Admin, nhung backend ko co quyen. Thuc thi quyen thuong."
-                except Exception as admin_check_e:
-                    admin_warning = f"Ko the check admin ({admin_check_e}). Thuc thi quyen thuong."
-            elif backend_os in ["linux", "darwin"]: # darwin la macos
-                try:
-                    subprocess.run(['which', 'sudo'], check=True, capture_output=True, text=True, errors='ignore')
-                    command.insert(0, 'sudo')
-                except (FileNotFoundError, subprocess.CalledProcessError):
-                     admin_warning = "Yeu cau Root, nhung ko tim thay 'sudo'. Thuc thi quyen thuong."
-                except Exception as sudo_check_e:
-                     admin_warning = f"Loi khi check sudo ({sudo_check_e}). Thuc thi quyen thuong."
-            else:
-                admin_warning = f"Yeu cau 'Admin/Root' ko ho tro tren HDH ({backend_os}). Thuc thi quyen thuong."
-            if admin_warning: logger.warning(f"{admin_warning}")
+        temp_file_path, command, admin_warning = _prepare_local_command(code_to_execute, file_extension, run_as_admin, backend_os)
 
         logger.info(f"Chuan bi chay lenh: {' '.join(shlex.quote(str(c)) for c in command)}")
         process_env = os.environ.copy()
         process_env["PYTHONIOENCODING"] = "utf-8"
 
-        result = subprocess.run(
-            command, capture_output=True, encoding='utf-8', errors='replace',
-            timeout=60, check=False, env=process_env, text=True
+        started = time.monotonic()
+        deadline = started + float(timeout_seconds)
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+            encoding='utf-8', errors='replace', text=True, bufsize=1, env=process_env
         )
+        out_queue = queue.Queue(maxsize=1000)
+        for pipe, stream_name in ((process.stdout, "stdout"), (process.stderr, "stderr")):
+            threading.Thread(target=_pump_pipe, args=(pipe, stream_name, out_queue, max_line_chars, stop_event), daemon=True).start()
+
+        open_streams = 2
+        timed_out = False
+        cancelled = False
+        while open_streams:
+            if cancel_event is not None and cancel_event.is_set():
+                cancelled = True
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            try:
+                stream_name, line, line_ts = out_queue.get(timeout=min(0.5, remaining))
+            except queue.Empty:
+                continue
+            if line is None:
+                open_streams -= 1
+                continue
+            buffers[stream_name].append(line)
+            yield {"type": "output", "stream": stream_name, "line": line, "timestamp": line_ts}
 
-        logger.info(f"--- Ket qua thuc thi (Ma tra ve: {result.returncode}) ---")
-        if result.stdout: logger.info(f"Output:\n{result.stdout}")
-        if result.stderr: logger.info(f"Loi Output:\n{result.stderr}")
-
-        message = "Thực thi file thành công." if result.returncode == 0 else "Thực thi file hoàn tất (có thể có lỗi)."
+        if not (timed_out or cancelled):
+            try:
+                process.wait(timeout=max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                timed_out = True
+        if timed_out or cancelled:
+            _kill_process(process)
+            process.wait()
+
+        duration = time.monotonic() - started
+        stdout_text = buffers["stdout"].text()
+        stderr_text = buffers["stderr"].text()
+        logger.info(
+            f"--- Ket qua thuc thi (Ma tra ve: {process.returncode}, {duration:.2f}s, "
+            f"stdout {buffers['stdout'].total_lines} dong/{buffers['stdout'].total_bytes}B, "
+            f"stderr {buffers['stderr'].total_lines} dong/{buffers['stderr'].total_bytes}B) ---"
+        )
+        if stdout_text: logger.info(f"Output:\n{stdout_text}")
+        if stderr_text: logger.info(f"Loi Output:\n{stderr_text}")
+        script_outcome = "timeout" if timed_out else "cancelled" if cancelled else ("ok" if process.returncode == 0 else "nonzero_exit")
+        SCRIPT_EXECUTION_DURATION.observe(duration, extension=_metric_extension(file_extension), outcome=script_outcome)
+        SCRIPT_OUTPUT_BYTES.observe(buffers['stdout'].total_bytes, stream="stdout")
+        SCRIPT_OUTPUT_BYTES.observe(buffers['stderr'].total_bytes, stream="stderr")
+
+        if timed_out:
+            logger.error(f"Loi: Thuc thi file qua thoi gian ({timeout_seconds}s).")
+            yield {"type": "result", "result": {"error_type": "Timeout", "message": "Thực thi file vượt quá thời gian cho phép.", "output": stdout_text, "error_detail": "Timeout", "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}}
+            return
+        if cancelled:
+            logger.warning("Thuc thi file da bi huy theo yeu cau.")
+            yield {"type": "result", "result": {"error_type": "Cancelled", "message": "Thực thi file đã bị hủy.", "output": stdout_text, "error_detail": "Cancelled", "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}}
+            return
+
+        message = "Thực thi file thành công." if process.returncode == 0 else "Thực thi file hoàn tất (có thể có lỗi)."
         response_data = {
-            "message": message, "output": result.stdout, "error": result.stderr, "return_code": result.returncode,
+            "message": message, "output": stdout_text, "error": stderr_text, "return_code": process.returncode,
             "executed_file_type": file_extension,
             "codeThatFailed": code_to_execute
         }
         if admin_warning: response_data["warning"] = admin_warning
-        return response_data
+        yield {"type": "result", "result": response_data}
 
-    except subprocess.TimeoutExpired:
-        logger.error("Loi: Thuc thi file qua thoi gian (60s).")
-        return {"error_type": "Timeout", "message": "Thực thi file vượt quá thời gian cho phép.", "output": "", "error_detail": "Timeout", "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}
     except FileNotFoundError as fnf_error:
         missing_cmd = str(fnf_error)
         err_msg = f"Lỗi hệ thống: Không tìm thấy lệnh '{missing_cmd}' de chay file .{file_extension}."
         if 'sudo' in missing_cmd and run_as_admin and backend_os != "windows":
              err_msg = "Lỗi hệ thống: Lệnh 'sudo' không được tìm thấy. Không thể chạy với quyền root."
         logger.error(f"{err_msg}")
-        return {"error_type": "FileNotFound", "message": err_msg, "output": "", "error_detail": f"FileNotFoundError: {missing_cmd}", "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}
+        yield {"type": "result", "result": {"error_type": "FileNotFound", "message": err_msg, "output": "", "error_detail": f"FileNotFoundError: {missing_cmd}", "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}}
     except Exception as e:
         logger.error(f"Loi nghiem trong khi thuc thi file tam: {e}", exc_info=True)
-        return {"error_type": "Exception", "message": f"Lỗi hệ thống khi thực thi file: {e}", "output": "", "error_detail": str(e), "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}
+        yield {"type": "result", "result": {"error_type": "Exception", "message": f"Lỗi hệ thống khi thực thi file: {e}", "output": "", "error_detail": str(e), "return_code": -1, "warning": admin_warning, "codeThatFailed": code_to_execute}}
     finally:
+        stop_event.set()
+        if process is not None and process.poll() is None:
+            # Client ngat ket noi giua chung -> ko de process mo coi
+            _kill_process(process)
         if temp_file_path and os.path.exists(temp_file_path):
             try:
                 os.remove(temp_file_path)
                 logger.info(f"Da xoa file tam: {temp_file_path}")
             except Exception as cleanup_e:
-                logger.error(f"Ko the xoa file tam {temp_file_path}: {cleanup_e}")
\ No newline at end of file
+                logger.error(f"Ko the xoa file tam {temp_file_path}: {cleanup_e}")
+
+def execute_local_script(code_to_execute, file_extension, run_as_admin):
+    """Thuc thi script local (py, sh, bat, ps1)."""
+    result = None
+    for event in stream_local_script(code_to_execute, file_extension, run_as_admin):
+        if event["type"] == "result":
+            result = event["result"]
+    return result
@@ -0,0 +1,395 @@
+# backend/fleet_utils.py
+import os
+import re
+import json
+import time
+import queue
+import difflib
+import hashlib
+import threading
+from collections import deque
+from datetime import datetime
+from flask import current_app
+
+from .execution_utils import execute_fortigate_commands, fortigate_device_key
+from .metrics_utils import FORTIGATE_FLEET_DEVICE_RUNS, FORTIGATE_FLEET_RUN_DURATION
+
+_DEVICE_NAME_RE = re.compile(r"^[\w.\-]{1,64}$")
+_DEVICE_FIELDS = ("ipHost", "portSsh", "username", "password")
+_STORED_FIELDS = ("ipHost", "portSsh", "username", "password_env") # Ghi ra file: ko co mat khau
+_ENV_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]{0,127}$")
+
+# Trang thai tung thiet bi trong 1 lan chay fleet
+DEVICE_OK = "ok"
+DEVICE_ERROR = "error"
+DEVICE_TIMEOUT = "timeout"
+DEVICE_CANCELLED = "cancelled"
+
+
+class FleetInventoryError(ValueError):
+    """Du lieu thiet bi trong inventory ko hop le."""
+
+
+class FleetInventory:
+    """
+    Danh sach FortiGate cua fleet (ten -> ipHost, portSsh, username, password_env, tags), luu file JSON.
+    Mat khau KHONG ghi ra file: lay tu bien moi truong ten password_env, hoac mat khau gui qua API
+    (chi giu trong bo nho den khi restart). Ghi file nguyen tu (file tam + os.replace).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._passwords = {} # ten -> mat khau gui qua API (chi trong bo nho)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        legacy_passwords = False
+        for device in data.get("devices", []):
+            if device.get("password"): # File cu co mat khau -> chuyen vao bo nho & ghi lai file ko mat khau
+                self._passwords[device["name"]] = device["password"]
+                legacy_passwords = True
+            self._devices[device["name"]] = {key: value for key, value in device.items() if key != "password"}
+        if legacy_passwords:
+            with self._lock:
+                self._save_locked()
+
+    def _save_locked(self):
+        os.makedirs(os.path.dirname(self.path) or ".", mode=0o700, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"devices": list(self._devices.values())}, f, ensure_ascii=False, indent=2)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+
+    def _password_locked(self, device):
+        return self._passwords.get(device["name"]) or (os.getenv(device["password_env"], "") if device.get("password_env") else "")
+
+    def _with_password_locked(self, device):
+        return dict(device, password=self._password_locked(device))
+
+    def _public_device_locked(self, device):
+        """Ban ghi thiet bi tra ra API: ko kem mat khau."""
+        public = dict(device)
+        public["has_password"] = bool(self._password_locked(device))
+        return public
+
+    @staticmethod
+    def normalize_device(data, existing=None):
+        """Kiem tra & chuan hoa 1 thiet bi. Thieu truong khi cap nhat -> giu gia tri cu (ko gom mat khau)."""
+        if not isinstance(data, dict):
+            raise FleetInventoryError("Thiết bị phải là object JSON.")
+        name = str(data.get("name") or "").strip()
+        if not _DEVICE_NAME_RE.match(name):
+            raise FleetInventoryError(f"Tên thiết bị không hợp lệ: '{name}' (chữ, số, '.', '-', '_', tối đa 64 ký tự).")
+        device = {"name": name}
+        for field in _DEVICE_FIELDS:
+            value = data.get(field)
+            if value in (None, "") and existing:
+                value = existing.get(field)
+            value = "" if value is None else str(value)
+            device[field] = value if field == "password" else value.strip()
+        device["portSsh"] = device["portSsh"] or "22"
+        if not device["ipHost"] or not device["username"]:
+            raise FleetInventoryError(f"Thiết bị '{name}' thiếu IP/Hostname hoặc Username.")
+        if not device["portSsh"].isdigit():
+            raise FleetInventoryError(f"Port SSH không hợp lệ cho thiết bị '{name}': {device['portSsh']}")
+        password_env = str(data.get("password_env") or (existing or {}).get("password_env") or "").strip()
+        if password_env and not _ENV_NAME_RE.match(password_env):
+            raise FleetInventoryError(f"Tên biến môi trường mật khẩu không hợp lệ cho thiết bị '{name}': {password_env}")
+        device["password_env"] = password_env
+        tags = data.get("tags", existing.get("tags", []) if existing else [])
+        if isinstance(tags, str):
+            tags = tags.split(",")
+        device["tags"] = sorted({str(tag).strip() for tag in tags if str(tag).strip()})
+        return device
+
+    def list_devices(self):
+        with self._lock:
+            return [self._public_device_locked(device) for device in sorted(self._devices.values(), key=lambda d: d["name"])]
+
+    def upsert(self, devices_data):
+        """Them/cap nhat 1 hoac nhieu thiet bi (kiem tra het truoc khi ghi). Tra ve list ten."""
+        with self._lock:
+            devices = [self.normalize_device(data, self._devices.get(str(data.get("name") or "").strip()) if isinstance(data, dict) else None)
+                       for data in devices_data]
+            for device in devices:
+                password = device.pop("password")
+                if password:
+                    self._passwords[device["name"]] = password
+                self._devices[device["name"]] = {key: device[key] for key in ("name",) + _STORED_FIELDS + ("tags",)}
+            self._save_locked()
+            return [device["name"] for device in devices]
+
+    def remove(self, name):
+        with self._lock:
+            if self._devices.pop(name, None) is None:
+                return False
+            self._passwords.pop(name, None)
+            self._save_locked()
+            return True
+
+    def select(self, names=None, tags=None):
+        """
+        Chon thiet bi theo ten va/hoac tag (co tag bat ky trong list). Ko truyen gi -> ca fleet.
+        Tra ve (list thiet bi day du, list ten ko ton tai).
+        """
+        with self._lock:
+            if not names and not tags:
+                return [self._with_password_locked(device) for device in sorted(self._devices.values(), key=lambda d: d["name"])], []
+            selected, missing = {}, []
+            for name in names or []:
+                if name in self._devices:
+                    selected[name] = self._devices[name]
+                else:
+                    missing.append(name)
+            wanted_tags = set(tags or [])
+            for device in self._devices.values():
+                if wanted_tags.intersection(device.get("tags", [])):
+                    selected[device["name"]] = device
+            return [self._with_password_locked(device) for device in sorted(selected.values(), key=lambda d: d["name"])], missing
+
+
+def _device_config(device):
+    return {field: device.get(field, "") for field in _DEVICE_FIELDS}
+
+
+def _run_device(app, index, device, commands_string, results_queue, device_timeout, cancel_event):
+    """Worker: chay lenh tren 1 thiet bi (tu dung khi qua device_timeout/bi huy), day (index, ket qua, thoi gian) vao hang doi chung."""
+    started = time.perf_counter()
+    with app.app_context():
+        try:
+            result = execute_fortigate_commands(commands_string, _device_config(device), cancel_event=cancel_event, timeout_seconds=device_timeout)
+        except Exception as e:
+            current_app.logger.error(f"Fleet: loi khi chay tren '{device['name']}': {e}", exc_info=True)
+            result = {"output": "", "error": f"Lỗi không xác định khi thực thi trên thiết bị: {e}", "return_code": -100}
+    results_queue.put((index, result, time.perf_counter() - started))
+
+
+def iter_fleet_run(commands_string, devices, max_parallel=8, device_timeout=120, cancel_event=None):
+    """
+    Chay cung bo lenh tren nhieu FortiGate song song (toi da max_parallel thiet bi cung luc), sinh su kien tien do:
+    {'type': 'device_start'|'device_done', 'device', ...} va cuoi cung {'type': 'done', 'result': tong hop}.
+    Thiet bi qua device_timeout giay bi danh dau 'timeout' ngay, nhung luong cua no van giu slot den khi
+    thuc su ket thuc (luong tu dung theo device_timeout/cancel_event, ket qua muon bi bo qua) -> so luong SSH
+    dong thoi ko bao gio vuot max_parallel.
+    """
+    app = current_app._get_current_object()
+    max_parallel = max(1, int(max_parallel))
+    device_timeout = max(1.0, float(device_timeout))
+    results_queue = queue.Queue()
+    pending = deque(enumerate(devices))
+    running = {} # index -> (thiet bi, thoi diem het han)
+    live_threads = set() # index cac luong chua ket thuc (ke ca da timeout/huy) -> tinh vao max_parallel
+    results = [None] * len(devices)
+    started = time.perf_counter()
+    yield {"type": "start", "devices": [device["name"] for device in devices], "max_parallel": max_parallel,
+           "device_timeout": device_timeout, "timestamp": datetime.now().isoformat()}
+
+    def finish(index, device, status, result, duration):
+        FORTIGATE_FLEET_DEVICE_RUNS.inc(outcome=status)
+        results[index] = {
+            "device": device["name"], "host": device.get("ipHost"), "status": status,
+            "output": result.get("output", ""), "error": result.get("error", ""), "return_code": result.get("return_code"),
+            "duration_ms": round(duration * 1000, 1),
+        }
+        return dict(results[index], type="device_done", completed=sum(1 for r in results if r is not None), total=len(devices))
+
+    while pending or running:
+        if cancel_event is not None and cancel_event.is_set():
+            for index, device in list(pending) + [(i, d) for i, (d, _) in running.items()]:
+                yield finish(index, device, DEVICE_CANCELLED, {"error": "Đã hủy trước khi thiết bị hoàn tất.", "return_code": -1}, 0.0)
+            pending.clear()
+            running.clear()
+            break
+        while pending and len(live_threads) < max_parallel:
+            index, device = pending.popleft()
+            running[index] = (device, time.monotonic() + device_timeout)
+            live_threads.add(index)
+            threading.Thread(
+                target=_run_device, args=(app, index, device, commands_string, results_queue, device_timeout, cancel_event),
+                name=f"fgt-fleet-{device['name']}", daemon=True,
+            ).start()
+            yield {"type": "device_start", "device": device["name"], "host": device.get("ipHost")}
+        # Moi slot bi luong da timeout chiem -> cho luong do ket thuc (kiem tra lai moi giay)
+        wait_seconds = max(0.0, min(deadline for _, deadline in running.values()) - time.monotonic()) if running else 1.0
+        try:
+            index, result, duration = results_queue.get(timeout=min(wait_seconds, 1.0) if cancel_event is not None else wait_seconds)
+        except queue.Empty:
+            now = time.monotonic()
+            for index, (device, deadline) in list(running.items()):
+                if deadline <= now:
+                    del running[index]
+                    current_app.logger.warning(f"Fleet: '{device['name']}' qua {device_timeout:.0f}s, danh dau timeout.")
+                    yield finish(index, device, DEVICE_TIMEOUT, {
+                        "error": f"Thiết bị không hoàn tất trong {device_timeout:.0f} giây.", "return_code": -101
+                    }, device_timeout)
+            continue
+        live_threads.discard(index)
+        if index not in running: # Ket qua muon cua thiet bi da timeout/huy
+            continue
+        device, _ = running.pop(index)
+        if result.get("error_type") == "Timeout":
+            status = DEVICE_TIMEOUT
+        elif result.get("error_type") == "Cancelled":
+            status = DEVICE_CANCELLED
+        else:
+            status = DEVICE_OK if result.get("return_code") == 0 and not result.get("error") else DEVICE_ERROR
+        yield finish(index, device, status, result, duration)
+
+    elapsed = time.perf_counter() - started
+    FORTIGATE_FLEET_RUN_DURATION.observe(elapsed)
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    slowest = max(results, key=lambda r: r["duration_ms"], default=None)
+    current_app.logger.info(
+        f"Fleet: chay {len(devices)} thiet bi (song song {max_parallel}) trong {elapsed:.2f}s: {counts}"
+        + (f", cham nhat '{slowest['device']}' {slowest['duration_ms']}ms." if slowest else ".")
+    )
+    yield {"type": "done", "result": {
+        "devices": results, "counts": counts, "total": len(devices), "elapsed_ms": round(elapsed * 1000, 1),
+        "sum_device_ms": round(sum(r["duration_ms"] for r in results), 1),
+    }}
+
+
+def run_fleet(commands_string, devices, max_parallel=8, device_timeout=120, on_event=None, cancel_event=None):
+    """Ban dong bo cua iter_fleet_run: goi on_event(su kien) cho moi su kien, tra ve ket qua tong hop."""
+    for event in iter_fleet_run(commands_string, devices, max_parallel, device_timeout, cancel_event):
+        if on_event is not None:
+            on_event(event)
+        if event["type"] == "done":
+            return event["result"]
+    return None
+
+
+def _normalize_output(text, ignore_res):
+    lines = [line.rstrip() for line in (text or "").splitlines()]
+    lines = [line for line in lines if not any(pattern.search(line) for pattern in ignore_res)]
+    while lines and not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def diff_fleet_outputs(device_results, baseline=None, ignore_patterns=None, max_diff_lines=200):
+    """
+    Nhom thiet bi theo output (sau chuan hoa) & diff tung nhom voi nhom chuan: thiet bi baseline neu co,
+    con lai nhom dong nhat (nhieu thiet bi nhat). Chi xet thiet bi co output (thanh cong hoac lenh bao loi).
+    ignore_patterns: regex bo qua dong bien dong (uptime, bo dem...).
+    """
+    try:
+        ignore_res = [re.compile(pattern) for pattern in ignore_patterns or []]
+    except re.error as e:
+        raise ValueError(f"Regex bỏ qua không hợp lệ: {e}")
+    groups = {} # digest -> {'lines', 'devices'}
+    for result in device_results:
+        if result["status"] != DEVICE_OK and not (result["status"] == DEVICE_ERROR and result["output"]):
+            continue
+        lines = _normalize_output(result["output"], ignore_res)
+        digest = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()[:16]
+        groups.setdefault(digest, {"lines": lines, "devices": []})["devices"].append(result["device"])
+    if not groups:
+        return {"baseline": None, "groups": []}
+    ordered = sorted(groups.items(), key=lambda item: (-len(item[1]["devices"]), item[1]["devices"][0]))
+    baseline_digest = next((digest for digest, group in ordered if baseline in group["devices"]), ordered[0][0])
+    baseline_group = groups[baseline_digest]
+    baseline_name = baseline if baseline in baseline_group["devices"] else baseline_group["devices"][0]
+    view = []
+    for digest, group in ordered:
+        entry = {"digest": digest, "devices": group["devices"], "lines": len(group["lines"]),
+                 "is_baseline": digest == baseline_digest}
+        if digest != baseline_digest:
+            diff_lines = list(difflib.unified_diff(
+                baseline_group["lines"], group["lines"], fromfile=baseline_name, tofile=group["devices"][0], lineterm="", n=2,
+            ))
+            entry["diff"] = "\n".join(diff_lines[:max_diff_lines]) + (
+                f"\n[... còn {len(diff_lines) - max_diff_lines} dòng diff ...]" if len(diff_lines) > max_diff_lines else ""
+            )
+        view.append(entry)
+    return {"baseline": baseline_name, "groups": view}
+
+
+def make_fleet_job_runner(commands_string, devices, max_parallel, device_timeout):
+    """Runner JobManager: tien do tung thiet bi ghi vao output job, ket qua job = ket qua tong hop."""
+    def run(job):
+        def on_event(event):
+            timestamp = datetime.now().isoformat()
+            if event["type"] == "device_start":
+                job.append_output("stdout", f"[{event['device']}] bắt đầu\n", timestamp)
+            elif event["type"] == "device_done":
+                job.append_output(
+                    "stdout" if event["status"] == DEVICE_OK else "stderr",
+                    f"[{event['device']}] {event['status']} ({event['duration_ms']}ms) - {event['completed']}/{event['total']}\n",
+                    timestamp,
+                )
+        result = run_fleet(commands_string, devices, max_parallel, device_timeout, on_event=on_event, cancel_event=job.cancel_event)
+        result["return_code"] = 0 if result["counts"].get(DEVICE_OK, 0) == result["total"] else 1
+        result["executed_file_type"] = "fortios"
+        return result
+    return run
+
+
+def resolve_fleet_targets(data):
+    """
+    Thiet bi dich tu request: 'devices' (ten trong inventory hoac object fortigate_config rieng co 'name')
+    va/hoac 'tags'. 'passwords' (ten -> mat khau) ghi de mat khau cho lan chay nay. Tra ve (list thiet bi, loi).
+    """
+    requested = data.get("devices") or []
+    if not isinstance(requested, list):
+        return None, "'devices' phải là danh sách."
+    passwords = data.get("passwords") or {}
+    if not isinstance(passwords, dict):
+        return None, "'passwords' phải là object (tên thiết bị -> mật khẩu)."
+    names = [str(item) for item in requested if isinstance(item, str)]
+    inline = [item for item in requested if isinstance(item, dict)]
+    tags = data.get("tags") or []
+    if isinstance(tags, str):
+        tags = [tag.strip() for tag in tags.split(",") if tag.strip()]
+    devices, missing = [], []
+    if names or tags or not inline:
+        devices, missing = get_fleet_inventory().select(names, tags)
+    if missing:
+        return None, f"Không có trong inventory: {', '.join(missing)}."
+    try:
+        devices += [FleetInventory.normalize_device(dict(item, name=item.get("name") or item.get("ipHost"))) for item in inline]
+    except FleetInventoryError as e:
+        return None, str(e)
+    unique, seen_names, seen_keys = [], set(), set()
+    for device in devices:
+        if passwords.get(device["name"]):
+            device["password"] = str(passwords[device["name"]])
+        elif not device.get("password") and device.get("password_env"):
+            device["password"] = os.getenv(device["password_env"], "")
+        key = fortigate_device_key(_device_config(device))
+        if device["name"] in seen_names or key in seen_keys: # Cung thiet bi 2 lan -> chay 1 lan
+            continue
+        seen_names.add(device["name"])
+        seen_keys.add(key)
+        unique.append(device)
+    if not unique:
+        return None, "Không có thiết bị nào để thực thi (inventory trống hoặc không khớp tag)."
+    max_devices = current_app.config.get('FGT_FLEET_MAX_DEVICES', 500)
+    if len(unique) > max_devices:
+        return None, f"Quá nhiều thiết bị ({len(unique)} > {max_devices})."
+    return unique, None
+
+
+_fleet_inventory = None
+_fleet_inventory_lock = threading.Lock()
+
+def get_fleet_inventory():
+    """Lay FleetInventory dung chung (khoi tao lan dau tu app.config)."""
+    global _fleet_inventory
+    if _fleet_inventory is None:
+        with _fleet_inventory_lock:
+            if _fleet_inventory is None:
+                path = current_app.config.get('FGT_FLEET_INVENTORY_PATH') or os.path.abspath(
+                    os.path.join(current_app.root_path, '..', 'data', 'fleet_inventory.json')
+                )
+                _fleet_inventory = FleetInventory(path)
+    return _fleet_inventory
@@ -0,0 +1,360 @@
+# backend/fortios_config_utils.py
+import re
+import time
+import shlex
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+from .metrics_utils import FORTIOS_CONFIG_INDEX_QUERIES, FORTIOS_CONFIG_INDEX_BUILD_DURATION
+
+_ATTRIBUTE_VERBS = ("set", "unset", "append", "select", "unselect")
+_SUPPORTED_GREP_FLAGS = {"-i", "-v", "-f"}
+INDENT = "    "
+
+
+class ConfigNode:
+    """
+    1 khoi cau hinh FortiOS: 'config <ten>' (kind='config'), 'edit <khoa>' (kind='edit') hoac goc.
+    items giu dung thu tu dong: ('set', ten, gia tri tho) / ConfigNode con; attrs & entries/sections de tra cuu.
+    """
+
+    def __init__(self, kind, name, raw_name=None):
+        self.kind = kind
+        self.name = name
+        self.raw_name = raw_name if raw_name is not None else name # Nhu tren CLI (giu dau nhay)
+        self.items = []
+        self.attrs = {} # ten thuoc tinh -> gia tri tho
+        self.entries = {} # khoa edit -> ConfigNode (chi khi kind='config')
+        self.sections = {} # ten config con -> ConfigNode
+
+    def add_attr(self, verb, attr_name, raw_value):
+        self.items.append((verb, attr_name, raw_value))
+        if verb == "set":
+            self.attrs[attr_name] = raw_value
+
+    def add_child(self, node):
+        self.items.append(node)
+        if node.kind == "edit":
+            self.entries[node.name] = node
+        else:
+            self.sections[node.name] = node
+        return node
+
+    def render_lines(self, depth=0, entry_filter=None):
+        """Dong CLI cua khoi (dinh dang giong output 'show'). entry_filter(edit_node) -> bo qua entry ko khop."""
+        pad = INDENT * depth
+        header = f"{pad}config {self.raw_name}" if self.kind == "config" else f"{pad}edit {self.raw_name}"
+        lines = [header]
+        for item in self.items:
+            if isinstance(item, ConfigNode):
+                if entry_filter is not None and item.kind == "edit" and not entry_filter(item):
+                    continue
+                lines.extend(item.render_lines(depth + 1))
+            else:
+                verb, attr_name, raw_value = item
+                lines.append(f"{pad}{INDENT}{verb} {attr_name}{' ' + raw_value if raw_value else ''}")
+        lines.append(f"{pad}end" if self.kind == "config" else f"{pad}next")
+        return lines
+
+    def render(self, entry_filter=None):
+        return "\n".join(self.render_lines(entry_filter=entry_filter))
+
+
+def _unquote(token):
+    token = token.strip()
+    if len(token) >= 2 and token[0] == token[-1] == '"':
+        return token[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return token
+
+
+def _has_open_quote(text):
+    """Chuoi con 1 dau nhay kep chua dong (gia tri nhieu dong nhu certificate, replacemsg)."""
+    open_quote, escaped = False, False
+    for char in text:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == '"':
+            open_quote = not open_quote
+    return open_quote
+
+
+def _logical_lines(config_text):
+    pending = None
+    for line in config_text.splitlines():
+        if pending is not None:
+            pending += "\n" + line
+            if not _has_open_quote(pending):
+                yield pending
+                pending = None
+            continue
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        if _has_open_quote(stripped):
+            pending = stripped
+            continue
+        yield stripped
+    if pending is not None:
+        yield pending
+
+
+def parse_fortios_config(config_text):
+    """Phan tich output 'show (full-configuration)' thanh cay ConfigNode (goc kind='root')."""
+    root = ConfigNode("root", "")
+    stack = [root]
+    for line in _logical_lines(config_text):
+        verb, _, rest = line.partition(" ")
+        if verb == "config" and rest:
+            stack.append(stack[-1].add_child(ConfigNode("config", " ".join(rest.split()))))
+        elif verb == "edit" and rest and stack[-1].kind == "config":
+            stack.append(stack[-1].add_child(ConfigNode("edit", _unquote(rest), raw_name=rest.strip())))
+        elif verb == "next":
+            while len(stack) > 1 and stack.pop().kind != "edit":
+                pass
+        elif verb == "end":
+            while len(stack) > 1 and stack[-1].kind == "edit": # 'end' dong ca edit dang mo
+                stack.pop()
+            if len(stack) > 1:
+                stack.pop()
+        elif verb in _ATTRIBUTE_VERBS and rest:
+            attr_name, _, raw_value = rest.partition(" ")
+            stack[-1].add_attr(verb, attr_name, raw_value.strip())
+    return root
+
+
+def _parse_grep(grep_expr):
+    """'grep [-i] [-v] [-f] pattern' -> (flags, regex) hoac None neu ko ho tro (-> hoi thiet bi)."""
+    try:
+        words = shlex.split(grep_expr)
+    except ValueError:
+        return None
+    if not words or words[0] != "grep" or len(words) < 2:
+        return None
+    flags = set()
+    for word in words[1:-1]:
+        if word not in _SUPPORTED_GREP_FLAGS:
+            return None
+        flags.add(word)
+    try:
+        return flags, re.compile(words[-1], re.IGNORECASE if "-i" in flags else 0)
+    except re.error:
+        return None
+
+
+class FortiOSConfigIndex:
+    """
+    Chi muc cau hinh 1 thiet bi (tu 1 lan 'show full-configuration'): duong dan config -> khoi,
+    khoa edit -> entry. Tra loi 'show [full-configuration] <duong dan> [khoa] [| grep ...]' ko can SSH.
+    """
+
+    def __init__(self, config_text, built_at=None):
+        self.root = parse_fortios_config(config_text)
+        self.built_at = built_at or time.time()
+        self.bytes = len(config_text)
+        # Nhieu VDOM: cung 1 duong dan co o moi VDOM, ngu canh CLI quyet dinh -> ko tra loi tai cho
+        self.multi_vdom = "vdom" in self.root.sections and "global" in self.root.sections
+        self.sections = self.root.sections
+        self._derived = {} # ten -> cau truc dung tu cay cau hinh (VD: bo so khop policy)
+        self._derived_lock = threading.Lock()
+
+    def derived(self, name, factory):
+        """Cau truc dung tu chi muc nay, tao 1 lan (factory(index)) va bo cung chi muc."""
+        with self._derived_lock:
+            if name not in self._derived:
+                self._derived[name] = factory(self)
+            return self._derived[name]
+
+    def resolve(self, words):
+        """words (sau 'show') -> (khoi config, khoa edit hoac None); None neu ko khop."""
+        for split_at in range(len(words), 0, -1):
+            section = self.sections.get(" ".join(words[:split_at]))
+            if section is None:
+                continue
+            rest = words[split_at:]
+            if not rest:
+                return section, None
+            if len(rest) == 1 and rest[0] in section.entries:
+                return section, rest[0]
+            return None
+        return None
+
+    def answer(self, command):
+        """Output cho lenh show tra tu chi muc, hoac None neu phai hoi thiet bi."""
+        if self.multi_vdom:
+            return None
+        base_command, _, pipe_expr = command.partition("|")
+        grep = None
+        if pipe_expr.strip():
+            grep = _parse_grep(pipe_expr.strip())
+            if grep is None:
+                return None
+        try:
+            words = shlex.split(base_command)
+        except ValueError:
+            return None
+        if len(words) < 2 or words[0] != "show":
+            return None
+        words = words[2:] if words[1] == "full-configuration" else words[1:]
+        if not words: # Toan bo cau hinh: ko loi gi hon hoi thiet bi
+            return None
+        resolved = self.resolve(words)
+        if resolved is None:
+            return None
+        section, entry_key = resolved
+        entry_filter = (lambda node: node.name == entry_key) if entry_key is not None else None
+        if grep is None:
+            return section.render(entry_filter=entry_filter)
+        flags, pattern = grep
+        if "-f" in flags: # Nhu FortiOS: giu ca khoi edit chua dong khop
+            def block_matches(node):
+                if entry_filter is not None and not entry_filter(node):
+                    return False
+                return any(bool(pattern.search(line)) != ("-v" in flags) for line in node.render_lines())
+            if not section.entries:
+                return section.render() if block_matches(section) else ""
+            return section.render(entry_filter=block_matches)
+        rendered_lines = section.render(entry_filter=entry_filter).splitlines()
+        return "\n".join(line for line in rendered_lines if bool(pattern.search(line)) != ("-v" in flags))
+
+    def summary_info(self):
+        return {
+            "built_at": datetime.fromtimestamp(self.built_at).isoformat(), "bytes": self.bytes,
+            "sections": len(self.sections), "multi_vdom": self.multi_vdom,
+        }
+
+
+class FortiOSConfigIndexStore:
+    """
+    Chi muc cau hinh theo thiet bi. Chua co/het han -> dung nen 1 lan (single-flight) va tra None
+    (lenh nay van chay qua SSH). invalidate() khi chay lenh config: tang generation, bo chi muc
+    & ket qua dung nen dang do.
+    """
+
+    def __init__(self, app, ttl=300, max_workers=2):
+        self.app = app
+        self.ttl = float(ttl)
+        self._indexes = {} # device_key -> FortiOSConfigIndex
+        self._generations = {} # device_key -> so lan invalidate
+        self._building = {} # device_key -> Event, set khi dung xong (thanh cong hay ko)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix="fgt-config-index")
+        self.builds = 0
+        self.build_errors = 0
+        self.invalidations = 0
+
+    def generation(self, device_key):
+        with self._lock:
+            return self._generations.get(device_key, 0)
+
+    def get_index(self, device_key):
+        with self._lock:
+            index = self._indexes.get(device_key)
+            if index is not None and time.time() - index.built_at > self.ttl:
+                del self._indexes[device_key]
+                index = None
+            return index
+
+    def answer(self, device_key, command, fetch_config):
+        """
+        Tra loi lenh show tu chi muc: (output, thoi diem dung chi muc) hoac None.
+        fetch_config() -> (text, loi) dung de dung chi muc khi chua co.
+        """
+        index = self.get_index(device_key)
+        if index is None:
+            self.schedule_build(device_key, fetch_config)
+            FORTIOS_CONFIG_INDEX_QUERIES.inc(result="building")
+            return None
+        output = index.answer(command)
+        FORTIOS_CONFIG_INDEX_QUERIES.inc(result="miss" if output is None else "hit")
+        return (output, index.built_at) if output is not None else None
+
+    def wait_for_index(self, device_key, fetch_config, timeout):
+        """Chi muc cua thiet bi, dung (single-flight) va cho toi da timeout giay neu chua co. None neu ko kip/loi."""
+        index = self.get_index(device_key)
+        if index is not None:
+            return index
+        self.schedule_build(device_key, fetch_config)
+        with self._lock:
+            build_done = self._building.get(device_key)
+        if build_done is not None:
+            build_done.wait(timeout)
+        return self.get_index(device_key)
+
+    def schedule_build(self, device_key, fetch_config):
+        with self._lock:
+            if device_key in self._building:
+                return False
+            self._building[device_key] = threading.Event()
+            generation = self._generations.get(device_key, 0)
+        self._executor.submit(self._build_in_app_context, device_key, generation, fetch_config)
+        return True
+
+    def _build_in_app_context(self, device_key, generation, fetch_config):
+        with self.app.app_context():
+            logger = current_app.logger
+            try:
+                with FORTIOS_CONFIG_INDEX_BUILD_DURATION.time():
+                    config_text, error = fetch_config()
+                    index = FortiOSConfigIndex(config_text) if not error and config_text else None
+                if index is None:
+                    self.build_errors += 1
+                    logger.warning(f"Chi muc cau hinh {device_key[0]}:{device_key[1]}: ko lay duoc cau hinh ({error}).")
+                    return
+                with self._lock:
+                    if self._generations.get(device_key, 0) != generation:
+                        logger.info(f"Chi muc cau hinh {device_key[0]}:{device_key[1]}: cau hinh da doi trong luc dung, bo ket qua.")
+                        return
+                    self._indexes[device_key] = index
+                    self.builds += 1
+                logger.info(
+                    f"Da dung chi muc cau hinh {device_key[0]}:{device_key[1]}: {len(index.sections)} khoi, {index.bytes} byte"
+                    + (" (nhieu VDOM, ko tra loi tai cho)." if index.multi_vdom else ".")
+                )
+            except Exception as e:
+                self.build_errors += 1
+                logger.error(f"Loi khi dung chi muc cau hinh {device_key[0]}:{device_key[1]}: {e}", exc_info=True)
+            finally:
+                with self._lock:
+                    build_done = self._building.pop(device_key, None)
+                if build_done is not None:
+                    build_done.set()
+
+    def invalidate(self, device_key):
+        with self._lock:
+            self._generations[device_key] = self._generations.get(device_key, 0) + 1
+            self.invalidations += 1
+            return self._indexes.pop(device_key, None) is not None
+
+    def clear(self):
+        """Bo moi chi muc (tang generation de ket qua dung nen dang do cung bi bo)."""
+        with self._lock:
+            for device_key in set(self._indexes) | set(self._building):
+                self._generations[device_key] = self._generations.get(device_key, 0) + 1
+            self._indexes.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._indexes), "building": len(self._building), "ttl": self.ttl, "builds": self.builds,
+                "build_errors": self.build_errors, "invalidations": self.invalidations,
+                "indexes": [dict(index.summary_info(), device=f"{key[0]}:{key[1]}") for key, index in self._indexes.items()],
+            }
+
+
+_config_index_store = None
+_config_index_store_lock = threading.Lock()
+
+def get_config_index_store():
+    """Lay FortiOSConfigIndexStore dung chung (khoi tao lan dau tu app.config)."""
+    global _config_index_store
+    if _config_index_store is None:
+        with _config_index_store_lock:
+            if _config_index_store is None:
+                _config_index_store = FortiOSConfigIndexStore(
+                    current_app._get_current_object(), ttl=current_app.config.get('FGT_CONFIG_INDEX_TTL', 300)
+                )
+    return _config_index_store
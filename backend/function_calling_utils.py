@@ -0,0 +1,359 @@
+# backend/function_calling_utils.py
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+from .gemini_utils import iter_response_parts, model_metric_label
+from .cache_utils import TTLCache
+from .metrics_utils import GEMINI_CALL_DURATION, FUNCTION_CALLING_TOOL_CALLS, FUNCTION_CALLING_TOOL_DURATION, FUNCTION_CALLING_TOOL_MEMO
+from .execution_utils import (
+    execute_fortigate_commands, fortigate_device_key, fetch_fortigate_full_configuration, fetch_fortigate_routing_table,
+    _FGT_CONFIG_PREFIXES
+)
+from .fortios_config_utils import get_config_index_store
+from .policy_match_utils import get_policy_matcher, format_policy_match
+from .output_reducer_utils import reduce_tool_response
+from .route_lookup_utils import get_route_table_store, format_route_lookup, is_routing_table_command
+from .ssh_pool_utils import get_fortigate_pool
+
+MAX_FUNCTION_CALLS = 500
+KNOWN_TOOLS = ("get_fortigate_data", "match_firewall_policy", "lookup_route") # Tool backend ho tro (giu label metric huu han)
+
+def _has_fortigate_connection_info(fortigate_config):
+    return bool(fortigate_config and fortigate_config.get('ipHost') and fortigate_config.get('username'))
+
+def _answer_from_config_index(command, fortigate_config):
+    """Lenh show cau hinh -> tra tu chi muc 'show full-configuration' (ko SSH). None -> chay tren thiet bi."""
+    command = command.strip()
+    if not current_app.config.get('FGT_CONFIG_INDEX_ENABLED', True) or "\n" in command or not command.lower().startswith("show "):
+        return None
+    device_key = fortigate_device_key(fortigate_config)
+    if device_key is None:
+        return None
+    answer = get_config_index_store().answer(device_key, command, lambda: fetch_fortigate_full_configuration(fortigate_config))
+    if answer is None:
+        return None
+    output, built_at = answer
+    current_app.logger.info(f"Tool 'get_fortigate_data': tra '{command}' tu chi muc cau hinh ({len(output)} ky tu).")
+    return (
+        f"(Trả lời từ chỉ mục cấu hình 'show full-configuration' lấy lúc {datetime.fromtimestamp(built_at).strftime('%H:%M:%S')}, "
+        f"có thể gồm cả giá trị mặc định)\n$ {command}\n{output if output else '(Không có dòng nào khớp)'}\n"
+    )
+
+def _match_firewall_policy(tool_args, fortigate_config):
+    """Doi chieu 1 luong voi firewall policy tren chi muc cau hinh (cho dung chi muc neu chua co)."""
+    device_key = fortigate_device_key(fortigate_config)
+    index = get_config_index_store().wait_for_index(
+        device_key, lambda: fetch_fortigate_full_configuration(fortigate_config),
+        timeout=current_app.config.get('FGT_POLICY_MATCH_INDEX_WAIT', 150)
+    )
+    if index is None:
+        return "Lỗi: Không lấy được cấu hình đầy đủ của FortiGate để đối chiếu policy. Hãy dùng tool `get_fortigate_data` với 'show firewall policy'.", True
+    try:
+        matcher = get_policy_matcher(index)
+        result = matcher.match(tool_args)
+    except ValueError as e:
+        return f"Lỗi: {e}", True
+    return format_policy_match(matcher, result, index.built_at), False
+
+def _compact_routing_table(command, output, fortigate_config):
+    """Bang dinh tuyen lon: dung trie tra cuu va chi tra tom tat cho model (None = gui nguyen van)."""
+    if not is_routing_table_command(command) or output.count("\n") <= current_app.config.get('FGT_ROUTE_TABLE_INLINE_MAX_LINES', 200):
+        return None
+    table = get_route_table_store().record_output(fortigate_device_key(fortigate_config), output)
+    current_app.logger.info(f"Tool 'get_fortigate_data': thay {table.source_lines} dong routing-table bang tom tat ({table.route_count} route).")
+    return f"$ {command}\n{table.summary_text()}\n"
+
+def _lookup_route(tool_args, fortigate_config):
+    """Tra next-hop/interface cho 1 hoac nhieu IP tren trie LPM cua bang dinh tuyen thiet bi."""
+    ips = [ip for ip in str(tool_args.get("ips") or tool_args.get("ip") or "").replace(",", " ").split() if ip]
+    if not ips:
+        return "Lỗi: Tool 'lookup_route' cần tham số 'ips' (một hoặc nhiều IPv4, phân cách bởi dấu phẩy).", True
+    table, error = get_route_table_store().get_or_fetch(
+        fortigate_device_key(fortigate_config), lambda: fetch_fortigate_routing_table(fortigate_config)
+    )
+    if table is None:
+        return f"Lỗi: Không lấy được bảng định tuyến từ FortiGate: {error}", True
+    return format_route_lookup(table, table.lookup_many(ips, tool_args.get("vrf"))), False
+
+# Thuc thi 1 tool ma Gemini yeu cau
+def dispatch_tool_call(tool_name, tool_args, fortigate_config):
+    """Chay tool backend cho function call. Tra ve (tool_response_text, is_error)."""
+    logger = current_app.logger
+    if tool_name == "get_fortigate_data":
+        fgt_command_to_run = tool_args.get("command")
+        if not fgt_command_to_run:
+            return "Lỗi: Tool 'get_fortigate_data' được gọi nhưng thiếu tham số 'command'.", True
+        if not _has_fortigate_connection_info(fortigate_config):
+            return "Lỗi: Backend không thể thực thi lệnh FortiGate vì thiếu thông tin IP/Host hoặc Username.", True
+        indexed_output = _answer_from_config_index(fgt_command_to_run, fortigate_config)
+        if indexed_output is not None:
+            return indexed_output, False
+        logger.info(f"Tool '{tool_name}': Executing command '{fgt_command_to_run}'")
+        exec_result = execute_fortigate_commands(fgt_command_to_run, fortigate_config)
+        if exec_result["error"]:
+            return f"[LỖI THỰC THI FORTIGATE]: Lệnh '{fgt_command_to_run}' thất bại. Chi tiết: {exec_result['error']}. Output: {exec_result['output']}", True
+        compact_output = _compact_routing_table(fgt_command_to_run, exec_result["output"], fortigate_config)
+        if compact_output is not None:
+            return compact_output, False
+        return (exec_result["output"] if exec_result["output"] else "(Lệnh không trả về output)"), False
+    if tool_name == "match_firewall_policy":
+        if not _has_fortigate_connection_info(fortigate_config):
+            return "Lỗi: Backend không thể đối chiếu policy vì thiếu thông tin IP/Host hoặc Username.", True
+        logger.info(f"Tool '{tool_name}': doi chieu luong {tool_args}")
+        return _match_firewall_policy(tool_args, fortigate_config)
+    if tool_name == "lookup_route":
+        if not _has_fortigate_connection_info(fortigate_config):
+            return "Lỗi: Backend không thể tra bảng định tuyến vì thiếu thông tin IP/Host hoặc Username.", True
+        logger.info(f"Tool '{tool_name}': tra route {tool_args}")
+        return _lookup_route(tool_args, fortigate_config)
+    return f"Lỗi: Tool '{tool_name}' không được backend hỗ trợ.", True
+
+def _timed_dispatch(tool_name, tool_args, fortigate_config):
+    """Chay 1 tool; exception -> ket qua loi (ko lam hong vong lap FC), du chay 1 hay nhieu tool."""
+    with FUNCTION_CALLING_TOOL_DURATION.time(tool=tool_name if tool_name in KNOWN_TOOLS else "unknown", outcome="exception") as tool_metric_labels:
+        try:
+            tool_response_text, tool_error_flag = dispatch_tool_call(tool_name, tool_args, fortigate_config)
+        except Exception as e_tool:
+            current_app.logger.error(f"Tool '{tool_name}' loi: {e_tool}", exc_info=True)
+            return f"Lỗi: Tool '{tool_name}' gặp lỗi không mong muốn: {e_tool}", True
+        tool_metric_labels["outcome"] = "error" if tool_error_flag else "ok"
+    return tool_response_text, tool_error_flag
+
+def _dispatch_in_app_context(app, tool_name, tool_args, fortigate_config):
+    with app.app_context():
+        return _timed_dispatch(tool_name, tool_args, fortigate_config)
+
+def _dispatch_tool_calls(tool_calls, fortigate_config):
+    """
+    Chay cac tool call [(ten, args)]. Nhieu call -> chay song song, so luong toi da
+    = min(FC_MAX_PARALLEL_TOOL_CALLS, so phien pool / thiet bi).
+    Generator phat (tool_response_text, is_error) dung thu tu tool_calls.
+    """
+    if len(tool_calls) <= 1:
+        for tool_name, tool_args in tool_calls:
+            yield _timed_dispatch(tool_name, tool_args, fortigate_config)
+        return
+    max_parallel = min(
+        int(current_app.config.get('FC_MAX_PARALLEL_TOOL_CALLS', 4)),
+        get_fortigate_pool().max_per_device, # Ko mo nhieu phien hon pool cho phep / thiet bi
+        len(tool_calls),
+    )
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel), thread_name_prefix="fc-tool") as executor:
+        futures = [executor.submit(_dispatch_in_app_context, app, tool_name, tool_args, fortigate_config)
+                   for tool_name, tool_args in tool_calls]
+        for future in futures:
+            yield future.result()
+
+def run_tool_calls(tool_calls, fortigate_config, tool_memo=None):
+    """
+    Chay cac tool call cua cung 1 luot model, dung ket qua da nho (tool_memo) neu con moi.
+    Generator phat (tool_response_text, is_error, memo_age) dung thu tu tool_calls;
+    memo_age = so giay tu luc ket qua duoc nho (None neu vua chay that).
+    """
+    memo_hits = [tool_memo.get(tool_name, tool_args, fortigate_config) if tool_memo else None
+                 for tool_name, tool_args in tool_calls]
+    pending_calls = [call for call, hit in zip(tool_calls, memo_hits) if hit is None]
+    pending_results = _dispatch_tool_calls(pending_calls, fortigate_config)
+    for (tool_name, tool_args), hit in zip(tool_calls, memo_hits):
+        if hit is not None:
+            yield hit[0], False, hit[1]
+            continue
+        tool_response_text, tool_error_flag = next(pending_results)
+        if tool_memo and not tool_error_flag:
+            tool_memo.set(tool_name, tool_args, fortigate_config, tool_response_text)
+        yield tool_response_text, tool_error_flag, None
+
+# Nho ket qua tool theo hoi thoai (chi lenh read-only, trong cua so TTL)
+class ToolResultMemo:
+    """
+    Ket qua get_fortigate_data theo (thiet bi, lenh da chuan hoa). Lenh duoc nho
+    hay ko & bao lau theo FC_TOOL_MEMO_TTLS (prefix khop dau tien, TTL 0 = ko nho).
+    Ket qua nho truoc khi thiet bi chay lenh config (generation chi muc cau hinh doi) bi bo.
+    """
+
+    def __init__(self, ttl_rules, max_entries=64):
+        self.ttl_rules = [(prefix.lower(), ttl) for prefix, ttl in ttl_rules]
+        self._cache = TTLCache(max_entries=max_entries, default_ttl=0)
+
+    @classmethod
+    def from_config(cls):
+        cfg = current_app.config
+        return cls(cfg.get('FC_TOOL_MEMO_TTLS', []), max_entries=cfg.get('FC_TOOL_MEMO_MAX_ENTRIES', 64))
+
+    @staticmethod
+    def normalize_command(command):
+        """Chi chuan hoa khoang trang: ten object FortiOS phan biet hoa/thuong."""
+        return " ".join(str(command).split())
+
+    def ttl_for(self, command):
+        normalized = self.normalize_command(command).lower() # So prefix ko phan biet hoa/thuong
+        if normalized.startswith(_FGT_CONFIG_PREFIXES): # Ko bao gio nho lenh thay doi cau hinh
+            return 0
+        for prefix, ttl in self.ttl_rules:
+            if normalized.startswith(prefix):
+                return ttl
+        return 0
+
+    def _key(self, tool_name, tool_args, fortigate_config):
+        """Khoa = khoa thiet bi dung chung (fortigate_device_key, co digest mat khau) + lenh da chuan hoa."""
+        if tool_name not in KNOWN_TOOLS:
+            return None
+        command = tool_args.get("command")
+        if not command or self.ttl_for(command) <= 0:
+            return None
+        device_key = fortigate_device_key(fortigate_config)
+        return (device_key, self.normalize_command(command)) if device_key is not None else None
+
+    def get(self, tool_name, tool_args, fortigate_config):
+        """Tra ve (ket qua, so giay tu luc nho) hoac None."""
+        key = self._key(tool_name, tool_args, fortigate_config)
+        entry = self._cache.get(key) if key else None
+        if entry is not None and entry[2] != self._config_generation(fortigate_config):
+            self._cache.invalidate(key) # Cau hinh da doi sau khi nho
+            entry = None
+        FUNCTION_CALLING_TOOL_MEMO.inc(result="hit" if entry else ("miss" if key else "skip"))
+        if entry is None:
+            return None
+        stored_at, tool_response_text, _ = entry
+        return tool_response_text, time.monotonic() - stored_at
+
+    def set(self, tool_name, tool_args, fortigate_config, tool_response_text):
+        key = self._key(tool_name, tool_args, fortigate_config)
+        if key:
+            entry = (time.monotonic(), tool_response_text, self._config_generation(fortigate_config))
+            self._cache.set(key, entry, ttl=self.ttl_for(tool_args["command"]))
+
+    @staticmethod
+    def _config_generation(fortigate_config):
+        return get_config_index_store().generation(fortigate_device_key(fortigate_config))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+# Vong lap Function Calling dung chung cho /generate (FortiOS) va /fortigate_chat
+def run_function_calling_loop(chat_session, first_message, generation_config, safety_settings,
+                              fortigate_config, log_prefix="FC", max_calls=MAX_FUNCTION_CALLS, stream=False, loop_name="other",
+                              tool_memo=None, query=None):
+    """
+    Generator chay vong lap Function Calling, phat su kien ngay khi xay ra:
+      {'type': 'thought', 'thought': {...}}        - function_call_request / function_call_result
+      {'type': 'text', 'text': '...'}              - doan text cua model (chi khi stream=True)
+      {'type': 'final', 'text': '...', 'thoughts': [...]}
+      {'type': 'error', 'error': '...', 'thoughts': [...]}
+    loop_name: label metric (generate/chat) cho so lan goi tool moi vong lap.
+    tool_memo: ToolResultMemo dung chung cho ca hoi thoai; None -> tao moi cho vong lap nay
+    (neu FC_TOOL_MEMO_ENABLED). Ket qua lay tu memo co 'cached': True trong thought.
+    query: cau hoi nguoi dung, dung xep hang khoi khi rut gon ket qua tool lon (memo van giu ban day du).
+    """
+    logger = current_app.logger
+    thoughts_for_ui = []
+    num_calls = 0 # So luot model yeu cau tool (gioi han boi max_calls)
+    tool_calls_total = 0
+    current_content_for_send_message = first_message
+    model_label = model_metric_label(getattr(chat_session, 'model', None))
+    loop_outcome = "aborted" # Generator bi dong giua chung (client ngat SSE)
+    if tool_memo is None and current_app.config.get('FC_TOOL_MEMO_ENABLED', True):
+        tool_memo = ToolResultMemo.from_config()
+    try:
+        while num_calls < max_calls:
+            logger.info(f"{log_prefix} (FC Loop {num_calls+1}/{max_calls}): Sending to Gemini...")
+            gemini_started = time.perf_counter()
+            try:
+                response = chat_session.send_message(
+                    content=current_content_for_send_message,
+                    generation_config=generation_config,
+                    safety_settings=safety_settings,
+                    stream=stream
+                )
+                if stream:
+                    for chunk in response:
+                        for part_item in iter_response_parts(chunk):
+                            if getattr(part_item, 'text', None):
+                                yield {"type": "text", "text": part_item.text}
+                candidate = response.candidates[0]
+                GEMINI_CALL_DURATION.observe(time.perf_counter() - gemini_started, model=model_label, kind="function_calling", outcome="ok")
+            except Exception as e_send:
+                GEMINI_CALL_DURATION.observe(time.perf_counter() - gemini_started, model=model_label, kind="function_calling", outcome="error")
+                logger.error(f"{log_prefix}: Loi khi goi Gemini trong vong lap FC: {e_send}", exc_info=True)
+                loop_outcome = "error"
+                yield {"type": "error", "error": f"Lỗi máy chủ khi gọi Gemini: {e_send}", "thoughts": thoughts_for_ui}
+                return
+
+            if not candidate.content or not candidate.content.parts:
+                logger.error(f"{log_prefix}: Phan hoi cua AI khong co content hoac parts.")
+                loop_outcome = "error"
+                yield {"type": "error", "error": "AI trả về phản hồi không hợp lệ (không có content hoặc parts).", "thoughts": thoughts_for_ui}
+                return
+
+            function_call_parts = [
+                part_item.function_call for part_item in candidate.content.parts
+                if hasattr(part_item, 'function_call') and part_item.function_call
+            ]
+
+            if function_call_parts:
+                tool_calls = []
+                for function_call_part in function_call_parts:
+                    tool_name = function_call_part.name
+                    tool_args = dict(function_call_part.args) if function_call_part.args else {}
+                    logger.info(f"{log_prefix}: AI requested tool '{tool_name}' with args: {tool_args}")
+                    request_thought = {
+                        "type": "function_call_request", "tool_name": tool_name,
+                        "tool_args": tool_args, "timestamp": datetime.now().isoformat()
+                    }
+                    thoughts_for_ui.append(request_thought)
+                    yield {"type": "thought", "thought": request_thought}
+                    tool_calls.append((tool_name, tool_args))
+                if len(tool_calls) > 1:
+                    logger.info(f"{log_prefix}: Chay {len(tool_calls)} tool call cua cung 1 luot song song.")
+
+                function_responses = []
+                tool_results = run_tool_calls(tool_calls, fortigate_config, tool_memo)
+                for (tool_name, tool_args), (tool_response_text, tool_error_flag, memo_age) in zip(tool_calls, tool_results):
+                    tool_response_text, reduction = reduce_tool_response(tool_name, tool_args, tool_response_text, query)
+                    result_thought = {
+                        "type": "function_call_result", "tool_name": tool_name,
+                        "result_data": tool_response_text, "is_error": tool_error_flag,
+                        "timestamp": datetime.now().isoformat()
+                    }
+                    if reduction:
+                        result_thought["output_reduced"] = reduction
+                    if memo_age is not None:
+                        logger.info(f"{log_prefix}: Dung ket qua da nho cho '{tool_name}' {tool_args} ({memo_age:.0f}s truoc).")
+                        result_thought.update({"cached": True, "cache_age_seconds": round(memo_age, 1)})
+                    thoughts_for_ui.append(result_thought)
+                    yield {"type": "thought", "thought": result_thought}
+                    function_responses.append({
+                        "function_response": {
+                            "name": tool_name,
+                            "response": {"output": tool_response_text}
+                        }
+                    })
+                tool_calls_total += len(tool_calls)
+                current_content_for_send_message = function_responses
+            else:
+                finish_reason_name = candidate.finish_reason.name if hasattr(candidate.finish_reason, 'name') else str(candidate.finish_reason)
+                if finish_reason_name == "STOP":
+                    final_text_response = "".join(part_item.text for part_item in candidate.content.parts if hasattr(part_item, 'text') and part_item.text)
+                    logger.info(f"{log_prefix}: AI final response (text): {final_text_response[:200]}...")
+                    loop_outcome = "ok"
+                    yield {"type": "final", "text": final_text_response, "thoughts": thoughts_for_ui}
+                    return
+                safety_ratings_str = str(getattr(candidate, 'safety_ratings', 'N/A'))
+                error_msg_fc_loop = f"AI không trả về function call hoặc text cuối cùng. Lý do: {finish_reason_name}. Safety: {safety_ratings_str}"
+                logger.error(f"{log_prefix}: {error_msg_fc_loop}")
+                loop_outcome = "error"
+                yield {"type": "error", "error": error_msg_fc_loop, "thoughts": thoughts_for_ui}
+                return
+            num_calls += 1
+
+        logger.error(f"{log_prefix}: Đã vượt quá số lần gọi tool tối đa.")
+        loop_outcome = "max_calls"
+        yield {"type": "error", "error": "Đã vượt quá số lần gọi tool tối đa.", "thoughts": thoughts_for_ui}
+    finally:
+        FUNCTION_CALLING_TOOL_CALLS.observe(tool_calls_total, loop=loop_name, outcome=loop_outcome)
@@ -1,139 +1,427 @@
 # backend/gemini_utils.py
 import os
 import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig
+from google.ai import generativelanguage as glm
 from flask import current_app
 import logging # Them logging
+from .cache_utils import TieredResponseCache
+from .metrics_utils import GEMINI_CALL_DURATION
+
+# Tien to cau mo dau can bo khi review/debug/explain
+_REVIEW_PREFIXES_TO_REMOVE = (
+    "đây là đánh giá", "here is the review", "phân tích code",
+    "review:", "analysis:", "đây là phân tích", "here is the analysis",
+    "giải thích và đề xuất:", "phân tích và đề xuất:",
+    "đây là giải thích", "here is the explanation", "giải thích:", "explanation:",
+    "```text"
+)
+
+# google-generativeai ko co API cong khai gan client rieng cho 1 GenerativeModel: cac ban 0.4 - 0.8.x tao client
+# mac dinh (tu genai.configure) vao thuoc tinh private `_client` khi no con None. Chi gan vao do voi cac ban da kiem
+# chung; ban khac -> RuntimeError ro rang thay vi am tham dung nham key global.
+_MODEL_CLIENT_ATTR = "_client"
+_MODEL_CLIENT_SUPPORTED_VERSIONS = ((0, 4), (0, 9)) # [min, max)
+
+def _sdk_version():
+    return tuple(int(part) for part in re.findall(r"\d+", getattr(genai, "__version__", "0"))[:2])
+
+def bind_model_client(model, client):
+    """Gan client theo API key cho model (adapter quanh thuoc tinh private cua SDK, co kiem tra phien ban)."""
+    low, high = _MODEL_CLIENT_SUPPORTED_VERSIONS
+    if not (low <= _sdk_version() < high) or getattr(model, _MODEL_CLIENT_ATTR, False) is not None:
+        raise RuntimeError(
+            f"google-generativeai {getattr(genai, '__version__', '?')} chưa được hỗ trợ gắn client theo API key "
+            f"(hỗ trợ {low[0]}.{low[1]} - <{high[0]}.{high[1]})."
+        )
+    setattr(model, _MODEL_CLIENT_ATTR, client)
+    return model
+
+# --- Registry client/model Gemini theo API key (ko dung genai.configure global) ---
+class GeminiClientRegistry:
+    """
+    Giu client theo API key va GenerativeModel theo (key, model, tools, safety), LRU.
+    Moi model gan voi client cua key rieng -> request dong thoi voi key khac nhau ko anh huong nhau.
+    """
+
+    def __init__(self, max_clients=16, max_models=64):
+        self.max_clients = max(1, int(max_clients))
+        self.max_models = max(1, int(max_models))
+        self._clients = OrderedDict() # key_digest -> GenerativeServiceClient
+        self._models = OrderedDict()  # (key_digest, model_name, tools_fp, safety_key) -> GenerativeModel
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(value):
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _tools_fingerprint(tools):
+        if not tools:
+            return ""
+        return hashlib.sha256(json.dumps(tools, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+    def _get_client_locked(self, api_key, key_digest):
+        client = self._clients.get(key_digest)
+        if client is None:
+            client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            self._clients[key_digest] = client
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(key_digest)
+        return client
+
+    def get_model(self, api_key, model_name, tools=None, safety_key=None, safety_settings=None):
+        """Lay (hoac tao) GenerativeModel dung client rieng cua api_key."""
+        key_digest = self._digest(api_key)
+        model_key = (key_digest, model_name, self._tools_fingerprint(tools), safety_key or "")
+        with self._lock:
+            model = self._models.get(model_key)
+            if model is not None:
+                self._models.move_to_end(model_key)
+                return model
+            client = self._get_client_locked(api_key, key_digest)
+        model = genai.GenerativeModel(model_name=model_name, tools=tools, safety_settings=safety_settings)
+        bind_model_client(model, client) # Client theo key, ko dung client mac dinh (global)
+        with self._lock:
+            existing = self._models.get(model_key)
+            if existing is not None:
+                return existing
+            self._models[model_key] = model
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+        return model
+
+    def stats(self):
+        with self._lock:
+            return {"clients": len(self._clients), "models": len(self._models)}
+
+
+_client_registry = None
+_client_registry_lock = threading.Lock()
+
+def get_client_registry():
+    """Lay registry dung chung (khoi tao lan dau tu app.config)."""
+    global _client_registry
+    if _client_registry is None:
+        with _client_registry_lock:
+            if _client_registry is None:
+                _client_registry = GeminiClientRegistry(
+                    max_clients=current_app.config.get('GEMINI_MAX_CLIENTS', 16),
+                    max_models=current_app.config.get('GEMINI_MAX_MODELS', 64),
+                )
+    return _client_registry
+
+def resolve_api_key(model_config):
+    """Tra ve (api_key hieu luc, co_phai_key_tu_UI). Key UI rong -> dung key .env."""
+    ui_api_key = model_config.get('api_key') if isinstance(model_config, dict) else None
+    if ui_api_key and not ui_api_key.strip():
+        ui_api_key = None
+    return (ui_api_key or current_app.config.get('GOOGLE_API_KEY')), bool(ui_api_key)
+
+def get_function_calling_model(model_config, tools):
+    """Model co tools cho vong lap FC. Tra ve (model, loi)."""
+    api_key, from_ui = resolve_api_key(model_config)
+    if not api_key:
+        return None, "API Key của Google chưa được cấu hình."
+    model_name = model_config.get('model_name') or 'gemini-1.5-flash'
+    try:
+        model = get_client_registry().get_model(api_key, model_name, tools=tools)
+    except Exception as e_model:
+        current_app.logger.error(f"Loi tao model Gemini (FC) voi key {'tu UI' if from_ui else 'tu .env'}: {e_model}")
+        return None, f"Lỗi cấu hình thư viện Google GenAI: {e_model}"
+    current_app.logger.info(f"Dung model {model_name} (FC) voi key {'tu UI' if from_ui else 'tu .env'}.")
+    return model, None
+
+def _copy_model_config(model_config_param, logger):
+    if not isinstance(model_config_param, dict):
+        logger.warning(f"model_config ko phai dict, ma la {type(model_config_param)}. Dung dict rong.")
+        return {}
+    return model_config_param.copy()
+
+def _prepare_gemini_call(model_config_internal, ui_api_key):
+    """Lay model (theo key) & config. Tra ve (model, generation_config, safety_settings, loi)."""
+    logger = current_app.logger
+    google_api_key_cfg = current_app.config.get('GOOGLE_API_KEY')
+    safety_settings_map_cfg = current_app.config.get('SAFETY_SETTINGS_MAP')
+
+    effective_api_key = ui_api_key if ui_api_key else google_api_key_cfg
+    if not effective_api_key:
+        logger.error("API Key thieu (ca .env va UI).")
+        return None, None, None, "Lỗi cấu hình: Thiếu API Key. Vui lòng đặt GOOGLE_API_KEY trong .env hoặc nhập vào Cài đặt."
+
+    if ui_api_key:
+        logger.info("Dung API Key tu UI.")
+
+    model_name = model_config_internal.get('model_name', 'gemini-1.5-flash')
+    if not model_name: model_name = 'gemini-1.5-flash'
+
+    temperature = model_config_internal.get('temperature', 0.7)
+    top_p = model_config_internal.get('top_p', 0.95)
+    top_k = model_config_internal.get('top_k', 40)
+    safety_setting_key = model_config_internal.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE')
+    safety_settings = safety_settings_map_cfg.get(safety_setting_key, safety_settings_map_cfg['BLOCK_MEDIUM_AND_ABOVE'])
+
+    generation_config = GenerationConfig(
+        temperature=float(temperature),
+        top_p=float(top_p),
+        top_k=int(top_k)
+    )
+
+    logger.info(f"Goi model: {model_name} voi config: T={temperature}, P={top_p}, K={top_k}, Safety={safety_setting_key}")
+    try:
+        model = get_client_registry().get_model(effective_api_key, model_name)
+    except Exception as config_e:
+        key_source = "giao diện" if ui_api_key else ".env"
+        logger.error(f"Loi tao client Gemini voi API Key tu {key_source}: {config_e}")
+        return None, None, None, f"Lỗi cấu hình: Không thể cấu hình Gemini với API key từ {key_source} ({config_e})."
+    return model, generation_config, safety_settings, None
+
+def _describe_gemini_error(e, model_config_internal, ui_api_key):
+    """Chuyen exception khi goi Gemini thanh thong bao loi cho UI."""
+    logger = current_app.logger
+    error_message = str(e)
+    model_name_for_error = model_config_internal.get('model_name', 'unknown_model')
+    logger.error(f"Loi API Gemini ({model_name_for_error}): {error_message}", exc_info=True)
+    if "API key not valid" in error_message:
+         key_source = "giao diện" if ui_api_key else ".env"
+         return f"Lỗi cấu hình: API key từ {key_source} không hợp lệ. Vui lòng kiểm tra."
+    elif "Could not find model" in error_message or "permission denied" in error_message.lower():
+         return f"Lỗi cấu hình: Không tìm thấy hoặc không có quyền truy cập model '{model_name_for_error}'."
+    elif "invalid" in error_message.lower() and any(p in error_message.lower() for p in ["temperature", "top_p", "top_k", "safety_settings"]):
+         return f"Lỗi cấu hình: Giá trị tham số (Temperature/TopP/TopK/Safety) không hợp lệ. ({error_message})"
+    elif "Deadline Exceeded" in error_message or "timeout" in error_message.lower():
+         return f"Lỗi mạng: Yêu cầu tới Gemini API bị quá thời gian (timeout). Vui lòng thử lại."
+    elif "SAFETY" in error_message.upper(): 
+         details_match = re.search(r"Finish Reason: (\w+)", error_message)
+         reason_detail = f" (Lý do: {details_match.group(1)})" if details_match else ""
+         safety_ratings_match = re.search(r"Safety Ratings: \[(.+?)]", error_message, re.DOTALL)
+         ratings_detail = f", Ratings: {safety_ratings_match.group(1)}" if safety_ratings_match else ""
+         return f"Lỗi: Yêu cầu hoặc phản hồi có thể vi phạm chính sách an toàn của Gemini.{reason_detail}{ratings_detail} ({error_message[:100]}...)"
+    return f"Lỗi máy chủ khi gọi Gemini: {error_message}"
+
+def _pop_ui_api_key(model_config_internal):
+    ui_api_key = model_config_internal.pop('api_key', None)
+    if ui_api_key and not ui_api_key.strip():
+        ui_api_key = None
+    return ui_api_key
+
+def _blocked_response_message(response):
+    """Tra ve thong bao loi neu prompt bi chan (ko co candidate), nguoc lai None."""
+    if not response.candidates and hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
+        block_reason = response.prompt_feedback.block_reason.name
+        safety_ratings_str = str(getattr(response.prompt_feedback, 'safety_ratings', 'Không có'))
+        current_app.logger.warning(f"Phan hoi bi chan: {block_reason}. Ratings: {safety_ratings_str}")
+        return f"Lỗi: Phản hồi bị chặn bởi cài đặt an toàn (Lý do: {block_reason}). Hãy thử điều chỉnh Safety Settings hoặc prompt."
+    return None
+
+def clean_review_text(raw_text):
+    """Bo dong [thinking...] & cau mo dau cua phan hoi review/debug/explain."""
+    lines = raw_text.splitlines()
+    cleaned_lines = []
+    first_meaningful_line = False
+    for line in lines:
+        stripped_line_lower = line.strip().lower()
+        if stripped_line_lower.startswith(("[thinking", "[processing")) and stripped_line_lower.endswith("]"):
+            continue
+        if not first_meaningful_line and any(stripped_line_lower.startswith(p) for p in _REVIEW_PREFIXES_TO_REMOVE):
+            continue
+        if line.strip():
+            first_meaningful_line = True
+        if first_meaningful_line:
+            cleaned_lines.append(line)
+    return "\n".join(cleaned_lines).strip()
 
 # Ham goi Gemini API
 def generate_response_from_gemini(full_prompt, model_config_param, is_for_review_or_debug=False):
     """Goi Gemini API va xu ly phan hoi."""
     logger = current_app.logger
-    # Lay config tu current_app.config
-    google_api_key_cfg = current_app.config.get('GOOGLE_API_KEY')
-    safety_settings_map_cfg = current_app.config.get('SAFETY_SETTINGS_MAP')
-    
+    model_config_internal = _copy_model_config(model_config_param, logger)
     ui_api_key = None
 
-    if not isinstance(model_config_param, dict):
-        logger.warning(f"model_config ko phai dict, ma la {type(model_config_param)}. Dung dict rong.")
-        model_config_internal = {}
-    else:
-        model_config_internal = model_config_param.copy()
-
     try:
-        ui_api_key = model_config_internal.pop('api_key', None)
-        if ui_api_key and not ui_api_key.strip():
-            ui_api_key = None
-
-        effective_api_key = ui_api_key if ui_api_key else google_api_key_cfg
-
-        if not effective_api_key:
-            logger.error("API Key thieu (ca .env va UI).")
-            return "Lỗi cấu hình: Thiếu API Key. Vui lòng đặt GOOGLE_API_KEY trong .env hoặc nhập vào Cài đặt."
-
-        try:
-            genai.configure(api_key=effective_api_key)
-            if ui_api_key:
-                 logger.info("Dung API Key tu UI.")
-        except Exception as config_e:
-             key_source = "giao diện" if ui_api_key else ".env"
-             logger.error(f"Loi config Gemini voi API Key tu {key_source}: {config_e}")
-             error_detail = str(config_e)
-             if "API key not valid" in error_detail:
-                  return f"Lỗi cấu hình: API key từ {key_source} không hợp lệ. Vui lòng kiểm tra lại."
-             else:
-                  return f"Lỗi cấu hình: Không thể cấu hình Gemini với API key từ {key_source} ({error_detail})."
-
-        model_name = model_config_internal.get('model_name', 'gemini-1.5-flash')
-        if not model_name: model_name = 'gemini-1.5-flash'
-
-        temperature = model_config_internal.get('temperature', 0.7)
-        top_p = model_config_internal.get('top_p', 0.95)
-        top_k = model_config_internal.get('top_k', 40)
-        safety_setting_key = model_config_internal.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE')
-        safety_settings = safety_settings_map_cfg.get(safety_setting_key, safety_settings_map_cfg['BLOCK_MEDIUM_AND_ABOVE'])
-
-        generation_config = GenerationConfig(
-            temperature=float(temperature),
-            top_p=float(top_p),
-            top_k=int(top_k)
-        )
+        ui_api_key = _pop_ui_api_key(model_config_internal)
+        model, generation_config, safety_settings, setup_error = _prepare_gemini_call(model_config_internal, ui_api_key)
+        if setup_error:
+            return setup_error
 
-        logger.info(f"Goi model: {model_name} voi config: T={temperature}, P={top_p}, K={top_k}, Safety={safety_setting_key}")
-        model = genai.GenerativeModel(model_name=model_name)
-        
         if full_prompt.startswith("Lỗi: Không thể tải template prompt"): 
             logger.error(f"Huy goi Gemini do: {full_prompt}")
             return full_prompt 
 
-        response = model.generate_content(
-            full_prompt,
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
+        with GEMINI_CALL_DURATION.time(model=model_metric_label(model), kind="generate", outcome="ok") as metric_labels:
+            try:
+                response = model.generate_content(
+                    full_prompt,
+                    generation_config=generation_config,
+                    safety_settings=safety_settings
+                )
+            except Exception:
+                metric_labels["outcome"] = "error"
+                raise
 
-        if not response.candidates and hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
-            block_reason = response.prompt_feedback.block_reason.name
-            safety_ratings_str = str(getattr(response.prompt_feedback, 'safety_ratings', 'Không có'))
-            logger.warning(f"Phan hoi bi chan: {block_reason}. Ratings: {safety_ratings_str}")
-            return f"Lỗi: Phản hồi bị chặn bởi cài đặt an toàn (Lý do: {block_reason}). Hãy thử điều chỉnh Safety Settings hoặc prompt."
+        blocked_message = _blocked_response_message(response)
+        if blocked_message:
+            return blocked_message
 
         raw_text = response.text.strip()
 
         if is_for_review_or_debug and raw_text: 
-             lines = raw_text.splitlines()
-             cleaned_lines = []
-             prefixes_to_remove = (
-                 "đây là đánh giá", "here is the review", "phân tích code",
-                 "review:", "analysis:", "đây là phân tích", "here is the analysis",
-                 "giải thích và đề xuất:", "phân tích và đề xuất:",
-                 "đây là giải thích", "here is the explanation", "giải thích:", "explanation:",
-                 "```text"
-             )
-             first_meaningful_line = False
-             for line in lines:
-                 stripped_line_lower = line.strip().lower()
-                 if stripped_line_lower.startswith(("[thinking", "[processing")) and stripped_line_lower.endswith("]"):
-                     continue
-                 if not first_meaningful_line and any(stripped_line_lower.startswith(p) for p in prefixes_to_remove):
-                     continue
-                 if line.strip():
-                     first_meaningful_line = True
-                 if first_meaningful_line:
-                     cleaned_lines.append(line)
-             final_text = "\n".join(cleaned_lines).strip()
-             return final_text
+             return clean_review_text(raw_text)
 
         return raw_text
 
     except Exception as e:
-        error_message = str(e)
-        model_name_for_error = model_config_internal.get('model_name', 'unknown_model')
-        logger.error(f"Loi API Gemini ({model_name_for_error}): {error_message}", exc_info=True)
-        if "API key not valid" in error_message:
-             key_source = "giao diện" if ui_api_key else ".env"
-             return f"Lỗi cấu hình: API key từ {key_source} không hợp lệ. Vui lòng kiểm tra."
-        elif "Could not find model" in error_message or "permission denied" in error_message.lower():
-             return f"Lỗi cấu hình: Không tìm thấy hoặc không có quyền truy cập model '{model_name_for_error}'."
-        elif "invalid" in error_message.lower() and any(p in error_message.lower() for p in ["temperature", "top_p", "top_k", "safety_settings"]):
-             return f"Lỗi cấu hình: Giá trị tham số (Temperature/TopP/TopK/Safety) không hợp lệ. ({error_message})"
-        elif "Deadline Exceeded" in error_message or "timeout" in error_message.lower():
-             return f"Lỗi mạng: Yêu cầu tới Gemini API bị quá thời gian (timeout). Vui lòng thử lại."
-        elif "SAFETY" in error_message.upper(): 
-             details_match = re.search(r"Finish Reason: (\w+)", error_message)
-             reason_detail = f" (Lý do: {details_match.group(1)})" if details_match else ""
-             safety_ratings_match = re.search(r"Safety Ratings: \[(.+?)]", error_message, re.DOTALL)
-             ratings_detail = f", Ratings: {safety_ratings_match.group(1)}" if safety_ratings_match else ""
-             return f"Lỗi: Yêu cầu hoặc phản hồi có thể vi phạm chính sách an toàn của Gemini.{reason_detail}{ratings_detail} ({error_message[:100]}...)"
-        return f"Lỗi máy chủ khi gọi Gemini: {error_message}"
-
-    finally: 
-        if ui_api_key and google_api_key_cfg and google_api_key_cfg != ui_api_key:
+        return _describe_gemini_error(e, model_config_internal, ui_api_key)
+
+# --- Cache phan hoi cho review/explain/debug ---
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """Lay cache phan hoi dung chung (khoi tao lan dau tu app.config)."""
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                cfg = current_app.config
+                _response_cache = TieredResponseCache(
+                    max_entries=cfg.get('RESPONSE_CACHE_MAX_ENTRIES', 512),
+                    ttl=cfg.get('RESPONSE_CACHE_TTL', 3600),
+                    sqlite_path=cfg.get('RESPONSE_CACHE_SQLITE_PATH'),
+                )
+    return _response_cache
+
+def _response_cache_key(full_prompt, model_config_param, is_for_review_or_debug):
+    """Key = hash(prompt da chuan hoa + model + tham so sinh). Ko gom API key."""
+    model_config_param = model_config_param if isinstance(model_config_param, dict) else {}
+    normalized_prompt = "\n".join(line.rstrip() for line in full_prompt.replace("\r\n", "\n").strip().split("\n"))
+    return TieredResponseCache.make_key(
+        normalized_prompt,
+        model_config_param.get('model_name') or 'gemini-1.5-flash',
+        float(model_config_param.get('temperature', 0.7)),
+        float(model_config_param.get('top_p', 0.95)),
+        int(model_config_param.get('top_k', 40)),
+        model_config_param.get('safety_setting') or 'BLOCK_MEDIUM_AND_ABOVE',
+        bool(is_for_review_or_debug),
+    )
+
+def cached_generate_response(full_prompt, model_config_param, is_for_review_or_debug=False, bypass_cache=False):
+    """
+    generate_response_from_gemini co cache theo noi dung prompt. Tra ve (text, from_cache).
+    Phan hoi loi ko duoc cache; bypass_cache=True luon goi Gemini (va ghi de cache).
+    """
+    logger = current_app.logger
+    if not current_app.config.get('RESPONSE_CACHE_ENABLED', True):
+        return generate_response_from_gemini(full_prompt, model_config_param, is_for_review_or_debug), False
+
+    cache = get_response_cache()
+    cache_key = _response_cache_key(full_prompt, model_config_param, is_for_review_or_debug)
+    if not bypass_cache:
+        cached_text = cache.get(cache_key)
+        if cached_text is not None:
+            logger.info(f"Cache phan hoi Gemini: hit ({cache_key[:12]}).")
+            return cached_text, True
+
+    response_text = generate_response_from_gemini(full_prompt, model_config_param, is_for_review_or_debug)
+    if response_text and not response_text.startswith("Lỗi"):
+        cache.set(cache_key, response_text)
+    return response_text, False
+
+def stream_response_from_gemini(full_prompt, model_config_param):
+    """
+    Goi Gemini voi stream=True. Generator phat {'type': 'text', 'text': ...} cho tung doan,
+    ket thuc bang {'type': 'final', 'text': <toan bo phan hoi hoac thong bao loi>}.
+    """
+    logger = current_app.logger
+    model_config_internal = _copy_model_config(model_config_param, logger)
+    ui_api_key = None
+
+    try:
+        ui_api_key = _pop_ui_api_key(model_config_internal)
+        model, generation_config, safety_settings, setup_error = _prepare_gemini_call(model_config_internal, ui_api_key)
+        if setup_error:
+            yield {"type": "final", "text": setup_error}
+            return
+
+        if full_prompt.startswith("Lỗi: Không thể tải template prompt"):
+            logger.error(f"Huy goi Gemini do: {full_prompt}")
+            yield {"type": "final", "text": full_prompt}
+            return
+
+        collected_chunks = []
+        with GEMINI_CALL_DURATION.time(model=model_metric_label(model), kind="stream", outcome="ok") as metric_labels:
             try:
-                genai.configure(api_key=google_api_key_cfg)
-            except Exception as reset_e:
-                logger.warning(f"Ko the reset API key global ve key .env: {reset_e}")
-        elif ui_api_key and not google_api_key_cfg:
-             pass 
\ No newline at end of file
+                response = model.generate_content(
+                    full_prompt,
+                    generation_config=generation_config,
+                    safety_settings=safety_settings,
+                    stream=True
+                )
+                for chunk in response:
+                    for part in iter_response_parts(chunk):
+                        if getattr(part, 'text', None):
+                            collected_chunks.append(part.text)
+                            yield {"type": "text", "text": part.text}
+            except Exception:
+                metric_labels["outcome"] = "error"
+                raise
+
+        blocked_message = _blocked_response_message(response)
+        if blocked_message:
+            yield {"type": "final", "text": blocked_message}
+            return
+        yield {"type": "final", "text": "".join(collected_chunks).strip()}
+
+    except Exception as e:
+        yield {"type": "final", "text": _describe_gemini_error(e, model_config_internal, ui_api_key)}
+
+def model_metric_label(model):
+    """Ten model cho label metric ('models/gemini-1.5-flash' -> 'gemini-1.5-flash')."""
+    return str(getattr(model, 'model_name', '') or 'unknown').replace('models/', '', 1)
+
+def iter_response_parts(response_or_chunk):
+    """Lay parts cua candidate dau tien (an toan voi chunk rong)."""
+    candidates = getattr(response_or_chunk, 'candidates', None)
+    if not candidates:
+        return []
+    content = getattr(candidates[0], 'content', None)
+    if not content or not content.parts:
+        return []
+    return content.parts
+
+def build_generation_settings(model_config):
+    """Tao GenerationConfig & list SafetySetting cho cac vong lap Function Calling."""
+    logger = current_app.logger
+    try:
+        generation_config_obj = GenerationConfig(
+            temperature=float(model_config.get('temperature', 0.7)),
+            top_p=float(model_config.get('top_p', 0.95)),
+            top_k=int(model_config.get('top_k', 40))
+        )
+    except AttributeError as e_types_attr:
+        logger.error(f"Loi AttributeError khi truy cap GenerationConfig tu google.generativeai.types: {e_types_attr}. Thu import truc tiep tu genai.types")
+        generation_config_obj = genai.types.GenerationConfig(
+            temperature=float(model_config.get('temperature', 0.7)),
+            top_p=float(model_config.get('top_p', 0.95)),
+            top_k=int(model_config.get('top_k', 40))
+        )
+
+    safety_setting_key = model_config.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE')
+    safety_settings_config = current_app.config.get('SAFETY_SETTINGS_MAP', {}).get(safety_setting_key, [])
+    safety_settings_list = []
+    for setting in safety_settings_config:
+        category_name = setting['category'].replace("HARM_CATEGORY_", "")
+        if hasattr(genai.types.HarmCategory, category_name):
+            category_enum = getattr(genai.types.HarmCategory, category_name)
+            threshold_enum = getattr(genai.types.SafetySetting.HarmBlockThreshold, setting['threshold'])
+            safety_settings_list.append(genai.types.SafetySetting(category=category_enum, threshold=threshold_enum))
+        else:
+            logger.warning(f"Bo qua safety setting voi category khong hop le: {setting['category']}")
+    return generation_config_obj, safety_settings_list
@@ -0,0 +1,201 @@
+# backend/job_utils.py
+import uuid
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+
+from .execution_utils import stream_local_script, execute_fortigate_commands
+
+# Trang thai job
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+_FINISHED_STATES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+
+class JobQueueFull(Exception):
+    """Hang doi job da day."""
+
+
+class Job:
+    """1 job thuc thi (script local hoac lenh FortiGate) chay nen."""
+
+    def __init__(self, kind, description, max_output_lines, timeout_seconds):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.description = description
+        self.status = JOB_QUEUED
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.timeout_seconds = timeout_seconds
+        self.result = None
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._output = deque(maxlen=max_output_lines) # (seq, stream, line, timestamp)
+        self._next_seq = 0
+
+    def append_output(self, stream_name, line, timestamp):
+        with self._lock:
+            self._output.append((self._next_seq, stream_name, line, timestamp))
+            self._next_seq += 1
+
+    def read_output(self, since=0):
+        """Lay cac dong co seq >= since. Dong qua cu da bi day khoi buffer se bi bo qua."""
+        with self._lock:
+            lines = [
+                {"seq": seq, "stream": stream_name, "line": line, "timestamp": ts}
+                for seq, stream_name, line, ts in self._output if seq >= since
+            ]
+            first_available = self._output[0][0] if self._output else self._next_seq
+            return lines, self._next_seq, first_available > since
+
+    @property
+    def is_finished(self):
+        return self.status in _FINISHED_STATES
+
+    def summary(self):
+        return {
+            "job_id": self.id, "kind": self.kind, "description": self.description,
+            "status": self.status, "created_at": self.created_at,
+            "started_at": self.started_at, "finished_at": self.finished_at,
+            "timeout_seconds": self.timeout_seconds, "output_lines": self._next_seq,
+        }
+
+
+class JobManager:
+    """Pool worker gioi han + hang doi co gioi han cho cac job thuc thi."""
+
+    def __init__(self, app, max_workers=4, max_queue_depth=16, max_finished_jobs=200, max_output_lines=5000):
+        self.app = app
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue_depth = max(0, int(max_queue_depth))
+        self.max_finished_jobs = max(1, int(max_finished_jobs))
+        self.max_output_lines = max(1, int(max_output_lines))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job-worker")
+        self._jobs = OrderedDict() # job_id -> Job (theo thu tu tao)
+        self._lock = threading.Lock()
+
+    def _active_count_locked(self):
+        return sum(1 for job in self._jobs.values() if not job.is_finished)
+
+    def _prune_finished_locked(self):
+        finished_ids = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished_ids[:max(0, len(finished_ids) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def submit(self, kind, description, runner, timeout_seconds=None):
+        """Dua job vao hang doi. runner(job) chay trong worker, tra ve dict ket qua."""
+        with self._lock:
+            if self._active_count_locked() >= self.max_workers + self.max_queue_depth:
+                raise JobQueueFull(f"Hàng đợi job đã đầy ({self.max_workers} đang chạy + {self.max_queue_depth} chờ). Vui lòng thử lại sau.")
+            job = Job(kind, description, self.max_output_lines, timeout_seconds)
+            self._jobs[job.id] = job
+            self._prune_finished_locked()
+        self._executor.submit(self._run_job, job, runner)
+        return job
+
+    def _run_job(self, job, runner):
+        with self.app.app_context():
+            logger = current_app.logger
+            if job.cancel_event.is_set():
+                job.status = JOB_CANCELLED
+                job.finished_at = datetime.now().isoformat()
+                return
+            job.status = JOB_RUNNING
+            job.started_at = datetime.now().isoformat()
+            logger.info(f"Job {job.id} ({job.kind}) bat dau chay.")
+            try:
+                job.result = runner(job)
+                if job.cancel_event.is_set():
+                    job.status = JOB_CANCELLED
+                elif job.result and (job.result.get("error_type") or job.result.get("return_code", 0) != 0):
+                    job.status = JOB_FAILED
+                else:
+                    job.status = JOB_SUCCEEDED
+            except Exception as e:
+                logger.error(f"Job {job.id} loi: {e}", exc_info=True)
+                job.result = {"error_type": "Exception", "message": f"Lỗi hệ thống khi chạy job: {e}", "return_code": -1}
+                job.status = JOB_FAILED
+            finally:
+                job.finished_at = datetime.now().isoformat()
+                logger.info(f"Job {job.id} ket thuc voi trang thai: {job.status}.")
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self):
+        with self._lock:
+            return [job.summary() for job in reversed(self._jobs.values())]
+
+    def cancel(self, job_id):
+        """Yeu cau huy job. Job dang cho se ko chay; script dang chay se bi kill."""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if not job.is_finished:
+            job.cancel_event.set()
+            if job.status == JOB_QUEUED:
+                job.status = JOB_CANCELLED
+                job.finished_at = datetime.now().isoformat()
+        return job
+
+    def stats(self):
+        with self._lock:
+            states = {}
+            for job in self._jobs.values():
+                states[job.status] = states.get(job.status, 0) + 1
+            return {"max_workers": self.max_workers, "max_queue_depth": self.max_queue_depth, "jobs": states}
+
+
+# Runner cho tung loai job
+def make_script_job_runner(code_to_execute, file_extension, run_as_admin):
+    def run(job):
+        result = None
+        for event in stream_local_script(code_to_execute, file_extension, run_as_admin,
+                                         timeout_seconds=job.timeout_seconds, cancel_event=job.cancel_event):
+            if event["type"] == "output":
+                job.append_output(event["stream"], event["line"], event["timestamp"])
+            else:
+                result = event["result"]
+        return result
+    return run
+
+def make_fortigate_job_runner(commands_string, fortigate_config):
+    def run(job):
+        fgt_result = execute_fortigate_commands(
+            commands_string, fortigate_config, cancel_event=job.cancel_event, timeout_seconds=job.timeout_seconds
+        )
+        timestamp = datetime.now().isoformat()
+        for line in (fgt_result.get("output") or "").splitlines(keepends=True):
+            job.append_output("stdout", line, timestamp)
+        for line in (fgt_result.get("error") or "").splitlines(keepends=True):
+            job.append_output("stderr", line, timestamp)
+        fgt_result["executed_file_type"] = "fortios"
+        return fgt_result
+    return run
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """Lay JobManager dung chung (khoi tao lan dau tu app.config)."""
+    global _job_manager
+    if _job_manager is None:
+        with _job_manager_lock:
+            if _job_manager is None:
+                cfg = current_app.config
+                _job_manager = JobManager(
+                    current_app._get_current_object(),
+                    max_workers=cfg.get('JOB_MAX_WORKERS', 4),
+                    max_queue_depth=cfg.get('JOB_MAX_QUEUE_DEPTH', 16),
+                    max_finished_jobs=cfg.get('JOB_MAX_FINISHED', 200),
+                    max_output_lines=cfg.get('JOB_MAX_OUTPUT_LINES', 5000),
+                )
+    return _job_manager
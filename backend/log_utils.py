@@ -0,0 +1,332 @@
+# backend/log_utils.py
+import os
+import json
+import time
+import zlib
+import queue
+import hashlib
+import logging # Them logging
+import logging.handlers
+from datetime import datetime
+
+# Cursor = "<inode>:<byte offset>:<fingerprint>" cua file log. Inode giu nguyen khi
+# RotatingFileHandler doi ten file (base -> .1 -> .2 ...), nen cursor van theo dung du lieu
+# sau khi xoay vong. Fingerprint (crc32 cua toi da 64 byte dau file) chong nham file khi
+# inode cua backup da bi xoa duoc tai su dung.
+_FINGERPRINT_BYTES = 64
+
+
+class InvalidLogCursor(ValueError):
+    """Cursor log ko dung dinh dang."""
+
+
+def find_log_file_handler(logger):
+    """Tra ve FileHandler (hoac RotatingFileHandler) dau tien cua logger (ke ca sau QueueHandler)."""
+    for handler in getattr(logger, 'handlers', []):
+        for target in [handler] + list(getattr(handler, 'target_handlers', ())):
+            if isinstance(target, logging.FileHandler) and getattr(target, 'baseFilename', None):
+                return target
+    return None
+
+
+# --- Pipeline ghi log ko chan request ---
+
+class RequestIdFilter(logging.Filter):
+    """Gan record.request_id (chay o thread goi log, truoc khi vao hang doi)."""
+
+    def __init__(self, request_id_provider):
+        super().__init__()
+        self.request_id_provider = request_id_provider
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            try:
+                record.request_id = self.request_id_provider() or "-"
+            except Exception:
+                record.request_id = "-"
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler voi hang doi gioi han: day thi bo record (dem lai) thay vi chan request."""
+
+    def __init__(self, log_queue, target_handlers=()):
+        super().__init__(log_queue)
+        self.target_handlers = tuple(target_handlers)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class PayloadCapMixin:
+    """Cat message qua dai; ban day du duoc ghi ra file blob rieng (chay trong thread listener)."""
+
+    def _init_payload_cap(self, max_message_chars, blob_dir, max_blob_files=200):
+        self.max_message_chars = max(256, int(max_message_chars))
+        self.blob_dir = blob_dir
+        self.max_blob_files = max(1, int(max_blob_files))
+
+    def _prune_blobs(self):
+        """Chi giu max_blob_files file blob moi nhat (ten file bat dau bang timestamp)."""
+        try:
+            blob_names = sorted(entry.name for entry in os.scandir(self.blob_dir) if entry.is_file())
+        except OSError:
+            return
+        for name in blob_names[:max(0, len(blob_names) - self.max_blob_files)]:
+            try:
+                os.remove(os.path.join(self.blob_dir, name))
+            except OSError:
+                pass
+
+    def _spill_to_blob(self, message, record):
+        digest = hashlib.sha1(message.encode('utf-8', errors='replace')).hexdigest()[:12]
+        filename = f"{datetime.fromtimestamp(record.created).strftime('%Y%m%d_%H%M%S')}_{getattr(record, 'request_id', '-')}_{digest}.log"
+        blob_path = os.path.join(self.blob_dir, filename)
+        try:
+            os.makedirs(self.blob_dir, exist_ok=True)
+            with open(blob_path, 'w', encoding='utf-8') as f:
+                f.write(message)
+            self._prune_blobs()
+            return blob_path
+        except OSError:
+            return None
+
+    def cap_message(self, message, record):
+        if len(message) <= self.max_message_chars:
+            return message
+        omitted = len(message) - self.max_message_chars
+        blob_path = self._spill_to_blob(message, record) if self.blob_dir else None
+        where = f", bản đầy đủ: {os.path.basename(blob_path)}" if blob_path else ""
+        return f"{message[:self.max_message_chars]}... [đã cắt {omitted} ký tự{where}]"
+
+
+class CappedTextFormatter(PayloadCapMixin, logging.Formatter):
+    """Formatter dang text cu, them request_id & gioi han kich thuoc message."""
+
+    def __init__(self, fmt, max_message_chars=8000, blob_dir=None, max_blob_files=200):
+        super().__init__(fmt)
+        self._init_payload_cap(max_message_chars, blob_dir, max_blob_files)
+
+    def formatMessage(self, record):
+        record.message = self.cap_message(record.message, record)
+        return super().formatMessage(record)
+
+
+class JsonLogFormatter(PayloadCapMixin, logging.Formatter):
+    """Moi record -> 1 dong JSON (ts, level, request_id, msg, vi tri code)."""
+
+    def __init__(self, max_message_chars=8000, blob_dir=None, max_blob_files=200):
+        super().__init__()
+        self._init_payload_cap(max_message_chars, blob_dir, max_blob_files)
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            message = f"{message}\n{record.exc_text}"
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "request_id": getattr(record, 'request_id', '-'),
+            "msg": self.cap_message(message, record),
+            "logger": record.name,
+            "where": f"{record.pathname}:{record.lineno}",
+            "thread": record.threadName,
+        }
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_queue_logging(logger, target_handlers, request_id_provider=None, max_queue_size=10000):
+    """
+    Gan QueueHandler vao logger; cac handler ghi that (file...) chay trong QueueListener.
+    Tra ve (queue_handler, listener) - goi listener.stop() khi tat de flush.
+    """
+    log_queue = queue.Queue(maxsize=max(0, int(max_queue_size)))
+    queue_handler = NonBlockingQueueHandler(log_queue, target_handlers)
+    if request_id_provider is not None:
+        queue_handler.addFilter(RequestIdFilter(request_id_provider))
+    listener = logging.handlers.QueueListener(log_queue, *target_handlers, respect_handler_level=True)
+    logger.addHandler(queue_handler)
+    listener.start()
+    return queue_handler, listener
+
+
+def format_cursor(inode, offset, fingerprint):
+    return f"{inode}:{offset}:{fingerprint}"
+
+
+def parse_cursor(cursor):
+    """Tra ve (inode, offset, fingerprint)."""
+    try:
+        inode_str, offset_str, fingerprint_str = str(cursor).split(":", 2)
+        inode, offset, fingerprint = int(inode_str), int(offset_str), int(fingerprint_str)
+    except (TypeError, ValueError):
+        raise InvalidLogCursor(f"Cursor log ko hop le: '{cursor}'. Dinh dang: <inode>:<offset>:<fingerprint>.")
+    if offset < 0:
+        raise InvalidLogCursor(f"Cursor log ko hop le: '{cursor}' (offset am).")
+    return inode, offset, fingerprint
+
+
+def _fingerprint(f, offset):
+    """crc32 cua phan dau file truoc offset (phan nay ko doi voi cung 1 file log)."""
+    f.seek(0)
+    return zlib.crc32(f.read(min(_FINGERPRINT_BYTES, offset)))
+
+
+def _decode_lines(raw_bytes):
+    return [line.rstrip("\r") for line in raw_bytes.decode('utf-8', errors='replace').split("\n")]
+
+
+class LogTailReader:
+    """
+    Doc log theo kieu tail: seek nguoc tu cuoi file, chi doc cac block can thiet.
+    Doc tiep theo cursor (byte offset) qua ca cac file backup .1 .. .N.
+    """
+
+    def __init__(self, base_path, backup_count=10, chunk_size=8192):
+        self.base_path = base_path
+        self.backup_count = max(0, int(backup_count))
+        self.chunk_size = max(512, int(chunk_size))
+
+    def _chain(self):
+        """Cac file log hien co, tu cu nhat (.N) den moi nhat (base): list (path, inode, size)."""
+        paths = [f"{self.base_path}.{i}" for i in range(self.backup_count, 0, -1)] + [self.base_path]
+        chain = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            chain.append((path, st.st_ino, st.st_size))
+        return chain
+
+    def _complete_end(self, f, size):
+        """Vi tri ngay sau ky tu '\\n' cuoi cung (bo dong dang ghi do)."""
+        pos = size
+        while pos > 0:
+            read_size = min(self.chunk_size, pos)
+            f.seek(pos - read_size)
+            chunk = f.read(read_size)
+            newline_idx = chunk.rfind(b"\n")
+            if newline_idx != -1:
+                return pos - read_size + newline_idx + 1
+            pos -= read_size
+        return 0
+
+    def _read_last_lines(self, f, end, needed):
+        """Doc nguoc tu 'end' toi khi du 'needed' dong. Tra ve (lines, da_het_file)."""
+        pos = end
+        buffer = b""
+        while pos > 0 and buffer.count(b"\n") <= needed:
+            read_size = min(self.chunk_size, pos)
+            pos -= read_size
+            f.seek(pos)
+            buffer = f.read(read_size) + buffer
+        if buffer.endswith(b"\n"):
+            buffer = buffer[:-1]
+        if not buffer:
+            return [], pos == 0
+        lines = _decode_lines(buffer)
+        if pos > 0:
+            lines = lines[1:] # Dong dau co the bi cat giua
+        return lines[-needed:], pos == 0 and len(lines) <= needed
+
+    def tail(self, num_lines):
+        """N dong cuoi (qua ca file backup neu file hien tai it dong). Tra ve (lines, cursor)."""
+        chain = self._chain()
+        if not chain:
+            return [], None
+        collected = []
+        cursor = None
+        for index, (path, _, _) in enumerate(reversed(chain)):
+            with open(path, 'rb') as f:
+                stat_result = os.fstat(f.fileno())
+                end = self._complete_end(f, stat_result.st_size) if index == 0 else stat_result.st_size
+                if index == 0:
+                    cursor = format_cursor(stat_result.st_ino, end, _fingerprint(f, end))
+                lines, exhausted = self._read_last_lines(f, end, num_lines - len(collected))
+            collected = lines + collected
+            if len(collected) >= num_lines or not exhausted:
+                break
+        return collected[-num_lines:], cursor
+
+    def read_since(self, cursor, max_bytes=1024 * 1024):
+        """
+        Doc cac dong moi tu cursor. Tra ve (lines, cursor_moi, truncated).
+        truncated=True neu du lieu tai cursor da bi xoay vong ra khoi backup cuoi cung.
+        """
+        inode, offset, fingerprint = parse_cursor(cursor)
+        chain = self._chain()
+        if not chain:
+            return [], cursor, False
+        start_index = next((i for i, (_, ino, _) in enumerate(chain) if ino == inode), None)
+        truncated = False
+        if start_index is not None:
+            try:
+                with open(chain[start_index][0], 'rb') as f:
+                    if offset > os.fstat(f.fileno()).st_size or _fingerprint(f, offset) != fingerprint:
+                        start_index = None # File bi ghi lai hoac inode da duoc dung cho file khac
+            except OSError:
+                start_index = None
+        if start_index is None:
+            start_index, offset, truncated = 0, 0, True
+
+        lines = []
+        budget = max(1, int(max_bytes))
+        new_cursor = cursor
+        for index in range(start_index, len(chain)):
+            path = chain[index][0]
+            is_newest = index == len(chain) - 1
+            try:
+                with open(path, 'rb') as f:
+                    stat_result = os.fstat(f.fileno())
+                    f.seek(offset)
+                    data = f.read(min(budget, max(0, stat_result.st_size - offset)))
+                    reached_eof = offset + len(data) >= stat_result.st_size
+                    if not (reached_eof and not is_newest): # Bo dong chua ghi xong / bi cat boi budget
+                        last_newline = data.rfind(b"\n")
+                        data = data[:last_newline + 1] if last_newline != -1 else b""
+                    new_offset = offset + len(data)
+                    new_cursor = format_cursor(stat_result.st_ino, new_offset, _fingerprint(f, new_offset))
+            except OSError: # File vua bi xoay vong/xoa giua chung
+                break
+            if data:
+                lines.extend(_decode_lines(data[:-1] if data.endswith(b"\n") else data))
+                budget -= len(data)
+            if budget <= 0 or not reached_eof or is_newest:
+                break
+            offset = 0 # File tiep theo (moi hon) doc tu dau
+        return lines, new_cursor, truncated
+
+    def current_cursor(self):
+        """Cursor o cuoi dong hoan chinh cuoi cung cua file hien tai."""
+        try:
+            with open(self.base_path, 'rb') as f:
+                stat_result = os.fstat(f.fileno())
+                end = self._complete_end(f, stat_result.st_size)
+                return format_cursor(stat_result.st_ino, end, _fingerprint(f, end))
+        except OSError:
+            return None
+
+    def wait_for_lines(self, cursor, timeout, poll_interval=0.5, max_bytes=1024 * 1024):
+        """Long-poll: cho toi khi co dong moi hoac het timeout. Chi stat file khi cho."""
+        deadline = time.monotonic() + max(0.0, float(timeout))
+        inode, offset, _ = parse_cursor(cursor)
+        while True:
+            try:
+                st = os.stat(self.base_path)
+                has_new_data = st.st_ino != inode or st.st_size > offset
+            except OSError:
+                has_new_data = False
+            if has_new_data:
+                lines, new_cursor, truncated = self.read_since(cursor, max_bytes=max_bytes)
+                if lines or truncated or new_cursor != cursor:
+                    return lines, new_cursor, truncated
+            if time.monotonic() >= deadline:
+                return [], cursor, False
+            time.sleep(poll_interval)
@@ -0,0 +1,219 @@
+# backend/metrics_utils.py
+import re
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+# Bucket mac dinh (giay) cho do tre: tu vai ms (cache, prompt) den vai phut (LLM, script)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (0, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100, 500)
+
+_METRIC_NAME_RE = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*$")
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{_escape_label_value(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        if not _METRIC_NAME_RE.match(name):
+            raise ValueError(f"Ten metric ko hop le: {name}")
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._series = {} # tuple gia tri label -> trang thai
+
+    def _label_key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} can label {self.label_names}, nhan {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            series = sorted(self._series.items())
+            lines.extend(self._render_series(series))
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._label_key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _render_series(self, series):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_number(value)}" for key, value in series]
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._label_key(labels)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._series.get(key)
+            if state is None:
+                state = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            state["counts"][bucket_index] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Do thoi gian khoi lenh (giay). labels co the sua trong khoi qua dict tra ve."""
+        mutable_labels = dict(labels)
+        started = time.perf_counter()
+        try:
+            yield mutable_labels
+        finally:
+            self.observe(time.perf_counter() - started, **mutable_labels)
+
+    def _render_series(self, series):
+        lines = []
+        for key, state in series:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), state["counts"]):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', _format_number(float(upper_bound))))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_number(round(state['sum'], 6))}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {state['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """Registry metric trong tien trinh, xuat dinh dang text cua Prometheus."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = [] # callable() -> list (ten, help, loai, [(labels dict, gia tri)])
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def register_collector(self, collector):
+        """Collector tinh gia tri luc scrape (vd stats cua cache/pool)."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render_prometheus(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                samples = collector()
+            except Exception: # Collector loi ko duoc lam hong ca trang metrics
+                continue
+            for name, documentation, metric_type, values in samples:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in values:
+                    lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# --- Metric dung chung ---
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds", "Thoi gian xu ly request (ca luong SSE) theo route.", ("method", "route", "status"))
+REQUEST_STAGE_DURATION = REGISTRY.histogram(
+    "request_stage_duration_seconds", "Thoi gian tung buoc trong request (lay ngu canh, tao prompt, trich xuat code...).", ("stage",))
+GEMINI_CALL_DURATION = REGISTRY.histogram(
+    "gemini_call_duration_seconds", "Thoi gian goi Gemini theo model.", ("model", "kind", "outcome"))
+FORTIGATE_SSH_CONNECT_DURATION = REGISTRY.histogram(
+    "fortigate_ssh_connect_duration_seconds", "Thoi gian mo phien SSH + xac thuc FortiGate.", ("outcome",))
+FORTIGATE_COMMAND_DURATION = REGISTRY.histogram(
+    "fortigate_command_duration_seconds", "Thoi gian thuc thi lenh FortiGate theo dong tu dau tien.", ("verb", "outcome"))
+FORTIGATE_COMMAND_OUTPUT_BYTES = REGISTRY.histogram(
+    "fortigate_command_output_bytes", "Kich thuoc output lenh FortiGate.", ("verb",), buckets=SIZE_BUCKETS)
+FUNCTION_CALLING_TOOL_CALLS = REGISTRY.histogram(
+    "function_calling_tool_calls", "So lan goi tool trong 1 vong lap Function Calling.", ("loop", "outcome"), buckets=COUNT_BUCKETS)
+FUNCTION_CALLING_TOOL_DURATION = REGISTRY.histogram(
+    "function_calling_tool_duration_seconds", "Thoi gian chay 1 tool backend.", ("tool", "outcome"))
+FUNCTION_CALLING_TOOL_MEMO = REGISTRY.counter(
+    "function_calling_tool_memo_total", "Tra cuu ket qua tool da nho trong hoi thoai (hit/miss/skip = lenh ko duoc nho).", ("result",))
+FUNCTION_CALLING_TOOL_OUTPUT_BYTES = REGISTRY.histogram(
+    "function_calling_tool_output_bytes", "Kich thuoc ket qua tool truoc (raw) va sau khi rut gon (sent) gui cho Gemini.", ("stage",), buckets=SIZE_BUCKETS)
+FORTIOS_CONFIG_INDEX_QUERIES = REGISTRY.counter(
+    "fortios_config_index_queries_total", "Lenh show tra tu chi muc cau hinh (hit/miss = phai hoi thiet bi/building = chua co chi muc).", ("result",))
+FORTIOS_CONFIG_INDEX_BUILD_DURATION = REGISTRY.histogram(
+    "fortios_config_index_build_duration_seconds", "Thoi gian lay 'show full-configuration' & dung chi muc cau hinh.")
+FORTIGATE_POLICY_MATCH_FLOWS = REGISTRY.counter(
+    "fortigate_policy_match_flows_total", "Luong doi chieu policy cuc bo (match/implicit_deny/error = luong sai dinh dang).", ("outcome",))
+FORTIGATE_POLICY_MATCHER_BUILD_DURATION = REGISTRY.histogram(
+    "fortigate_policy_matcher_build_duration_seconds", "Thoi gian dung bo so khop policy tu cay cau hinh.")
+FORTIGATE_ROUTE_LOOKUPS = REGISTRY.counter(
+    "fortigate_route_lookups_total", "Tra cuu route cuc bo theo IP (hit/no_route/error = IP sai).", ("outcome",))
+FORTIGATE_ROUTE_TABLE_BUILD_DURATION = REGISTRY.histogram(
+    "fortigate_route_table_build_duration_seconds", "Thoi gian phan tich routing-table & dung trie LPM.")
+FORTIGATE_FLEET_DEVICE_RUNS = REGISTRY.counter(
+    "fortigate_fleet_device_runs_total", "Ket qua chay lenh tren tung thiet bi trong fleet.", ("outcome",))
+FORTIGATE_FLEET_RUN_DURATION = REGISTRY.histogram(
+    "fortigate_fleet_run_duration_seconds", "Thoi gian 1 lan chay fleet (= thiet bi cham nhat neu du slot song song).")
+SCRIPT_EXECUTION_DURATION = REGISTRY.histogram(
+    "script_execution_duration_seconds", "Thoi gian chay script local.", ("extension", "outcome"))
+SCRIPT_OUTPUT_BYTES = REGISTRY.histogram(
+    "script_output_bytes", "Kich thuoc output script local (sau ring buffer).", ("stream",), buckets=SIZE_BUCKETS)
+
+
+def timed_stage(stage):
+    """Decorator: ghi thoi gian ham vao request_stage_duration_seconds{stage=...}."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with REQUEST_STAGE_DURATION.time(stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def command_verb(command):
+    """Dong tu dau tien cua lenh (show/get/diagnose/config...), giu so label it."""
+    verb = command.strip().split(None, 1)[0].lower() if command and command.strip() else ""
+    return verb if verb in ("show", "get", "diagnose", "execute", "config", "fnsysctl") else "other"
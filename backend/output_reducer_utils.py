@@ -0,0 +1,170 @@
+# backend/output_reducer_utils.py
+import re
+import math
+from collections import Counter
+from flask import current_app
+
+from .token_utils import get_token_counter
+from .metrics_utils import FUNCTION_CALLING_TOOL_OUTPUT_BYTES
+
+_TERM_RE = re.compile(r"[\w][\w\-\.:/]*", re.UNICODE) # Giu nguyen IP, prefix, 'port1', 'policy-id', MAC
+_LOG_LINE_RE = re.compile(r"\b(?:date|logid|type)=", re.IGNORECASE)
+_CONFIG_CHUNK_START_RE = re.compile(r"^(?:config |\s{0,4}edit )") # 'config' goc hoac 'edit' cap 1
+_STOP_TERMS = frozenset((
+    "show", "get", "diagnose", "execute", "full-configuration", "grep", "all", "the", "and", "cho", "của", "các",
+    "những", "trong", "với", "này", "nào", "không", "hãy", "giúp", "tôi", "được", "có", "là", "và", "tại", "sao", "bị",
+    "dùng", "xem", "kiểm", "tra",
+    # Tu hoi/tro dong tu tieng Anh (ko mang thong tin loc output)
+    "what", "which", "who", "whom", "whose", "why", "how", "when", "where", "is", "are", "was", "were", "be", "been",
+    "do", "does", "did", "has", "have", "had", "can", "could", "should", "would", "will", "there", "this", "that",
+    "these", "those", "it", "its", "my", "me", "we", "our", "you", "your", "of", "for", "with", "about", "please",
+    "to", "in", "on", "at", "an", "or", "if", "tell", "list", "check", "currently", "current",
+))
+_SYNTAX_TERMS = frozenset(("config", "edit", "set", "unset", "next", "end", "enable", "disable")) # Ko dung lam goi y loc
+_MAX_SUGGESTED_TERM_CHARS = 40
+_MAX_WINDOW_LINES = 20 # Doan van ban ko co dong trong: cat thanh cua so N dong
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def _terms(text):
+    return [term.strip(".:/-").lower() for term in _TERM_RE.findall(text or "") if len(term.strip(".:/-")) >= 2]
+
+
+def query_terms(question, command):
+    """Tu khoa truy van: cau hoi nguoi dung + tham so lenh (bo dong tu/tu dung pho bien)."""
+    return [term for term in dict.fromkeys(_terms(question) + _terms(command)) if term not in _STOP_TERMS]
+
+
+def chunk_tool_output(text):
+    """
+    Chia output thanh cac khoi (list cac list dong): cau hinh -> theo 'edit' cap 1 / 'config' goc,
+    log -> tung dong, con lai -> doan cach nhau boi dong trong (doan dai cat thanh cua so).
+    """
+    lines = text.splitlines()
+    if not lines:
+        return []
+    non_empty = [line for line in lines if line.strip()]
+    if non_empty and sum(1 for line in non_empty if _LOG_LINE_RE.search(line)) * 2 > len(non_empty):
+        return [[line] for line in lines if line.strip()]
+    chunks = []
+    if sum(1 for line in non_empty if _CONFIG_CHUNK_START_RE.match(line)) >= 2:
+        for line in lines:
+            if not chunks or _CONFIG_CHUNK_START_RE.match(line):
+                chunks.append([])
+            chunks[-1].append(line)
+        return chunks
+    for line in lines:
+        if not line.strip():
+            if chunks and chunks[-1]:
+                chunks.append([])
+            continue
+        if not chunks or len(chunks[-1]) >= _MAX_WINDOW_LINES:
+            chunks.append([])
+        chunks[-1].append(line)
+    return [chunk for chunk in chunks if chunk]
+
+
+def bm25_scores(chunk_terms, terms):
+    """Diem BM25 cua tung khoi (list Counter tu) voi tap tu khoa."""
+    if not terms or not chunk_terms:
+        return [0.0] * len(chunk_terms)
+    total = len(chunk_terms)
+    average_length = (sum(sum(counts.values()) for counts in chunk_terms) / total) or 1.0
+    idf = {}
+    for term in terms:
+        document_frequency = sum(1 for counts in chunk_terms if term in counts)
+        idf[term] = math.log(1 + (total - document_frequency + 0.5) / (document_frequency + 0.5)) if document_frequency else 0.0
+    scores = []
+    for counts in chunk_terms:
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * sum(counts.values()) / average_length)
+        scores.append(sum(
+            idf[term] * counts[term] * (BM25_K1 + 1) / (counts[term] + length_norm)
+            for term in terms if counts.get(term)
+        ))
+    return scores
+
+
+def suggest_filter(command, terms, dropped_chunks):
+    """Lenh goi lai de xem phan bi luoc: loc theo tu khoa xuat hien nhieu nhat trong phan bi bo."""
+    base_command = command.split("|", 1)[0].strip()
+    dropped_counts = Counter(term for chunk in dropped_chunks for term in _terms("\n".join(chunk)))
+    usable = lambda t: len(t) <= _MAX_SUGGESTED_TERM_CHARS and t not in _STOP_TERMS and t not in _SYNTAX_TERMS and not t.isdigit()
+    term = max((t for t in terms if usable(t)), key=lambda t: dropped_counts.get(t, 0), default=None)
+    if not term or not dropped_counts.get(term):
+        term = next((t for t, _ in dropped_counts.most_common() if usable(t)), "<từ khóa>")
+    grep_flag = "-f " if base_command.lower().startswith("show") else ""
+    return f"{base_command} | grep {grep_flag}{term}"
+
+
+def reduce_tool_output(command, text, question=None, token_budget=2500, max_bytes=12000, counter=None):
+    """
+    Output tool vuot ngan sach -> chi giu cac khoi lien quan nhat (BM25 voi cau hoi + lenh), dung thu tu goc,
+    kem chu thich so dong da luoc va goi y lenh loc. Tra ve (text, None) neu giu nguyen hoac
+    (text rut gon, {'original_lines', 'kept_lines', 'original_bytes'}).
+    """
+    counter = counter or get_token_counter()
+    original_bytes = len(text.encode('utf-8'))
+    if original_bytes <= max_bytes and counter.estimate(text) <= token_budget:
+        return text, None
+    chunks = chunk_tool_output(text)
+    terms = query_terms(question, command)
+    chunk_texts = ["\n".join(chunk) for chunk in chunks]
+    scores = bm25_scores([Counter(_terms(chunk_text)) for chunk_text in chunk_texts], terms)
+    # Khoi dau (thuong la '$ lenh' / header) luon giu de model biet output cua lenh nao. Co khoi lien quan
+    # -> chi giu khoi lien quan; ko co -> giu phan dau output.
+    has_relevant = any(score > 0 for score in scores[1:])
+    ranked = [0] + sorted((i for i in range(1, len(chunks)) if scores[i] > 0 or not has_relevant), key=lambda i: (-scores[i], i))
+    reserve_tokens = 80 # Cho header + chu thich luoc bo
+    selected, used_tokens, used_bytes = set(), 0, 0
+    for index in ranked:
+        chunk_tokens = counter.estimate(chunk_texts[index]) + 1
+        chunk_bytes = len(chunk_texts[index].encode('utf-8')) + 1
+        if used_tokens + chunk_tokens > token_budget - reserve_tokens or used_bytes + chunk_bytes > max_bytes - 400:
+            if not has_relevant and index != 0:
+                break # Lay phan dau output: dung o khoi dau tien ko vua
+            continue
+        selected.add(index)
+        used_tokens += chunk_tokens
+        used_bytes += chunk_bytes
+    dropped = [chunks[i] for i in range(len(chunks)) if i not in selected]
+    original_lines = len(text.splitlines())
+    kept_lines = sum(len(chunks[i]) for i in selected)
+    relevant = sum(1 for i in selected if scores[i] > 0)
+    parts = []
+    previous = -1
+    for index in sorted(selected):
+        if index != previous + 1:
+            parts.append(f"[... {sum(len(chunks[i]) for i in range(previous + 1, index))} dòng ...]")
+        parts.append(chunk_texts[index])
+        previous = index
+    hint = (
+        f"[Đã rút gọn output: giữ {kept_lines}/{original_lines} dòng ({len(selected)}/{len(chunks)} khối"
+        + (f", {relevant} khối liên quan theo từ khóa: {', '.join(terms[:8])}" if terms else ", không có từ khóa để xếp hạng")
+        + f"). Lược {original_lines - kept_lines} dòng; nếu cần xem thêm hãy gọi lại tool với bộ lọc, ví dụ: '{suggest_filter(command, terms, dropped)}'.]"
+    )
+    if previous != len(chunks) - 1:
+        parts.append(f"[... {sum(len(chunks[i]) for i in range(previous + 1, len(chunks)))} dòng ...]")
+    body = "\n".join(parts)
+    if not selected or len(body.encode('utf-8')) > max_bytes: # Khoi/dong don qua lon: cat cung theo ky tu
+        body = text[:max(0, max_bytes - 400) // 4] + "\n[... phần còn lại bị cắt ...]"
+    return body + "\n" + hint, {"original_lines": original_lines, "kept_lines": kept_lines, "original_bytes": original_bytes}
+
+
+def reduce_tool_response(tool_name, tool_args, tool_response_text, question=None):
+    """Rut gon ket qua tool trong vong lap FC theo cau hinh app (FC_TOOL_OUTPUT_*). Tra ve (text, thong tin rut gon)."""
+    cfg = current_app.config
+    FUNCTION_CALLING_TOOL_OUTPUT_BYTES.observe(len(tool_response_text.encode('utf-8')), stage="raw")
+    reduction = None
+    if cfg.get('FC_TOOL_OUTPUT_REDUCER_ENABLED', True):
+        command = str(tool_args.get("command") or tool_name)
+        tool_response_text, reduction = reduce_tool_output(
+            command, tool_response_text, question,
+            token_budget=cfg.get('FC_TOOL_OUTPUT_TOKEN_BUDGET', 2500), max_bytes=cfg.get('FC_TOOL_OUTPUT_MAX_BYTES', 12000),
+        )
+        if reduction:
+            current_app.logger.info(
+                f"Tool '{tool_name}': rut gon output '{command}' {reduction['original_lines']} -> {reduction['kept_lines']} dong."
+            )
+    FUNCTION_CALLING_TOOL_OUTPUT_BYTES.observe(len(tool_response_text.encode('utf-8')), stage="sent")
+    return tool_response_text, reduction
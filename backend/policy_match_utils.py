@@ -0,0 +1,525 @@
+# backend/policy_match_utils.py
+import shlex
+import ipaddress
+from bisect import bisect_right
+from datetime import datetime
+
+from .fortios_config_utils import parse_fortios_config
+from .metrics_utils import FORTIGATE_POLICY_MATCH_FLOWS, FORTIGATE_POLICY_MATCHER_BUILD_DURATION
+
+IPV4_MAX = (1 << 32) - 1
+PROTOCOL_NUMBERS = {"tcp": 6, "udp": 17, "sctp": 132, "icmp": 1}
+_PORT_RANGE_ATTRS = {6: "tcp-portrange", 17: "udp-portrange", 132: "sctp-portrange"}
+_ANY_NAMES = ("all", "any") # Ten doi tuong mac dinh khop moi thu (khi cau hinh ko day du)
+MAX_UNCERTAIN_REPORTED = 20
+
+
+def _values(raw_value):
+    """Gia tri tho cua 'set' -> list (bo dau nhay): '"a" "b c"' -> ['a', 'b c']."""
+    try:
+        return shlex.split(raw_value or "")
+    except ValueError:
+        return (raw_value or "").split()
+
+
+def _ip_to_int(text):
+    return int(ipaddress.IPv4Address(text))
+
+
+def _merge(intervals):
+    """Gop cac doan [dau, cuoi] chong/ke nhau, tra ve tuple da sap xep."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return tuple((start, end) for start, end in merged)
+
+
+def _subtract(intervals, removed):
+    """Cac doan trong intervals nhung ko thuoc removed (ca 2 da gop)."""
+    result = []
+    for start, end in intervals:
+        for r_start, r_end in removed:
+            if r_end < start or r_start > end:
+                continue
+            if r_start > start:
+                result.append((start, r_start - 1))
+            start = r_end + 1
+            if start > end:
+                break
+        if start <= end:
+            result.append((start, end))
+    return tuple(result)
+
+
+def _iter_bits(mask, limit=None):
+    """Vi tri cac bit 1 cua mask, tu thap den cao."""
+    positions = []
+    while mask and (limit is None or len(positions) < limit):
+        low = mask & -mask
+        positions.append(low.bit_length() - 1)
+        mask ^= low
+    return positions
+
+
+class _IntervalBitIndex:
+    """
+    Tra cuu gia tri (IP/port) -> bitset cac policy chua gia tri do. Dung bang quet cac diem bien:
+    moi doan giua 2 diem bien co 1 bitset, tra cuu = bisect (O(log so diem bien)).
+    """
+
+    def __init__(self, bit_intervals):
+        toggles = {}
+        for bit, intervals in bit_intervals: # Doan cua 1 bit da gop -> bat o dau, tat sau cuoi
+            for start, end in intervals:
+                toggles[start] = toggles.get(start, 0) ^ bit
+                toggles[end + 1] = toggles.get(end + 1, 0) ^ bit
+        self.points = sorted(toggles)
+        self.masks = []
+        running = 0
+        for point in self.points:
+            running ^= toggles[point]
+            self.masks.append(running)
+
+    def lookup(self, value):
+        position = bisect_right(self.points, value) - 1
+        return self.masks[position] if position >= 0 else 0
+
+
+class _AddressResolver:
+    """
+    Ten address/addrgrp/vip/vipgrp -> (doan IPv4 da gop, uncertain). uncertain = co thanh phan
+    ko xac dinh duoc tai cho (FQDN, geography, dynamic, wildcard, ten ko co trong cau hinh).
+    """
+
+    def __init__(self, root):
+        section = lambda name: root.sections[name].entries if name in root.sections else {}
+        self.addresses = section("firewall address")
+        self.groups = section("firewall addrgrp")
+        self.vips = section("firewall vip")
+        self.vip_groups = section("firewall vipgrp")
+        self._resolved = {}
+        self.unresolved_names = set()
+
+    def resolve(self, name, _visiting=None):
+        if name in self._resolved:
+            return self._resolved[name]
+        visiting = _visiting or set()
+        if name in visiting: # Nhom long vong
+            return (), True
+        visiting.add(name)
+        if name in self.addresses:
+            result = self._address(self.addresses[name])
+        elif name in self.groups:
+            result = self._group(self.groups[name], visiting)
+        elif name in self.vips:
+            result = self._vip(self.vips[name])
+        elif name in self.vip_groups:
+            result = self.resolve_many(_values(self.vip_groups[name].attrs.get("member")), visiting)
+        elif name.lower() in _ANY_NAMES:
+            result = ((0, IPV4_MAX),), False
+        elif name.lower() == "none":
+            result = (), False
+        else:
+            self.unresolved_names.add(name)
+            result = (), True
+        visiting.discard(name)
+        self._resolved[name] = result
+        return result
+
+    def resolve_many(self, names, _visiting=None):
+        intervals, uncertain = [], False
+        for name in names:
+            member_intervals, member_uncertain = self.resolve(name, _visiting)
+            intervals.extend(member_intervals)
+            uncertain = uncertain or member_uncertain
+        return _merge(intervals), uncertain
+
+    def _address(self, node):
+        address_type = node.attrs.get("type", "ipmask")
+        try:
+            if address_type in ("ipmask", "interface-subnet"):
+                subnet = _values(node.attrs.get("subnet")) or ["0.0.0.0", "0.0.0.0"]
+                network = ipaddress.IPv4Network("/".join(subnet[:2]) if len(subnet) > 1 else subnet[0], strict=False)
+                return ((int(network.network_address), int(network.broadcast_address)),), False
+            if address_type == "iprange":
+                start = _ip_to_int(node.attrs.get("start-ip", "0.0.0.0"))
+                end = _ip_to_int(node.attrs.get("end-ip", node.attrs.get("start-ip", "0.0.0.0")))
+                return ((min(start, end), max(start, end)),), False
+        except ValueError:
+            pass
+        self.unresolved_names.add(node.name)
+        return (), True
+
+    def _group(self, node, visiting):
+        intervals, uncertain = self.resolve_many(_values(node.attrs.get("member")), visiting)
+        if node.attrs.get("exclude") == "enable":
+            excluded, excluded_uncertain = self.resolve_many(_values(node.attrs.get("exclude-member")), visiting)
+            intervals = _subtract(intervals, excluded)
+            uncertain = uncertain or excluded_uncertain
+        return intervals, uncertain
+
+    def _vip(self, node):
+        """Policy dung VIP lam dstaddr: khop dia chi dich truoc NAT (extip)."""
+        try:
+            extip = _values(node.attrs.get("extip"))[0]
+            start, _, end = extip.partition("-")
+            return ((_ip_to_int(start), _ip_to_int(end or start)),), False
+        except (IndexError, ValueError):
+            self.unresolved_names.add(node.name)
+            return (), True
+
+
+class _ServiceSet:
+    """Tap dich vu: port dich theo giao thuc (6/17/132), giao thuc khop moi port, hoac moi giao thuc."""
+
+    def __init__(self):
+        self.ports = {} # so giao thuc -> list doan port dich
+        self.protocols = set()
+        self.any_protocol = False
+        self.uncertain = False
+
+    def update(self, other):
+        for protocol, intervals in other.ports.items():
+            self.ports.setdefault(protocol, []).extend(intervals)
+        self.protocols |= other.protocols
+        self.any_protocol = self.any_protocol or other.any_protocol
+        self.uncertain = self.uncertain or other.uncertain
+
+
+def _parse_port_ranges(raw_value):
+    """'80 443 1000-2000:1024-65535' -> doan port dich (bo phan port nguon sau ':')."""
+    intervals = []
+    for token in _values(raw_value):
+        destination = token.split(":", 1)[0]
+        low, _, high = destination.partition("-")
+        try:
+            low_port, high_port = int(low), int(high or low)
+        except ValueError:
+            continue
+        intervals.append((min(low_port, high_port), max(low_port, high_port)))
+    return intervals
+
+
+class _ServiceResolver:
+    def __init__(self, root):
+        section = lambda name: root.sections[name].entries if name in root.sections else {}
+        self.custom = section("firewall service custom")
+        self.groups = section("firewall service group")
+        self._resolved = {}
+        self.unresolved_names = set()
+
+    def resolve(self, name, _visiting=None):
+        if name in self._resolved:
+            return self._resolved[name]
+        visiting = _visiting or set()
+        service = _ServiceSet()
+        if name in visiting:
+            service.uncertain = True
+            return service
+        visiting.add(name)
+        if name in self.custom:
+            service = self._custom(self.custom[name])
+        elif name in self.groups:
+            for member in _values(self.groups[name].attrs.get("member")):
+                service.update(self.resolve(member, visiting))
+        elif name.upper() == "ALL":
+            service.any_protocol = True
+        else:
+            self.unresolved_names.add(name)
+            service.uncertain = True
+        visiting.discard(name)
+        self._resolved[name] = service
+        return service
+
+    def resolve_many(self, names):
+        service = _ServiceSet()
+        for name in names:
+            service.update(self.resolve(name))
+        return service
+
+    @staticmethod
+    def _custom(node):
+        service = _ServiceSet()
+        protocol = node.attrs.get("protocol", "TCP/UDP/SCTP").strip('"').upper()
+        if protocol == "IP":
+            protocol_number = int(node.attrs.get("protocol-number", "0") or 0)
+            if protocol_number == 0:
+                service.any_protocol = True
+            else:
+                service.protocols.add(protocol_number)
+        elif protocol in ("ICMP", "ICMP6"):
+            service.protocols.add(1 if protocol == "ICMP" else 58) # Ko xet icmptype/icmpcode
+        else: # TCP/UDP/SCTP va cac giao thuc proxy (HTTP, CONNECT...) dung tcp-portrange
+            for protocol_number, attr_name in _PORT_RANGE_ATTRS.items():
+                intervals = _parse_port_ranges(node.attrs.get(attr_name))
+                if intervals:
+                    service.ports[protocol_number] = intervals
+        return service
+
+
+class _ServiceIndex:
+    def __init__(self, policy_services):
+        """policy_services: list (bit, _ServiceSet)."""
+        self.port_indexes = {
+            protocol_number: _IntervalBitIndex(
+                (bit, _merge(service.ports[protocol_number])) for bit, service in policy_services if protocol_number in service.ports
+            )
+            for protocol_number in _PORT_RANGE_ATTRS
+        }
+        self.protocol_bits = {}
+        self.any_bits = 0
+        for bit, service in policy_services:
+            if service.any_protocol:
+                self.any_bits |= bit
+            for protocol_number in service.protocols:
+                self.protocol_bits[protocol_number] = self.protocol_bits.get(protocol_number, 0) | bit
+
+    def lookup(self, protocol_number, port):
+        bits = self.any_bits | self.protocol_bits.get(protocol_number, 0)
+        if protocol_number in self.port_indexes and port is not None:
+            bits |= self.port_indexes[protocol_number].lookup(port)
+        return bits
+
+
+class _InterfaceIndex:
+    """Interface -> bitset policy co interface do, zone chua no hoac 'any'."""
+
+    def __init__(self, policy_interfaces, zones_of):
+        self.zones_of = zones_of
+        self.name_bits = {}
+        self.any_bits = 0
+        for bit, names in policy_interfaces:
+            for name in names:
+                if name == "any":
+                    self.any_bits |= bit
+                else:
+                    self.name_bits[name] = self.name_bits.get(name, 0) | bit
+
+    def lookup(self, interface):
+        bits = self.any_bits | self.name_bits.get(interface, 0)
+        for zone in self.zones_of.get(interface, ()):
+            bits |= self.name_bits.get(zone, 0)
+        return bits
+
+
+def _zone_membership(root):
+    """Interface -> cac zone chua no (system zone + zone SD-WAN)."""
+    zones_of = {}
+    if "system zone" in root.sections:
+        for zone in root.sections["system zone"].entries.values():
+            for interface in _values(zone.attrs.get("interface")):
+                zones_of.setdefault(interface, set()).add(zone.name)
+    sdwan = root.sections.get("system sdwan") or root.sections.get("system virtual-wan-link")
+    if sdwan is not None and "members" in sdwan.sections:
+        for member in sdwan.sections["members"].entries.values():
+            for interface in _values(member.attrs.get("interface")):
+                zones_of.setdefault(interface, set()).add((_values(member.attrs.get("zone")) or ["virtual-wan-link"])[0])
+    return zones_of
+
+
+def normalize_flow(flow):
+    """
+    Luong can doi chieu (dict) -> (src, dst, giao thuc, port dich, srcintf, dstintf).
+    Nhan: src_ip/src, dst_ip/dst, protocol (tcp/udp/sctp/icmp/so, mac dinh tcp), dst_port/port, srcintf, dstintf.
+    """
+    if not isinstance(flow, dict):
+        raise ValueError("Luồng phải là object JSON.")
+    src_text, dst_text = flow.get("src_ip", flow.get("src")), flow.get("dst_ip", flow.get("dst"))
+    if not src_text or not dst_text:
+        raise ValueError("Luồng thiếu src_ip hoặc dst_ip.")
+    try:
+        src, dst = _ip_to_int(str(src_text).strip()), _ip_to_int(str(dst_text).strip())
+    except ValueError:
+        raise ValueError(f"Địa chỉ không hợp lệ hoặc không phải IPv4: {src_text} -> {dst_text}.")
+    protocol = str(flow.get("protocol") or "tcp").strip().lower()
+    try:
+        protocol_number = PROTOCOL_NUMBERS[protocol] if protocol in PROTOCOL_NUMBERS else int(float(protocol))
+    except ValueError:
+        raise ValueError(f"Giao thức không hợp lệ: {flow.get('protocol')}.")
+    port = flow.get("dst_port", flow.get("port"))
+    if protocol_number in _PORT_RANGE_ATTRS:
+        try:
+            port = int(float(port))
+        except (TypeError, ValueError):
+            raise ValueError(f"Luồng {protocol} cần dst_port là số (nhận được: {port}).")
+        if not 0 <= port <= 65535:
+            raise ValueError(f"dst_port ngoài khoảng 0-65535: {port}.")
+    else:
+        port = None
+    srcintf, dstintf = flow.get("srcintf") or None, flow.get("dstintf") or None
+    return src, dst, protocol_number, port, srcintf, dstintf
+
+
+class FirewallPolicyMatcher:
+    """
+    Doi chieu luong voi 'config firewall policy' theo dung thu tu policy (policy dau tien khop thang).
+    Moi chieu (src, dst, service, srcintf, dstintf) la 1 chi muc -> bitset policy; ket qua = bit thap nhat
+    cua AND cac bitset, nen 1 luong ton vai bisect + phep AND tren so nguyen lon du rulebase hang nghin policy.
+    Ko xet: schedule, user/group, ISDB (policy dung internet-service bi danh dau 'co the khop'), port nguon, IPv6.
+    """
+
+    def __init__(self, root):
+        if "vdom" in root.sections and "global" in root.sections:
+            raise ValueError("Cấu hình nhiều VDOM chưa được hỗ trợ khi đối chiếu policy cục bộ.")
+        with FORTIGATE_POLICY_MATCHER_BUILD_DURATION.time():
+            self._build(root)
+
+    @classmethod
+    def from_config_text(cls, config_text):
+        return cls(parse_fortios_config(config_text))
+
+    @classmethod
+    def from_index(cls, index):
+        return cls(index.root)
+
+    def _build(self, root):
+        policy_section = root.sections.get("firewall policy")
+        self.policy_nodes = list(policy_section.entries.values()) if policy_section is not None else []
+        self.policy_section = policy_section
+        addresses, services = _AddressResolver(root), _ServiceResolver(root)
+        src_entries, dst_entries, service_entries, srcintf_entries, dstintf_entries = [], [], [], [], []
+        self.enabled_mask = 0
+        self.src_negate = self.dst_negate = self.service_negate = 0
+        self.src_uncertain = self.dst_uncertain = self.service_uncertain = 0
+        self.policies = []
+        for position, node in enumerate(self.policy_nodes):
+            attrs = node.attrs
+            bit = 1 << position
+            self.policies.append({
+                "policyid": int(node.name) if node.name.isdigit() else node.name, "position": position + 1,
+                "name": _values(attrs.get("name"))[0] if attrs.get("name") else "",
+                "action": attrs.get("action", "deny"), "status": attrs.get("status", "enable"),
+                "srcintf": _values(attrs.get("srcintf")), "dstintf": _values(attrs.get("dstintf")),
+                "srcaddr": _values(attrs.get("srcaddr")), "dstaddr": _values(attrs.get("dstaddr")),
+                "service": _values(attrs.get("service")), "schedule": _values(attrs.get("schedule"))[:1] or ["always"],
+                "nat": attrs.get("nat", "disable"),
+            })
+            if attrs.get("status") == "disable":
+                continue
+            self.enabled_mask |= bit
+            for attr_prefix, entries, isdb_attr in (("src", src_entries, "internet-service-src"), ("dst", dst_entries, "internet-service")):
+                intervals, uncertain = addresses.resolve_many(_values(attrs.get(f"{attr_prefix}addr")))
+                if attrs.get(isdb_attr) == "enable": # Dich/nguon theo ISDB: ko co du lieu tai cho
+                    uncertain = True
+                entries.append((bit, intervals))
+                if uncertain:
+                    setattr(self, f"{attr_prefix}_uncertain", getattr(self, f"{attr_prefix}_uncertain") | bit)
+                if attrs.get(f"{attr_prefix}addr-negate") == "enable":
+                    setattr(self, f"{attr_prefix}_negate", getattr(self, f"{attr_prefix}_negate") | bit)
+            service = services.resolve_many(_values(attrs.get("service")))
+            if attrs.get("internet-service") == "enable" and not attrs.get("service"):
+                service.any_protocol = True # Port do ISDB quyet dinh (da danh dau uncertain o dst)
+            service_entries.append((bit, service))
+            if service.uncertain:
+                self.service_uncertain |= bit
+            if attrs.get("service-negate") == "enable":
+                self.service_negate |= bit
+            srcintf_entries.append((bit, _values(attrs.get("srcintf"))))
+            dstintf_entries.append((bit, _values(attrs.get("dstintf"))))
+        self.src_index = _IntervalBitIndex(src_entries)
+        self.dst_index = _IntervalBitIndex(dst_entries)
+        self.service_index = _ServiceIndex(service_entries)
+        zones_of = _zone_membership(root)
+        self.srcintf_index = _InterfaceIndex(srcintf_entries, zones_of)
+        self.dstintf_index = _InterfaceIndex(dstintf_entries, zones_of)
+        self.unresolved_objects = sorted(addresses.unresolved_names | services.unresolved_names)
+
+    def _dimension(self, hit_bits, negate_bits, uncertain_bits):
+        """(bitset chac chan khop, bitset co the khop) cua 1 chieu, da tinh negate."""
+        definite = ((hit_bits & ~negate_bits) | (~hit_bits & negate_bits)) & self.enabled_mask & ~(negate_bits & uncertain_bits)
+        return definite, definite | (uncertain_bits & self.enabled_mask)
+
+    def match(self, flow):
+        """
+        Policy dau tien khop luong. Tra ve dict: policy (None = implicit deny, policy 0), uncertain_policyids
+        (policy dung truoc co the khop nhung chua xac dinh duoc tai cho), interfaces_checked.
+        """
+        src, dst, protocol_number, port, srcintf, dstintf = normalize_flow(flow)
+        src_definite, src_maybe = self._dimension(self.src_index.lookup(src), self.src_negate, self.src_uncertain)
+        dst_definite, dst_maybe = self._dimension(self.dst_index.lookup(dst), self.dst_negate, self.dst_uncertain)
+        service_definite, service_maybe = self._dimension(
+            self.service_index.lookup(protocol_number, port), self.service_negate, self.service_uncertain
+        )
+        interface_bits = self.enabled_mask
+        if srcintf:
+            interface_bits &= self.srcintf_index.lookup(srcintf)
+        if dstintf:
+            interface_bits &= self.dstintf_index.lookup(dstintf)
+        definite = src_definite & dst_definite & service_definite & interface_bits
+        maybe = src_maybe & dst_maybe & service_maybe & interface_bits
+        position = (definite & -definite).bit_length() - 1 if definite else None
+        maybe_before = (maybe & ~definite) & (((1 << position) - 1) if position is not None else -1)
+        FORTIGATE_POLICY_MATCH_FLOWS.inc(outcome="implicit_deny" if position is None else "match")
+        return {
+            "flow": {
+                "src_ip": str(ipaddress.IPv4Address(src)), "dst_ip": str(ipaddress.IPv4Address(dst)),
+                "protocol": protocol_number, "dst_port": port, "srcintf": srcintf, "dstintf": dstintf,
+            },
+            "policy": self.policies[position] if position is not None else None,
+            "action": self.policies[position]["action"] if position is not None else "deny",
+            "uncertain_policyids": [self.policies[p]["policyid"] for p in _iter_bits(maybe_before, MAX_UNCERTAIN_REPORTED)],
+            "interfaces_checked": bool(srcintf and dstintf),
+        }
+
+    def match_many(self, flows):
+        """Doi chieu theo lo; luong sai dinh dang -> {'error': ...} tai vi tri do, ko lam hong ca lo."""
+        results = []
+        for flow in flows:
+            try:
+                results.append(self.match(flow))
+            except ValueError as e:
+                FORTIGATE_POLICY_MATCH_FLOWS.inc(outcome="error")
+                results.append({"flow": flow, "error": str(e)})
+        return results
+
+    def render_policy(self, policyid):
+        if self.policy_section is None:
+            return ""
+        return self.policy_section.render(entry_filter=lambda node: node.name == str(policyid))
+
+    def summary_info(self):
+        return {
+            "policies": len(self.policies), "enabled_policies": bin(self.enabled_mask).count("1"),
+            "unresolved_objects": self.unresolved_objects[:50],
+        }
+
+
+def get_policy_matcher(index):
+    """Bo so khop policy cua 1 FortiOSConfigIndex (dung 1 lan / chi muc, bo cung chi muc khi cau hinh doi)."""
+    return index.derived("firewall_policy_matcher", FirewallPolicyMatcher.from_index)
+
+
+def format_policy_match(matcher, result, built_at=None):
+    """Ket qua doi chieu 1 luong -> van ban cho model (kem khoi cau hinh policy khop)."""
+    flow = result["flow"]
+    protocol_name = next((name for name, number in PROTOCOL_NUMBERS.items() if number == flow["protocol"]), str(flow["protocol"]))
+    lines = [
+        f"(Đối chiếu cục bộ trên {len(matcher.policies)} policy của chỉ mục cấu hình"
+        + (f" lấy lúc {datetime.fromtimestamp(built_at).strftime('%H:%M:%S')})" if built_at else ")"),
+        f"Luồng: {flow['src_ip']} -> {flow['dst_ip']} {protocol_name}"
+        + (f"/{flow['dst_port']}" if flow["dst_port"] is not None else "")
+        + f" (srcintf={flow['srcintf'] or '?'}, dstintf={flow['dstintf'] or '?'})",
+    ]
+    policy = result["policy"]
+    if policy is None:
+        lines.append("Không policy nào khớp: lưu lượng bị chặn bởi implicit deny (policy 0).")
+    else:
+        lines.append(
+            f"Khớp policy {policy['policyid']}" + (f" \"{policy['name']}\"" if policy["name"] else "")
+            + f", action {policy['action']}, vị trí thứ {policy['position']} trong danh sách, NAT {policy['nat']}, schedule {policy['schedule'][0]}."
+        )
+    if result["uncertain_policyids"]:
+        lines.append(
+            "Lưu ý: các policy đứng trước có thể khớp nhưng chứa đối tượng không xác định được cục bộ "
+            f"(FQDN, geography, ISDB...): {', '.join(str(p) for p in result['uncertain_policyids'])}."
+        )
+    if not result["interfaces_checked"]:
+        lines.append("Lưu ý: chưa xét đủ srcintf/dstintf (không được cung cấp), kết quả có thể khác khi tính theo interface thực tế.")
+    lines.append("Không xét schedule, user/group, port nguồn.")
+    if policy is not None:
+        lines.append(f"\n$ show firewall policy {policy['policyid']}\n{matcher.render_policy(policy['policyid'])}")
+    return "\n".join(lines)
@@ -1,51 +1,242 @@
 # backend/prompt_utils.py
 import os
+import re
 import json
+import time
+import string
+import threading
+from datetime import datetime
 from flask import current_app
 import logging # Them logging
 from .helpers import get_language_name
+from .token_utils import fit_sections, trim_context_to_budget, trim_examples_to_budget, prompt_token_budget, get_token_counter
+from .metrics_utils import timed_stage
+
+# Cac truong .format() ma code truyen vao tung template chinh
+TEMPLATE_FIELDS = {
+    "generate_code_prompt.txt": {
+        "backend_os_name", "target_os_name", "file_type_description", "code_block_tag",
+        "script_cli_guidance", "language_specific_examples", "user_input", "fortigate_context_section",
+    },
+    "review_code_prompt.txt": {"language_name", "code_block_tag", "code_to_review"},
+    "debug_code_prompt.txt": {
+        "language_name", "code_block_tag", "processed_original_prompt", "failed_code",
+        "processed_stdout", "processed_stderr", "fortigate_context_section",
+    },
+    "explain_content_prompt.txt": {"prompt_header", "context_description", "additional_context_from_caller", "prompt_instruction"},
+}
+
+_FORMATTER = string.Formatter()
+
+def parse_template_fields(template_text):
+    """Tra ve tap ten truong {field} trong template (ValueError neu sai cu phap)."""
+    fields = set()
+    for _, field_name, _, _ in _FORMATTER.parse(template_text):
+        if field_name is None:
+            continue
+        base_name = re.split(r'[.\[]', field_name, maxsplit=1)[0]
+        if not base_name or base_name.isdigit():
+            raise ValueError(f"truong vi tri '{{{field_name}}}' ko duoc ho tro, can dat ten truong")
+        fields.add(base_name)
+    return fields
+
+
+class PromptTemplateStore:
+    """
+    Giu toan bo file instruction/example (prompt_data/*.txt) va template chinh
+    (prompt_data/prompts/*.txt) trong bo nho. Tu nap lai khi mtime thay doi
+    (kiem tra toi da 1 lan / check_interval giay) hoac khi goi reload().
+    """
+
+    def __init__(self, prompt_data_dir, prompts_dir, check_interval=2.0):
+        self.prompt_data_dir = prompt_data_dir
+        self.prompts_dir = prompts_dir
+        self.check_interval = float(check_interval)
+        self._lock = threading.Lock()
+        self._data_files = {} # filename -> noi dung (da strip)
+        self._templates = {} # filename -> noi dung goc
+        self._template_errors = {} # filename -> loi validate
+        self._mtimes = {}
+        self._last_check = 0.0
+        self.loaded_at = None
+        self.reload_count = 0
+
+    @staticmethod
+    def _scan_dir(directory):
+        """{filename: mtime} cua cac file .txt trong thu muc (ko de quy)."""
+        mtimes = {}
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith('.txt'):
+                        mtimes[entry.name] = entry.stat().st_mtime
+        except FileNotFoundError:
+            current_app.logger.error(f"Thu muc prompt '{directory}' ko ton tai.")
+        return mtimes
 
-# Ham doc nd file prompt instruction/example
-def read_prompt_file(filename, default_content=""):
-    """Doc file instruction/example, fallback default."""
-    prompt_data_dir = current_app.config.get('PROMPT_DATA_DIR', os.path.join(os.path.dirname(__file__), 'prompt_data'))
-    logger = current_app.logger
+    def _current_mtimes(self):
+        return {
+            "data": self._scan_dir(self.prompt_data_dir),
+            "templates": self._scan_dir(self.prompts_dir),
+        }
 
-    filepath = os.path.join(prompt_data_dir, filename)
-    try:
+    @staticmethod
+    def _read_file(filepath):
         with open(filepath, 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        logger.warning(f"File prompt '{filepath}' ko tim thay. Dung default.")
-        default_filepath = os.path.join(prompt_data_dir, f"default_{filename.split('_', 1)[-1]}")
-        try:
-            with open(default_filepath, 'r', encoding='utf-8') as f_default:
-                return f_default.read().strip()
-        except FileNotFoundError:
-            logger.error(f"Ca file prompt '{filepath}' & default '{default_filepath}' ko tim thay.")
-            return default_content
-    except Exception as e:
-        logger.error(f"Loi doc file prompt '{filepath}': {e}")
-        return default_content
+            return f.read()
+
+    def reload(self, mtimes=None):
+        """Doc lai toan bo file & validate template. Tra ve tom tat ket qua."""
+        logger = current_app.logger
+        mtimes = mtimes or self._current_mtimes()
+        data_files, templates, template_errors = {}, {}, {}
+
+        for filename in mtimes["data"]:
+            filepath = os.path.join(self.prompt_data_dir, filename)
+            try:
+                data_files[filename] = self._read_file(filepath).strip()
+            except Exception as e:
+                logger.error(f"Loi doc file prompt '{filepath}': {e}")
+
+        for filename in mtimes["templates"]:
+            filepath = os.path.join(self.prompts_dir, filename)
+            try:
+                template_text = self._read_file(filepath)
+            except Exception as e:
+                logger.error(f"Loi doc template prompt '{filepath}': {e}")
+                continue
+            expected_fields = TEMPLATE_FIELDS.get(filename)
+            try:
+                fields = parse_template_fields(template_text)
+            except ValueError as e:
+                template_errors[filename] = f"Cu phap template ko hop le: {e}"
+                logger.error(f"Template prompt '{filepath}' ko hop le, bo qua: {e}")
+                continue
+            if expected_fields is not None:
+                unknown_fields = fields - expected_fields
+                if unknown_fields:
+                    template_errors[filename] = f"Truong ko xac dinh: {', '.join(sorted(unknown_fields))}"
+                    logger.error(f"Template prompt '{filepath}' dung truong ko xac dinh {sorted(unknown_fields)}, bo qua.")
+                    continue
+                missing_fields = expected_fields - fields
+                if missing_fields:
+                    logger.warning(f"Template prompt '{filepath}' ko dung cac truong: {sorted(missing_fields)}")
+            templates[filename] = template_text
+
+        with self._lock:
+            self._data_files = data_files
+            self._templates = templates
+            self._template_errors = template_errors
+            self._mtimes = mtimes
+            self._last_check = time.monotonic()
+            self.loaded_at = datetime.now().isoformat()
+            self.reload_count += 1
+        logger.info(f"Da nap {len(data_files)} file prompt & {len(templates)} template ({len(template_errors)} loi).")
+        return self.stats()
+
+    def _ensure_fresh(self):
+        """Nap lan dau, sau do chi stat thu muc khi het check_interval."""
+        now = time.monotonic()
+        with self._lock:
+            never_loaded = self.loaded_at is None
+            due = self.check_interval > 0 and now - self._last_check >= self.check_interval
+            if not never_loaded and not due:
+                return
+            self._last_check = now
+        if never_loaded:
+            self.reload()
+            return
+        mtimes = self._current_mtimes()
+        if mtimes != self._mtimes:
+            current_app.logger.info("Phat hien file prompt thay doi, nap lai.")
+            self.reload(mtimes)
+
+    def get_data_file(self, filename):
+        self._ensure_fresh()
+        return self._data_files.get(filename)
+
+    def get_template(self, filename):
+        self._ensure_fresh()
+        return self._templates.get(filename)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "data_files": sorted(self._data_files),
+                "templates": sorted(self._templates),
+                "template_errors": dict(self._template_errors),
+                "loaded_at": self.loaded_at,
+                "reload_count": self.reload_count,
+                "check_interval": self.check_interval,
+            }
+
+
+_prompt_store = None
+_prompt_store_lock = threading.Lock()
+
+def get_prompt_store():
+    """Lay PromptTemplateStore dung chung (khoi tao lan dau tu app.config)."""
+    global _prompt_store
+    if _prompt_store is None:
+        with _prompt_store_lock:
+            if _prompt_store is None:
+                cfg = current_app.config
+                prompt_data_dir = cfg.get('PROMPT_DATA_DIR', os.path.join(os.path.dirname(__file__), 'prompt_data'))
+                _prompt_store = PromptTemplateStore(
+                    prompt_data_dir,
+                    cfg.get('PROMPTS_DIR', os.path.join(prompt_data_dir, 'prompts')),
+                    check_interval=cfg.get('PROMPT_RELOAD_CHECK_INTERVAL', 2.0),
+                )
+    return _prompt_store
+
+# Ham doc nd file prompt instruction/example
+def read_prompt_file(filename, default_content=""):
+    """Doc file instruction/example (tu bo nho), fallback default."""
+    store = get_prompt_store()
+    content = store.get_data_file(filename)
+    if content is not None:
+        return content
+    default_filename = f"default_{filename.split('_', 1)[-1]}"
+    current_app.logger.warning(f"File prompt '{filename}' ko tim thay. Dung '{default_filename}'.")
+    content = store.get_data_file(default_filename)
+    if content is not None:
+        return content
+    current_app.logger.error(f"Ca file prompt '{filename}' & default '{default_filename}' ko tim thay.")
+    return default_content
 
 # Ham load template prompt chinh
 def load_prompt_template(filename, default_content=""):
-    """Load template prompt chinh tu thu muc prompts."""
-    prompts_dir = current_app.config.get('PROMPTS_DIR', os.path.join(os.path.dirname(__file__), 'prompt_data', 'prompts'))
-    logger = current_app.logger
-    filepath = os.path.join(prompts_dir, filename)
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return f.read() 
-    except FileNotFoundError:
-        logger.error(f"Template prompt '{filepath}' ko tim thay.")
-        return default_content
-    except Exception as e:
-        logger.error(f"Loi doc template prompt '{filepath}': {e}")
+    """Lay template prompt chinh (da validate) tu bo nho."""
+    template_text = get_prompt_store().get_template(filename)
+    if template_text is None:
+        current_app.logger.error(f"Template prompt '{filename}' ko tim thay hoac ko hop le.")
         return default_content
+    return template_text
+
+# Cat cac phan co the rut gon (ngu canh, vi du) cho vua ngan sach token cua model (prompt_token_budget)
+def fit_prompt_sections(query, fixed_texts, context_data=None, examples=None, model_name=None):
+    """Tra ve (ngu canh, vi du) da cat; khoi lien quan den query duoc uu tien giu lai."""
+    counter = get_token_counter(model_name)
+    fitted = fit_sections(
+        prompt_token_budget(model_name),
+        fixed_texts,
+        {
+            "context": (context_data or "", 2.0, lambda text, budget: trim_context_to_budget(text, budget, query=query, counter=counter)),
+            "examples": (examples or "", 1.0, lambda text, budget: trim_examples_to_budget(text, budget, query=query, counter=counter)),
+        },
+        counter=counter,
+    )
+    return fitted["context"], fitted["examples"]
+
+# Huong dan doc ngu canh 'tom tat baseline + delta' (luot /fortigate_chat, xem context_snapshot_utils)
+FORTIGATE_CONTEXT_DELTA_NOTE = (
+    "Ngữ cảnh dưới đây chỉ gồm tóm tắt các lệnh không đổi và phần thay đổi (unified diff: dòng '-' là cũ, '+' là mới) "
+    "so với phiên bản ngữ cảnh đã gửi trước đó; hãy suy luận trạng thái hiện tại từ đó."
+)
 
 # Ham tao prompt yeu cau Gemini sinh code/lenh
-def create_prompt(user_input, backend_os_name, target_os_name, file_type, fortigate_context_data=None):
+@timed_stage("prompt_build")
+def create_prompt(user_input, backend_os_name, target_os_name, file_type, fortigate_context_data=None, model_name=None):
     """Tao prompt sinh code/lenh."""
     file_extension = ""
     file_type_description = ""
@@ -95,13 +286,20 @@ def create_prompt(user_input, backend_os_name, target_os_name, file_type, fortig
     if not prompt_template:
         return "Lỗi: Không thể tải template prompt để sinh mã."
 
+    include_fortigate_context = bool(fortigate_context_data) and \
+        (is_target_fortios or is_fortigate_request_context_input or lang_key_for_prompt_files == 'fortios')
+    fitted_context, language_specific_examples = fit_prompt_sections(
+        user_input, [prompt_template, script_cli_guidance, user_input],
+        context_data=fortigate_context_data if include_fortigate_context else None,
+        examples=language_specific_examples, model_name=model_name
+    )
+
     fortigate_context_section_str = ""
-    if fortigate_context_data and \
-       (is_target_fortios or is_fortigate_request_context_input or lang_key_for_prompt_files == 'fortios'):
+    if include_fortigate_context:
         fortigate_context_section_str = f"""
 **Thông tin ngữ cảnh FortiGate hiện tại (được trích xuất tự động để Gemini tham khảo):**
 ```text
-{fortigate_context_data[:15000]}
+{fitted_context}
 ```
 """ 
 
@@ -134,7 +332,8 @@ def create_review_prompt(code_to_review, language):
     ).strip()
 
 # Ham tao prompt yeu cau Gemini go loi code
-def create_debug_prompt(original_prompt, failed_code, stdout, stderr, language, fortigate_context_data=None):
+@timed_stage("prompt_build")
+def create_debug_prompt(original_prompt, failed_code, stdout, stderr, language, fortigate_context_data=None, model_name=None):
     """Tao prompt go loi code."""
     language_name = get_language_name(language)
     code_block_tag = language if language and language.isalnum() else 'code'
@@ -152,10 +351,15 @@ def create_debug_prompt(original_prompt, failed_code, stdout, stderr, language,
     if fortigate_context_data and \
        (language.lower() == 'fortios' or \
         (original_prompt and ("fortigate" in original_prompt.lower() or "fortios" in original_prompt.lower()))):
+        fitted_context, _ = fit_prompt_sections(
+            f"{processed_original_prompt}\n{failed_code}\n{processed_stderr}",
+            [prompt_template, processed_original_prompt, failed_code, processed_stdout, processed_stderr],
+            context_data=fortigate_context_data, model_name=model_name
+        )
         fortigate_context_section_str = f"""
 **Thông tin ngữ cảnh FortiGate tại thời điểm trước khi chạy lệnh gây lỗi (được trích xuất tự động để Gemini tham khảo):**
 ```text
-{fortigate_context_data[:15000]}
+{fitted_context}
 ```
 """ 
 
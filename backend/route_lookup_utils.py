@@ -0,0 +1,289 @@
+# backend/route_lookup_utils.py
+import re
+import time
+import ipaddress
+import threading
+from collections import Counter
+from datetime import datetime
+from flask import current_app
+
+from .metrics_utils import FORTIGATE_ROUTE_LOOKUPS, FORTIGATE_ROUTE_TABLE_BUILD_DURATION
+
+ROUTING_TABLE_COMMAND = "get router info routing-table all"
+_PREFIX_RE = re.compile(r"(?<![\d.])(\d{1,3}(?:\.\d{1,3}){3})/(\d{1,2})(?!\d)")
+_VRF_RE = re.compile(r"^Routing table for VRF=(\d+)")
+_DISTANCE_RE = re.compile(r"\[(\d+)/(\d+)\]")
+_GATEWAY_RE = re.compile(r"via (\d{1,3}(?:\.\d{1,3}){3})")
+_RECURSIVE_RE = re.compile(r"\(recursive (?:via [^,()]+|is directly connected), ([^,()\s]+)\)")
+_CONNECTED_RE = re.compile(r"is directly connected, ([^,\s]+)")
+_STRIDE = 8
+
+
+def is_routing_table_command(command):
+    return " ".join(str(command).split()).lower() == ROUTING_TABLE_COMMAND
+
+
+def _parse_nexthop(text):
+    """Phan sau prefix (hoac dong ECMP tiep theo) -> (distance, metric, {'gateway', 'interface'})."""
+    distance_match = _DISTANCE_RE.search(text)
+    distance, metric = (int(distance_match.group(1)), int(distance_match.group(2))) if distance_match else (None, None)
+    connected = _CONNECTED_RE.search(text)
+    if connected and "via" not in text:
+        return distance, metric, {"gateway": None, "interface": connected.group(1)}
+    gateway = _GATEWAY_RE.search(text)
+    interface = None
+    recursive = _RECURSIVE_RE.search(text)
+    if recursive:
+        interface = recursive.group(1)
+    elif gateway:
+        # Token dau tien bat dau bang chu sau 'via GW,' la interface (bo qua age '1d02h', '00:10:22', '[1/0]')
+        interface = next((token.strip() for token in text[gateway.end():].split(",")
+                          if token.strip()[:1].isalpha()), None)
+    elif "Null" in text or "blackhole" in text:
+        interface = "Null"
+    return distance, metric, {"gateway": gateway.group(1) if gateway else None, "interface": interface}
+
+
+def parse_routing_table(text):
+    """
+    Output 'get router info routing-table all' -> list route dict: vrf, prefix (int), length, codes,
+    distance, metric, nexthops [{'gateway', 'interface'}]. Dong ECMP (chi co '[d/m] via ...') gop vao route truoc.
+    """
+    routes, vrf = [], 0
+    for line in (text or "").splitlines():
+        vrf_match = _VRF_RE.match(line.strip())
+        if vrf_match:
+            vrf = int(vrf_match.group(1))
+            continue
+        prefix_match = _PREFIX_RE.search(line)
+        if prefix_match is None:
+            if routes and line[:1].isspace() and "via" in line and _DISTANCE_RE.search(line): # ECMP
+                routes[-1]["nexthops"].append(_parse_nexthop(line)[2])
+            continue
+        codes = line[:prefix_match.start()].strip()
+        if not codes or codes.startswith("Codes") or not codes[0].isalpha():
+            continue
+        try:
+            network = ipaddress.IPv4Network(f"{prefix_match.group(1)}/{prefix_match.group(2)}", strict=False)
+        except ValueError:
+            continue
+        distance, metric, nexthop = _parse_nexthop(line[prefix_match.end():])
+        routes.append({
+            "vrf": vrf, "prefix": int(network.network_address), "length": network.prefixlen, "codes": codes,
+            "distance": distance, "metric": metric, "nexthops": [nexthop],
+        })
+    return routes
+
+
+class RouteTrie:
+    """
+    Trie nhieu bit (stride 8, mo rong prefix trong node) cho longest-prefix-match IPv4:
+    tra cuu toi da 4 buoc dict. Node: routes slot -> (do dai prefix, route), children slot -> node.
+    """
+
+    __slots__ = ("default", "root", "size")
+
+    def __init__(self):
+        self.default = None
+        self.root = ({}, {})
+        self.size = 0
+
+    def insert(self, prefix, length, route):
+        self.size += 1
+        if length == 0:
+            self.default = route
+            return
+        routes, children = self.root
+        depth = 0
+        while length > depth + _STRIDE:
+            slot = (prefix >> (32 - _STRIDE - depth)) & 0xFF
+            routes, children = children.setdefault(slot, ({}, {}))
+            depth += _STRIDE
+        span = 1 << (_STRIDE - (length - depth))
+        base = ((prefix >> (32 - _STRIDE - depth)) & 0xFF) & ~(span - 1)
+        for slot in range(base, base + span):
+            existing = routes.get(slot)
+            if existing is None or existing[0] <= length: # Prefix dai hon thang prefix ngan trong cung node
+                routes[slot] = (length, route)
+
+    def lookup(self, address):
+        best = self.default
+        node = self.root
+        depth = 0
+        while node is not None:
+            routes, children = node
+            slot = (address >> (32 - _STRIDE - depth)) & 0xFF
+            entry = routes.get(slot)
+            if entry is not None:
+                best = entry[1]
+            node = children.get(slot)
+            depth += _STRIDE
+        return best
+
+
+def _route_info(route):
+    return {
+        "prefix": f"{ipaddress.IPv4Address(route['prefix'])}/{route['length']}", "codes": route["codes"],
+        "distance": route["distance"], "metric": route["metric"], "nexthops": route["nexthops"], "vrf": route["vrf"],
+    }
+
+
+class RouteTable:
+    """Bang dinh tuyen 1 thiet bi: 1 RouteTrie / VRF, dung tu output routing-table."""
+
+    def __init__(self, text, built_at=None):
+        with FORTIGATE_ROUTE_TABLE_BUILD_DURATION.time():
+            routes, seen = [], {}
+            for route in parse_routing_table(text):
+                key = (route["vrf"], route["prefix"], route["length"])
+                if key in seen: # Cung prefix lap lai (ECMP in thanh nhieu dong) -> gop next-hop
+                    seen[key]["nexthops"].extend(route["nexthops"])
+                    continue
+                seen[key] = route
+                routes.append(route)
+            self.tries = {}
+            for route in routes:
+                self.tries.setdefault(route["vrf"], RouteTrie()).insert(route["prefix"], route["length"], route)
+        self.built_at = built_at or time.time()
+        self.route_count = len(routes)
+        self.source_lines = (text or "").count("\n") + 1
+        self.by_type = Counter(route["codes"].rstrip("*").strip() or "?" for route in routes)
+        self.default_routes = [_route_info(trie.default) for trie in self.tries.values() if trie.default is not None]
+
+    def lookup(self, ip, vrf=None):
+        """Route khop dai nhat cho 1 IP. Tra ve dict (route None = ko co route)."""
+        try:
+            address = int(ipaddress.IPv4Address(str(ip).strip()))
+            vrf = int(float(vrf)) if vrf not in (None, "") else (0 if 0 in self.tries or not self.tries else min(self.tries))
+        except ValueError:
+            FORTIGATE_ROUTE_LOOKUPS.inc(outcome="error")
+            return {"ip": ip, "error": f"Địa chỉ không hợp lệ hoặc không phải IPv4 (hoặc VRF sai): {ip}."}
+        trie = self.tries.get(vrf)
+        route = trie.lookup(address) if trie is not None else None
+        FORTIGATE_ROUTE_LOOKUPS.inc(outcome="no_route" if route is None else "hit")
+        return {"ip": str(ipaddress.IPv4Address(address)), "vrf": vrf, "route": _route_info(route) if route else None}
+
+    def lookup_many(self, ips, vrf=None):
+        return [self.lookup(ip, vrf) for ip in ips]
+
+    def summary_info(self):
+        return {
+            "built_at": datetime.fromtimestamp(self.built_at).isoformat(), "routes": self.route_count,
+            "source_lines": self.source_lines, "vrfs": sorted(self.tries), "by_type": dict(self.by_type),
+        }
+
+    def summary_text(self):
+        """Tom tat thay cho nguyen van bang dinh tuyen lon (gui cho model)."""
+        lines = [
+            f"(Bảng định tuyến có {self.route_count} route / {self.source_lines} dòng, không gửi nguyên văn. "
+            "Dùng tool `lookup_route` để tra next-hop/interface cho IP cụ thể.)",
+            "Số route theo loại: " + ", ".join(f"{code}={count}" for code, count in self.by_type.most_common()),
+            f"VRF: {', '.join(str(vrf) for vrf in sorted(self.tries))}",
+        ]
+        for default_route in self.default_routes:
+            lines.append(f"Default route (VRF {default_route['vrf']}): {_format_nexthops(default_route)}")
+        return "\n".join(lines)
+
+
+def _format_nexthops(route_info):
+    return "; ".join(
+        f"via {hop['gateway']}, {hop['interface'] or '?'}" if hop["gateway"] else f"trực tiếp qua {hop['interface'] or '?'}"
+        for hop in route_info["nexthops"]
+    ) + (f" [{route_info['distance']}/{route_info['metric']}]" if route_info["distance"] is not None else "")
+
+
+def format_route_lookup(table, results):
+    """Ket qua tra cuu nhieu IP -> van ban ngan cho model."""
+    lines = [f"(Tra cứu cục bộ trên bảng định tuyến {table.route_count} route lấy lúc {datetime.fromtimestamp(table.built_at).strftime('%H:%M:%S')})"]
+    for result in results:
+        if "error" in result:
+            lines.append(f"{result['ip']}: lỗi - {result['error']}")
+        elif result["route"] is None:
+            lines.append(f"{result['ip']} (VRF {result['vrf']}): không có route (gói tin bị drop).")
+        else:
+            route = result["route"]
+            lines.append(f"{result['ip']} (VRF {result['vrf']}): {route['codes']} {route['prefix']} {_format_nexthops(route)}")
+    return "\n".join(lines)
+
+
+class RouteTableStore:
+    """
+    Bang dinh tuyen theo thiet bi, het han sau ttl giay (route dong thay doi ngoai app).
+    Lay bang (SSH, cham) theo single-flight: cac tra cuu dong thoi cung thiet bi cho chung 1 lan lay.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = float(ttl)
+        self._tables = {} # device_key -> RouteTable
+        self._device_locks = {}
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.fetch_errors = 0
+        self.invalidations = 0
+
+    def get(self, device_key):
+        with self._lock:
+            table = self._tables.get(device_key)
+            if table is not None and time.time() - table.built_at > self.ttl:
+                del self._tables[device_key]
+                table = None
+            return table
+
+    def record_output(self, device_key, text):
+        """Dung bang tu output routing-table vua lay (tool/ngu canh) de cac tra cuu sau ko can SSH."""
+        table = RouteTable(text)
+        with self._lock:
+            self._tables[device_key] = table
+            self.builds += 1
+        return table
+
+    def get_or_fetch(self, device_key, fetch_table, refresh=False):
+        """Bang con han hoac lay moi qua fetch_table() -> (text, loi). Tra ve (RouteTable, loi)."""
+        table = None if refresh else self.get(device_key)
+        if table is not None:
+            return table, None
+        with self._lock:
+            device_lock = self._device_locks.setdefault(device_key, threading.Lock())
+        with device_lock:
+            table = None if refresh else self.get(device_key) # Luong khac vua lay xong
+            if table is not None:
+                return table, None
+            text, error = fetch_table()
+            if error or not text:
+                self.fetch_errors += 1
+                return None, error or "Không lấy được bảng định tuyến."
+            table = self.record_output(device_key, text)
+            current_app.logger.info(
+                f"Da dung bang dinh tuyen {device_key[0]}:{device_key[1]}: {table.route_count} route, {len(table.tries)} VRF."
+            )
+            return table, None
+
+    def invalidate(self, device_key):
+        with self._lock:
+            self.invalidations += 1
+            return self._tables.pop(device_key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._tables), "ttl": self.ttl, "builds": self.builds, "fetch_errors": self.fetch_errors,
+                "invalidations": self.invalidations,
+                "tables": [dict(table.summary_info(), device=f"{key[0]}:{key[1]}") for key, table in self._tables.items()],
+            }
+
+
+_route_table_store = None
+_route_table_store_lock = threading.Lock()
+
+def get_route_table_store():
+    """Lay RouteTableStore dung chung (khoi tao lan dau tu app.config)."""
+    global _route_table_store
+    if _route_table_store is None:
+        with _route_table_store_lock:
+            if _route_table_store is None:
+                _route_table_store = RouteTableStore(ttl=current_app.config.get('FGT_ROUTE_TABLE_TTL', 60))
+    return _route_table_store
@@ -5,26 +5,41 @@ import subprocess
 import shlex
 import re
 import json
+import time
 from datetime import datetime
-from flask import request, jsonify, Blueprint, current_app
+from flask import request, jsonify, Blueprint, current_app, Response
 import logging # Import logging
-import logging.handlers # Import handlers
-import glob
-
-
-import google.generativeai as genai
-from google.generativeai.types import GenerationConfig, SafetySettingDict, HarmCategory
-from google.generativeai import GenerativeModel
 
 from .helpers import get_os_name, get_language_name
 from .prompt_utils import (
     create_prompt, create_review_prompt,
-    create_debug_prompt, create_explain_prompt
+    create_debug_prompt, create_explain_prompt, get_prompt_store, FORTIGATE_CONTEXT_DELTA_NOTE
+)
+from .gemini_utils import (
+    generate_response_from_gemini, stream_response_from_gemini, build_generation_settings,
+    cached_generate_response, get_response_cache, get_function_calling_model
+)
+from .function_calling_utils import run_function_calling_loop, ToolResultMemo
+from .chat_session_utils import get_chat_session_store
+from .context_snapshot_utils import get_context_snapshot_store
+from .snapshot_store_utils import get_context_snapshot_archive, device_label
+from .fortios_config_utils import get_config_index_store
+from .policy_match_utils import FirewallPolicyMatcher, get_policy_matcher
+from .route_lookup_utils import RouteTable, get_route_table_store
+from .streaming_utils import sse_event, sse_response, wants_stream
+from .log_utils import LogTailReader, InvalidLogCursor, find_log_file_handler
+from .metrics_utils import REGISTRY, REQUEST_STAGE_DURATION
+from .ssh_pool_utils import get_fortigate_pool
+from .code_block_utils import scan_code_blocks, select_code_block, code_block_tag_priority, find_pip_install_block
+from .token_utils import fit_sections, trim_context_to_budget, trim_history_to_budget, prompt_token_budget, get_token_counter
+from .job_utils import get_job_manager, make_script_job_runner, make_fortigate_job_runner, JobQueueFull
+from .fleet_utils import (
+    get_fleet_inventory, FleetInventoryError, resolve_fleet_targets, iter_fleet_run, diff_fleet_outputs, make_fleet_job_runner
 )
-from .gemini_utils import generate_response_from_gemini
 from .execution_utils import (
     extract_code_block, execute_fortigate_commands,
-    execute_local_script, fetch_and_save_fortigate_context,
+    execute_local_script, stream_local_script, fetch_and_save_fortigate_context, build_fortigate_context_delta,
+    get_fortigate_context_cache, fortigate_device_key, fetch_fortigate_full_configuration, fetch_fortigate_routing_table,
     DEFAULT_FORTIGATE_CONTEXT_COMMANDS
 )
 
@@ -55,6 +70,43 @@ AVAILABLE_TOOLS = [{
                 "required": ["command"]
             }
         },
+        {
+            "name": "match_firewall_policy",
+            "description": (
+                "Xác định firewall policy IPv4 nào trên FortiGate sẽ khớp một luồng (policy đầu tiên khớp theo thứ tự), "
+                "đối chiếu cục bộ trên cấu hình đã phân tích (address/addrgrp/VIP, service/service group, interface/zone). "
+                "Dùng cho câu hỏi dạng 'policy nào cho phép 10.1.2.3 tới 8.8.8.8:443' thay vì tự đọc 'show firewall policy'. "
+                "Kết quả gồm policy khớp (hoặc implicit deny) và các policy đứng trước chứa đối tượng FQDN/geography/ISDB không xác định được."
+            ),
+            "parameters": {
+                "type_": "OBJECT",
+                "properties": {
+                    "src_ip": {"type_": "STRING", "description": "IPv4 nguồn, ví dụ '10.1.2.3'."},
+                    "dst_ip": {"type_": "STRING", "description": "IPv4 đích, ví dụ '8.8.8.8'."},
+                    "protocol": {"type_": "STRING", "description": "tcp, udp, sctp, icmp hoặc số giao thức IP. Mặc định tcp."},
+                    "dst_port": {"type_": "INTEGER", "description": "Port đích (bắt buộc với tcp/udp/sctp)."},
+                    "srcintf": {"type_": "STRING", "description": "Interface vào (tùy chọn, ví dụ 'port1'); bỏ trống nếu không biết."},
+                    "dstintf": {"type_": "STRING", "description": "Interface ra (tùy chọn, ví dụ 'wan1'); bỏ trống nếu không biết."},
+                },
+                "required": ["src_ip", "dst_ip"]
+            }
+        },
+        {
+            "name": "lookup_route",
+            "description": (
+                "Tra route khớp dài nhất (longest-prefix-match) trong bảng định tuyến FortiGate cho một hoặc nhiều IPv4: "
+                "trả về prefix, loại route, next-hop và interface ra. Dùng thay cho việc đọc toàn bộ "
+                "'get router info routing-table all' (có thể rất lớn)."
+            ),
+            "parameters": {
+                "type_": "OBJECT",
+                "properties": {
+                    "ips": {"type_": "STRING", "description": "Một hoặc nhiều IPv4, phân cách bởi dấu phẩy. Ví dụ: '8.8.8.8, 10.1.2.3'."},
+                    "vrf": {"type_": "INTEGER", "description": "VRF cần tra (tùy chọn, mặc định 0)."},
+                },
+                "required": ["ips"]
+            }
+        },
     ]
 }]
 
@@ -81,6 +133,63 @@ def _normalize_model_config(raw_config: dict) -> dict:
     return {k: v for k, v in normalized.items() if v is not None}
 
 
+def _fc_events_response(fc_events, build_success_payload, stream_requested):
+    """Chuyen su kien cua vong lap FC thanh 1 JSON (cho den het) hoac luong SSE."""
+    if not stream_requested:
+        for event in fc_events:
+            if event["type"] == "final":
+                return jsonify(build_success_payload(event["text"], event["thoughts"]))
+            if event["type"] == "error":
+                return jsonify({"error": event["error"], "thoughts": event["thoughts"]}), 500
+        return jsonify({"error": "Vòng lặp Function Calling kết thúc bất thường.", "thoughts": []}), 500
+
+    def generate_sse():
+        for event in fc_events:
+            if event["type"] == "thought":
+                yield sse_event("thought", event["thought"])
+            elif event["type"] == "text":
+                yield sse_event("text", {"text": event["text"]})
+            elif event["type"] == "final":
+                yield sse_event("done", build_success_payload(event["text"], event["thoughts"]))
+            elif event["type"] == "error":
+                yield sse_event("error", {"error": event["error"], "thoughts": event["thoughts"]})
+    return sse_response(generate_sse())
+
+
+def _build_normal_generate_payload(raw_response, user_input_prompt_str, target_os_name, file_extension):
+    """Trich xuat code tu phan hoi (che do thuong). Tra ve (payload, status_code)."""
+    logger = current_app.logger
+    if raw_response and not raw_response.startswith("Lỗi"):
+        ext_for_extraction = file_extension
+        if target_os_name.lower() == 'fortios' and file_extension in ['txt', 'conf', 'cli', 'log']:
+            ext_for_extraction = 'fortios'
+        elif file_extension == 'fortios':
+             ext_for_extraction = 'fortios'
+
+        generated_code = extract_code_block(raw_response, ext_for_extraction, user_input_for_context=user_input_prompt_str)
+        effective_generated_type = file_extension
+        if ext_for_extraction == 'fortios':
+            effective_generated_type = 'fortios'
+
+        is_likely_raw_text = (generated_code == raw_response) and not generated_code.strip().startswith("```")
+        if not generated_code.strip() or is_likely_raw_text:
+             logger.error(f"AI ko tra ve khoi ma hop lệ (Normal Gen). Phan hoi tho: {raw_response[:200]}...")
+             return {"error": f"AI không trả về khối mã hợp lệ. Phản hồi: '{raw_response[:50]}...'", "thoughts": []}, 500
+
+        potentially_dangerous = ["rm ", "del ", "format ", "shutdown ", "reboot ", ":(){:|:&};:", "dd if=/dev/zero", "mkfs", "execute formatlogdisk"]
+        detected_dangerous = [kw for kw in potentially_dangerous if kw.lower() in generated_code.lower()]
+        if detected_dangerous:
+            logger.warning(f"Canh bao (Normal Gen): Ma tao ra chua tu khoa nguy hiem: {detected_dangerous}")
+        return {"code": generated_code, "generated_for_type": effective_generated_type, "thoughts": []}, 200
+
+    status_code = 400
+    if raw_response and ("Lỗi cấu hình" in raw_response or "Lỗi: Phản hồi bị chặn" in raw_response):
+        status_code = 400
+    else:
+        status_code = 500
+    return {"error": raw_response or "Lỗi không xác định khi sinh mã.", "thoughts": []}, status_code
+
+
 @api_bp.route('/generate', methods=['POST'])
 def handle_generate():
     logger = current_app.logger
@@ -94,6 +203,8 @@ def handle_generate():
     fortigate_selected_context_commands = data.get('fortigate_selected_context_commands', DEFAULT_FORTIGATE_CONTEXT_COMMANDS)
     if not fortigate_selected_context_commands:
         fortigate_selected_context_commands = DEFAULT_FORTIGATE_CONTEXT_COMMANDS
+    refresh_fortigate_context = bool(data.get('refresh_fortigate_context', False)) # Bo qua cache ngu canh
+    stream_requested = wants_stream(request, data) # Tra ve SSE thay vi 1 JSON
 
     if not user_input_prompt_str:
         return jsonify({"error": "Vui lòng nhập yêu cầu."}), 400
@@ -127,7 +238,8 @@ def handle_generate():
         try:
             initial_fortigate_context_str = fetch_and_save_fortigate_context(
                 fortigate_config_from_request,
-                commands_to_fetch=fortigate_selected_context_commands
+                commands_to_fetch=fortigate_selected_context_commands,
+                bypass_cache=refresh_fortigate_context
             )
         except Exception as e_ctx:
             logger.error(f"Generate FGT (FC): Loi khi lay ngu canh ban dau: {e_ctx}")
@@ -138,152 +250,36 @@ def handle_generate():
             backend_os_name,
             target_os_name,
             file_type_input,
-            fortigate_context_data=initial_fortigate_context_str
+            fortigate_context_data=initial_fortigate_context_str,
+            model_name=model_config.get('model_name')
         )
         # Huong dan AI su dung tool get_fortigate_data
         full_prompt_for_gemini += (
             "\n\nQuan trọng: Nếu bạn cần thêm thông tin cấu hình, trạng thái, log hoặc kết quả chẩn đoán (diagnose) hiện tại của FortiGate " # Them diagnose
             "để hoàn thành yêu cầu, hãy sử dụng tool `get_fortigate_data`. Bạn có thể gọi tool này nhiều lần với các lệnh 'show', 'get', "
-            "hoặc 'diagnose' khác nhau nếu cần. Chỉ sử dụng tool này cho các lệnh không thay đổi cấu hình."
+            "hoặc 'diagnose' khác nhau nếu cần. Chỉ sử dụng tool này cho các lệnh không thay đổi cấu hình. "
+            "Để biết policy nào khớp một luồng cụ thể (IP nguồn/đích, port), hãy dùng tool `match_firewall_policy`; "
+            "để biết route/next-hop/interface ra cho một IP, hãy dùng tool `lookup_route`."
         )
         full_prompt_for_gemini += "\n**QUAN TRỌNG:** Nếu một lệnh thực thi qua tool `get_fortigate_data` trả về lỗi, bạn phải **NGAY LẬP TỨC** phân tích lỗi đó và thử lại tool `get_fortigate_data` với lệnh đã sửa đổi hoặc điều chỉnh cách tiếp cận. **KHÔNG** giải thích lỗi hoặc thông báo kế hoạch của bạn cho đến khi bạn đã thử lại tool và có kết quả mới. Mục tiêu là hoàn thành yêu cầu bằng cách thực thi lệnh tool thành công."
 
-        genai_api_key_to_use = model_config.get('api_key') or current_app.config.get('GOOGLE_API_KEY')
-        if not genai_api_key_to_use:
-            return jsonify({"error": "API Key của Google chưa được cấu hình.", "thoughts": []}), 500
-        try:
-            genai.configure(api_key=genai_api_key_to_use)
-            logger.info(f"Generate FGT (FC): Da (lai) cau hinh GenAI voi key {'tu UI' if model_config.get('api_key') else 'tu .env'}.")
-        except Exception as e_cfg_genai:
-            logger.error(f"Loi cau hinh GenAI (FC): {e_cfg_genai}")
-            return jsonify({"error": f"Lỗi cấu hình thư viện Google GenAI: {e_cfg_genai}", "thoughts": []}), 500
-
-        gemini_model_name = model_config.get('model_name', 'gemini-1.5-flash')
-        try:
-            generation_config_obj = GenerationConfig(
-                temperature=float(model_config.get('temperature', 0.7)),
-                top_p=float(model_config.get('top_p', 0.95)),
-                top_k=int(model_config.get('top_k', 40))
-            )
-            safety_setting_key = model_config.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE')
-            safety_settings_config = current_app.config.get('SAFETY_SETTINGS_MAP', {}).get(safety_setting_key, [])
-            
-            safety_settings_list = []
-            for setting in safety_settings_config:
-                category_name = setting['category'].replace("HARM_CATEGORY_", "")
-                if hasattr(genai.types.HarmCategory, category_name): 
-                    category_enum = getattr(genai.types.HarmCategory, category_name)
-                    threshold_enum = getattr(genai.types.SafetySetting.HarmBlockThreshold, setting['threshold'])
-                    safety_settings_list.append(genai.types.SafetySetting(category=category_enum, threshold=threshold_enum))
-                else:
-                    logger.warning(f"Bo qua safety setting voi category khong hop le: {setting['category']}")
-        except AttributeError as e_types_attr:
-             logger.error(f"Loi AttributeError khi truy cap GenConfig/Safety/HarmCategory tu google.generativeai.types: {e_types_attr}. Thu import truc tiep tu genai.types")
-             generation_config_obj = genai.types.GenerationConfig(
-                temperature=float(model_config.get('temperature', 0.7)),
-                top_p=float(model_config.get('top_p', 0.95)),
-                top_k=int(model_config.get('top_k', 40))
-             )
-             safety_setting_key = model_config.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE')
-             safety_settings_config = current_app.config.get('SAFETY_SETTINGS_MAP', {}).get(safety_setting_key, [])
-             safety_settings_list = []
-             for setting in safety_settings_config:
-                category_name = setting['category'].replace("HARM_CATEGORY_", "")
-                if hasattr(genai.types.HarmCategory, category_name):
-                    category_enum = getattr(genai.types.HarmCategory, category_name)
-                    threshold_enum = getattr(genai.types.SafetySetting.HarmBlockThreshold, setting['threshold'])
-                    safety_settings_list.append(genai.types.SafetySetting(category=category_enum, threshold=threshold_enum))
-                else:
-                    logger.warning(f"Bo qua safety setting (fallback) voi category khong hop le: {setting['category']}")
+        model_for_fc, model_error = get_function_calling_model(model_config, AVAILABLE_TOOLS)
+        if model_error:
+            return jsonify({"error": model_error, "thoughts": []}), 500
+        generation_config_obj, safety_settings_list = build_generation_settings(model_config)
 
-        model_for_fc = GenerativeModel(gemini_model_name, tools=AVAILABLE_TOOLS)
         chat_session = model_for_fc.start_chat(history=[])
-        thoughts_for_ui = []
-        MAX_FUNCTION_CALLS = 500
-        num_calls = 0
-        current_content_for_send_message: str | list[dict] = full_prompt_for_gemini
-
-        while num_calls < MAX_FUNCTION_CALLS:
-            logger.info(f"Generate FGT (FC Loop {num_calls+1}/{MAX_FUNCTION_CALLS}): Sending to Gemini...")
-            response = chat_session.send_message(
-                content=current_content_for_send_message,
-                generation_config=generation_config_obj,
-                safety_settings=safety_settings_list
-            )
-            candidate = response.candidates[0]
-
-            if not candidate.content or not candidate.content.parts:
-                 logger.error("Generate FGT (FC): Phan hoi cua AI khong co content hoac parts.")
-                 return jsonify({"error": "AI trả về phản hồi không hợp lệ (không có content hoặc parts).", "thoughts": thoughts_for_ui}), 500
-
-            function_call_part = None
-            for part_item in candidate.content.parts:
-                if hasattr(part_item, 'function_call') and part_item.function_call: 
-                    function_call_part = part_item.function_call
-                    break
-            
-            if function_call_part:
-                fc = function_call_part
-                tool_name = fc.name
-                tool_args = dict(fc.args) if fc.args else {}
-                current_ts = datetime.now().isoformat()
-                logger.info(f"Generate FGT (FC): AI requested tool '{tool_name}' with args: {tool_args}")
-                thoughts_for_ui.append({
-                    "type": "function_call_request", "tool_name": tool_name,
-                    "tool_args": tool_args, "timestamp": current_ts
-                })
-
-                tool_response_text = ""
-                tool_error_flag = False
-
-                if tool_name == "get_fortigate_data":
-                    fgt_command_to_run = tool_args.get("command")
-                    if fgt_command_to_run:
-                        logger.info(f"Tool '{tool_name}': Executing command '{fgt_command_to_run}'")
-                        exec_result = execute_fortigate_commands(fgt_command_to_run, fortigate_config_from_request)
-                        if exec_result["error"]:
-                            tool_response_text = f"[LỖI THỰC THI FORTIGATE]: Lệnh '{fgt_command_to_run}' thất bại. Chi tiết: {exec_result['error']}. Output: {exec_result['output']}"
-                            tool_error_flag = True
-                        else:
-                            tool_response_text = exec_result["output"] if exec_result["output"] else "(Lệnh không trả về output)"
-                    else:
-                        tool_response_text = "Lỗi: Tool 'get_fortigate_data' được gọi nhưng thiếu tham số 'command'."
-                        tool_error_flag = True
-                else:
-                    tool_response_text = f"Lỗi: Tool '{tool_name}' không được backend hỗ trợ."
-                    tool_error_flag = True
-                
-                thoughts_for_ui.append({
-                    "type": "function_call_result", "tool_name": tool_name,
-                    "result_data": tool_response_text, "is_error": tool_error_flag,
-                    "timestamp": datetime.now().isoformat()
-                })
-                current_content_for_send_message = [{
-                    "function_response": {
-                        "name": tool_name,
-                        "response": {"output": tool_response_text} 
-                    }
-                }]
-            else:
-                finish_reason_name = candidate.finish_reason.name if hasattr(candidate.finish_reason, 'name') else str(candidate.finish_reason)
-                if finish_reason_name == "STOP":
-                    final_text_response = "".join(part_item.text for part_item in candidate.content.parts if hasattr(part_item, 'text') and part_item.text)
-                    logger.info(f"Generate FGT (FC): AI final response (text): {final_text_response[:200]}...")
-                    generated_code = extract_code_block(final_text_response, 'fortios', user_input_prompt_str)
-                    return jsonify({"code": generated_code, "generated_for_type": "fortios", "thoughts": thoughts_for_ui})
-                else:
-                    safety_ratings_str = str(getattr(candidate, 'safety_ratings', 'N/A'))
-                    error_msg_fc_loop = f"AI không trả về function call hoặc text cuối cùng. Lý do: {finish_reason_name}. Safety: {safety_ratings_str}"
-                    logger.error(f"Generate FGT (FC): {error_msg_fc_loop}")
-                    return jsonify({"error": error_msg_fc_loop, "thoughts": thoughts_for_ui}), 500
-            num_calls += 1
-
-        if num_calls >= MAX_FUNCTION_CALLS:
-            logger.error("Generate FGT (FC): Đã vượt quá số lần gọi tool tối đa.")
-            return jsonify({"error": "Đã vượt quá số lần gọi tool tối đa.", "thoughts": thoughts_for_ui}), 500
-        
-        logger.error("Generate FGT (FC): Vong lap Function Calling ket thuc bat thuong.")
-        return jsonify({"error": "Xử lý yêu cầu FortiGate thất bại sau nhiều bước.", "thoughts": thoughts_for_ui}), 500
+        fc_events = run_function_calling_loop(
+            chat_session, full_prompt_for_gemini, generation_config_obj, safety_settings_list,
+            fortigate_config_from_request, log_prefix="Generate FGT (FC)", stream=stream_requested, loop_name="generate",
+            query=user_input_prompt_str
+        )
+
+        def build_generate_fc_payload(final_text_response, thoughts_for_ui):
+            generated_code = extract_code_block(final_text_response, 'fortios', user_input_prompt_str)
+            return {"code": generated_code, "generated_for_type": "fortios", "thoughts": thoughts_for_ui}
+
+        return _fc_events_response(fc_events, build_generate_fc_payload, stream_requested)
 
     fortigate_context_str_for_normal_generate = None
     is_fortigate_related_request_normal = (
@@ -302,44 +298,34 @@ def handle_generate():
             try:
                 fortigate_context_str_for_normal_generate = fetch_and_save_fortigate_context(
                     fortigate_config_from_request,
-                    commands_to_fetch=fortigate_selected_context_commands
+                    commands_to_fetch=fortigate_selected_context_commands,
+                    bypass_cache=refresh_fortigate_context
                 )
             except Exception as e_ctx_norm:
                 logger.error(f"Generate (Normal FGT): Loi khi lay ngu canh: {e_ctx_norm}", exc_info=True)
                 fortigate_context_str_for_normal_generate = f"Lưu ý: Lỗi khi lấy ngữ cảnh: {str(e_ctx_norm)}"
 
-    full_prompt = create_prompt(user_input_prompt_str, backend_os_name, target_os_name, file_type_input, fortigate_context_data=fortigate_context_str_for_normal_generate)
-    raw_response = generate_response_from_gemini(full_prompt, model_config, is_for_review_or_debug=False)
-
-    if raw_response and not raw_response.startswith("Lỗi"):
-        ext_for_extraction = file_extension
-        if target_os_name.lower() == 'fortios' and file_extension in ['txt', 'conf', 'cli', 'log']:
-            ext_for_extraction = 'fortios'
-        elif file_extension == 'fortios':
-             ext_for_extraction = 'fortios'
-
-        generated_code = extract_code_block(raw_response, ext_for_extraction, user_input_for_context=user_input_prompt_str)
-        effective_generated_type = file_extension
-        if ext_for_extraction == 'fortios':
-            effective_generated_type = 'fortios'
-
-        is_likely_raw_text = (generated_code == raw_response) and not generated_code.strip().startswith("```")
-        if not generated_code.strip() or is_likely_raw_text:
-             logger.error(f"AI ko tra ve khoi ma hop lệ (Normal Gen). Phan hoi tho: {raw_response[:200]}...")
-             return jsonify({"error": f"AI không trả về khối mã hợp lệ. Phản hồi: '{raw_response[:50]}...'", "thoughts": []}), 500
+    full_prompt = create_prompt(
+        user_input_prompt_str, backend_os_name, target_os_name, file_type_input,
+        fortigate_context_data=fortigate_context_str_for_normal_generate,
+        model_name=model_config.get('model_name')
+    )
 
-        potentially_dangerous = ["rm ", "del ", "format ", "shutdown ", "reboot ", ":(){:|:&};:", "dd if=/dev/zero", "mkfs", "execute formatlogdisk"]
-        detected_dangerous = [kw for kw in potentially_dangerous if kw.lower() in generated_code.lower()]
-        if detected_dangerous:
-            logger.warning(f"Canh bao (Normal Gen): Ma tao ra chua tu khoa nguy hiem: {detected_dangerous}")
-        return jsonify({"code": generated_code, "generated_for_type": effective_generated_type, "thoughts": []})
+    if stream_requested:
+        def generate_normal_sse():
+            raw_response = ""
+            for event in stream_response_from_gemini(full_prompt, model_config):
+                if event["type"] == "text":
+                    yield sse_event("text", {"text": event["text"]})
+                else:
+                    raw_response = event["text"]
+            payload, status_code = _build_normal_generate_payload(raw_response, user_input_prompt_str, target_os_name, file_extension)
+            yield sse_event("done" if status_code == 200 else "error", payload)
+        return sse_response(generate_normal_sse())
 
-    status_code = 400
-    if raw_response and ("Lỗi cấu hình" in raw_response or "Lỗi: Phản hồi bị chặn" in raw_response):
-        status_code = 400
-    else:
-        status_code = 500
-    return jsonify({"error": raw_response or "Lỗi không xác định khi sinh mã.", "thoughts": []}), status_code
+    raw_response = generate_response_from_gemini(full_prompt, model_config, is_for_review_or_debug=False)
+    payload, status_code = _build_normal_generate_payload(raw_response, user_input_prompt_str, target_os_name, file_extension)
+    return jsonify(payload), status_code
 
 
 @api_bp.route('/review', methods=['POST'])
@@ -350,6 +336,7 @@ def handle_review():
     raw_model_config_from_request = data.get('model_config', {})
     model_config = _normalize_model_config(raw_model_config_from_request)
     file_type = data.get('file_type', 'py')
+    bypass_cache = bool(data.get('bypass_cache', False)) # Bo qua cache phan hoi
 
     if not code_to_review:
         return jsonify({"error": "Không có mã nào để đánh giá."}), 400
@@ -358,10 +345,10 @@ def handle_review():
     if not language_extension: language_extension = 'py'
 
     full_prompt = create_review_prompt(code_to_review, language_extension)
-    review_text = generate_response_from_gemini(full_prompt, model_config, is_for_review_or_debug=True)
+    review_text, from_cache = cached_generate_response(full_prompt, model_config, is_for_review_or_debug=True, bypass_cache=bypass_cache)
 
     if review_text and not review_text.startswith("Lỗi"):
-        return jsonify({"review": review_text})
+        return jsonify({"review": review_text, "cached": from_cache})
 
     status_code = 400
     if review_text and ("Lỗi cấu hình" in review_text or "Lỗi: Phản hồi bị chặn" in review_text):
@@ -370,25 +357,35 @@ def handle_review():
         status_code = 500
     return jsonify({"error": review_text or "Lỗi không xác định khi đánh giá."}), status_code
 
+def _execution_error_payload(exec_result, code_to_execute):
+    return {
+        "error": exec_result["message"], "output": exec_result["output"],
+        "error_detail": exec_result["error_detail"], "return_code": exec_result["return_code"],
+        "warning": exec_result.get("warning"), "codeThatFailed": code_to_execute
+    }
+
+def _parse_execution_request(data):
+    """Doc code, phan mo rong file (mac dinh 'py'), run_as_admin, fortigate_config tu body /execute & /jobs."""
+    file_type_requested = str(data.get('file_type') or 'py')
+    file_extension = file_type_requested.split('.')[-1].lower() if '.' in file_type_requested else file_type_requested.lower()
+    if not file_extension or not (file_extension.isalnum() or file_extension == 'fortios'):
+        file_extension = 'py'
+    return data.get('code'), file_extension, data.get('run_as_admin', False), data.get('fortigate_config')
+
+def _has_fortigate_target(fortigate_config):
+    return bool(fortigate_config and fortigate_config.get('ipHost') and fortigate_config.get('username'))
+
 @api_bp.route('/execute', methods=['POST'])
 def handle_execute():
     logger = current_app.logger
-    data = request.get_json()
-    code_to_execute = data.get('code')
-    run_as_admin = data.get('run_as_admin', False)
-    file_type_requested = data.get('file_type', 'py')
-    fortigate_config = data.get('fortigate_config')
-
+    data = request.get_json(silent=True) or {}
+    code_to_execute, file_extension, run_as_admin, fortigate_config = _parse_execution_request(data)
     if not code_to_execute:
         return jsonify({"error": "Không có mã nào để thực thi."}), 400
 
-    file_extension = file_type_requested.split('.')[-1].lower() if '.' in file_type_requested else file_type_requested.lower()
-    if not file_extension or not (file_extension.isalnum() or file_extension == 'fortios'):
-        file_extension = 'py'
-
     if file_extension == 'fortios':
         logger.info(f"Nhan lenh FortiOS CLI (.{file_extension}). Chuan bi thuc thi.")
-        if not fortigate_config or not fortigate_config.get('ipHost') or not fortigate_config.get('username'):
+        if not _has_fortigate_target(fortigate_config):
             logger.error("Thieu fortigate_config (IP/Host, User) cho lenh FortiOS.")
             return jsonify({
                 "message": "Lỗi: Thiếu thông tin kết nối FortiGate (IP/Host, Username). Vui lòng kiểm tra Cài đặt.",
@@ -409,19 +406,102 @@ def handle_execute():
             "codeThatFailed": code_to_execute
         })
 
+    if wants_stream(request, data):
+        # SSE: 'output' cho tung dong stdout/stderr, ket thuc bang 'done' hoac 'error'
+        def generate_execute_sse():
+            for event in stream_local_script(code_to_execute, file_extension, run_as_admin):
+                if event["type"] == "output":
+                    yield sse_event("output", {"stream": event["stream"], "line": event["line"], "timestamp": event["timestamp"]})
+                elif "error_type" in event["result"]:
+                    yield sse_event("error", _execution_error_payload(event["result"], code_to_execute))
+                else:
+                    yield sse_event("done", event["result"])
+        return sse_response(generate_execute_sse())
+
     exec_result = execute_local_script(code_to_execute, file_extension, run_as_admin)
 
     if "error_type" in exec_result:
         status_code = 408 if exec_result["error_type"] == "Timeout" else 500
-        return jsonify({
-            "error": exec_result["message"], "output": exec_result["output"],
-            "error_detail": exec_result["error_detail"], "return_code": exec_result["return_code"],
-            "warning": exec_result.get("warning"), "codeThatFailed": code_to_execute
-        }), status_code
+        return jsonify(_execution_error_payload(exec_result, code_to_execute)), status_code
 
     return jsonify(exec_result)
 
 
+@api_bp.route('/jobs', methods=['POST'])
+def handle_submit_job():
+    logger = current_app.logger
+    data = request.get_json(silent=True) or {}
+    code_to_execute, file_extension, run_as_admin, fortigate_config = _parse_execution_request(data)
+    if not code_to_execute:
+        return jsonify({"error": "Không có mã nào để thực thi."}), 400
+
+    # Gioi han thoi gian chay moi job (ko vuot JOB_MAX_TIMEOUT_SECONDS)
+    max_timeout = current_app.config.get('JOB_MAX_TIMEOUT_SECONDS', 3600)
+    try:
+        timeout_seconds = int(data.get('timeout_seconds') or current_app.config.get('JOB_DEFAULT_TIMEOUT_SECONDS', 600))
+    except (ValueError, TypeError):
+        return jsonify({"error": "timeout_seconds không hợp lệ."}), 400
+    timeout_seconds = max(1, min(timeout_seconds, max_timeout))
+
+    if file_extension == 'fortios':
+        if not _has_fortigate_target(fortigate_config):
+            return jsonify({"error": "Thiếu thông tin kết nối FortiGate (IP/Host, Username). Vui lòng kiểm tra Cài đặt."}), 400
+        kind, runner = "fortigate", make_fortigate_job_runner(code_to_execute, fortigate_config)
+        description = f"FortiOS CLI @ {fortigate_config.get('ipHost')}"
+    else:
+        kind, runner = "script", make_script_job_runner(code_to_execute, file_extension, run_as_admin)
+        description = f"Script .{file_extension}{' (Admin/Root)' if run_as_admin else ''}"
+
+    try:
+        job = get_job_manager().submit(kind, description, runner, timeout_seconds=timeout_seconds)
+    except JobQueueFull as e_full:
+        logger.warning(f"Tu choi job moi: {e_full}")
+        return jsonify({"error": str(e_full)}), 429
+    logger.info(f"Da nhan job {job.id} ({description}, timeout {timeout_seconds}s).")
+    return jsonify(job.summary()), 202
+
+@api_bp.route('/jobs', methods=['GET'])
+def handle_list_jobs():
+    manager = get_job_manager()
+    return jsonify({"jobs": manager.list_jobs(), "stats": manager.stats()})
+
+@api_bp.route('/jobs/<job_id>', methods=['GET'])
+def handle_job_status(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job."}), 404
+    return jsonify(job.summary())
+
+@api_bp.route('/jobs/<job_id>/output', methods=['GET'])
+def handle_job_output(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job."}), 404
+    try:
+        since = max(0, int(request.args.get('since', 0)))
+    except ValueError:
+        since = 0
+    lines, next_seq, truncated = job.read_output(since)
+    return jsonify({"job_id": job.id, "status": job.status, "lines": lines, "next": next_seq, "truncated": truncated})
+
+@api_bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def handle_job_cancel(job_id):
+    job = get_job_manager().cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job."}), 404
+    current_app.logger.info(f"Yeu cau huy job {job_id} (trang thai: {job.status}).")
+    return jsonify(job.summary())
+
+@api_bp.route('/jobs/<job_id>/result', methods=['GET'])
+def handle_job_result(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job."}), 404
+    if not job.is_finished:
+        return jsonify({"error": "Job chưa hoàn tất.", "status": job.status}), 409
+    return jsonify({"job_id": job.id, "status": job.status, "result": job.result})
+
+
 @api_bp.route('/debug', methods=['POST'])
 def handle_debug():
     logger = current_app.logger
@@ -437,6 +517,8 @@ def handle_debug():
     fortigate_selected_commands = data.get('fortigate_selected_context_commands', DEFAULT_FORTIGATE_CONTEXT_COMMANDS)
     if not fortigate_selected_commands:
         fortigate_selected_commands = DEFAULT_FORTIGATE_CONTEXT_COMMANDS
+    refresh_fortigate_context = bool(data.get('refresh_fortigate_context', False)) # Bo qua cache ngu canh
+    bypass_cache = bool(data.get('bypass_cache', False)) # Bo qua cache phan hoi
 
     if not failed_code:
         return jsonify({"error": "Thiếu mã lỗi để gỡ rối."}), 400
@@ -460,47 +542,42 @@ def handle_debug():
             try:
                 fortigate_context_str_debug = fetch_and_save_fortigate_context(
                     fortigate_config_for_context,
-                    commands_to_fetch=fortigate_selected_commands
+                    commands_to_fetch=fortigate_selected_commands,
+                    bypass_cache=refresh_fortigate_context
                 )
             except Exception as e_ctx_dbg:
                 logger.error(f"Debug FGT: Loi khi lay ngu canh: {e_ctx_dbg}", exc_info=True)
                 fortigate_context_str_debug = f"Lưu ý: Lỗi khi lấy ngữ cảnh cho debug: {str(e_ctx_dbg)}"
 
-    full_prompt = create_debug_prompt(original_prompt, failed_code, stdout, stderr, language_extension, fortigate_context_data=fortigate_context_str_debug)
-    raw_response = generate_response_from_gemini(full_prompt, model_config, is_for_review_or_debug=True)
+    full_prompt = create_debug_prompt(
+        original_prompt, failed_code, stdout, stderr, language_extension,
+        fortigate_context_data=fortigate_context_str_debug,
+        model_name=model_config.get('model_name')
+    )
+    raw_response, from_cache = cached_generate_response(full_prompt, model_config, is_for_review_or_debug=True, bypass_cache=bypass_cache)
 
     if raw_response and not raw_response.startswith("Lỗi"):
-        explanation_part = raw_response
         corrected_code = None
         suggested_package = None
 
-        if language_extension == 'py':
-            install_match = re.search(r"```bash\s*pip install\s+([\w\-==\.\+\[\]]+)\s*```", explanation_part, re.IGNORECASE | re.DOTALL)
-            if install_match:
-                suggested_package = install_match.group(1).strip()
-                explanation_part = explanation_part.replace(install_match.group(0), "").strip()
-
-        last_code_block_match = None
-        debug_code_block_tags_priority = [language_extension]
-        if language_extension == 'py': debug_code_block_tags_priority.append('python')
-        if language_extension == 'sh': debug_code_block_tags_priority.extend(['bash', 'shell'])
-        if language_extension == 'bat': debug_code_block_tags_priority.append('batch')
-        if language_extension == 'ps1': debug_code_block_tags_priority.append('powershell')
-        if language_extension == 'fortios': debug_code_block_tags_priority.extend(['fortios', 'cli', 'text'])
-        if 'code' not in debug_code_block_tags_priority: debug_code_block_tags_priority.append('code')
-
-        for lang_tag in reversed(debug_code_block_tags_priority):
-            pattern_str = r"```" + (re.escape(lang_tag) if lang_tag != 'code' else "") + r"(?:[^\S\n].*?)?\s*\n([\s\S]*?)\n```"
-            try:
-                matches = list(re.finditer(pattern_str, explanation_part, re.IGNORECASE | re.MULTILINE))
-                if matches:
-                    last_code_block_match = matches[-1]
-                    break
-            except re.error: pass
-        
-        if last_code_block_match:
-            corrected_code = last_code_block_match.group(1).strip()
-            explanation_part = explanation_part[:last_code_block_match.start()].strip()
+        with REQUEST_STAGE_DURATION.time(stage="code_extraction"):
+            code_blocks = scan_code_blocks(raw_response)
+            install_block = None
+            if language_extension == 'py':
+                install_block, suggested_package = find_pip_install_block(code_blocks)
+
+            debug_tag_priority = code_block_tag_priority(language_extension, language_extension == 'fortios') + ['']
+            corrected_block = select_code_block(
+                [block for block in code_blocks if block is not install_block], debug_tag_priority, fenced_only=True
+            )
+
+        explanation_end = corrected_block.start if corrected_block else len(raw_response)
+        if install_block and install_block.start < explanation_end:
+            explanation_part = (raw_response[:install_block.start] + raw_response[install_block.end:explanation_end]).strip()
+        else:
+            explanation_part = raw_response[:explanation_end].strip()
+        if corrected_block:
+            corrected_code = corrected_block.content
             if not explanation_part:
                  explanation_part = f"(AI chỉ trả về mã {get_language_name(language_extension)} đã sửa.)"
         
@@ -512,7 +589,8 @@ def handle_debug():
             "explanation": explanation_part,
             "corrected_code": corrected_code,
             "suggested_package": suggested_package,
-            "original_language": language_extension
+            "original_language": language_extension,
+            "cached": from_cache
         })
 
     status_code = 400
@@ -582,6 +660,7 @@ def handle_explain():
     file_type_for_code_context = data.get('file_type') 
     original_user_prompt = data.get('original_user_prompt')
     executed_code_or_command = data.get('executed_code_or_command')
+    bypass_cache = bool(data.get('bypass_cache', False)) # Bo qua cache phan hoi
 
 
     if not content_to_explain_input:
@@ -614,11 +693,11 @@ def handle_explain():
         original_user_prompt=original_user_prompt,
         executed_code_or_command=executed_code_or_command
     )
-    explanation_text = generate_response_from_gemini(full_prompt, model_config, is_for_review_or_debug=True)
+    explanation_text, from_cache = cached_generate_response(full_prompt, model_config, is_for_review_or_debug=True, bypass_cache=bypass_cache)
 
     if explanation_text and not explanation_text.startswith("Lỗi"):
         explanation_text = re.sub(r"^(Đây là giải thích về.*?:\s*|Giải thích về.*?:\s*)", "", explanation_text, flags=re.IGNORECASE | re.MULTILINE).strip()
-        return jsonify({"explanation": explanation_text})
+        return jsonify({"explanation": explanation_text, "cached": from_cache})
 
     status_code = 400
     if explanation_text and ("Lỗi cấu hình" in explanation_text or "Lỗi: Phản hồi bị chặn" in explanation_text):
@@ -634,10 +713,14 @@ def handle_fortigate_chat():
     fortigate_config_from_request = data.get('fortigate_config')
     raw_model_config_from_request = data.get('model_config', {})
     model_config = _normalize_model_config(raw_model_config_from_request)
-    conversation_history_context_str = data.get('conversation_history_for_chat_context', "(Không có lịch sử FortiOS)")
+    session_id = data.get('session_id') # Hoi thoai phia server; ko co/het han -> tao moi
+    conversation_history_context_str = data.get('conversation_history_for_chat_context') # Chi can o luot dau
+    conversation_update_str = data.get('conversation_update_for_chat_context') # Hoat dong ngoai chat (generate/execute) tu luot truoc
     fortigate_selected_context_commands = data.get('fortigate_selected_context_commands', DEFAULT_FORTIGATE_CONTEXT_COMMANDS)
     if not fortigate_selected_context_commands:
         fortigate_selected_context_commands = DEFAULT_FORTIGATE_CONTEXT_COMMANDS
+    refresh_fortigate_context = bool(data.get('refresh_fortigate_context', False)) # Bo qua cache ngu canh
+    stream_requested = wants_stream(request, data) # Tra ve SSE thay vi 1 JSON
 
     if not user_prompt_str:
         return jsonify({"error": "Vui lòng nhập yêu cầu.", "thoughts": []}), 400
@@ -647,215 +730,536 @@ def handle_fortigate_chat():
         logger.warning("FortiGate Chat (FC): Thieu IP/Host hoac Username FortiGate.")
 
     initial_fortigate_context_str = "Thông tin ngữ cảnh FortiGate không thể lấy do thiếu cấu hình hoặc lỗi kết nối."
+    context_snapshot = None
     if fortigate_config_from_request and fortigate_config_from_request.get('ipHost') and fortigate_config_from_request.get('username'):
         try:
-            initial_fortigate_context_str = fetch_and_save_fortigate_context(
+            initial_fortigate_context_str, context_snapshot = fetch_and_save_fortigate_context(
                 fortigate_config_from_request,
-                commands_to_fetch=fortigate_selected_context_commands
+                commands_to_fetch=fortigate_selected_context_commands,
+                bypass_cache=refresh_fortigate_context,
+                return_snapshot=True
             )
         except Exception as e_ctx_chat:
             logger.error(f"FGT Chat (FC): Loi khi lay ctx ban dau: {e_ctx_chat}")
             initial_fortigate_context_str = f"Lưu ý: Lỗi khi lấy ngữ cảnh FortiGate ban đầu: {str(e_ctx_chat)}"
 
-    HISTORY_LIMIT_CHAT = 8000
-    FGT_CTX_LIMIT_CHAT = 6000
-    
     # Huong dan AI dung tool get_fortigate_data cho chat
-    system_instruction_for_chat = f"""Bạn là một trợ lý AI chuyên gia về FortiGate.
+    system_instruction_template_chat = """Bạn là một trợ lý AI chuyên gia về FortiGate.
 Nhiệm vụ của bạn là trả lời câu hỏi của người dùng dựa trên kiến thức của bạn, thông tin ngữ cảnh FortiGate được cung cấp, và lịch sử hội thoại.
 Nếu bạn cần thêm thông tin chi tiết về cấu hình, trạng thái, logs, hoặc kết quả chẩn đoán (diagnose) từ FortiGate để trả lời chính xác, hãy sử dụng tool `get_fortigate_data`. Tool này cho phép bạn chạy bất kỳ lệnh 'show', 'get', hoặc 'diagnose' nào không làm thay đổi cấu hình. Bạn có thể gọi tool này nhiều lần nếu cần thiết.
+Khi cần biết policy nào cho phép/chặn một luồng cụ thể (IP nguồn, IP đích, giao thức, port), hãy dùng tool `match_firewall_policy` thay vì tự suy luận từ output 'show firewall policy'. Khi cần biết route, next-hop hoặc interface ra cho một IP, hãy dùng tool `lookup_route` thay vì đọc toàn bộ bảng định tuyến.
 KHÔNG tạo ra các khối mã lệnh mới trừ khi người dùng YÊU CẦU RÕ RÀNG trong câu hỏi hiện tại của họ là "tạo lệnh", "viết script", "generate config".
 Nếu người dùng chỉ hỏi thông tin, giải thích, hoặc gợi ý sửa lỗi, hãy cung cấp câu trả lời dưới dạng văn bản.
 Sử dụng Markdown cho câu trả lời của bạn. Bắt đầu trực tiếp bằng câu trả lời, không thêm lời dẫn.
 
 Ngữ cảnh FortiGate hiện tại:
 <fortigate_config_context_start>
-{initial_fortigate_context_str[:FGT_CTX_LIMIT_CHAT]}
+{fortigate_context}
 </fortigate_config_context_start>
 
-Lịch sử hội thoại gần đây (nếu có):
+Lịch sử hội thoại trước đó (nếu có):
 <conversation_history_start>
-{conversation_history_context_str[:HISTORY_LIMIT_CHAT]}
+{conversation_history}
 </conversation_history_start>
 
-Yêu cầu hiện tại của người dùng: "{user_prompt_str}"
+Các lượt hội thoại tiếp theo (nếu có) nằm ngay sau tin nhắn này; yêu cầu hiện tại của người dùng là tin nhắn cuối cùng.
 
 **QUAN TRỌNG (Retry Tool):** Nếu một lệnh thực thi qua tool `get_fortigate_data` trả về lỗi hoặc không đủ thông tin, bạn phải **NGAY LẬP TỨC** phân tích lỗi đó và thử lại tool `get_fortigate_data` với lệnh đã sửa đổi hoặc một lệnh khác phù hợp hơn. **KHÔNG** giải thích lỗi hoặc thông báo kế hoạch của bạn cho đến khi bạn đã thử lại tool và có kết quả mới, hoặc khi bạn đã thử nhiều cách mà vẫn không được. Mục tiêu là hoàn thành yêu cầu bằng cách thực thi lệnh tool thành công hoặc cung cấp câu trả lời hữu ích dựa trên thông tin tool thu được.
 """
 
-
-    genai_api_key_to_use_chat = model_config.get('api_key') or current_app.config.get('GOOGLE_API_KEY')
-    if not genai_api_key_to_use_chat:
-        return jsonify({"error": "API Key của Google chưa được cấu hình.", "thoughts": []}), 500
-    try:
-        genai.configure(api_key=genai_api_key_to_use_chat)
-        logger.info(f"FGT Chat (FC): Da (lai) cau hinh GenAI voi key {'tu UI' if model_config.get('api_key') else 'tu .env'}.")
-    except Exception as e_cfg_genai_chat:
-        logger.error(f"Loi cau hinh GenAI (Chat FC): {e_cfg_genai_chat}")
-        return jsonify({"error": f"Lỗi cấu hình thư viện Google GenAI: {e_cfg_genai_chat}", "thoughts": []}), 500
-
-    gemini_model_name_chat = model_config.get('model_name', 'gemini-1.5-flash')
-    try:
-        generation_config_obj_chat = GenerationConfig(
-            temperature=float(model_config.get('temperature', 0.7)),
-            top_p=float(model_config.get('top_p', 0.95)),
-            top_k=int(model_config.get('top_k', 40))
+    model_for_chat_fc, model_error_chat = get_function_calling_model(model_config, AVAILABLE_TOOLS)
+    if model_error_chat:
+        return jsonify({"error": model_error_chat, "thoughts": []}), 500
+    generation_config_obj_chat, safety_settings_list_chat = build_generation_settings(model_config)
+
+    chat_store = get_chat_session_store()
+    memo_factory = ToolResultMemo.from_config if current_app.config.get('FC_TOOL_MEMO_ENABLED', True) else None
+    chat_store_session, session_created = chat_store.get_or_create(session_id, tool_memo_factory=memo_factory)
+    if session_created:
+        if session_id:
+            logger.info(f"FGT Chat: session '{session_id}' ko ton tai hoac da het han, tao hoi thoai moi.")
+        # Session het han: client chi gui phan cap nhat -> dung lam lich su ban dau
+        chat_store_session.summary = conversation_history_context_str or conversation_update_str or ""
+    user_request_message = f'Yêu cầu hiện tại của người dùng: "{user_prompt_str}"'
+    if conversation_update_str and not session_created:
+        # Session chi ghi cac luot chat -> lenh FortiOS da tao / ket qua thuc thi tu luot truoc di kem luot nay (va duoc luu vao history)
+        update_text = trim_history_to_budget(
+            conversation_update_str, current_app.config.get('CHAT_SESSION_UPDATE_TOKEN_BUDGET', 3000),
+            counter=get_token_counter(model_config.get('model_name'))
         )
-        safety_setting_key_chat = model_config.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE')
-        safety_settings_config_chat = current_app.config.get('SAFETY_SETTINGS_MAP', {}).get(safety_setting_key_chat, [])
-        safety_settings_list_chat = []
-        for setting in safety_settings_config_chat:
-            category_name_chat = setting['category'].replace("HARM_CATEGORY_", "")
-            if hasattr(genai.types.HarmCategory, category_name_chat): 
-                category_enum_chat = getattr(genai.types.HarmCategory, category_name_chat)
-                threshold_enum_chat = getattr(genai.types.SafetySetting.HarmBlockThreshold, setting['threshold'])
-                safety_settings_list_chat.append(genai.types.SafetySetting(category=category_enum_chat, threshold=threshold_enum_chat))
-            else:
-                logger.warning(f"Bo qua safety setting (Chat) voi category khong hop le: {setting['category']}")
-    except AttributeError as e_types_attr_chat:
-        logger.error(f"Loi AttributeError khi truy cap GenConfig/Safety/HarmCategory (Chat) tu google.generativeai.types: {e_types_attr_chat}. Thu import truc tiep tu genai.types")
-        generation_config_obj_chat = genai.types.GenerationConfig(
-            temperature=float(model_config.get('temperature', 0.7)),
-            top_p=float(model_config.get('top_p', 0.95)),
-            top_k=int(model_config.get('top_k', 40))
+        user_request_message = f"Hoạt động mới ngoài chat kể từ lượt trước (tạo lệnh / thực thi):\n{update_text}\n\n{user_request_message}"
+    user_turn_message = user_request_message
+
+    def apply_context_baseline():
+        """
+        Preamble giu ngu canh baseline cua session (prefix on dinh qua cac luot); ngu canh moi khac baseline
+        -> chi gui delta kem luot nay. Ko dung duoc delta -> ngu canh moi thanh baseline. Goi khi giu session.lock.
+        """
+        nonlocal user_turn_message
+        user_turn_message = user_request_message
+        session = chat_store_session
+        device_key = fortigate_device_key(fortigate_config_from_request) if context_snapshot is not None else None
+        if context_snapshot is None:
+            session.context_device_key, session.context_version, session.context_digest = None, None, None
+            session.context_text = initial_fortigate_context_str
+            return
+        if session.context_device_key == device_key and session.context_digest == context_snapshot.digest:
+            return
+        delta_text = None
+        if session.context_device_key == device_key: # Doi thiet bi -> baseline cu ko lien quan, gui day du
+            delta_text = build_fortigate_context_delta(
+                fortigate_config_from_request, context_snapshot, session.context_version, base_digest=session.context_digest
+            )
+        if delta_text is None:
+            session.context_device_key, session.context_version = device_key, context_snapshot.version
+            session.context_digest, session.context_text = context_snapshot.digest, context_snapshot.text
+            return
+        user_turn_message = (f"Ngữ cảnh FortiGate đã thay đổi so với ngữ cảnh ở đầu hội thoại. {FORTIGATE_CONTEXT_DELTA_NOTE}\n"
+                             f"```text\n{delta_text}\n```\n\n{user_request_message}")
+
+    def build_chat_preamble():
+        # Chia ngan sach token (tru phan history da luu cua session): ngu canh giu khoi lenh lien quan,
+        # tom tat/lich su client giu phan moi nhat
+        counter = get_token_counter(model_config.get('model_name'))
+        fitted_chat_sections = fit_sections(
+            max(0, prompt_token_budget(model_config.get('model_name')) - chat_store_session.history_tokens),
+            [system_instruction_template_chat.format(fortigate_context="", conversation_history=""), user_turn_message],
+            {
+                "context": (chat_store_session.context_text, 1.0, lambda text, budget: trim_context_to_budget(text, budget, query=user_prompt_str, counter=counter)),
+                "history": (chat_store_session.summary, 1.0, lambda text, budget: trim_history_to_budget(text, budget, counter=counter)),
+            },
+            counter=counter,
         )
-        safety_setting_key_chat = model_config.get('safety_setting', 'BLOCK_MEDIUM_AND_ABOVE')
-        safety_settings_config_chat = current_app.config.get('SAFETY_SETTINGS_MAP', {}).get(safety_setting_key_chat, [])
-        safety_settings_list_chat = []
-        for setting in safety_settings_config_chat:
-            category_name_chat = setting['category'].replace("HARM_CATEGORY_", "")
-            if hasattr(genai.types.HarmCategory, category_name_chat):
-                category_enum_chat = getattr(genai.types.HarmCategory, category_name_chat)
-                threshold_enum_chat = getattr(genai.types.SafetySetting.HarmBlockThreshold, setting['threshold'])
-                safety_settings_list_chat.append(genai.types.SafetySetting(category=category_enum_chat, threshold=threshold_enum_chat))
-            else:
-                logger.warning(f"Bo qua safety setting (Chat fallback) voi category khong hop le: {setting['category']}")
-
-    model_for_chat_fc = GenerativeModel(gemini_model_name_chat, tools=AVAILABLE_TOOLS)
-    chat_session_fc = model_for_chat_fc.start_chat(history=[])
-    thoughts_for_ui_chat = []
-    MAX_FC_CHAT = 500
-    num_calls_chat = 0
-    current_content_for_send_message_chat: str | list[dict] = system_instruction_for_chat
-
-
-    while num_calls_chat < MAX_FC_CHAT:
-        logger.info(f"FGT Chat (FC Loop {num_calls_chat+1}/{MAX_FC_CHAT}): Sending to Gemini...")
-        response_chat = chat_session_fc.send_message(
-            content=current_content_for_send_message_chat,
-            generation_config=generation_config_obj_chat,
-            safety_settings=safety_settings_list_chat
+        return system_instruction_template_chat.format(
+            fortigate_context=fitted_chat_sections["context"],
+            conversation_history=fitted_chat_sections["history"] or "(Không có lịch sử)",
         )
-        candidate_chat = response_chat.candidates[0]
-
-        if not candidate_chat.content or not candidate_chat.content.parts:
-            logger.error("FGT Chat (FC): Phan hoi cua AI khong co content hoac parts.")
-            return jsonify({"error": "AI trả về phản hồi không hợp lệ (không có content hoặc parts).", "thoughts": thoughts_for_ui_chat}), 500
-
-        function_call_part_chat = None
-        for part_item_chat in candidate_chat.content.parts:
-            if hasattr(part_item_chat, 'function_call') and part_item_chat.function_call: 
-                function_call_part_chat = part_item_chat.function_call
-                break
-
-        if function_call_part_chat:
-            fc_chat = function_call_part_chat
-            tool_name_chat = fc_chat.name
-            tool_args_chat = dict(fc_chat.args) if fc_chat.args else {}
-            current_ts_chat = datetime.now().isoformat()
-            logger.info(f"FGT Chat (FC): AI requested tool '{tool_name_chat}' with args: {tool_args_chat}")
-            thoughts_for_ui_chat.append({
-                "type": "function_call_request", "tool_name": tool_name_chat,
-                "tool_args": tool_args_chat, "timestamp": current_ts_chat
-            })
-
-            tool_response_text_chat = ""
-            tool_error_flag_chat = False
-
-            if tool_name_chat == "get_fortigate_data":
-                fgt_cmd_chat = tool_args_chat.get("command")
-                if fgt_cmd_chat:
-                    if not fortigate_config_from_request or not fortigate_config_from_request.get('ipHost') or not fortigate_config_from_request.get('username'):
-                        tool_response_text_chat = "Lỗi: Backend không thể thực thi lệnh FortiGate vì thiếu thông tin IP/Host hoặc Username."
-                        tool_error_flag_chat = True
-                    else:
-                        exec_res_chat = execute_fortigate_commands(fgt_cmd_chat, fortigate_config_from_request)
-                        if exec_res_chat["error"]:
-                            tool_response_text_chat = f"[LỖI THỰC THI FORTIGATE]: Lệnh '{fgt_cmd_chat}' thất bại. Chi tiết: {exec_res_chat['error']}. Output: {exec_res_chat['output']}"
-                            tool_error_flag_chat = True
-                        else:
-                            tool_response_text_chat = exec_res_chat["output"] if exec_res_chat["output"] else "(Lệnh không có output)"
-                else:
-                    tool_response_text_chat = "Lỗi: Tool 'get_fortigate_data' thiếu 'command'."
-                    tool_error_flag_chat = True
-            else:
-                tool_response_text_chat = f"Lỗi: Tool '{tool_name_chat}' không được backend hỗ trợ."
-                tool_error_flag_chat = True
-            
-            thoughts_for_ui_chat.append({
-                "type": "function_call_result", "tool_name": tool_name_chat,
-                "result_data": tool_response_text_chat, "is_error": tool_error_flag_chat,
-                "timestamp": datetime.now().isoformat()
-            })
-            current_content_for_send_message_chat = [{
-                "function_response": {
-                    "name": tool_name_chat,
-                    "response": {"output": tool_response_text_chat}
-                }
-            }]
+
+    def session_fc_events():
+        # 1 luot / hoi thoai tai 1 thoi diem; history chi duoc luu khi luot thanh cong
+        if not chat_store_session.lock.acquire(timeout=current_app.config.get('CHAT_SESSION_LOCK_TIMEOUT', 120)):
+            yield {"type": "error", "error": "Hội thoại đang xử lý lượt trước, vui lòng thử lại sau.", "thoughts": []}
+            return
+        lock_held = True
+        try:
+            apply_context_baseline()
+            chat_session_fc = model_for_chat_fc.start_chat(history=chat_store_session.start_history(build_chat_preamble()))
+            for event in run_function_calling_loop(
+                chat_session_fc, user_turn_message, generation_config_obj_chat, safety_settings_list_chat,
+                fortigate_config_from_request, log_prefix="FGT Chat (FC)", stream=stream_requested, loop_name="chat",
+                tool_memo=chat_store_session.tool_memo, query=user_prompt_str
+            ):
+                if event["type"] == "final":
+                    lock_handed_off = chat_store.commit_turn(chat_store_session, chat_session_fc.history, model_config)
+                    if not lock_handed_off:
+                        chat_store_session.lock.release()
+                    lock_held = False
+                yield event
+        finally:
+            if lock_held:
+                chat_store_session.lock.release()
+
+    fc_events_chat = session_fc_events()
+
+    def build_chat_payload(final_text_chat, thoughts_for_ui_chat):
+        cleaned_response_chat = re.sub(r"^\s*\[(thinking|internal|process\w*)\].*$\n?", "", final_text_chat, flags=re.MULTILINE).strip()
+        return {"chat_response": cleaned_response_chat, "thoughts": thoughts_for_ui_chat, "session_id": chat_store_session.session_id}
+
+    return _fc_events_response(fc_events_chat, build_chat_payload, stream_requested)
+
+@api_bp.route('/chat_sessions', methods=['GET'])
+def handle_list_chat_sessions():
+    chat_store = get_chat_session_store()
+    return jsonify({"stats": chat_store.stats(), "sessions": chat_store.list_sessions()})
+
+@api_bp.route('/chat_sessions/<session_id>', methods=['DELETE'])
+def handle_delete_chat_session(session_id):
+    if not get_chat_session_store().delete(session_id):
+        return jsonify({"error": "Không tìm thấy hội thoại."}), 404
+    current_app.logger.info(f"Da xoa chat session {session_id} theo yeu cau.")
+    return jsonify({"deleted": session_id})
+
+@api_bp.route('/fortigate_context_cache', methods=['GET', 'DELETE'])
+def handle_fortigate_context_cache():
+    logger = current_app.logger
+    cache = get_fortigate_context_cache()
+    if request.method == 'DELETE':
+        cache.clear()
+        logger.info("Da xoa toan bo cache ngu canh FortiGate theo yeu cau.")
+    return jsonify({"stats": cache.stats(), "snapshots": get_context_snapshot_store().stats()})
+
+def _snapshot_device_from_request():
+    """Thiet bi cua query: ?device=host:port/user hoac ?host=&port=&username=."""
+    if request.args.get('device'):
+        return request.args['device']
+    if request.args.get('host'):
+        return device_label({"ipHost": request.args['host'], "portSsh": request.args.get('port'), "username": request.args.get('username')})
+    return None
+
+@api_bp.route('/fortigate_context_snapshots', methods=['GET'])
+def handle_list_context_snapshots():
+    archive = get_context_snapshot_archive()
+    since = request.args.get('since', type=float) # Epoch giay; gia tri sai -> bo qua
+    until = request.args.get('until', type=float)
+    limit = min(request.args.get('limit', default=50, type=int), 500)
+    return jsonify({
+        "stats": archive.stats(), "devices": archive.devices(),
+        "snapshots": archive.list_snapshots(device=_snapshot_device_from_request(), since=since, until=until, limit=limit),
+    })
+
+@api_bp.route('/fortigate_context_snapshots/latest', methods=['GET'])
+def handle_latest_context_snapshot():
+    device = _snapshot_device_from_request()
+    if not device:
+        return jsonify({"error": "Thiếu tham số device (host:port/username) hoặc host."}), 400
+    snapshot = get_context_snapshot_archive().latest(device)
+    if snapshot is None:
+        return jsonify({"error": f"Chưa có snapshot nào cho thiết bị {device}."}), 404
+    return jsonify(snapshot)
+
+@api_bp.route('/fortigate_context_snapshots/<int:snapshot_id>', methods=['GET'])
+def handle_get_context_snapshot(snapshot_id):
+    snapshot = get_context_snapshot_archive().get(snapshot_id)
+    if snapshot is None:
+        return jsonify({"error": "Không tìm thấy snapshot."}), 404
+    return jsonify(snapshot)
+
+@api_bp.route('/fortigate_context_snapshots/retention', methods=['POST'])
+def handle_context_snapshot_retention():
+    result = get_context_snapshot_archive().enforce_retention()
+    return jsonify(dict(result, stats=get_context_snapshot_archive().stats()))
+
+@api_bp.route('/fortigate_config_index', methods=['GET', 'DELETE'])
+def handle_fortigate_config_index():
+    store = get_config_index_store()
+    if request.method == 'DELETE':
+        store.clear()
+        current_app.logger.info("Da xoa toan bo chi muc cau hinh FortiGate theo yeu cau.")
+    return jsonify({"stats": store.stats()})
+
+@api_bp.route('/fortigate_policy_match', methods=['POST'])
+def handle_fortigate_policy_match():
+    """
+    Doi chieu lo luong voi firewall policy. Nguon cau hinh: config_text (dan truc tiep) hoac
+    fortigate_config (chi muc cau hinh cua thiet bi, dung neu chua co).
+    """
+    logger = current_app.logger
+    data = request.get_json() or {}
+    flows = data.get('flows')
+    if flows is None and data.get('flow') is not None:
+        flows = [data['flow']]
+    if not isinstance(flows, list) or not flows:
+        return jsonify({"error": "Thiếu danh sách luồng (flows)."}), 400
+    max_flows = current_app.config.get('FGT_POLICY_MATCH_MAX_FLOWS', 20000)
+    if len(flows) > max_flows:
+        return jsonify({"error": f"Quá nhiều luồng trong 1 yêu cầu ({len(flows)} > {max_flows})."}), 400
+
+    config_text = data.get('config_text')
+    fortigate_config = data.get('fortigate_config')
+    built_at = None
+    try:
+        if config_text:
+            matcher = FirewallPolicyMatcher.from_config_text(config_text)
         else:
-            finish_reason_name_chat = candidate_chat.finish_reason.name if hasattr(candidate_chat.finish_reason, 'name') else str(candidate_chat.finish_reason)
-            if finish_reason_name_chat == "STOP":
-                final_text_chat = "".join(part_item_chat.text for part_item_chat in candidate_chat.content.parts if hasattr(part_item_chat, 'text') and part_item_chat.text)
-                logger.info(f"FGT Chat (FC): AI final response (text): {final_text_chat[:200]}...")
-                cleaned_response_chat = re.sub(r"^\s*\[(thinking|internal|process\w*)\].*$\n?", "", final_text_chat, flags=re.MULTILINE).strip()
-                return jsonify({"chat_response": cleaned_response_chat, "thoughts": thoughts_for_ui_chat})
-            else:
-                safety_ratings_str_chat = str(getattr(candidate_chat, 'safety_ratings', 'N/A'))
-                error_msg_fc_loop_chat = f"AI (Chat FC) không trả về FC/text. Lý do: {finish_reason_name_chat}. Safety: {safety_ratings_str_chat}"
-                logger.error(f"FGT Chat (FC): {error_msg_fc_loop_chat}")
-                return jsonify({"error": error_msg_fc_loop_chat, "thoughts": thoughts_for_ui_chat}), 500
-        num_calls_chat += 1
-
-    if num_calls_chat >= MAX_FC_CHAT:
-        logger.error("FGT Chat (FC): Đã vượt quá số lần gọi tool tối đa.")
-        return jsonify({"error": "Đã vượt quá số lần gọi tool tối đa cho chat.", "thoughts": thoughts_for_ui_chat}), 500
-    
-    logger.error("FGT Chat (FC): Vong lap Function Calling ket thuc bat thuong.")
-    return jsonify({"error": "Xử lý yêu cầu chat FortiGate thất bại.", "thoughts": thoughts_for_ui_chat}), 500
+            device_key = fortigate_device_key(fortigate_config) if fortigate_config else None
+            if device_key is None:
+                return jsonify({"error": "Cần config_text hoặc fortigate_config (IP/Host, Username)."}), 400
+            index = get_config_index_store().wait_for_index(
+                device_key, lambda: fetch_fortigate_full_configuration(fortigate_config),
+                timeout=current_app.config.get('FGT_POLICY_MATCH_INDEX_WAIT', 150)
+            )
+            if index is None:
+                return jsonify({"error": "Không lấy được cấu hình đầy đủ của FortiGate (xem log backend)."}), 502
+            matcher, built_at = get_policy_matcher(index), index.built_at
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    started = time.perf_counter()
+    results = matcher.match_many(flows)
+    duration = time.perf_counter() - started
+    logger.info(f"Doi chieu policy: {len(flows)} luong / {len(matcher.policies)} policy trong {duration * 1000:.1f} ms.")
+    return jsonify({
+        "results": results, "matcher": matcher.summary_info(), "duration_ms": round(duration * 1000, 2),
+        "source": "config_text" if config_text else "device",
+        "config_built_at": datetime.fromtimestamp(built_at).isoformat() if built_at else None,
+    })
+
+@api_bp.route('/fortigate_route_lookup', methods=['POST'])
+def handle_fortigate_route_lookup():
+    """
+    Tra route (LPM) cho 1 hoac nhieu IP. Nguon bang: routing_table_text (dan truc tiep) hoac
+    fortigate_config (bang cua thiet bi, lay lai neu het han hoac refresh=true).
+    """
+    logger = current_app.logger
+    data = request.get_json() or {}
+    ips = data.get('ips')
+    if ips is None and data.get('ip'):
+        ips = [data['ip']]
+    if isinstance(ips, str):
+        ips = ips.replace(",", " ").split()
+    if not isinstance(ips, list) or not ips:
+        return jsonify({"error": "Thiếu danh sách IP (ips)."}), 400
+    max_ips = current_app.config.get('FGT_ROUTE_LOOKUP_MAX_IPS', 10000)
+    if len(ips) > max_ips:
+        return jsonify({"error": f"Quá nhiều IP trong 1 yêu cầu ({len(ips)} > {max_ips})."}), 400
+
+    routing_table_text = data.get('routing_table_text')
+    fortigate_config = data.get('fortigate_config')
+    if routing_table_text:
+        table = RouteTable(routing_table_text)
+    else:
+        device_key = fortigate_device_key(fortigate_config) if fortigate_config else None
+        if device_key is None:
+            return jsonify({"error": "Cần routing_table_text hoặc fortigate_config (IP/Host, Username)."}), 400
+        table, error = get_route_table_store().get_or_fetch(
+            device_key, lambda: fetch_fortigate_routing_table(fortigate_config), refresh=bool(data.get('refresh'))
+        )
+        if table is None:
+            return jsonify({"error": f"Không lấy được bảng định tuyến: {error}"}), 502
+
+    started = time.perf_counter()
+    results = table.lookup_many(ips, data.get('vrf'))
+    duration = time.perf_counter() - started
+    logger.info(f"Tra route: {len(ips)} IP / {table.route_count} route trong {duration * 1000:.1f} ms.")
+    return jsonify({
+        "results": results, "table": table.summary_info(), "duration_ms": round(duration * 1000, 2),
+        "source": "routing_table_text" if routing_table_text else "device",
+    })
+
+@api_bp.route('/fortigate_route_tables', methods=['GET', 'DELETE'])
+def handle_fortigate_route_tables():
+    store = get_route_table_store()
+    if request.method == 'DELETE':
+        store.clear()
+        current_app.logger.info("Da xoa toan bo bang dinh tuyen da luu theo yeu cau.")
+    return jsonify({"stats": store.stats()})
+
+def _fleet_diff_options(source):
+    """baseline / ignore (regex, lap lai hoac list) cho diff theo thiet bi."""
+    ignore = source.getlist('ignore') if hasattr(source, 'getlist') else (source.get('ignore_patterns') or [])
+    return source.get('baseline'), [pattern for pattern in ignore if pattern]
+
+@api_bp.route('/fleet/devices', methods=['GET', 'POST'])
+def handle_fleet_devices():
+    inventory = get_fleet_inventory()
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        devices_data = data.get('devices') if isinstance(data.get('devices'), list) else [data]
+        try:
+            names = inventory.upsert(devices_data)
+        except FleetInventoryError as e:
+            return jsonify({"error": str(e)}), 400
+        current_app.logger.info(f"Fleet: da cap nhat inventory: {', '.join(names)}.")
+    return jsonify({"devices": inventory.list_devices()})
+
+@api_bp.route('/fleet/devices/<name>', methods=['DELETE'])
+def handle_fleet_device_delete(name):
+    if not get_fleet_inventory().remove(name):
+        return jsonify({"error": "Không tìm thấy thiết bị trong inventory."}), 404
+    current_app.logger.info(f"Fleet: da xoa thiet bi '{name}' khoi inventory.")
+    return jsonify({"devices": get_fleet_inventory().list_devices()})
+
+@api_bp.route('/fleet/execute', methods=['POST'])
+def handle_fleet_execute():
+    """
+    Chay lenh FortiOS tren nhieu thiet bi: 'devices' (ten inventory / fortigate_config) va/hoac 'tags'.
+    stream -> SSE tien do tung thiet bi; background -> job (/api/jobs/<id>); mac dinh -> JSON tong hop + diff.
+    """
+    logger = current_app.logger
+    cfg = current_app.config
+    data = request.get_json(silent=True) or {}
+    commands_string = data.get('code') or data.get('commands')
+    if not commands_string or not str(commands_string).strip():
+        return jsonify({"error": "Không có lệnh nào để thực thi."}), 400
+    devices, target_error = resolve_fleet_targets(data)
+    if target_error:
+        return jsonify({"error": target_error}), 400
+    try:
+        max_parallel = max(1, min(int(data.get('max_parallel') or cfg.get('FGT_FLEET_MAX_PARALLEL', 16)), cfg.get('FGT_FLEET_MAX_PARALLEL', 16)))
+        device_timeout = max(1, min(int(data.get('device_timeout_seconds') or cfg.get('FGT_FLEET_DEVICE_TIMEOUT', 180)),
+                                    cfg.get('JOB_MAX_TIMEOUT_SECONDS', 3600)))
+    except (ValueError, TypeError):
+        return jsonify({"error": "max_parallel / device_timeout_seconds không hợp lệ."}), 400
+    baseline, ignore_patterns = _fleet_diff_options(data)
+    diff_max_lines = cfg.get('FGT_FLEET_DIFF_MAX_LINES', 200)
+    try:
+        diff_fleet_outputs([], baseline, ignore_patterns) # Kiem tra regex truoc khi chay
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    logger.info(f"Fleet: chay lenh tren {len(devices)} thiet bi (song song {max_parallel}, timeout {device_timeout}s).")
+
+    if data.get('background'):
+        description = f"FortiOS CLI @ fleet ({len(devices)} thiết bị)"
+        # Timeout job: du cho tung dot thiet bi chay het timeout cua minh
+        job_timeout = device_timeout * -(-len(devices) // max_parallel)
+        try:
+            job = get_job_manager().submit("fleet", description, make_fleet_job_runner(commands_string, devices, max_parallel, device_timeout),
+                                           timeout_seconds=job_timeout)
+        except JobQueueFull as e_full:
+            logger.warning(f"Tu choi job fleet: {e_full}")
+            return jsonify({"error": str(e_full)}), 429
+        return jsonify(job.summary()), 202
+
+    if wants_stream(request, data):
+        def generate_fleet_sse():
+            for event in iter_fleet_run(commands_string, devices, max_parallel, device_timeout):
+                if event["type"] == "done":
+                    event["result"]["diff"] = diff_fleet_outputs(event["result"]["devices"], baseline, ignore_patterns, diff_max_lines)
+                    yield sse_event("done", event["result"])
+                else:
+                    yield sse_event(event["type"], event)
+        return sse_response(generate_fleet_sse())
+
+    result = None
+    for event in iter_fleet_run(commands_string, devices, max_parallel, device_timeout):
+        if event["type"] == "done":
+            result = event["result"]
+    result["diff"] = diff_fleet_outputs(result["devices"], baseline, ignore_patterns, diff_max_lines)
+    return jsonify(result)
+
+@api_bp.route('/fleet/jobs/<job_id>/diff', methods=['GET'])
+def handle_fleet_job_diff(job_id):
+    """Diff theo thiet bi cho ket qua job fleet (?baseline=<ten>&ignore=<regex>...)."""
+    job = get_job_manager().get(job_id)
+    if job is None or job.kind != "fleet":
+        return jsonify({"error": "Không tìm thấy job fleet."}), 404
+    if not job.is_finished or not job.result or "devices" not in job.result:
+        return jsonify({"error": "Job chưa hoàn tất.", "status": job.status}), 409
+    baseline, ignore_patterns = _fleet_diff_options(request.args)
+    try:
+        diff = diff_fleet_outputs(job.result["devices"], baseline, ignore_patterns, current_app.config.get('FGT_FLEET_DIFF_MAX_LINES', 200))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"job_id": job.id, "status": job.status, "counts": job.result.get("counts"), "diff": diff})
+
+@api_bp.route('/response_cache', methods=['GET', 'DELETE'])
+def handle_response_cache():
+    logger = current_app.logger
+    cache = get_response_cache()
+    if request.method == 'DELETE':
+        cache.clear()
+        logger.info("Da xoa toan bo cache phan hoi Gemini theo yeu cau.")
+    return jsonify({"stats": cache.stats()})
+
+@api_bp.route('/prompts', methods=['GET'])
+def handle_prompt_store_stats():
+    return jsonify({"stats": get_prompt_store().stats()})
+
+@api_bp.route('/prompts/reload', methods=['POST'])
+def handle_prompt_reload():
+    logger = current_app.logger
+    stats = get_prompt_store().reload()
+    logger.info("Da nap lai file prompt theo yeu cau.")
+    return jsonify({"stats": stats})
+
+# Gia tri tinh luc scrape /api/metrics (pool SSH, cache, job)
+def _stats_gauges(prefix, documentation_by_key, stats, labels=None):
+    return [
+        (f"{prefix}_{key}", documentation, "gauge", [(labels or {}, stats.get(key, 0))])
+        for key, documentation in documentation_by_key.items()
+    ]
+
+def _collect_pool_metrics():
+    return _stats_gauges("fortigate_pool", {
+        "devices": "So thiet bi co slot trong pool SSH.",
+        "idle_sessions": "So phien SSH dang ranh trong pool.",
+    }, get_fortigate_pool().stats())
+
+def _collect_cache_metrics():
+    samples = [("fortigate_context", get_fortigate_context_cache().stats()), ("gemini_response", get_response_cache().stats())]
+    documentation_by_key = {
+        "entries": "So entry dang giu trong cache.",
+        "hits": "So lan trung cache (tich luy).",
+        "misses": "So lan truot cache (tich luy).",
+        "evictions": "So entry bi day ra do het cho (tich luy).",
+        "expirations": "So entry het han TTL (tich luy).",
+    }
+    return [
+        (f"cache_{key}", documentation, "counter" if key != "entries" else "gauge",
+         [({"cache": cache_name}, stats.get(key, 0)) for cache_name, stats in samples])
+        for key, documentation in documentation_by_key.items()
+    ]
+
+def _collect_job_metrics():
+    job_stats = get_job_manager().stats()
+    return [("jobs", "So job theo trang thai.", "gauge",
+             [({"status": status}, count) for status, count in sorted(job_stats["jobs"].items())])]
+
+REGISTRY.register_collector(_collect_pool_metrics)
+REGISTRY.register_collector(_collect_cache_metrics)
+REGISTRY.register_collector(_collect_job_metrics)
+
+@api_bp.route('/metrics', methods=['GET'])
+def handle_metrics():
+    """Metric dinh dang text Prometheus (histogram do tre, kich thuoc output, stats cache/pool/job)."""
+    return Response(REGISTRY.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+def _get_log_tail_reader():
+    """LogTailReader cho file log cua app (theo handler, fallback logs/gemini_executor.log)."""
+    logger = current_app.logger
+    file_handler = find_log_file_handler(logger)
+    if file_handler:
+        return LogTailReader(file_handler.baseFilename, backup_count=getattr(file_handler, 'backupCount', 0))
+    project_root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    log_file_path_from_app = os.path.join(project_root_dir, 'logs', 'gemini_executor.log')
+    logger.info(f"Log path from handler not found or invalid, falling back to: {log_file_path_from_app}")
+    return LogTailReader(log_file_path_from_app, backup_count=10)
 
 @api_bp.route('/backend_logs', methods=['GET'])
 def get_backend_logs():
+    """
+    ?lines=N            : N dong cuoi (mac dinh 50, toi da 500) + cursor
+    ?cursor=X           : chi cac dong moi sau cursor (kem cursor moi)
+    ?cursor=X&wait=S    : long-poll toi da S giay neu chua co dong moi
+    ?stream=1           : theo doi lien tuc qua SSE (su kien 'log')
+    """
     logger = current_app.logger
-    log_file_path_from_app = None
-
-    if hasattr(logger, 'handlers'):
-        for handler in logger.handlers:
-            if isinstance(handler, logging.handlers.RotatingFileHandler) or isinstance(handler, logging.FileHandler):
-                if hasattr(handler, 'baseFilename') and handler.baseFilename: 
-                    log_file_path_from_app = handler.baseFilename
-                    break
-    
-    if not log_file_path_from_app:
-        project_root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-        logs_dir_path = os.path.join(project_root_dir, 'logs')
-        log_file_path_from_app = os.path.join(logs_dir_path, 'gemini_executor.log')
-        logger.info(f"Log path from handler not found or invalid, falling back to: {log_file_path_from_app}")
+    reader = _get_log_tail_reader()
+    log_file_path_from_app = reader.base_path
 
     if not os.path.exists(log_file_path_from_app):
         logger.error(f"Backend log file not found at: {log_file_path_from_app}")
         return jsonify({"logs": [f"Log file '{os.path.basename(log_file_path_from_app)}' not found."], "error": "Log file not found"}), 404
 
+    cursor = request.args.get('cursor')
+    max_wait = current_app.config.get('LOG_LONG_POLL_MAX_SECONDS', 30)
     try:
+        wait_seconds = min(max(float(request.args.get('wait', 0)), 0.0), max_wait)
+    except ValueError:
+        wait_seconds = 0.0
+
+    if wants_stream(request):
+        follow_max_seconds = current_app.config.get('LOG_FOLLOW_MAX_SECONDS', 300)
+        start_cursor = cursor or reader.current_cursor()
+
+        def generate_log_sse():
+            follow_cursor = start_cursor
+            deadline = time.monotonic() + follow_max_seconds
+            yield sse_event("cursor", {"cursor": follow_cursor})
+            while follow_cursor and time.monotonic() < deadline:
+                lines, follow_cursor, truncated = reader.wait_for_lines(follow_cursor, timeout=min(15, max_wait))
+                if lines or truncated:
+                    yield sse_event("log", {"logs": lines, "cursor": follow_cursor, "truncated": truncated})
+                else:
+                    yield ": keepalive\n\n" # Giu ket noi qua proxy
+            yield sse_event("done", {"cursor": follow_cursor}) # Client ket noi lai voi cursor nay
+        return sse_response(generate_log_sse())
+
+    try:
+        if cursor:
+            if wait_seconds > 0:
+                log_lines, next_cursor, truncated = reader.wait_for_lines(cursor, timeout=wait_seconds)
+            else:
+                log_lines, next_cursor, truncated = reader.read_since(cursor)
+            return jsonify({"logs": log_lines, "cursor": next_cursor, "truncated": truncated})
+
         lines_to_fetch = int(request.args.get('lines', 50)) 
         if lines_to_fetch <= 0 or lines_to_fetch > 500: 
             lines_to_fetch = 50
-            
-        with open(log_file_path_from_app, 'r', encoding='utf-8') as f:
-            all_lines = f.readlines()
-            log_lines = [line.strip() for line in all_lines[-lines_to_fetch:]]
-        
-        return jsonify({"logs": log_lines})
+        log_lines, next_cursor = reader.tail(lines_to_fetch)
+        return jsonify({"logs": log_lines, "cursor": next_cursor})
+    except InvalidLogCursor as e:
+        return jsonify({"logs": [], "error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error reading backend log file '{log_file_path_from_app}': {e}", exc_info=True)
         return jsonify({"logs": [f"Error reading log file: {str(e)}"], "error": str(e)}), 500
@@ -0,0 +1,295 @@
+# backend/snapshot_store_utils.py
+import os
+import gzip
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from flask import current_app
+
+try: # Tuy chon: nen tot & nhanh hon gzip
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY, codec TEXT NOT NULL, raw_bytes INTEGER NOT NULL,
+    stored_bytes INTEGER NOT NULL, created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, device TEXT NOT NULL, target TEXT, username TEXT,
+    commands TEXT NOT NULL, command_set_hash TEXT NOT NULL, hash TEXT NOT NULL REFERENCES blobs(hash),
+    version INTEGER, created_at REAL NOT NULL, last_seen_at REAL NOT NULL, seen_count INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS idx_snapshots_device_time ON snapshots (device, last_seen_at);
+CREATE INDEX IF NOT EXISTS idx_snapshots_hash ON snapshots (hash);
+"""
+_CODEC_SUFFIX = {"zstd": ".zst", "gzip": ".gz"}
+
+
+def device_label(fortigate_config):
+    """Dinh danh thiet bi trong kho snapshot: 'host:port/username' (ko chua mat khau)."""
+    host = str(fortigate_config.get('ipHost') or '').strip()
+    port = str(fortigate_config.get('portSsh') or '22').strip()
+    return f"{host}:{port}/{fortigate_config.get('username') or ''}"
+
+
+def _command_set_hash(commands):
+    normalized = sorted({" ".join(cmd.split()).lower() for cmd in commands})
+    return hashlib.sha256("\n".join(normalized).encode('utf-8')).hexdigest()[:16]
+
+
+class ContextSnapshotArchive:
+    """
+    Kho snapshot ngu canh FortiGate tren dia: noi dung dinh danh theo sha256 (trung noi dung -> 1 file),
+    nen zstd (neu co) hoac gzip, chi muc SQLite (thiet bi, thoi gian, bo lenh, hash).
+    Lay lai cung noi dung + bo lenh lien tiep chi cap nhat last_seen_at/seen_count.
+    Giu theo tuoi & tong dung luong, luon giu snapshot moi nhat cua moi thiet bi.
+    """
+
+    def __init__(self, root_dir, compression="auto", max_age_days=30, max_total_bytes=200 * 1024 * 1024,
+                 retention_interval=60):
+        self.root_dir = root_dir
+        self.objects_dir = os.path.join(root_dir, "objects")
+        self.db_path = os.path.join(root_dir, "index.sqlite")
+        if compression == "auto":
+            compression = "zstd" if zstandard is not None else "gzip"
+        if compression == "zstd" and zstandard is None:
+            current_app.logger.warning("Snapshot: chua cai 'zstandard', dung gzip.")
+            compression = "gzip"
+        self.codec = compression
+        self.max_age_seconds = float(max_age_days) * 86400
+        self.max_total_bytes = int(max_total_bytes)
+        self.retention_interval = float(retention_interval)
+        self._last_retention = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+        self.writes = 0
+        self.dedup_hits = 0
+        self.pruned_snapshots = 0
+        self.pruned_blobs = 0
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn: # commit/rollback
+                yield conn
+        finally:
+            conn.close()
+
+    # --- Blob (noi dung nen) ---
+    def _blob_path(self, content_hash, codec):
+        return os.path.join(self.objects_dir, content_hash[:2], content_hash + _CODEC_SUFFIX[codec])
+
+    def _compress(self, raw):
+        if self.codec == "zstd":
+            return zstandard.ZstdCompressor(level=3).compress(raw)
+        return gzip.compress(raw, compresslevel=6)
+
+    @staticmethod
+    def _decompress(data, codec):
+        if codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError("Snapshot nen zstd nhung chua cai 'zstandard'.")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    def _write_blob(self, conn, content_hash, raw):
+        """Ghi blob neu chua co. Tra ve True neu da ton tai (dedup)."""
+        if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (content_hash,)).fetchone():
+            return True
+        stored = self._compress(raw)
+        blob_path = self._blob_path(content_hash, self.codec)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        tmp_path = f"{blob_path}.tmp{threading.get_ident()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(stored)
+        os.replace(tmp_path, blob_path) # Ghi nguyen tu
+        conn.execute(
+            "INSERT INTO blobs (hash, codec, raw_bytes, stored_bytes, created_at) VALUES (?, ?, ?, ?, ?)",
+            (content_hash, self.codec, len(raw), len(stored), time.time())
+        )
+        return False
+
+    def _read_blob(self, content_hash, codec):
+        with open(self._blob_path(content_hash, codec), 'rb') as f:
+            return self._decompress(f.read(), codec).decode('utf-8')
+
+    # --- Ghi ---
+    def put(self, device, commands, context_text, target=None, username=None, version=None):
+        """Luu 1 lan lay ngu canh. Tra ve id snapshot (dong cu neu trung noi dung & bo lenh voi lan truoc)."""
+        raw = context_text.encode('utf-8')
+        content_hash = hashlib.sha256(raw).hexdigest()
+        command_set_hash = _command_set_hash(commands)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            latest = conn.execute(
+                "SELECT id, hash, command_set_hash FROM snapshots WHERE device = ? ORDER BY last_seen_at DESC, id DESC LIMIT 1",
+                (device,)
+            ).fetchone()
+            if latest and latest["hash"] == content_hash and latest["command_set_hash"] == command_set_hash:
+                conn.execute(
+                    "UPDATE snapshots SET last_seen_at = ?, seen_count = seen_count + 1, version = COALESCE(?, version) WHERE id = ?",
+                    (now, version, latest["id"])
+                )
+                self.dedup_hits += 1
+                snapshot_id = latest["id"]
+            else:
+                if self._write_blob(conn, content_hash, raw):
+                    self.dedup_hits += 1
+                snapshot_id = conn.execute(
+                    "INSERT INTO snapshots (device, target, username, commands, command_set_hash, hash, version, created_at, last_seen_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (device, target, username, json.dumps(list(commands), ensure_ascii=False), command_set_hash,
+                     content_hash, version, now, now)
+                ).lastrowid
+            self.writes += 1
+            retention_due = now - self._last_retention >= self.retention_interval
+        if retention_due:
+            self.enforce_retention()
+        return snapshot_id
+
+    # --- Giu / don dep ---
+    def _collect_unreferenced_blobs(self, conn):
+        orphans = conn.execute(
+            "SELECT hash, codec, stored_bytes FROM blobs WHERE hash NOT IN (SELECT DISTINCT hash FROM snapshots)"
+        ).fetchall()
+        for row in orphans:
+            try:
+                os.remove(self._blob_path(row["hash"], row["codec"]))
+            except FileNotFoundError:
+                pass
+            conn.execute("DELETE FROM blobs WHERE hash = ?", (row["hash"],))
+        return len(orphans)
+
+    def enforce_retention(self):
+        """Xoa snapshot qua max_age & cu nhat khi vuot max_total_bytes (tru snapshot moi nhat moi thiet bi)."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            self._last_retention = now
+            keep_ids = "SELECT MAX(id) FROM snapshots GROUP BY device"
+            pruned = conn.execute(
+                f"DELETE FROM snapshots WHERE last_seen_at < ? AND id NOT IN ({keep_ids})", (now - self.max_age_seconds,)
+            ).rowcount
+            pruned_blobs = self._collect_unreferenced_blobs(conn)
+            total_bytes = conn.execute("SELECT COALESCE(SUM(stored_bytes), 0) FROM blobs").fetchone()[0]
+            if total_bytes > self.max_total_bytes:
+                candidates = conn.execute(
+                    f"SELECT id FROM snapshots WHERE id NOT IN ({keep_ids}) ORDER BY last_seen_at ASC, id ASC"
+                ).fetchall()
+                for row in candidates:
+                    if total_bytes <= self.max_total_bytes:
+                        break
+                    content_hash = conn.execute("SELECT hash FROM snapshots WHERE id = ?", (row["id"],)).fetchone()["hash"]
+                    conn.execute("DELETE FROM snapshots WHERE id = ?", (row["id"],))
+                    pruned += 1
+                    if not conn.execute("SELECT 1 FROM snapshots WHERE hash = ? LIMIT 1", (content_hash,)).fetchone():
+                        blob = conn.execute("SELECT codec, stored_bytes FROM blobs WHERE hash = ?", (content_hash,)).fetchone()
+                        try:
+                            os.remove(self._blob_path(content_hash, blob["codec"]))
+                        except FileNotFoundError:
+                            pass
+                        conn.execute("DELETE FROM blobs WHERE hash = ?", (content_hash,))
+                        total_bytes -= blob["stored_bytes"]
+                        pruned_blobs += 1
+            self.pruned_snapshots += pruned
+            self.pruned_blobs += pruned_blobs
+        if pruned or pruned_blobs:
+            current_app.logger.info(f"Snapshot: da xoa {pruned} snapshot & {pruned_blobs} file noi dung theo chinh sach giu.")
+        return {"pruned_snapshots": pruned, "pruned_blobs": pruned_blobs}
+
+    # --- Truy van ---
+    @staticmethod
+    def _row_info(row):
+        info = {key: row[key] for key in row.keys() if key not in ("commands", "codec", "raw_bytes", "stored_bytes")}
+        info["commands"] = json.loads(row["commands"])
+        info["raw_bytes"], info["stored_bytes"] = row["raw_bytes"], row["stored_bytes"]
+        return info
+
+    _SELECT = ("SELECT s.*, b.codec, b.raw_bytes, b.stored_bytes FROM snapshots s JOIN blobs b ON b.hash = s.hash ")
+
+    def _with_content(self, row):
+        if row is None:
+            return None
+        info = self._row_info(row)
+        try:
+            info["content"] = self._read_blob(row["hash"], row["codec"])
+        except (OSError, RuntimeError) as e:
+            current_app.logger.error(f"Snapshot {row['id']}: ko doc duoc noi dung: {e}")
+            info["content"], info["error"] = None, str(e)
+        return info
+
+    def get(self, snapshot_id):
+        with self._connect() as conn:
+            return self._with_content(conn.execute(self._SELECT + "WHERE s.id = ?", (snapshot_id,)).fetchone())
+
+    def latest(self, device):
+        with self._connect() as conn:
+            return self._with_content(conn.execute(
+                self._SELECT + "WHERE s.device = ? ORDER BY s.last_seen_at DESC, s.id DESC LIMIT 1", (device,)
+            ).fetchone())
+
+    def list_snapshots(self, device=None, since=None, until=None, limit=50):
+        """Metadata snapshot moi nhat truoc (ko kem noi dung)."""
+        clauses, params = [], []
+        if device:
+            clauses.append("s.device = ?"); params.append(device)
+        if since is not None:
+            clauses.append("s.last_seen_at >= ?"); params.append(float(since))
+        if until is not None:
+            clauses.append("s.created_at <= ?"); params.append(float(until))
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        with self._connect() as conn:
+            rows = conn.execute(
+                self._SELECT + where + "ORDER BY s.last_seen_at DESC, s.id DESC LIMIT ?", params + [max(1, int(limit))]
+            ).fetchall()
+        return [self._row_info(row) for row in rows]
+
+    def devices(self):
+        """Moi thiet bi: snapshot moi nhat & so snapshot dang giu."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT device, COUNT(*) AS snapshots, MAX(id) AS latest_id, MAX(last_seen_at) AS last_seen_at "
+                "FROM snapshots GROUP BY device ORDER BY last_seen_at DESC"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self):
+        with self._connect() as conn:
+            snapshot_count = conn.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0]
+            blob_row = conn.execute("SELECT COUNT(*), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(stored_bytes), 0) FROM blobs").fetchone()
+        return {
+            "codec": self.codec, "snapshots": snapshot_count, "blobs": blob_row[0], "raw_bytes": blob_row[1],
+            "stored_bytes": blob_row[2], "max_total_bytes": self.max_total_bytes, "max_age_days": self.max_age_seconds / 86400,
+            "writes": self.writes, "dedup_hits": self.dedup_hits, "pruned_snapshots": self.pruned_snapshots,
+            "pruned_blobs": self.pruned_blobs,
+        }
+
+
+_context_snapshot_archive = None
+_context_snapshot_archive_lock = threading.Lock()
+
+def get_context_snapshot_archive():
+    """Lay ContextSnapshotArchive dung chung (khoi tao lan dau tu app.config)."""
+    global _context_snapshot_archive
+    if _context_snapshot_archive is None:
+        with _context_snapshot_archive_lock:
+            if _context_snapshot_archive is None:
+                cfg = current_app.config
+                root_dir = cfg.get('FGT_SNAPSHOT_STORE_DIR') or os.path.abspath(
+                    os.path.join(current_app.root_path, '..', 'logs', 'context_snapshots')
+                )
+                _context_snapshot_archive = ContextSnapshotArchive(
+                    root_dir,
+                    compression=cfg.get('FGT_SNAPSHOT_COMPRESSION', 'auto'),
+                    max_age_days=cfg.get('FGT_SNAPSHOT_RETENTION_DAYS', 30),
+                    max_total_bytes=cfg.get('FGT_SNAPSHOT_MAX_BYTES', 200 * 1024 * 1024),
+                )
+    return _context_snapshot_archive
@@ -0,0 +1,238 @@
+# backend/ssh_pool_utils.py
+import time
+import atexit
+import hashlib
+import threading
+from contextlib import contextmanager
+from netmiko import ConnectHandler, NetmikoTimeoutException, NetmikoAuthenticationException
+from flask import current_app
+import logging # Them logging
+
+from .metrics_utils import FORTIGATE_SSH_CONNECT_DURATION
+
+# Gia tri mac dinh cho pool (co the ghi de qua app.config)
+DEFAULT_POOL_MAX_PER_DEVICE = 2
+DEFAULT_POOL_IDLE_TIMEOUT = 300 # giay
+DEFAULT_POOL_ACQUIRE_TIMEOUT = 60 # giay
+
+_module_logger = logging.getLogger(__name__)
+
+
+class PoolAcquireTimeout(Exception):
+    """Het thoi gian cho slot ket noi toi thiet bi."""
+
+
+class _PooledSession:
+    __slots__ = ('connection', 'secret_digest', 'created_at', 'last_used')
+
+    def __init__(self, connection, digest):
+        now = time.monotonic()
+        self.connection = connection
+        self.secret_digest = digest
+        self.created_at = now
+        self.last_used = now
+
+
+def secret_digest(device_params):
+    """Hash cac tham so ket noi (ko luu password dang ro trong pool)."""
+    raw = "|".join(str(device_params.get(k, '')) for k in ('password', 'device_type', 'secret'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class FortiGateSessionPool:
+    """Pool phien SSH Netmiko, key theo (host, port, username)."""
+
+    def __init__(self, max_per_device=DEFAULT_POOL_MAX_PER_DEVICE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 acquire_timeout=DEFAULT_POOL_ACQUIRE_TIMEOUT):
+        self.max_per_device = max(1, int(max_per_device))
+        self.idle_timeout = float(idle_timeout)
+        self.acquire_timeout = float(acquire_timeout)
+        self._lock = threading.Lock()
+        self._idle = {}  # key -> list[_PooledSession]
+        self._slots = {} # key -> BoundedSemaphore (gioi han dong thoi / thiet bi)
+        self._reaper_stop = threading.Event()
+        self._reaper = None
+
+    @staticmethod
+    def make_key(device_params):
+        return (str(device_params.get('host', '')).lower(), int(device_params.get('port', 22)), device_params.get('username', ''))
+
+    def _get_slot(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_per_device)
+                self._slots[key] = slot
+            return slot
+
+    def _evict_expired_locked(self, now):
+        """Tach cac phien idle qua han, tra ve list de dong ngoai lock."""
+        expired = []
+        for key in list(self._idle.keys()):
+            keep = []
+            for pooled in self._idle[key]:
+                if now - pooled.last_used > self.idle_timeout:
+                    expired.append(pooled)
+                else:
+                    keep.append(pooled)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+        return expired
+
+    def _close_sessions(self, sessions, reason):
+        for pooled in sessions:
+            try:
+                pooled.connection.disconnect()
+            except Exception as e_close:
+                _module_logger.debug(f"Loi khi dong phien SSH ({reason}): {e_close}")
+
+    def _checkout_idle(self, key, digest):
+        """Lay 1 phien idle con song cho key (hoac None)."""
+        now = time.monotonic()
+        to_close = []
+        found = None
+        with self._lock:
+            to_close.extend(self._evict_expired_locked(now))
+            candidates = self._idle.get(key, [])
+            while candidates:
+                pooled = candidates.pop()
+                if pooled.secret_digest != digest:
+                    to_close.append(pooled) # Doi password -> ko dung lai phien cu
+                    continue
+                found = pooled
+                break
+            if key in self._idle and not self._idle[key]:
+                del self._idle[key]
+        self._close_sessions(to_close, "idle/het han")
+
+        if found is not None:
+            try:
+                alive = found.connection.is_alive()
+            except Exception:
+                alive = False
+            if not alive:
+                _module_logger.info(f"Phien SSH pool toi {key[0]}:{key[1]} da chet, tao phien moi.")
+                self._close_sessions([found], "health check")
+                return None
+        return found
+
+    def _release(self, key, pooled):
+        pooled.last_used = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(key, []).append(pooled)
+
+    @contextmanager
+    def session(self, device_params, reusable=True):
+        """
+        Muon 1 ket noi Netmiko da xac thuc; tra lai pool khi xong.
+        reusable=False (vd da chay send_config_set): dong phien thay vi tra lai, vi FortiOS ko thoat
+        ngu canh 'config ...'/'edit ...' chua dong -> lenh sau tren phien nay se chay sai ngu canh.
+        """
+        key = self.make_key(device_params)
+        slot = self._get_slot(key)
+        if not slot.acquire(timeout=self.acquire_timeout):
+            raise PoolAcquireTimeout(f"Hết thời gian chờ kết nối rảnh tới {key[0]}:{key[1]} (tối đa {self.max_per_device} phiên đồng thời).")
+        pooled = None
+        try:
+            digest = secret_digest(device_params)
+            pooled = self._checkout_idle(key, digest)
+            if pooled is None:
+                _module_logger.info(f"Pool: tao phien SSH moi toi {key[0]}:{key[1]} (user: {key[2]}).")
+                with FORTIGATE_SSH_CONNECT_DURATION.time(outcome="error") as metric_labels:
+                    try:
+                        connection = ConnectHandler(**device_params)
+                    except NetmikoAuthenticationException:
+                        metric_labels["outcome"] = "auth_error"
+                        raise
+                    except NetmikoTimeoutException:
+                        metric_labels["outcome"] = "timeout"
+                        raise
+                    metric_labels["outcome"] = "ok"
+                pooled = _PooledSession(connection, digest)
+            else:
+                _module_logger.info(f"Pool: dung lai phien SSH toi {key[0]}:{key[1]}.")
+            try:
+                yield pooled.connection
+            except BaseException:
+                # Trang thai kenh ko ro -> bo phien nay
+                self._close_sessions([pooled], "loi khi dung")
+                pooled = None
+                raise
+            if reusable:
+                self._release(key, pooled)
+            else:
+                self._close_sessions([pooled], "ko dung lai")
+            pooled = None
+        finally:
+            slot.release()
+
+    def invalidate(self, device_params):
+        """Dong toan bo phien idle cua 1 thiet bi."""
+        key = self.make_key(device_params)
+        with self._lock:
+            sessions = self._idle.pop(key, [])
+        self._close_sessions(sessions, "invalidate")
+
+    def evict_idle(self):
+        """Dong cac phien idle qua han (goi dinh ky hoac khi can)."""
+        with self._lock:
+            expired = self._evict_expired_locked(time.monotonic())
+        self._close_sessions(expired, "idle")
+        return len(expired)
+
+    def start_reaper(self):
+        """Luong nen goi evict_idle dinh ky (moi nua idle_timeout, toi da 60s) de ko giu phien idle qua han."""
+        if self._reaper is not None:
+            return
+        interval = max(1.0, min(self.idle_timeout / 2, 60.0))
+
+        def reap():
+            while not self._reaper_stop.wait(interval):
+                try:
+                    closed = self.evict_idle()
+                    if closed:
+                        _module_logger.info(f"Pool: da dong {closed} phien SSH idle qua han.")
+                except Exception as e_reap:
+                    _module_logger.debug(f"Loi khi don phien SSH idle: {e_reap}")
+
+        self._reaper = threading.Thread(target=reap, name="fgt-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def close_all(self):
+        self._reaper_stop.set()
+        with self._lock:
+            sessions = [p for plist in self._idle.values() for p in plist]
+            self._idle.clear()
+        self._close_sessions(sessions, "shutdown")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._slots),
+                "idle_sessions": sum(len(v) for v in self._idle.values()),
+                "max_per_device": self.max_per_device,
+                "idle_timeout": self.idle_timeout,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_fortigate_pool():
+    """Lay pool dung chung (khoi tao lan dau tu app.config)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                cfg = current_app.config
+                _pool = FortiGateSessionPool(
+                    max_per_device=cfg.get('FGT_POOL_MAX_PER_DEVICE', DEFAULT_POOL_MAX_PER_DEVICE),
+                    idle_timeout=cfg.get('FGT_POOL_IDLE_TIMEOUT', DEFAULT_POOL_IDLE_TIMEOUT),
+                    acquire_timeout=cfg.get('FGT_POOL_ACQUIRE_TIMEOUT', DEFAULT_POOL_ACQUIRE_TIMEOUT),
+                )
+                _pool.start_reaper()
+                atexit.register(_pool.close_all)
+    return _pool
@@ -0,0 +1,29 @@
+# backend/streaming_utils.py
+import json
+from flask import Response, stream_with_context
+
+# Dinh dang 1 su kien Server-Sent Events
+def sse_event(event_name, data):
+    """Dong goi data (dict/str) thanh 1 su kien SSE."""
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+    lines = "".join(f"data: {line}\n" for line in payload.split("\n"))
+    return f"event: {event_name}\n{lines}\n"
+
+def sse_response(event_generator):
+    """Tra ve Response text/event-stream tu generator chuoi SSE (giu request context)."""
+    return Response(
+        stream_with_context(event_generator),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no', # Tat buffer cua reverse proxy (nginx)
+        }
+    )
+
+def wants_stream(request_obj, data=None):
+    """Client yeu cau stream qua ?stream=1, body {"stream": true} hoac Accept: text/event-stream."""
+    if str(request_obj.args.get('stream', '')).lower() in ('1', 'true', 'yes'):
+        return True
+    if isinstance(data, dict) and data.get('stream') is True:
+        return True
+    return 'text/event-stream' in (request_obj.headers.get('Accept') or '')
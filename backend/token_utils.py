@@ -0,0 +1,357 @@
+# backend/token_utils.py
+import re
+import math
+import threading
+from collections import OrderedDict
+from flask import current_app
+
+# Uoc luong: tu chu ~4 ky tu/token, so ~3 chu so/token, moi dau cau 1 token.
+# Tieng Viet co dau bi tach nhieu hon nen tinh theo ky tu ngan hon.
+_TOKEN_PIECE_RE = re.compile(r"[^\W\d_]+|\d+|[^\w\s]", re.UNICODE)
+_CONTEXT_BLOCK_RE = re.compile(r"^\$ ", re.MULTILINE) # Moi lenh trong ngu canh: "$ lenh"
+_EXAMPLE_BLOCK_RE = re.compile(r"^# ", re.MULTILINE) # Moi vi du trong file *_exp.txt: "# tieu de"
+_QUERY_TERM_RE = re.compile(r"[\w\-\.]{3,}", re.UNICODE)
+HISTORY_TURN_SEPARATOR = "\n\n---\n\n"
+TRIM_MARKER_BLOCKS = "[... đã lược bỏ {count} khối ít liên quan để vừa giới hạn token ...]"
+TRIM_MARKER_LINES = "[... đã lược bỏ {count} dòng ...]"
+TRIM_MARKER_HISTORY = "[... đã lược bỏ {count} lượt hội thoại cũ hơn ...]"
+
+
+def approximate_token_count(text):
+    """Dem token xap xi, ko can goi API. Thuong lech < 20% so voi tokenizer that."""
+    if not text:
+        return 0
+    count = 0
+    for piece in _TOKEN_PIECE_RE.findall(text):
+        if piece.isdigit():
+            count += math.ceil(len(piece) / 3)
+        elif piece.isalpha():
+            chars_per_token = 4 if piece.isascii() else 2.5
+            count += math.ceil(len(piece) / chars_per_token)
+        else:
+            count += 1
+    return count
+
+
+def _default_model_name(model_name=None):
+    """Model cua request; ko co -> model mac dinh (TOKEN_COUNTER_MODEL)."""
+    name = model_name or current_app.config.get('TOKEN_COUNTER_MODEL', 'gemini-1.5-flash')
+    return name[len("models/"):] if name.startswith("models/") else name
+
+
+def _gemini_token_counter(model_name):
+    """Dem token bang model.count_tokens cua dung model request (goi API, tra ve None neu loi)."""
+    from .gemini_utils import get_client_registry, resolve_api_key # Tranh import vong
+    api_key, _ = resolve_api_key({})
+    if not api_key:
+        return None
+    model = get_client_registry().get_model(api_key, model_name)
+
+    def count(text):
+        return model.count_tokens(text).total_tokens
+    return count
+
+
+_TOKEN_COUNTER_FACTORIES = {
+    "approx": lambda model_name: approximate_token_count,
+    "gemini": _gemini_token_counter,
+}
+
+
+def register_token_counter(name, factory):
+    """Dang ky tokenizer moi: factory(model_name) -> callable(text) -> int (hoac None neu ko dung duoc)."""
+    _TOKEN_COUNTER_FACTORIES[name] = factory
+
+
+# Cua so dau vao da biet (token) - dung khi ko hoi duoc API (ko co key, offline). Khop theo prefix dai nhat.
+KNOWN_INPUT_TOKEN_LIMITS = {
+    "gemini-1.0-pro": 30720,
+    "gemini-pro": 30720,
+    "gemini-1.5-flash": 1048576,
+    "gemini-1.5-pro": 2097152,
+    "gemini-2.0-flash": 1048576,
+    "gemini-2.5-flash": 1048576,
+    "gemini-2.5-pro": 1048576,
+}
+_input_token_limits = {} # model_name -> input_token_limit tu API (None = loi / dang hoi)
+_input_token_limits_lock = threading.Lock()
+
+
+def _known_input_token_limit(model_name):
+    prefix = max((known for known in KNOWN_INPUT_TOKEN_LIMITS if model_name.startswith(known)), key=len, default=None)
+    return KNOWN_INPUT_TOKEN_LIMITS.get(prefix)
+
+
+def _fetch_input_token_limit(app, model_name):
+    """Chay nen: models.get (goi gRPC co the treo lau khi mat mang -> ko chan request)."""
+    try:
+        import google.generativeai as genai
+        limit = int(genai.get_model(f"models/{model_name}").input_token_limit) or None
+    except Exception as e:
+        app.logger.info(f"Ko lay duoc input_token_limit cua '{model_name}' qua API ({e}), dung bang mac dinh.")
+        return
+    with _input_token_limits_lock:
+        _input_token_limits[model_name] = limit
+    app.logger.info(f"Cua so dau vao cua '{model_name}': {limit} token.")
+
+
+def model_input_token_limit(model_name=None):
+    """
+    input_token_limit cua model: gia tri tu API (models.get, hoi nen 1 lan / model) neu da co,
+    trong luc cho hoac khi loi -> bang KNOWN_INPUT_TOKEN_LIMITS.
+    """
+    model_name = _default_model_name(model_name)
+    with _input_token_limits_lock:
+        if model_name in _input_token_limits:
+            return _input_token_limits[model_name] or _known_input_token_limit(model_name)
+        _input_token_limits[model_name] = None
+    threading.Thread(
+        target=_fetch_input_token_limit, args=(current_app._get_current_object(), model_name),
+        name="gemini-model-info", daemon=True,
+    ).start()
+    return _known_input_token_limit(model_name)
+
+
+def prompt_token_budget(model_name=None):
+    """
+    Ngan sach token dau vao cho 1 prompt: PROMPT_TOKEN_BUDGET (0 = ca cua so) nhung ko vuot cua so dau vao
+    cua model dang dung tru PROMPT_WINDOW_RESERVE_TOKENS (tool declaration, luot FC them vao).
+    """
+    cfg = current_app.config
+    configured = cfg.get('PROMPT_TOKEN_BUDGET', 12000)
+    limit = model_input_token_limit(model_name)
+    window = max(0, limit - cfg.get('PROMPT_WINDOW_RESERVE_TOKENS', 2048)) if limit else None
+    if window is None:
+        return configured if configured > 0 else 12000
+    return min(configured, window) if configured > 0 else window
+
+
+class TokenCounter:
+    """
+    Boc tokenizer duoc chon, tu fallback ve uoc luong khi tokenizer loi.
+    count() dung tokenizer that cho tong cac phan; estimate() dung uoc luong
+    (hieu chinh theo ti le thuc te da do) khi cat theo khoi/dong, tranh goi
+    tokenizer tu xa cho tung dong.
+    """
+
+    def __init__(self, name="approx", model_name=None):
+        self.name = name
+        self.model_name = model_name
+        self._count_fn = None
+        self._lock = threading.Lock()
+        self._ratio = 1.0 # token that / token uoc luong (trung binh truot)
+        self._recent = OrderedDict() # hash(text) -> so token, tranh dem lai cung 1 doan
+
+    def _resolve(self):
+        if self._count_fn is None:
+            with self._lock:
+                if self._count_fn is None:
+                    count_fn = None
+                    factory = _TOKEN_COUNTER_FACTORIES.get(self.name)
+                    if factory is None:
+                        current_app.logger.warning(f"Tokenizer '{self.name}' ko ton tai, dung uoc luong.")
+                    else:
+                        try:
+                            count_fn = factory(self.model_name)
+                        except Exception as e:
+                            current_app.logger.warning(f"Ko khoi tao duoc tokenizer '{self.name}': {e}. Dung uoc luong.")
+                    self._count_fn = count_fn or approximate_token_count
+        return self._count_fn
+
+    def count(self, text):
+        if not text:
+            return 0
+        count_fn = self._resolve()
+        if count_fn is approximate_token_count:
+            return approximate_token_count(text)
+        text_key = hash(text)
+        with self._lock:
+            if text_key in self._recent:
+                return self._recent[text_key]
+        try:
+            real_count = int(count_fn(text))
+        except Exception as e:
+            current_app.logger.warning(f"Tokenizer '{self.name}' loi: {e}. Dung uoc luong cho lan nay.")
+            return self.estimate(text)
+        approx_count = approximate_token_count(text)
+        if approx_count >= 50: # Mau du lon moi cap nhat ti le
+            self._ratio = 0.8 * self._ratio + 0.2 * (real_count / approx_count)
+        with self._lock:
+            self._recent[text_key] = real_count
+            while len(self._recent) > 64:
+                self._recent.popitem(last=False)
+        return real_count
+
+    def estimate(self, text):
+        if not text:
+            return 0
+        return math.ceil(approximate_token_count(text) * self._ratio)
+
+
+_token_counters = OrderedDict() # (tokenizer, model) -> TokenCounter
+_token_counters_lock = threading.Lock()
+_MAX_TOKEN_COUNTERS = 16
+
+def get_token_counter(model_name=None):
+    """Lay TokenCounter dung chung theo app.config['TOKEN_COUNTER'] va model cua request (tokenizer 'gemini')."""
+    name = current_app.config.get('TOKEN_COUNTER', 'approx')
+    key = (name, _default_model_name(model_name) if name != "approx" else None)
+    with _token_counters_lock:
+        counter = _token_counters.get(key)
+        if counter is None:
+            counter = _token_counters[key] = TokenCounter(name, model_name=key[1])
+            while len(_token_counters) > _MAX_TOKEN_COUNTERS:
+                _token_counters.popitem(last=False)
+        else:
+            _token_counters.move_to_end(key)
+        return counter
+
+
+# Chia ngan sach token cho cac phan cua prompt
+def allocate_budget(total_budget, fixed_texts, flexible_sections, counter=None):
+    """
+    Tru token cac phan co dinh (instruction, example, template, input nguoi dung),
+    phan con lai chia cho cac phan co the cat theo trong so.
+    flexible_sections: {name: (text, weight)}. Phan nao can it hon phan chia
+    thi tra lai phan du cho cac phan khac. Tra ve {name: so token duoc cap}.
+    """
+    counter = counter or get_token_counter()
+    remaining = max(0, total_budget - sum(counter.count(text) for text in fixed_texts))
+    demands = {name: counter.count(text) for name, (text, _) in flexible_sections.items()}
+    weights = {name: max(weight, 0.0001) for name, (_, weight) in flexible_sections.items()}
+    allocations = {name: 0 for name in flexible_sections}
+    pending = set(flexible_sections)
+
+    while pending and remaining > 0:
+        total_weight = sum(weights[name] for name in pending)
+        satisfied = [name for name in pending if demands[name] <= remaining * weights[name] / total_weight]
+        if not satisfied:
+            for name in pending:
+                allocations[name] = int(remaining * weights[name] / total_weight)
+            break
+        for name in satisfied:
+            allocations[name] = demands[name]
+            remaining -= demands[name]
+            pending.discard(name)
+    return allocations
+
+
+def _trim_lines_to_budget(text, budget, counter, keep="head"):
+    """Cat theo dong (ko cat giua dong), giu dau hoac cuoi van ban."""
+    lines = text.splitlines()
+    ordered = lines if keep == "head" else list(reversed(lines))
+    kept, used = [], 0
+    for line in ordered:
+        line_tokens = counter.estimate(line) + 1
+        if used + line_tokens > budget:
+            break
+        kept.append(line)
+        used += line_tokens
+    dropped = len(lines) - len(kept)
+    if not dropped:
+        return text
+    marker = TRIM_MARKER_LINES.format(count=dropped)
+    if keep == "head":
+        return "\n".join(kept + [marker])
+    return "\n".join([marker] + list(reversed(kept)))
+
+
+def split_blocks(text, block_re=_CONTEXT_BLOCK_RE):
+    """Tach van ban thanh cac khoi, moi khoi bat dau tai dong khop block_re."""
+    starts = [m.start() for m in block_re.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return [text[start:end].strip("\n") for start, end in zip(starts, starts[1:] + [len(text)]) if text[start:end].strip()]
+
+
+def _relevance_score(block, query_terms):
+    if not query_terms:
+        return 0
+    block_lower = block.lower()
+    header = block_lower.split("\n", 1)[0]
+    return sum(block_lower.count(term) + (3 if term in header else 0) for term in query_terms)
+
+
+def trim_blocks_to_budget(text, budget, query=None, counter=None, block_re=_CONTEXT_BLOCK_RE):
+    """
+    Giu van ban theo khoi trong gioi han token: uu tien khoi lien quan den
+    query (theo so lan xuat hien tu khoa), giu nguyen thu tu goc. Ngan sach con
+    du duoc dung cho khoi lien quan nhat ko vua, cat theo dong thay vi giua dong.
+    """
+    counter = counter or get_token_counter()
+    if not text or counter.count(text) <= budget:
+        return text
+    blocks = split_blocks(text, block_re)
+    if budget <= 0: # Phan co dinh da dung het ngan sach: van bao ro da luoc
+        return TRIM_MARKER_BLOCKS.format(count=len(blocks))
+    query_terms = {term.lower() for term in _QUERY_TERM_RE.findall(query or "")}
+    ranked = sorted(range(len(blocks)), key=lambda i: (-_relevance_score(blocks[i], query_terms), i))
+
+    selected, used, first_skipped = {}, 0, None
+    for index in ranked:
+        block_tokens = counter.estimate(blocks[index]) + 1
+        if used + block_tokens <= budget:
+            selected[index] = blocks[index]
+            used += block_tokens
+        elif first_skipped is None:
+            first_skipped = index
+    if first_skipped is not None and budget - used > 50: # Phan con lai: cat theo dong khoi lien quan nhat bi bo
+        selected[first_skipped] = _trim_lines_to_budget(blocks[first_skipped], budget - used - 1, counter, keep="head")
+    dropped = len(blocks) - len(selected)
+    parts = [selected[i] for i in sorted(selected)]
+    if dropped:
+        parts.append(TRIM_MARKER_BLOCKS.format(count=dropped))
+    return "\n\n".join(parts)
+
+
+def trim_context_to_budget(context_text, budget, query=None, counter=None):
+    """Cat ngu canh FortiGate theo khoi lenh ('$ lenh')."""
+    return trim_blocks_to_budget(context_text, budget, query=query, counter=counter, block_re=_CONTEXT_BLOCK_RE)
+
+
+def trim_examples_to_budget(examples_text, budget, query=None, counter=None):
+    """Cat file vi du theo tung vi du ('# tieu de')."""
+    return trim_blocks_to_budget(examples_text, budget, query=query, counter=counter, block_re=_EXAMPLE_BLOCK_RE)
+
+
+def fit_sections(total_budget, fixed_texts, sections, counter=None):
+    """
+    Chia total_budget cho cac phan co the cat roi cat tung phan.
+    sections: {name: (text, weight, trim_fn)} voi trim_fn(text, budget) -> text.
+    Tra ve {name: text da cat}.
+    """
+    counter = counter or get_token_counter()
+    fixed_tokens = sum(counter.count(text) for text in fixed_texts)
+    if fixed_tokens >= total_budget:
+        current_app.logger.warning(f"Prompt: phan co dinh (~{fixed_tokens} token) da dung het ngan sach {total_budget}, cac phan co the cat chi con ghi chu luoc bo.")
+    budgets = allocate_budget(total_budget, fixed_texts, {name: (text, weight) for name, (text, weight, _) in sections.items()}, counter=counter)
+    fitted = {}
+    for name, (text, _, trim_fn) in sections.items():
+        fitted[name] = trim_fn(text, budgets[name]) if text else text
+        if fitted[name] != text:
+            current_app.logger.info(f"Prompt: phan '{name}' duoc cat con ~{budgets[name]} token de vua ngan sach {total_budget}.")
+    return fitted
+
+
+def trim_history_to_budget(history_text, budget, counter=None, separator=HISTORY_TURN_SEPARATOR):
+    """Giu cac luot hoi thoai moi nhat (lich su xep tu cu den moi) vua trong budget."""
+    counter = counter or get_token_counter()
+    if not history_text or counter.count(history_text) <= budget:
+        return history_text
+    turns = history_text.split(separator)
+    if budget <= 0:
+        return TRIM_MARKER_HISTORY.format(count=len(turns))
+    kept, used = [], 0
+    for turn in reversed(turns):
+        turn_tokens = counter.estimate(turn) + 2
+        if used + turn_tokens > budget:
+            if not kept: # Luot moi nhat van qua dai: giu phan cuoi cua no
+                kept.append(_trim_lines_to_budget(turn, budget, counter, keep="tail"))
+            break
+        kept.append(turn)
+        used += turn_tokens
+    dropped = len(turns) - len(kept)
+    kept.reverse()
+    if dropped:
+        kept.insert(0, TRIM_MARKER_HISTORY.format(count=dropped))
+    return separator.join(kept)
@@ -67,6 +67,8 @@ export interface AiThought {
     tool_args?: Record<string, any>;
     result_data?: any;
     is_error?: boolean;
+    cached?: boolean; // Ket qua lay tu bo nho tool cua hoi thoai
+    cache_age_seconds?: number;
     timestamp: string;
 }
 
@@ -168,6 +170,8 @@ function App() {
     return initial;
   });
 
+  const [chatSessionId, setChatSessionId] = useState<string | null>(null); // Hoi thoai FortiGate chat phia server
+  const [chatSyncedBlockId, setChatSyncedBlockId] = useState<string | null>(null); // Block cuoi server session da biet (luot chat truoc)
   const [editingBlockId, setEditingBlockId] = useState<string | null>(null);
   const [currentEditingCode, setCurrentEditingCode] = useState<string | null>(null);
   
@@ -211,6 +215,12 @@ function App() {
   }, [fetchBackendLogs]);
 
 
+  useEffect(() => {
+    // Doi thiet bi FortiGate -> hoi thoai chat moi (session cu gan voi thiet bi cu)
+    setChatSessionId(null);
+    setChatSyncedBlockId(null);
+  }, [fortiGateConfig.ipHost, fortiGateConfig.portSsh, fortiGateConfig.username]);
+
    const isBusyOverall = isLoading || isExecuting || isReviewing || isDebugging || isInstalling || isExplaining;
 
   useEffect(() => {
@@ -589,7 +599,9 @@ function App() {
       'user', 'ai-code', 'execution', 'explanation', 'ai_thinking_process'
     ];
     const MAX_HISTORY_BLOCKS_FOR_CHAT = 10;
-    const historyForChatContext = conversation 
+    // Block do chinh chat tao ra (server session da luu trong history cua no)
+    const isChatBlock = (block: ConversationBlock) => block.id.includes('_u_chat') || block.id.includes('_chatload');
+    const formatBlocksForChatContext = (blocks: ConversationBlock[]) => blocks
       .filter(b => relevantHistoryTypesForFgtChat.includes(b.type))
       .slice(-MAX_HISTORY_BLOCKS_FOR_CHAT)
       .map(block => {
@@ -623,11 +635,20 @@ function App() {
       .filter(item => item !== null)
       .join('\n\n---\n\n');
 
+    // Server chi ghi cac luot chat -> luot sau gui kem cac block ngoai chat (lenh da tao, ket qua thuc thi...) tu luot truoc
+    const syncedIndex = chatSyncedBlockId ? conversation.findIndex(b => b.id === chatSyncedBlockId) : -1;
+    const updateForChatContext = formatBlocksForChatContext(conversation.slice(syncedIndex + 1).filter(b => !isChatBlock(b)));
+
     try {
       const data = await sendApiRequest('fortigate_chat', {
         prompt: currentPrompt,
-        conversation_history_for_chat_context: historyForChatContext || "(Không có lịch sử FortiOS gần đây)",
+        session_id: chatSessionId,
+        ...(chatSessionId
+          ? (updateForChatContext ? { conversation_update_for_chat_context: updateForChatContext } : {})
+          : { conversation_history_for_chat_context: formatBlocksForChatContext(conversation) || "(Không có lịch sử FortiOS gần đây)" }),
       }, false);
+      if (data.session_id) setChatSessionId(data.session_id);
+      setChatSyncedBlockId(conversation.length > 0 ? conversation[conversation.length - 1].id : null);
 
       addThoughtsAndResultToConversation(
           loadingId, data, 'explanation',
@@ -653,7 +674,7 @@ function App() {
           });
       }
     } finally { setIsLoading(false); }
-  }, [sendApiRequest, conversation, setPrompt, addThoughtsAndResultToConversation]);
+  }, [sendApiRequest, conversation, chatSessionId, chatSyncedBlockId, setPrompt, addThoughtsAndResultToConversation]);
 
   const handleGenerateOrFortiGateChat = useCallback(async (currentPrompt: string) => {
     if (!currentPrompt.trim()) {
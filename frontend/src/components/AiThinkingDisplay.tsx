@@ -48,6 +48,7 @@ const AiThinkingDisplay: React.FC<AiThinkingDisplayProps> = ({ thoughts, blockId
                                 <span className="thought-title">
                                     {/* Thay đổi để hiển thị rõ ràng hơn trạng thái lỗi */}
                                     {thought.type === 'function_call_request' ? `Gọi Tool: ${thought.tool_name}` : (thought.is_error ? `Kết quả Tool Thất Bại: ${thought.tool_name}` : `Kết quả Tool: ${thought.tool_name}`)}
+                                    {thought.cached && ` (dùng lại kết quả ${Math.round(thought.cache_age_seconds ?? 0)}s trước)`}
                                 </span>
                                 <span className="thought-timestamp">{formatThoughtTimestamp(thought.timestamp)}</span>
                             </div>
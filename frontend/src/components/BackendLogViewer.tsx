@@ -11,29 +11,70 @@ interface LogLineProps {
   log: string;
 }
 
+interface ParsedLogLine {
+  timestamp: string;
+  level: string;
+  requestId: string | null;
+  message: string;
+  location: string | null;
+}
+
+const LOG_LEVELS = ['INFO', 'WARNING', 'ERROR', 'DEBUG', 'CRITICAL'];
+// Format text: "2024-07-30 10:00:00,123 INFO [req-id]: message [in /path/to/file.py:123]" ([req-id] co the ko co)
+const TEXT_LOG_RE = /^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3})\s+(INFO|WARNING|ERROR|DEBUG|CRITICAL)(?:\s+\[([^\]]*)\])?:\s+([\s\S]*?)\s+\[in\s+(.+?):(\d+)]$/;
+
+// Lay ten file tu full path (ho tro ca / va \)
+const shortLocation = (filePath: string, lineNumber: string | number) =>
+  `${filePath.split(/[/\\]/).pop() || filePath}:${lineNumber}`;
+
+// Parse 1 dong log backend: JSON (LOG_FORMAT=json, mac dinh) hoac text
+const parseLogLine = (log: string): ParsedLogLine | null => {
+  if (log.startsWith('{')) {
+    try {
+      const entry = JSON.parse(log);
+      if (entry && typeof entry.ts === 'string' && LOG_LEVELS.includes(entry.level)) {
+        const where = typeof entry.where === 'string' ? entry.where.match(/^(.*):(\d+)$/) : null;
+        return {
+          timestamp: entry.ts.replace('T', ' ').split('.')[0], // Bo ms de display gon hon
+          level: entry.level,
+          requestId: entry.request_id && entry.request_id !== '-' ? String(entry.request_id) : null,
+          message: String(entry.msg ?? ''),
+          location: where ? shortLocation(where[1], where[2]) : null,
+        };
+      }
+    } catch {
+      // Ko phai JSON hop le -> thu format text
+    }
+  }
+  const match = log.match(TEXT_LOG_RE);
+  if (!match) return null;
+  const [, timestampWithMs, level, requestId, message, filePath, lineNumber] = match;
+  return {
+    timestamp: timestampWithMs.split(',')[0],
+    level,
+    requestId: requestId && requestId !== '-' ? requestId : null,
+    message,
+    location: shortLocation(filePath, lineNumber),
+  };
+};
+
 const LogLine: React.FC<LogLineProps> = ({ log }) => {
-  // Regex de parse log format: "2024-07-30 10:00:00,123 INFO: message [in /path/to/file.py:123]"
-  const match = log.match(/^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3})\s+(INFO|WARNING|ERROR|DEBUG|CRITICAL):\s+(.*?)\s+\[in\s+(.+?):(\d+)]$/);
+  const parsed = parseLogLine(log);
 
-  if (!match) {
+  if (!parsed) {
     // Fallback cho dong ko dung format
     return <pre className="log-line log-unparsed">{log}</pre>;
   }
 
-  const [_, timestampWithMs, level, message, filePath, lineNumber] = match;
-  const timestamp = timestampWithMs.split(',')[0]; // Bo ms de display gon hon
-  
-  // Lay ten file tu full path (ho tro ca / va \)
-  const fileName = filePath.split(/[/\\]/).pop() || filePath;
-
-  const levelClass = `log-level-${level.toLowerCase()}`;
+  const levelClass = `log-level-${parsed.level.toLowerCase()}`;
 
   return (
     <pre className={`log-line ${levelClass}`}>
-      <span className="log-timestamp">{timestamp}</span>
-      <span className={`log-level ${levelClass}`}>{level}</span>
-      <span className="log-message">{message.trim()}</span>
-      <span className="log-location">({fileName}:{lineNumber})</span>
+      <span className="log-timestamp">{parsed.timestamp}</span>
+      <span className={`log-level ${levelClass}`}>{parsed.level}</span>
+      {parsed.requestId && <span className="log-request-id" title="Request ID">{parsed.requestId}</span>}
+      <span className="log-message">{parsed.message.trim()}</span>
+      {parsed.location && <span className="log-location">({parsed.location})</span>}
     </pre>
   );
 };